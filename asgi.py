@@ -0,0 +1,7 @@
+import os
+
+from chubbyrepo.asgi import create_asgi_app
+
+
+config_name = os.getenv('APP_SETTINGS')
+app = create_asgi_app(config_name)
@@ -0,0 +1,59 @@
+"""Microbenchmark of building and serializing the chubbiest repositories.
+
+Compares, for 100 and 1000 repositories, the CPU spent per request by the
+original path (validated construction, recursive `attr.asdict` and standard
+library `json`) against the current one (trusted construction, precompiled
+serializer and orjson when installed).
+
+    python -m benchmarks.bench_entities
+"""
+import json
+import timeit
+
+import attr
+
+from chubbyrepo.core.entities import Repository
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def github_result(size):
+    return {'search': {'edges': [{'node': {'name': 'repo{}'.format(i), 'stargazers': {'totalCount': 10 ** 6 - i}}}
+                                 for i in range(size)]}}
+
+
+def original_path(result):
+    repositories = [Repository(r['node']['name'], r['node']['stargazers']['totalCount'])
+                    for r in result['search']['edges']]
+    return json.dumps([attr.asdict(r) for r in repositories], sort_keys=True)
+
+
+def current_path(result):
+    trusted = Repository.trusted
+    repositories = [trusted(r['node']['name'], r['node']['stargazers']['totalCount'])
+                    for r in result['search']['edges']]
+    values = [r.asdict() for r in repositories]
+    if orjson is not None:
+        return orjson.dumps(values, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(values, sort_keys=True)
+
+
+def bench(fn, result, repeat=5):
+    number = max(10, 20000 // len(result['search']['edges']))
+    return min(timeit.repeat(lambda: fn(result), number=number, repeat=repeat)) / number
+
+
+def main():
+    print('encoder: {}'.format('orjson' if orjson is not None else 'json'))
+    print('{:>6} {:>14} {:>14} {:>8}'.format('repos', 'original (us)', 'current (us)', 'speedup'))
+    for size in (100, 1000):
+        result = github_result(size)
+        original, current = bench(original_path, result), bench(current_path, result)
+        print('{:>6} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(size, original * 1e6, current * 1e6, original / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Compare two saved benchmark runs and flag regressions.
+
+Exits with status 1 when any metric got worse than `--threshold`, so it can
+gate CI runs against a saved baseline.
+
+    python -m benchmarks.compare baseline.json current.json --threshold 0.1
+"""
+import argparse
+import sys
+from typing import List, Tuple
+
+from benchmarks import results
+
+# Metrics where a bigger value is an improvement, lower is better for the rest
+HIGHER_IS_BETTER = {'throughput', 'ops_per_sec'}
+# Metrics only reported, not compared
+IGNORED = {'requests', 'statuses'}
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[Tuple[str, str, float, float, float, bool]]:
+    """Return (name, metric, baseline, current, change, regressed) for every
+    metric found in both runs. `change` is relative, positive when better.
+    """
+    rows = []
+    for name in sorted(set(baseline['results']) & set(current['results'])):
+        before, after = baseline['results'][name], current['results'][name]
+        for metric in sorted(set(before) & set(after) - IGNORED):
+            if not isinstance(before[metric], (int, float)) or not before[metric]:
+                continue
+            change = (after[metric] - before[metric]) / before[metric]
+            if metric not in HIGHER_IS_BETTER:
+                change = -change
+            rows.append((name, metric, before[metric], after[metric], change, change < -threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change tolerated, 0.1 is 10%%')
+    args = parser.parse_args()
+
+    baseline, current = results.load(args.baseline), results.load(args.current)
+    print('baseline {} ({}) vs current {} ({})'.format(
+        baseline['commit'], baseline['created_at'], current['commit'], current['created_at']))
+    rows = compare(baseline, current, args.threshold)
+    for name, metric, before, after, change, regressed in rows:
+        print('{:<48} {:<12} {:>14.6g} {:>14.6g} {:>+8.1%} {}'.format(
+            name, metric, before, after, change, 'REGRESSION' if regressed else ''))
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Local stand-in for the Github GraphQL API.
+
+Answers the documents sent by the gateways, single and batched organization
+stats and the paginated repositories search, with deterministic data after a
+configurable latency, and fails a configurable ratio of calls with a 502.
+
+    python -m benchmarks.github_stub --port 8080 --latency 0.05 --jitter 0.01
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+
+class GithubStub:
+    """Threaded GraphQL server. Organizations named `missing*` don't exist."""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 repositories: int = 5000, host: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.repositories = repositories
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/graphql'.format(host, port)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self) -> 'GithubStub':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True, name='github-stub')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> 'GithubStub':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def answer(self, payload: Dict) -> Tuple[int, Dict]:
+        """Return the status and body answering a GraphQL payload."""
+        delay = self.latency + (random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        time.sleep(max(delay, 0))
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+        if failed:
+            return 502, {'message': 'Server Error'}
+        query, variables = payload.get('query', ''), payload.get('variables') or {}
+        if 'search(' in query:
+            result = {'data': self._search(variables['limit'], variables.get('after'))}
+        else:
+            result = self._organizations(variables)
+        if 'rateLimit' in query:
+            result['data']['rateLimit'] = {'cost': 1, 'remaining': 1000000000, 'resetAt': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600))}
+        return 200, result
+
+    def _search(self, first: int, after: Optional[str]) -> Dict:
+        start = int(after) if after else 0
+        end = min(start + first, self.repositories)
+        edges = [{'node': {'name': 'repo{}'.format(i), 'owner': {'login': 'org{}'.format(i % 100)},
+                           'stargazers': {'totalCount': self.repositories * 100 - i}}} for i in range(start, end)]
+        return {'search': {'pageInfo': {'endCursor': str(end), 'hasNextPage': end < self.repositories},
+                           'edges': edges}}
+
+    @staticmethod
+    def _organizations(variables: Dict) -> Dict:
+        data, errors = {}, []
+        for alias, name in variables.items():
+            # A single organization document selects `organization` with the `org_name` variable
+            field = 'organization' if alias == 'org_name' else alias
+            if name.startswith('missing'):
+                data[field] = None
+                errors.append({'type': 'NOT_FOUND', 'path': [field],
+                               'message': "Could not resolve to an Organization with the login of '{}'.".format(name)})
+                continue
+            seed = zlib.crc32(name.encode())
+            data[field] = {'repositories': {
+                'totalCount': seed % 500 + 1,
+                'nodes': [{'name': '{}-chubbiest'.format(name), 'stargazers': {'totalCount': seed % 100000}}],
+            }}
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return result
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately: with Nagle, keep-alive calls wait on the delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                status, result = stub.answer(payload)
+                body = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                # Plenty of budget, so the upstream scheduler never paces the benchmark
+                self.send_header('X-RateLimit-Remaining', '1000000000')
+                self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds taken by every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Max seconds added or removed to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Ratio of calls failing with a 502')
+    parser.add_argument('--repositories', type=int, default=5000, help='Repositories returned by the search')
+    args = parser.parse_args()
+    stub = GithubStub(args.latency, args.jitter, args.error_rate, args.repositories, args.host, args.port)
+    print('Github stub listening on {}'.format(stub.url))
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Load test of the full request path against the local Github stub.
+
+Serves the real app with the werkzeug threaded server, pointed to a
+`GithubStub`, and drives its endpoints from `--concurrency` client threads,
+reporting throughput and latency percentiles per scenario.
+
+    python -m benchmarks.load --concurrency 16 --requests 2000 --latency 0.05 --output load.json
+"""
+import argparse
+import collections
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List
+
+import requests
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from benchmarks import results
+from benchmarks.github_stub import GithubStub
+from chubbyrepo import create_app
+
+SCENARIOS = ('organization_stats', 'chubbiest_repositories')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def organization_stats_paths(organizations: int, **kwargs) -> Iterator[str]:
+    return ('/organizations/org{}/stats'.format(i % organizations) for i in itertools.count())
+
+
+def chubbiest_repositories_paths(limit: int, **kwargs) -> Iterator[str]:
+    return itertools.repeat('/chubbiest_repositories?limit={}'.format(limit))
+
+
+def run_scenario(base_url: str, paths: Iterator[str], concurrency: int, total: int, warmup: int) -> Dict:
+    lock = threading.Lock()
+    local = threading.local()
+
+    def call(path):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            status = local.session.get(base_url + path).status_code
+        except requests.RequestException:
+            status = None
+        return time.perf_counter() - started, status
+
+    def worker(count):
+        measures = []
+        for _ in range(count):
+            with lock:
+                path = next(paths)
+            measures.append(call(path))
+        return measures
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, _split(warmup, concurrency)))
+        started = time.perf_counter()
+        measures = [m for ms in executor.map(worker, _split(total, concurrency)) for m in ms]
+        elapsed = time.perf_counter() - started
+    return _summarize(measures, elapsed)
+
+
+def _split(total: int, parts: int) -> List[int]:
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def _summarize(measures: List, elapsed: float) -> Dict:
+    latencies = sorted(latency for latency, _ in measures)
+    statuses = collections.Counter(str(status) for _, status in measures)
+    return {
+        'requests': len(measures),
+        'errors': sum(1 for _, status in measures if status is None or status >= 500),
+        'statuses': dict(statuses),
+        'throughput': len(measures) / elapsed,
+        'mean': sum(latencies) / len(latencies),
+        'p50': results.percentile(latencies, 50),
+        'p95': results.percentile(latencies, 95),
+        'p99': results.percentile(latencies, 99),
+        'max': latencies[-1],
+    }
+
+
+def _parse_overrides(values: List[str]) -> Dict:
+    overrides = {}
+    for value in values:
+        key, _, raw = value.partition('=')
+        try:
+            overrides[key] = json.loads(raw)
+        except ValueError:
+            overrides[key] = raw
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', help='Defaults to every scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=1000, help='Measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=50, help='Requests per scenario not measured')
+    parser.add_argument('--organizations', type=int, default=100, help='Distinct organizations requested')
+    parser.add_argument('--limit', type=int, default=100, help='Chubbiest repositories requested')
+    parser.add_argument('--latency', type=float, default=0.05, help='Github stub seconds per call')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Github stub max latency variation')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Github stub ratio of 502 answers')
+    parser.add_argument('--config', default='production', help='App config name')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='App config override, VALUE parsed as JSON when possible')
+    parser.add_argument('--output', help='Save results to this JSON file')
+    args = parser.parse_args()
+
+    stub = GithubStub(args.latency, args.jitter, args.error_rate).start()
+    overrides = dict({'GITHUB_GRAPHQL_URL': stub.url, 'GITHUB_API_KEY': 'benchmark', 'CACHE_TYPE': 'simple'},
+                     **_parse_overrides(args.set))
+    app = create_app(args.config, overrides)
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='app-server').start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    paths = {'organization_stats': organization_stats_paths, 'chubbiest_repositories': chubbiest_repositories_paths}
+    scenario_results = {}
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            upstream_calls = stub.calls
+            result = run_scenario(base_url, paths[scenario](organizations=args.organizations, limit=args.limit),
+                                  args.concurrency, args.requests, args.warmup)
+            result['upstream_calls'] = stub.calls - upstream_calls
+            scenario_results[scenario] = result
+            print('{:<24} {:>8.1f} req/s  p50 {:>7.1f}ms  p95 {:>7.1f}ms  p99 {:>7.1f}ms  errors {}'.format(
+                scenario, result['throughput'], result['p50'] * 1e3, result['p95'] * 1e3, result['p99'] * 1e3,
+                result['errors']))
+    finally:
+        server.shutdown()
+        stub.stop()
+
+    if args.output:
+        parameters = {k: v for k, v in vars(args).items() if k != 'output'}
+        results.save(args.output, 'load', scenario_results, parameters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Microbenchmarks of the CPU bound steps of a request.
+
+Times request objects `from_dict`, `Interactor.execute` over in-memory
+gateways, entity building and JSON serialization, without any network.
+
+    python -m benchmarks.micro --output micro.json
+"""
+import argparse
+import json
+import timeit
+from typing import Callable, Dict, List
+
+from benchmarks import results
+from chubbyrepo import create_app
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import RepositoryGateway, StatsGateway
+from chubbyrepo.core.interactors import ChubbiestRepositoriesInteractor, OrganizationStatsInteractor
+from chubbyrepo.core.requests import ChubbiestRepositoriesRequest, OrganizationStatsRequest
+
+
+class MemoryStatsGateway(StatsGateway):
+    def __init__(self):
+        self.stats = OrganizationStats.trusted(42, Repository.trusted('chubbiest', 1000))
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        return self.stats
+
+
+class MemoryRepositoryGateway(RepositoryGateway):
+    def __init__(self, size: int):
+        self.repositories = [Repository.trusted('repo{}'.format(i), 10 ** 6 - i) for i in range(size)]
+
+    def chubbiest_repositories(self, limit: int) -> List[Repository]:
+        return self.repositories[:limit]
+
+
+def github_edges(size: int) -> List[Dict]:
+    return [{'node': {'name': 'repo{}'.format(i), 'stargazers': {'totalCount': 10 ** 6 - i}}} for i in range(size)]
+
+
+def cases() -> Dict[str, Callable]:
+    app = create_app('testing')
+    stats_interactor = OrganizationStatsInteractor(MemoryStatsGateway())
+    repositories_interactor = ChubbiestRepositoriesInteractor(MemoryRepositoryGateway(1000))
+    stats_request = OrganizationStatsRequest.from_dict({'organization_name': 'chubbyrepo'})
+    stats_dict = MemoryStatsGateway().stats.asdict()
+    edges = {size: github_edges(size) for size in (100, 1000)}
+    values = {size: [r.asdict() for r in MemoryRepositoryGateway(size).repositories] for size in (100, 1000)}
+
+    def chubbiest_repositories_execute(limit):
+        request_object = ChubbiestRepositoriesRequest.from_dict({'limit': limit})
+        return list(repositories_interactor.execute(request_object).value)
+
+    def build_repositories(size):
+        trusted = Repository.trusted
+        return [trusted(e['node']['name'], e['node']['stargazers']['totalCount']) for e in edges[size]]
+
+    def app_json_dumps(size):
+        with app.app_context():
+            return app.json.dumps(values[size])
+
+    return {
+        'organization_stats_request.from_dict': lambda: OrganizationStatsRequest.from_dict(
+            {'organization_name': 'chubbyrepo'}),
+        'chubbiest_repositories_request.from_dict': lambda: ChubbiestRepositoriesRequest.from_dict({'limit': '100'}),
+        'organization_stats.from_dict': lambda: OrganizationStats.from_dict(stats_dict),
+        'organization_stats_interactor.execute': lambda: stats_interactor.execute(stats_request),
+        'chubbiest_repositories_interactor.execute_100': lambda: chubbiest_repositories_execute(100),
+        'chubbiest_repositories_interactor.execute_1000': lambda: chubbiest_repositories_execute(1000),
+        'repositories.build_100': lambda: build_repositories(100),
+        'repositories.build_1000': lambda: build_repositories(1000),
+        'repositories.json_100': lambda: app_json_dumps(100),
+        'repositories.json_1000': lambda: app_json_dumps(1000),
+        'repositories.stdlib_json_100': lambda: json.dumps(values[100], sort_keys=True),
+        'repositories.stdlib_json_1000': lambda: json.dumps(values[1000], sort_keys=True),
+    }
+
+
+def measure(fn: Callable, repeat: int) -> Dict:
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {'mean': best, 'ops_per_sec': 1 / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Timing runs per case, the best one is kept')
+    parser.add_argument('--filter', default='', help='Only run cases containing this text')
+    parser.add_argument('--output', help='Save results to this JSON file')
+    args = parser.parse_args()
+
+    case_results = {}
+    for name, fn in cases().items():
+        if args.filter not in name:
+            continue
+        case_results[name] = measure(fn, args.repeat)
+        print('{:<48} {:>12.2f} us'.format(name, case_results[name]['mean'] * 1e6))
+
+    if args.output:
+        results.save(args.output, 'micro', case_results, {'repeat': args.repeat, 'filter': args.filter})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Benchmark results saved as JSON so runs can be compared."""
+import json
+import math
+import platform
+import subprocess
+import time
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return float('nan')
+    rank = max(int(math.ceil(percent / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def save(path: str, kind: str, results: Dict[str, Dict], parameters: Dict):
+    document = {
+        'kind': kind,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def load(path: str) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
@@ -0,0 +1,132 @@
+"""Simulation of the upstream calls saved by adaptive cache TTLs.
+
+Replays organization stats lookups against organizations whose stars change at
+very different rates, most of them dormant and a few viral, and compares the
+fixed TTL with the adaptive one: upstream calls, lookups answered with stale
+stats and how long they had been stale. Lookups follow a Zipf popularity and
+changes a Poisson process per organization. Time is simulated, so a day runs in
+seconds.
+
+    python -m benchmarks.ttl --organizations 1000 --hours 24 --output ttl.json
+"""
+import argparse
+import bisect
+import random
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks import results
+from chubbyrepo.cache import SimpleCache
+from chubbyrepo.ttl import AdaptiveTTL
+from instance.config import Config
+
+# Share of organizations and their star changes per day
+PROFILES = (('dormant', 0.7, 0.2), ('active', 0.25, 20), ('viral', 0.05, 2000))
+
+
+def poisson_times(rate: float, duration: float, rng: random.Random) -> List[float]:
+    """Times of the events of a Poisson process of `rate` per second."""
+    times, now = [], 0.0
+    if rate <= 0:
+        return times
+    while True:
+        now += rng.expovariate(rate)
+        if now >= duration:
+            return times
+        times.append(now)
+
+
+def organizations(count: int, lookups_per_second: float, duration: float, zipf: float,
+                  rng: random.Random) -> List[Tuple[str, List[float], List[float]]]:
+    """Name, lookup times and change times of every simulated organization."""
+    weights = [1 / (rank + 1) ** zipf for rank in range(count)]
+    total = sum(weights)
+    simulated = []
+    for rank, weight in enumerate(weights):
+        profile = rng.choices(PROFILES, weights=[share for _, share, _ in PROFILES])[0]
+        lookups = poisson_times(lookups_per_second * weight / total, duration, rng)
+        changes = poisson_times(profile[2] / 86400, duration, rng)
+        simulated.append(('{}-{}'.format(profile[0], rank), lookups, changes))
+    return simulated
+
+
+def simulate(simulated: List[Tuple[str, List[float], List[float]]], fixed_ttl: int,
+             adaptive_ttl: Optional[AdaptiveTTL]) -> Dict:
+    calls = lookups = stale = 0
+    stale_seconds = 0.0
+    profiles = {profile: {'lookups': 0, 'upstream_calls': 0, 'stale_lookups': 0} for profile, _, _ in PROFILES}
+    for name, lookup_times, change_times in simulated:
+        fetched_at, expires_at = None, 0.0
+        profile = profiles[name.split('-')[0]]
+        profile['lookups'] += len(lookup_times)
+        for now in lookup_times:
+            lookups += 1
+            if now >= expires_at:
+                calls += 1
+                profile['upstream_calls'] += 1
+                fetched_at = now
+                stars = bisect.bisect_right(change_times, now)
+                value = {'repositories_count': 1, 'chubby_repository': {'name': 'chubby', 'stars': stars}}
+                ttl = fixed_ttl if adaptive_ttl is None else adaptive_ttl.ttl(name, value, fixed_ttl, now)
+                expires_at = now + ttl
+                continue
+            first_change = bisect.bisect_right(change_times, fetched_at)
+            if first_change < len(change_times) and change_times[first_change] <= now:
+                stale += 1
+                profile['stale_lookups'] += 1
+                stale_seconds += now - change_times[first_change]
+    return {
+        'lookups': lookups,
+        'upstream_calls': calls,
+        'stale_lookups': stale,
+        'stale_ratio': stale / lookups if lookups else 0,
+        'mean_staleness': stale_seconds / stale if stale else 0,
+        'profiles': profiles,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--organizations', type=int, default=1000, help='Organizations looked up')
+    parser.add_argument('--lookups-per-second', type=float, default=5, help='Lookups across every organization')
+    parser.add_argument('--hours', type=float, default=24, help='Simulated duration')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the organizations popularity')
+    parser.add_argument('--fixed-ttl', type=int, default=Config.CACHE_TTL_ORGANIZATION_STATS,
+                        help='Fixed TTL of the baseline, and first TTL of the adaptive one')
+    parser.add_argument('--min-ttl', type=int, default=Config.ADAPTIVE_TTL_MIN['organization_stats'])
+    parser.add_argument('--max-ttl', type=int, default=Config.ADAPTIVE_TTL_MAX['organization_stats'])
+    parser.add_argument('--tolerance', type=float, default=Config.ADAPTIVE_TTL_TOLERANCE['organization_stats'])
+    parser.add_argument('--smoothing', type=float, default=Config.ADAPTIVE_TTL_SMOOTHING)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Save results to this JSON file')
+    args = parser.parse_args()
+
+    simulated = organizations(args.organizations, args.lookups_per_second, args.hours * 3600, args.zipf,
+                              random.Random(args.seed))
+    adaptive_ttl = AdaptiveTTL(SimpleCache(), 'organization_stats', args.min_ttl, args.max_ttl, args.tolerance,
+                               args.smoothing)
+    strategy_results = {
+        'fixed': simulate(simulated, args.fixed_ttl, None),
+        'adaptive': simulate(simulated, args.fixed_ttl, adaptive_ttl),
+    }
+    baseline = strategy_results['fixed']['upstream_calls']
+    print('{:<10} {:>10} {:>10} {:>8} {:>8} {:>14}'.format(
+        'strategy', 'lookups', 'upstream', 'saved', 'stale', 'staleness (s)'))
+    for strategy, result in strategy_results.items():
+        result['saved_calls_ratio'] = 1 - result['upstream_calls'] / baseline if baseline else 0
+        print('{:<10} {:>10} {:>10} {:>7.1%} {:>7.1%} {:>14.1f}'.format(
+            strategy, result['lookups'], result['upstream_calls'], result['saved_calls_ratio'],
+            result['stale_ratio'], result['mean_staleness']))
+    print()
+    print('{:<10} {:<8} {:>10} {:>10} {:>8}'.format('strategy', 'profile', 'lookups', 'upstream', 'stale'))
+    for strategy, result in strategy_results.items():
+        for profile, counts in result['profiles'].items():
+            print('{:<10} {:<8} {:>10} {:>10} {:>7.1%}'.format(
+                strategy, profile, counts['lookups'], counts['upstream_calls'],
+                counts['stale_lookups'] / counts['lookups'] if counts['lookups'] else 0))
+
+    if args.output:
+        results.save(args.output, 'ttl', strategy_results, vars(args))
+
+
+if __name__ == '__main__':
+    main()
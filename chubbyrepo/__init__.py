@@ -1,17 +1,78 @@
 from flask import Flask
 
+from chubbyrepo.batching import MicroBatcher
+from chubbyrepo.cache import build_cache
+from chubbyrepo.container import Container
+from chubbyrepo.leaderboard import refresh_leaderboard_command
+from chubbyrepo.metrics import init_metrics
+from chubbyrepo.profiling import init_profiling
+from chubbyrepo.ratelimit import UpstreamScheduler
+from chubbyrepo.resilience import AdmissionController, CircuitBreaker, Hedger
+from chubbyrepo.serialization import init_json_provider
+from chubbyrepo.singleflight import SingleFlight
+from chubbyrepo.tracing import init_tracing
+from chubbyrepo.transport import build_session
+from chubbyrepo.ttl import build_adaptive_ttls
 from instance.config import app_config
 
 
-def create_app(config_name):
+def create_app(config_name, overrides=None):
     # instantiate the app
     app = Flask(__name__, instance_relative_config=True)
 
     # set config
     app.config.from_object(app_config[config_name])
+    app.config.update(overrides or {})
+
+    # faster JSON responses
+    init_json_provider(app)
+
+    # shared upstream transport
+    app.extensions['github_session'] = build_session(app.config)
+    app.extensions['upstream_scheduler'] = UpstreamScheduler.from_config(app.config)
+    app.extensions['upstream_hedger'] = Hedger.from_config(app.config)
+    app.extensions['circuit_breaker'] = CircuitBreaker.from_config(app.config)
+    app.extensions['admission_controller'] = AdmissionController.from_config(app.config)
+
+    # shared response cache, with TTLs following how fast values change when adaptive
+    app.extensions['cache'] = build_cache(app.config)
+    app.extensions['adaptive_ttls'] = build_adaptive_ttls(app.config, app.extensions['cache'])
+
+    # coalescing of identical in-flight upstream queries
+    app.extensions['single_flight'] = None
+    if app.config['SINGLEFLIGHT_ENABLED']:
+        app.extensions['single_flight'] = SingleFlight(
+            cache=app.extensions['cache'] if app.config['SINGLEFLIGHT_DISTRIBUTED'] else None,
+            lock_timeout=app.config['SINGLEFLIGHT_LOCK_TIMEOUT'],
+            poll_interval=app.config['SINGLEFLIGHT_POLL_INTERVAL'])
+
+    # micro-batching of concurrent single organization lookups
+    app.extensions['stats_batcher'] = MicroBatcher.from_config(app.config)
+
+    # long-lived gateways and interactors, with persistent organization stats snapshots, precomputed chubbiest
+    # repositories and the local repositories dataset
+    container = app.extensions['container'] = Container(app)
+    if app.config['LEADERBOARD_ENABLED'] and app.config['LEADERBOARD_REFRESH_IN_BACKGROUND']:
+        app.before_request(lambda: container.get('leaderboard').start_refresher(
+            app, app.config['LEADERBOARD_REFRESH_INTERVAL']))
+
+    if app.config['GATEWAY_BACKEND'] == 'dataset' and app.config['DATASET_RELOAD_INTERVAL']:
+        app.before_request(lambda: container.get('repository_dataset').start_reloader(
+            app.config['DATASET_RELOAD_INTERVAL']))
+
+    app.cli.add_command(refresh_leaderboard_command)
+
+    # instrumentation
+    init_metrics(app)
+    init_tracing(app)
+    init_profiling(app)
 
     # register blueprints
     from chubbyrepo.api import api_blueprint
     app.register_blueprint(api_blueprint)
 
+    # pay the setup cost now, e.g. once before forking workers
+    if app.config['CONTAINER_PRELOAD']:
+        container.preload()
+
     return app
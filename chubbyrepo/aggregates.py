@@ -0,0 +1,138 @@
+"""Running aggregates over the repositories of an organization.
+
+Organizations can own tens of thousands of repositories, so they are scanned
+page by page and folded into aggregates whose memory doesn't depend on the
+number of repositories: a heap with the top K repositories and a DDSketch-like
+quantile sketch, with bounded relative error, for the stars percentiles.
+
+Aggregates can be serialized, so a scan can be continued later from the
+cursor of its last page. Repositories are scanned by creation date, so
+continuing only visits repositories created since.
+"""
+import bisect
+import heapq
+import itertools
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from chubbyrepo.core.entities import OrganizationAggregateStats, Repository
+
+
+class QuantileSketch:
+    """Quantiles of positive values with `relative_accuracy` relative error.
+
+    Values are counted in buckets whose bounds grow geometrically, so the
+    number of buckets only grows with the logarithm of the values range. When
+    there are more than `max_bins` buckets the lowest ones are merged.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}  # type: Dict[int, int]
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: float):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = int(math.ceil(math.log(value) / self._log_gamma))
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > self.max_bins:
+            lowest, second = sorted(self.bins)[:2]
+            self.bins[second] += self.bins.pop(lowest)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the value at quantile `q`, between 0 and 1, None when empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return 0
+        indexes = sorted(self.bins)
+        seen = list(itertools.accumulate(self.bins[index] for index in indexes))
+        index = indexes[min(bisect.bisect_right(seen, rank - self.zeros), len(indexes) - 1)]
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_dict(self) -> Dict:
+        return {'relative_accuracy': self.relative_accuracy, 'max_bins': self.max_bins, 'zeros': self.zeros,
+                'count': self.count, 'bins': {str(index): count for index, count in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, adict: Dict) -> 'QuantileSketch':
+        sketch = cls(adict['relative_accuracy'], adict['max_bins'])
+        sketch.zeros, sketch.count = adict['zeros'], adict['count']
+        sketch.bins = {int(index): count for index, count in adict['bins'].items()}
+        return sketch
+
+
+class TopK:
+    """The `k` repositories with more stars seen, kept in a min-heap."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.heap = []  # type: List[Tuple[int, str]]
+
+    def add(self, name: str, stars: int):
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (stars, name))
+        elif (stars, name) > self.heap[0]:
+            heapq.heapreplace(self.heap, (stars, name))
+
+    def repositories(self) -> Tuple[Repository, ...]:
+        return tuple(Repository.trusted(name, stars) for stars, name in sorted(self.heap, reverse=True))
+
+
+class OrganizationAggregate:
+    """Aggregates of the repositories scanned so far and where the scan stopped."""
+
+    def __init__(self, top_k: int = 10, relative_accuracy: float = 0.01, percentiles: Sequence[int] = (50, 90, 99)):
+        self.percentiles = tuple(percentiles)
+        self.repositories_count = 0
+        self.total_stars = 0
+        self.sketch = QuantileSketch(relative_accuracy)
+        self.top = TopK(top_k)
+        self.cursor = None  # type: Optional[str]
+        self.full_scan_at = None  # type: Optional[float]
+        self.updated_at = None  # type: Optional[float]
+
+    def update(self, repositories: List[Repository], total_count: int, cursor: Optional[str]):
+        """Fold a page of repositories. `total_count` is the organization
+        repositories count reported with the page.
+        """
+        for repository in repositories:
+            self.total_stars += repository.stars
+            self.sketch.add(repository.stars)
+            self.top.add(repository.name, repository.stars)
+        self.repositories_count = total_count
+        # An empty last page has no cursor, the scan keeps going from the previous one
+        self.cursor = cursor or self.cursor
+
+    def organization_aggregate_stats(self) -> OrganizationAggregateStats:
+        percentiles = {}
+        for percent in self.percentiles:
+            value = self.sketch.quantile(percent / 100)
+            percentiles['p{}'.format(percent)] = None if value is None else int(round(value))
+        return OrganizationAggregateStats.trusted(self.repositories_count, self.total_stars, percentiles,
+                                                  self.top.repositories())
+
+    def to_dict(self) -> Dict:
+        return {'percentiles': list(self.percentiles), 'repositories_count': self.repositories_count,
+                'total_stars': self.total_stars, 'sketch': self.sketch.to_dict(), 'top_k': self.top.k,
+                'top': [list(item) for item in self.top.heap], 'cursor': self.cursor,
+                'full_scan_at': self.full_scan_at, 'updated_at': self.updated_at}
+
+    @classmethod
+    def from_dict(cls, adict: Dict) -> 'OrganizationAggregate':
+        aggregate = cls(adict['top_k'], percentiles=adict['percentiles'])
+        aggregate.repositories_count, aggregate.total_stars = adict['repositories_count'], adict['total_stars']
+        aggregate.sketch = QuantileSketch.from_dict(adict['sketch'])
+        aggregate.top.heap = [tuple(item) for item in adict['top']]
+        heapq.heapify(aggregate.top.heap)
+        aggregate.cursor, aggregate.full_scan_at = adict['cursor'], adict['full_scan_at']
+        aggregate.updated_at = adict['updated_at']
+        return aggregate
@@ -1,38 +1,195 @@
-from flask import Blueprint, jsonify, request
+import hashlib
+import math
+import time
+from typing import Iterable, Iterator, Union
 
-from chubbyrepo.core.interactors import ChubbiestRepositoriesInteractor, OrganizationStatsInteractor
-from chubbyrepo.core.requests import ChubbiestRepositoriesRequest, OrganizationStatsRequest
+from flask import Blueprint, Response, current_app, json, jsonify, request, stream_with_context
+
+from chubbyrepo import metrics
+from chubbyrepo.core.interactors import Interactor
+from chubbyrepo.core.requests import (
+    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsBatchRequest, OrganizationStatsHistoryRequest,
+    OrganizationStatsRequest, ValidRequest
+)
 from chubbyrepo.core.responses import ResponseFailure, ResponseSuccess
-from chubbyrepo.gateways import RepositoryGateway, StatsGateway
+from chubbyrepo.resilience import carry, deadline, priority
+from chubbyrepo.tracing import span
+from chubbyrepo.webhooks import verify_signature
 
 api_blueprint = Blueprint('api', __name__)
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
 STATUS_CODES = {
     ResponseSuccess.SUCCESS: 200,
     ResponseFailure.RESOURCE_ERROR: 404,
     ResponseFailure.PARAMETERS_ERROR: 400,
-    ResponseFailure.SYSTEM_ERROR: 500
+    ResponseFailure.SYSTEM_ERROR: 500,
+    ResponseFailure.RATE_LIMIT_ERROR: 429,
+    ResponseFailure.SERVICE_UNAVAILABLE: 503,
+    ResponseFailure.OVERLOADED: 503,
 }
 
 
 @api_blueprint.route('/organizations/<org_name>/stats', methods=['GET'])
 def organization_stats(org_name):
     """Get organization repositories stats. Number of repositories and
-    the biggest one.
+    the biggest one, or with `detail=full` total stars, stars percentiles and
+    the most starred repositories, aggregated over every repository.
+    """
+    request_object = _request_object(
+        OrganizationStatsRequest, {'organization_name': org_name, 'detail': request.args.get('detail')})
+    response = _execute(_component('organization_stats_interactor'), request_object)
+    return _make_response(response)
+
+
+@api_blueprint.route('/organizations/<org_name>/stats/history', methods=['GET'])
+def organization_stats_history(org_name):
+    """List past snapshots of the organization repositories stats, most recent
+    first. By default 10 and up to 100 with `limit` query param. Never calls
+    Github.
+    """
+    request_object = _request_object(
+        OrganizationStatsHistoryRequest, {'organization_name': org_name, 'limit': request.args.get('limit', 10)})
+    interactor = _component('organization_stats_history_interactor')
+    if interactor is None:
+        return _make_response(ResponseFailure.build_resource_error('Organization stats history is disabled'))
+    response = _execute(interactor, request_object)
+    return _make_response(response)
+
+
+@api_blueprint.route('/organizations/stats', methods=['POST'])
+def organization_stats_batch():
+    """Get repositories stats for a list of organizations sent as
+    `organization_names` in the JSON body. Unknown organizations get their
+    own error result.
     """
-    request_object = OrganizationStatsRequest.from_dict({'organization_name': org_name})
-    interactor = OrganizationStatsInteractor(StatsGateway())
-    response = interactor.execute(request_object)
-    return jsonify(response.value), STATUS_CODES[response.type]
+    body = request.get_json(silent=True)
+    request_object = _request_object(OrganizationStatsBatchRequest, body if isinstance(body, dict) else {})
+    response = _execute(_component('organization_stats_batch_interactor'), request_object)
+    return _make_response(response)
 
 
 @api_blueprint.route('/chubbiest_repositories', methods=['GET'])
 def chubbiest_repositories():
     """List n-th most starred repositories. By default n is 10 and can be
-     set with `limit` query param.
+     set, up to 1000, with `limit` query param. Served from the leaderboard
+     snapshot when fresh, reporting its age in `X-Snapshot-Age`, otherwise
+     results are streamed, as NDJSON if requested with the `Accept` header.
      """
     limit = request.args.get('limit', 10)
-    request_object = ChubbiestRepositoriesRequest.from_dict({'limit': limit})
-    interactor = ChubbiestRepositoriesInteractor(RepositoryGateway())
-    response = interactor.execute(request_object)
-    return jsonify(response.value), STATUS_CODES[response.type]
+    request_object = _request_object(ChubbiestRepositoriesRequest, {'limit': limit})
+    response = _execute(_component('chubbiest_repositories_interactor'), request_object)
+    if isinstance(response.value, (dict, list)):
+        return _make_response(response)
+    return _stream(response.value), STATUS_CODES[response.type]
+
+
+@api_blueprint.route('/webhooks/github', methods=['POST'])
+def github_webhook():
+    """Receive Github `star`, `repository` and `public` events, signed with
+    `GITHUB_WEBHOOK_SECRET`. Events are answered with 202 right away and
+    applied in background to the cached stats.
+    """
+    processor = _component('webhook_processor')
+    if processor is None:
+        return _make_response(ResponseFailure.build_resource_error('Github webhooks are disabled'))
+    body = request.get_data()
+    if not verify_signature(current_app.config['GITHUB_WEBHOOK_SECRET'], body,
+                            request.headers.get('X-Hub-Signature-256')):
+        return _make_response(ResponseFailure.build_parameters_error('Invalid signature'))
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return _make_response(ResponseFailure.build_parameters_error('Invalid payload'))
+    if not processor.submit(request.headers.get('X-GitHub-Delivery'), request.headers.get('X-GitHub-Event', ''),
+                            payload):
+        return _make_response(ResponseFailure.build_service_unavailable_error('Too many events queued', 1))
+    return Response(status=202)
+
+
+def _request_object(request_class, adict: dict) -> Union[ValidRequest, InvalidRequest]:
+    """Build and validate the request object."""
+    with span('{}.from_dict'.format(request_class.__name__)):
+        return request_class.from_dict(adict)
+
+
+def _component(name: str):
+    """Return a long-lived component of the app container."""
+    return current_app.extensions['container'].get(name)
+
+
+def _execute(interactor: Interactor, request_object: Union[ValidRequest, InvalidRequest]
+             ) -> Union[ResponseSuccess, ResponseFailure]:
+    """Execute the interactor within the request deadline, with the upstream
+    priority of the endpoint, recording its duration by response type. Lazy
+    results keep both while they are streamed.
+    """
+    started = time.perf_counter()
+    endpoint_priority = current_app.config['ADMISSION_PRIORITIES'].get(request.endpoint.rsplit('.', 1)[-1], 1)
+    with deadline(current_app.config['REQUEST_DEADLINE']), priority(endpoint_priority):
+        response = interactor.execute(request_object)
+        if response and isinstance(response.value, Iterator):
+            response.value = carry(response.value)
+    metrics.INTERACTOR_LATENCY.observe(time.perf_counter() - started, type(interactor).__name__, response.type)
+    return response
+
+
+def _make_response(response: Union[ResponseSuccess, ResponseFailure]) -> Response:
+    """Build the JSON response. Successful GET responses are cacheable: they
+    carry a strong ETag, answer `If-None-Match` with 304 and get the endpoint
+    max-age from `CACHE_CONTROL_MAX_AGE`.
+    """
+    http_response = jsonify(response.value)
+    http_response.status_code = STATUS_CODES[response.type]
+    if not response:
+        if response.retry_after is not None:
+            http_response.headers['Retry-After'] = str(int(math.ceil(response.retry_after)))
+        return http_response
+    if 'snapshot_age' in response.metadata:
+        http_response.headers['X-Snapshot-Age'] = str(int(response.metadata['snapshot_age']))
+    if request.method in ('GET', 'HEAD'):
+        # Keys are sorted when encoding, so equal payloads always get the same body and ETag
+        http_response.set_etag(hashlib.blake2b(http_response.get_data(), digest_size=16).hexdigest())
+        max_age = current_app.config['CACHE_CONTROL_MAX_AGE'].get(request.endpoint.rsplit('.', 1)[-1])
+        if max_age is not None:
+            http_response.cache_control.public = True
+            http_response.cache_control.max_age = max_age
+        http_response.make_conditional(request)
+    return http_response
+
+
+def _stream(items: Iterable) -> Response:
+    """Stream items as they are produced, as NDJSON when the client accepts it
+    or as a chunked JSON array otherwise, so memory doesn't grow with the size
+    of the result. The status is sent before the items, so an error while
+    streaming ends the stream with an `{"error": ...}` record instead, and
+    leaves the JSON array unterminated so it can't pass for a shorter result.
+    """
+    if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        def lines():
+            try:
+                for item in items:
+                    yield json.dumps(item) + '\n'
+            except Exception as exc:
+                yield json.dumps(_stream_error(exc)) + '\n'
+
+        return Response(stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+
+    def json_array():
+        yield '['
+        position = 0
+        try:
+            for position, item in enumerate(items, 1):
+                yield (',' if position > 1 else '') + json.dumps(item)
+        except Exception as exc:
+            yield (',' if position else '') + json.dumps(_stream_error(exc))
+            return
+        yield ']'
+
+    return Response(stream_with_context(json_array()), mimetype='application/json')
+
+
+def _stream_error(exc: Exception) -> dict:
+    failure = Interactor._build_failure(exc)
+    metrics.STREAM_ERRORS.inc(request.endpoint, failure.type)
+    return {'error': failure.value}
@@ -0,0 +1,141 @@
+"""ASGI application serving the ChubbyRepo API on the async stack.
+
+It exposes the same endpoints as `chubbyrepo.api`, but every upstream call is
+a non-blocking coroutine so one process can keep thousands of Github requests
+in flight. Run it with any ASGI server, e.g. `uvicorn asgi:app`.
+"""
+import json
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from flask import Config
+
+from chubbyrepo.api import STATUS_CODES
+from chubbyrepo.batching import AsyncMicroBatcher
+from chubbyrepo.core.interactors import (
+    AsyncChubbiestRepositoriesInteractor, AsyncOrganizationStatsBatchInteractor, AsyncOrganizationStatsInteractor
+)
+from chubbyrepo.core.requests import (
+    ChubbiestRepositoriesRequest, OrganizationStatsBatchRequest, OrganizationStatsRequest
+)
+from chubbyrepo.core.responses import ResponseFailure
+from chubbyrepo.gateways import AsyncRepositoryGateway, AsyncStatsGateway
+from chubbyrepo.ratelimit import UpstreamScheduler
+from chubbyrepo.singleflight import AsyncSingleFlight
+from chubbyrepo.transport import build_async_client
+from instance.config import app_config
+
+
+class ASGIApp:
+    """Minimal ASGI router dispatching to the async interactors."""
+
+    routes = [
+        ('GET', re.compile(r'^/organizations/(?P<org_name>[^/]+)/stats$'), 'organization_stats'),
+        ('POST', re.compile(r'^/organizations/stats$'), 'organization_stats_batch'),
+        ('GET', re.compile(r'^/chubbiest_repositories$'), 'chubbiest_repositories'),
+    ]
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.client = None
+        self.single_flight = AsyncSingleFlight() if config['SINGLEFLIGHT_ENABLED'] else None
+        self.stats_batcher = AsyncMicroBatcher.from_config(config)
+        self.upstream_scheduler = UpstreamScheduler.from_config(config)
+        # Kept across requests, micro-batches gather the lookups made through the same gateway
+        self.stats_gateway = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._get_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                    self.client = self.stats_gateway = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_client(self):
+        if self.client is None:
+            self.client = build_async_client(self.config)
+        return self.client
+
+    async def _http(self, scope, receive, send):
+        for method, pattern, handler_name in self.routes:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            if scope['method'] != method:
+                return await self._send_json(send, 405, {'type': ResponseFailure.PARAMETERS_ERROR,
+                                                         'message': 'Method not allowed'})
+            response = await getattr(self, handler_name)(scope, receive, **match.groupdict())
+            headers = []
+            if not response and response.retry_after is not None:
+                headers.append((b'retry-after', str(int(math.ceil(response.retry_after))).encode()))
+            return await self._send_json(send, STATUS_CODES[response.type], response.value, headers)
+        await self._send_json(send, 404, {'type': ResponseFailure.RESOURCE_ERROR, 'message': 'Not found'})
+
+    async def organization_stats(self, scope, receive, org_name):
+        request_object = OrganizationStatsRequest.from_dict({'organization_name': org_name})
+        interactor = AsyncOrganizationStatsInteractor(self._stats_gateway())
+        return await interactor.execute(request_object)
+
+    async def organization_stats_batch(self, scope, receive):
+        body = await self._read_json(receive)
+        request_object = OrganizationStatsBatchRequest.from_dict(body if isinstance(body, dict) else {})
+        interactor = AsyncOrganizationStatsBatchInteractor(self._stats_gateway())
+        return await interactor.execute(request_object)
+
+    async def chubbiest_repositories(self, scope, receive):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        request_object = ChubbiestRepositoriesRequest.from_dict({'limit': query.get('limit', [10])[0]})
+        interactor = AsyncChubbiestRepositoriesInteractor(self._repository_gateway())
+        return await interactor.execute(request_object)
+
+    def _stats_gateway(self) -> AsyncStatsGateway:
+        if self.stats_gateway is None:
+            self.stats_gateway = AsyncStatsGateway(self._get_client(), self.config, self.single_flight,
+                                                   self.stats_batcher, self.upstream_scheduler)
+        return self.stats_gateway
+
+    def _repository_gateway(self) -> AsyncRepositoryGateway:
+        return AsyncRepositoryGateway(self._get_client(), self.config, self.single_flight, self.upstream_scheduler)
+
+    @staticmethod
+    async def _read_json(receive) -> Optional[Dict]:
+        body, more_body = b'', True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    @staticmethod
+    async def _send_json(send, status: int, value, headers: Optional[List[Tuple[bytes, bytes]]] = None):
+        body = json.dumps(value).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())] + (headers or []),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_asgi_app(config_name: str) -> ASGIApp:
+    config = Config('.')
+    config.from_object(app_config[config_name])
+    return ASGIApp(config)
@@ -0,0 +1,166 @@
+"""Micro-batching of concurrent upstream lookups, DataLoader style.
+
+Lookups of different keys made within a few milliseconds of each other are
+queued for a short `window`, or until `max_size` keys are waiting, and then
+loaded together with a single call to a batch function, such as
+`organization_stats_many`. Every caller gets back its own result, or its own
+exception when the batch function returned one for its key. When the batch
+function raises, every caller raises its own copy of the exception.
+
+The threaded flavour doesn't need a thread of its own: the first caller of a
+batch waits for the window and runs it, within its app context and request
+deadline, while the others wait for the results.
+"""
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional
+
+from chubbyrepo import metrics, resilience
+from chubbyrepo.core.gateways import UpstreamUnavailable
+
+BatchFunction = Callable[[List[Any]], Dict[Any, Any]]
+AsyncBatchFunction = Callable[[List[Any]], Awaitable[Dict[Any, Any]]]
+
+
+class _Batch:
+    def __init__(self, batcher_name: str):
+        self.batcher_name = batcher_name
+        self.keys = []  # type: List[Any]
+        self.enqueued_at = []  # type: List[float]
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None  # type: Optional[Dict]
+        self.error = None  # type: Optional[BaseException]
+
+    def add(self, key: Any):
+        if key not in self.keys:
+            self.keys.append(key)
+        self.enqueued_at.append(time.perf_counter())
+
+    def dispatched(self):
+        """Record the batch size and how long its callers waited for it."""
+        name = self.batcher_name
+        now = time.perf_counter()
+        metrics.BATCH_SIZE.observe(len(self.keys), name)
+        for enqueued_at in self.enqueued_at:
+            metrics.BATCH_WAIT.observe(now - enqueued_at, name)
+
+    def result(self, key: Any) -> Any:
+        if self.error is not None:
+            raise _copy_error(self.error) from self.error
+        result = self.results[key]
+        if isinstance(result, Exception):
+            raise _copy_error(result) from result
+        return result
+
+
+def _copy_error(error: Exception) -> Exception:
+    """Copy the error for a single caller. Raising it from many threads would
+    mix their tracebacks, and error handlers of one caller would see the others'.
+    """
+    copy = error.__class__.__new__(error.__class__, *error.args)
+    copy.__dict__.update(error.__dict__)
+    return copy
+
+
+class MicroBatcher:
+    """Load keys in batches of up to `max_size` keys, waiting at most `window`
+    seconds for a batch to fill up. Batches are kept per batch function.
+    """
+
+    def __init__(self, window: float = 0.005, max_size: int = 50):
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}  # type: Dict[BatchFunction, _Batch]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional['MicroBatcher']:
+        if not config['GITHUB_MICRO_BATCH_ENABLED']:
+            return None
+        return cls(config['GITHUB_MICRO_BATCH_WINDOW'], config['GITHUB_MICRO_BATCH_MAX_SIZE'])
+
+    def load(self, key: Any, fn: BatchFunction) -> Any:
+        with self._lock:
+            batch = self._batches.get(fn)
+            leader = batch is None
+            if leader:
+                batch = self._batches[fn] = _Batch(type(self).__name__)
+            batch.add(key)
+            if len(batch.keys) >= self.max_size:
+                del self._batches[fn]
+                batch.full.set()
+
+        if not leader:
+            if not batch.done.wait(resilience.time_left()):
+                raise UpstreamUnavailable('Request deadline exceeded')
+            return batch.result(key)
+
+        left = resilience.time_left()
+        batch.full.wait(self.window if left is None else max(min(self.window, left), 0))
+        with self._lock:
+            if self._batches.get(fn) is batch:
+                del self._batches[fn]
+        batch.dispatched()
+        try:
+            batch.results = fn(batch.keys)
+        except Exception as exc:
+            batch.error = exc
+        finally:
+            batch.done.set()
+        return batch.result(key)
+
+
+class _AsyncBatch(_Batch):
+    def __init__(self, batcher_name: str, loop: asyncio.AbstractEventLoop):
+        super().__init__(batcher_name)
+        self.future = loop.create_future()
+        self.timer = None  # type: Optional[asyncio.TimerHandle]
+
+
+class AsyncMicroBatcher:
+    """Coroutine flavour of MicroBatcher, batching lookups awaited within one
+    event loop. Batches are run by a task of their own, so a cancelled caller
+    doesn't cancel the others.
+    """
+
+    def __init__(self, window: float = 0.005, max_size: int = 50):
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}  # type: Dict[AsyncBatchFunction, _AsyncBatch]
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional['AsyncMicroBatcher']:
+        if not config['GITHUB_MICRO_BATCH_ENABLED']:
+            return None
+        return cls(config['GITHUB_MICRO_BATCH_WINDOW'], config['GITHUB_MICRO_BATCH_MAX_SIZE'])
+
+    async def load(self, key: Any, fn: AsyncBatchFunction) -> Any:
+        batch = self._batches.get(fn)
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = self._batches[fn] = _AsyncBatch(type(self).__name__, loop)
+            batch.timer = loop.call_later(self.window, self._dispatch, fn, batch)
+        batch.add(key)
+        if len(batch.keys) >= self.max_size:
+            batch.timer.cancel()
+            self._dispatch(fn, batch)
+        await asyncio.shield(batch.future)
+        return batch.result(key)
+
+    def _dispatch(self, fn: AsyncBatchFunction, batch: _AsyncBatch):
+        # Dispatched either by its timer or when full, which cancels the timer
+        del self._batches[fn]
+        batch.dispatched()
+        asyncio.ensure_future(self._run(fn, batch))
+
+    @staticmethod
+    async def _run(fn: AsyncBatchFunction, batch: _AsyncBatch):
+        try:
+            batch.results = await fn(batch.keys)
+        except Exception as exc:
+            batch.error = exc
+        finally:
+            # Callers read the outcome from the batch, the future only wakes them up
+            batch.future.set_result(None)
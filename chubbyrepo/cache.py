@@ -0,0 +1,173 @@
+"""Key-value caches shared by the gateways.
+
+Two backends are available and selected with the `CACHE_TYPE` setting:
+    * redis: shared by every worker and replica, used in production.
+    * simple: in-process memory, used for tests and local runs.
+
+`LRUCache` is an in-process cache of bounded size, for data that is cheap to
+lose and not worth a network round trip.
+
+Values are stored as strings; callers are in charge of serializing them.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class BaseCache:
+    """Base class for all ChubbyRepo cache backends."""
+
+    def __init__(self, key_prefix: str = ''):
+        self.key_prefix = key_prefix
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: int):
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl: int) -> Optional[bool]:
+        """Store value only if key is not already cached. Return whether it was
+        stored, or None when the backend failed and it is unknown whether key is.
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class SimpleCache(BaseCache):
+    """Thread safe in-memory cache. Expired entries are dropped when read."""
+
+    def __init__(self, key_prefix: str = ''):
+        super().__init__(key_prefix)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        key = self.key_prefix + key
+        with self._lock:
+            expires_at, value = self._data.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[self.key_prefix + key] = time.monotonic() + ttl, value
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            expires_at, _ = self._data.get(self.key_prefix + key, (None, None))
+            if expires_at is not None and expires_at > time.monotonic():
+                return False
+            self._data[self.key_prefix + key] = time.monotonic() + ttl, value
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(self.key_prefix + key, None)
+
+
+class LRUCache(BaseCache):
+    """Thread safe in-memory cache of up to `max_size` keys, evicting the least
+    recently used ones first.
+    """
+
+    def __init__(self, max_size: int, key_prefix: str = ''):
+        super().__init__(key_prefix)
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        key = self.key_prefix + key
+        with self._lock:
+            expires_at, value = self._data.get(key, (None, None))
+            if expires_at is None:
+                return None
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(self.key_prefix + key, value, ttl)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            expires_at, _ = self._data.get(self.key_prefix + key, (None, None))
+            if expires_at is not None and expires_at > time.monotonic():
+                return False
+            self._store(self.key_prefix + key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(self.key_prefix + key, None)
+
+    def _store(self, key: str, value: str, ttl: int):
+        self._data[key] = time.monotonic() + ttl, value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class RedisCache(BaseCache):
+    """Redis backed cache. Connection errors are logged and treated as misses
+    so an unavailable cache never fails a request, and `add` returns None.
+    """
+
+    def __init__(self, host: str, port: int = 6379, db: int = 0, key_prefix: str = '', socket_timeout: float = 0.5):
+        import redis
+
+        super().__init__(key_prefix)
+        self._client = redis.Redis(host=host, port=port, db=db, socket_timeout=socket_timeout,
+                                   decode_responses=True)
+        self._errors = redis.RedisError
+
+    def get(self, key):
+        try:
+            return self._client.get(self.key_prefix + key)
+        except self._errors:
+            logger.exception('Cache get failed for key %s', key)
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self._client.set(self.key_prefix + key, value, ex=ttl)
+        except self._errors:
+            logger.exception('Cache set failed for key %s', key)
+
+    def add(self, key, value, ttl):
+        try:
+            return bool(self._client.set(self.key_prefix + key, value, ex=ttl, nx=True))
+        except self._errors:
+            logger.exception('Cache add failed for key %s', key)
+            return None
+
+    def delete(self, key):
+        try:
+            self._client.delete(self.key_prefix + key)
+        except self._errors:
+            logger.exception('Cache delete failed for key %s', key)
+
+
+def build_cache(config: Mapping) -> BaseCache:
+    """Return the cache backend selected by `CACHE_TYPE`."""
+    if config['CACHE_TYPE'] == 'redis':
+        return RedisCache(config['CACHE_REDIS_HOST'], config['CACHE_REDIS_PORT'], config['CACHE_REDIS_DB'],
+                          key_prefix=config['CACHE_KEY_PREFIX'])
+    if config['CACHE_TYPE'] == 'simple':
+        return SimpleCache(key_prefix=config['CACHE_KEY_PREFIX'])
+    raise ValueError('Unknown cache type "{}"'.format(config['CACHE_TYPE']))
@@ -0,0 +1,209 @@
+"""Long-lived gateways and interactors of an application.
+
+Gateways are built once per application, already wrapped in their decorators
+(Github transport, snapshot store, response cache), so pooled connections,
+in-memory caches and warm state survive across requests. Components are built
+the first time they are needed or, with `CONTAINER_PRELOAD`, all at once in
+`create_app`, so a preloading server such as gunicorn pays the setup cost once
+before forking its workers.
+"""
+import os
+import threading
+import time
+from typing import Any
+
+from flask import Flask
+from werkzeug.utils import import_string
+
+from chubbyrepo.cache import LRUCache
+from chubbyrepo.core.interactors import (
+    ChubbiestRepositoriesInteractor, OrganizationStatsBatchInteractor, OrganizationStatsHistoryInteractor,
+    OrganizationStatsInteractor
+)
+from chubbyrepo.dataset import RepositoryDataset
+from chubbyrepo.gateways import (
+    AggregateStatsGateway, CachedRepositoryGateway, CachedStatsGateway, DatasetRepositoryGateway, DatasetStatsGateway,
+    NotFoundCachedStatsGateway, PersistentStatsGateway, RepositoryGateway, StatsGateway
+)
+from chubbyrepo.leaderboard import Leaderboard
+from chubbyrepo.store import SnapshotStore
+from chubbyrepo.tracing import instrument
+from chubbyrepo.transport import build_session
+from chubbyrepo.webhooks import WebhookProcessor
+
+GATEWAY_BACKENDS = ('github', 'dataset')
+
+
+class Container:
+    """Registry of the application components, built lazily by name.
+
+    Every component has a `_build_<name>` method, which can be replaced per
+    environment with `CONTAINER_PROVIDERS`, a mapping of component names to
+    import paths of callables taking the container. Tests can swap components
+    for fakes with `override`.
+    """
+
+    COMPONENTS = (
+        'repository_dataset', 'upstream_stats_gateway', 'upstream_repository_gateway', 'stats_snapshots',
+        'not_found_stats_gateway', 'stats_gateway', 'aggregate_stats_gateway', 'repository_gateway', 'leaderboard',
+        'organization_stats_interactor', 'organization_stats_history_interactor', 'organization_stats_batch_interactor',
+        'chubbiest_repositories_interactor', 'webhook_processor',
+    )
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.config = app.config
+        self._providers = {}
+        for name, provider in self.config['CONTAINER_PROVIDERS'].items():
+            if name not in self.COMPONENTS:
+                raise ValueError('Unknown component {}'.format(name))
+            self._providers[name] = import_string(provider) if isinstance(provider, str) else provider
+        self._components = {}
+        self._lock = threading.RLock()
+
+    def get(self, name: str) -> Any:
+        try:
+            return self._components[name]
+        except KeyError:
+            pass
+        # Components depend on each other, so the lock is reentrant
+        with self._lock:
+            if name not in self._components:
+                if name not in self.COMPONENTS:
+                    raise ValueError('Unknown component {}'.format(name))
+                provider = self._providers.get(name) or getattr(type(self), '_build_' + name)
+                component = provider(self)
+                if name.endswith('_interactor') and component is not None and self.app.extensions.get('tracer'):
+                    instrument(component, 'execute', '_process_request')
+                self._components[name] = component
+            return self._components[name]
+
+    def override(self, **components):
+        """Replace components, built or not, with the given instances."""
+        unknown = set(components) - set(self.COMPONENTS)
+        if unknown:
+            raise ValueError('Unknown components {}'.format(', '.join(sorted(unknown))))
+        with self._lock:
+            self._components.update(components)
+
+    def preload(self):
+        """Build every component now instead of on first use."""
+        for name in self.COMPONENTS:
+            self.get(name)
+
+    def after_fork(self):
+        """Give a forked worker its own upstream connections. Pooled sockets
+        opened before the fork would otherwise be shared with the parent.
+        """
+        self.app.extensions['github_session'] = build_session(self.config)
+
+    def _build_repository_dataset(self):
+        """Local repositories dataset, loaded now, when `GATEWAY_BACKEND` is
+        `dataset`, otherwise None.
+        """
+        backend = self.config['GATEWAY_BACKEND']
+        if backend not in GATEWAY_BACKENDS:
+            raise ValueError('Unknown gateway backend {}'.format(backend))
+        if backend != 'dataset':
+            return None
+        dataset = RepositoryDataset(os.path.join(self.app.instance_path, self.config['DATASET_PATH']))
+        dataset.reload()
+        return dataset
+
+    def _build_upstream_stats_gateway(self):
+        dataset = self.get('repository_dataset')
+        return StatsGateway() if dataset is None else DatasetStatsGateway(dataset)
+
+    def _build_upstream_repository_gateway(self):
+        dataset = self.get('repository_dataset')
+        return RepositoryGateway() if dataset is None else DatasetRepositoryGateway(dataset)
+
+    def _build_stats_snapshots(self):
+        """Snapshot store of organization stats, warm started with the hottest
+        organizations, or None when disabled.
+        """
+        path = self.config['SNAPSHOT_STORE_PATH']
+        if not path:
+            return None
+        if not path.startswith('file:'):
+            os.makedirs(self.config['DATA_DIR'], exist_ok=True)
+            path = os.path.join(self.config['DATA_DIR'], path)
+        store = SnapshotStore(path, retention=self.config['SNAPSHOT_STORE_RETENTION'],
+                              prune_every=self.config['SNAPSHOT_STORE_PRUNE_EVERY'])
+        store.prune(time.time() - store.retention)
+        gateway = PersistentStatsGateway(self.get('upstream_stats_gateway'), store,
+                                         self.config['SNAPSHOT_STORE_MAX_AGE'],
+                                         self.config['SNAPSHOT_STORE_MEMORY_SIZE'],
+                                         self.app.extensions['adaptive_ttls'].get('organization_stats'))
+        gateway.warm_start(self.config['SNAPSHOT_STORE_PRELOAD_WINDOW'])
+        return gateway
+
+    def _build_not_found_stats_gateway(self):
+        """Organizations not found, remembered in memory for a short while, or
+        None when disabled.
+        """
+        if not self.config['CACHE_TTL_ORGANIZATION_NOT_FOUND']:
+            return None
+        gateway = self.get('stats_snapshots') or self.get('upstream_stats_gateway')
+        # Generations are shared, so webhooks forget organizations created since for every worker
+        return NotFoundCachedStatsGateway(gateway, LRUCache(self.config['NOT_FOUND_CACHE_SIZE']),
+                                          self.config['CACHE_TTL_ORGANIZATION_NOT_FOUND'], self.app.extensions['cache'])
+
+    def _build_stats_gateway(self) -> CachedStatsGateway:
+        """Organization stats served from cache, then from the organizations not
+        found and the snapshot store when enabled.
+        """
+        gateway = (self.get('not_found_stats_gateway') or self.get('stats_snapshots') or
+                   self.get('upstream_stats_gateway'))
+        # Snapshots observe the stats they fetch, with their fetch time, for the adaptive TTLs
+        return CachedStatsGateway(gateway, self.app.extensions['cache'], self.config['CACHE_TTL_ORGANIZATION_STATS'],
+                                  self.config['CACHE_STALE_TTL_ORGANIZATION_STATS'],
+                                  self.app.extensions['adaptive_ttls'].get('organization_stats'),
+                                  observe_fetches=self.get('stats_snapshots') is None)
+
+    def _build_aggregate_stats_gateway(self) -> AggregateStatsGateway:
+        config = self.config
+        # The dataset has no per repository detail, full detail stats still come from Github
+        gateway = StatsGateway() if self.get('repository_dataset') is not None else self.get('upstream_stats_gateway')
+        return AggregateStatsGateway(
+            gateway, self.app.extensions['cache'],
+            config['CACHE_TTL_ORGANIZATION_AGGREGATE_STATS'], config['ORGANIZATION_AGGREGATE_RESCAN_INTERVAL'],
+            config['ORGANIZATION_AGGREGATE_TOP_K'], config['ORGANIZATION_AGGREGATE_RELATIVE_ACCURACY'],
+            config['ORGANIZATION_AGGREGATE_PERCENTILES'], self.app.extensions['single_flight'])
+
+    def _build_repository_gateway(self) -> CachedRepositoryGateway:
+        return CachedRepositoryGateway(self.get('upstream_repository_gateway'), self.app.extensions['cache'],
+                                       self.config['CACHE_TTL_CHUBBIEST_REPOSITORIES'],
+                                       adaptive_ttl=self.app.extensions['adaptive_ttls'].get('chubbiest_repositories'))
+
+    def _build_leaderboard(self):
+        """Precomputed chubbiest repositories, or None when disabled."""
+        if not self.config['LEADERBOARD_ENABLED']:
+            return None
+        return Leaderboard(self.get('upstream_repository_gateway'), self.config['LEADERBOARD_SIZE'],
+                           self.config['LEADERBOARD_MAX_STALENESS'], cache=self.app.extensions['cache'])
+
+    def _build_organization_stats_interactor(self) -> OrganizationStatsInteractor:
+        return OrganizationStatsInteractor(self.get('stats_gateway'), self.get('aggregate_stats_gateway'))
+
+    def _build_organization_stats_history_interactor(self):
+        """History of the snapshot store, or None when disabled."""
+        gateway = self.get('stats_snapshots')
+        return None if gateway is None else OrganizationStatsHistoryInteractor(gateway)
+
+    def _build_organization_stats_batch_interactor(self) -> OrganizationStatsBatchInteractor:
+        return OrganizationStatsBatchInteractor(self.get('stats_gateway'))
+
+    def _build_chubbiest_repositories_interactor(self) -> ChubbiestRepositoriesInteractor:
+        return ChubbiestRepositoriesInteractor(self.get('repository_gateway'), self.get('leaderboard'))
+
+    def _build_webhook_processor(self):
+        """Github webhook events applied to the cached stats and the
+        leaderboard, or None when no webhook secret is set.
+        """
+        if not self.config['GITHUB_WEBHOOK_SECRET']:
+            return None
+        return WebhookProcessor(
+            self.app, self.get('stats_gateway'), self.get('upstream_stats_gateway'), self.app.extensions['cache'],
+            self.get('stats_snapshots'), self.get('not_found_stats_gateway'), self.get('leaderboard'),
+            self.config['GITHUB_WEBHOOK_QUEUE_SIZE'], self.config['GITHUB_WEBHOOK_PROCESS_IN_BACKGROUND'])
@@ -1,5 +1,5 @@
 """Domain objects used by ChubbyRepo app."""
-from typing import Dict
+from typing import Callable, Dict
 
 import attr
 
@@ -15,22 +15,111 @@ class Entity:
     that information, and attach them to your class."
     """
 
+    __slots__ = ()
+
     def asdict(self) -> Dict:
         """Return class attributes in a dictionary."""
-        return attr.asdict(self)
+        cls = type(self)
+        serializer = _SERIALIZERS.get(cls)
+        if serializer is None:
+            serializer = _SERIALIZERS[cls] = _compile_serializer(cls)
+        return serializer(self)
+
+    @classmethod
+    def trusted(cls, *values):
+        """Build an entity from all its attribute values skipping validators.
+
+        Only meant for data whose types are already known to be right, such as
+        the results parsed by the gateways.
+        """
+        builder = _BUILDERS.get(cls)
+        if builder is None:
+            builder = _BUILDERS[cls] = _compile_builder(cls)
+        return builder(*values)
+
+
+# Serializers and builders are generated once per entity class, the first
+# time they are needed, unrolling attributes access as attrs does for __init__
+_SERIALIZERS = {}  # type: Dict[type, Callable]
+_BUILDERS = {}  # type: Dict[type, Callable]
+
+
+def _compile_serializer(cls: type) -> Callable:
+    items = []
+    for field in attr.fields(cls):
+        value = 'self.{}'.format(field.name)
+        # Nested entities, and sequences of them, are serialized with their own serializer
+        items.append("'{0}': _nested({1}) if isinstance({1}, _NESTED) else {1}".format(field.name, value))
+    source = 'def asdict(self):\n    return {{{}}}\n'.format(', '.join(items))
+    return _compile(source, 'asdict', {'_nested': _nested, '_NESTED': (Entity, list, tuple)})
+
+
+def _nested(value):
+    if isinstance(value, Entity):
+        return value.asdict()
+    return [v.asdict() if isinstance(v, Entity) else v for v in value]
+
+
+def _compile_builder(cls: type) -> Callable:
+    names = [field.name for field in attr.fields(cls)]
+    lines = ['def trusted({}):'.format(', '.join(names)), '    self = _new(_cls)']
+    namespace = {'_new': object.__new__, '_cls': cls, '_setattr': object.__setattr__}
+    for name in names:
+        descriptor = cls.__dict__.get(name)
+        if '__slots__' in cls.__dict__ and hasattr(descriptor, '__set__'):
+            # Slot descriptors set the value without going through the frozen __setattr__
+            namespace['_set_' + name] = descriptor.__set__
+            lines.append('    _set_{0}(self, {0})'.format(name))
+        else:
+            lines.append("    _setattr(self, '{0}', {0})".format(name))
+    lines.append('    return self')
+    return _compile('\n'.join(lines) + '\n', 'trusted', namespace)
 
 
-@attr.s
+def _compile(source: str, name: str, namespace: Dict) -> Callable:
+    exec(compile(source, '<entity {}>'.format(name), 'exec'), namespace)
+    return namespace[name]
+
+
+@attr.s(slots=True, frozen=True)
 class Repository(Entity):
     """Repository stores metadata for a set of files or directory structure."""
 
     name = attr.ib(validator=attr.validators.instance_of(str))
     stars = attr.ib(validator=attr.validators.instance_of(int))
 
+    @classmethod
+    def from_dict(cls, adict: Dict) -> 'Repository':
+        return cls(adict['name'], adict['stars'])
+
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class OrganizationStats(Entity):
     """Organization statistics such as number of repositories and biggest one"""
 
     repositories_count = attr.ib(validator=attr.validators.instance_of(int))
     chubby_repository = attr.ib(validator=attr.validators.instance_of(Repository))
+
+    @classmethod
+    def from_dict(cls, adict: Dict) -> 'OrganizationStats':
+        return cls(adict['repositories_count'], Repository.from_dict(adict['chubby_repository']))
+
+
+@attr.s(slots=True, frozen=True)
+class OrganizationStatsSnapshot(Entity):
+    """Organization statistics as they were fetched at some point in time"""
+
+    fetched_at = attr.ib(validator=attr.validators.instance_of(float))
+    organization_stats = attr.ib(validator=attr.validators.instance_of(OrganizationStats))
+
+
+@attr.s(slots=True, frozen=True)
+class OrganizationAggregateStats(Entity):
+    """Statistics over every repository of an organization: total stars, stars
+    percentiles and its most starred repositories"""
+
+    repositories_count = attr.ib(validator=attr.validators.instance_of(int))
+    total_stars = attr.ib(validator=attr.validators.instance_of(int))
+    stars_percentiles = attr.ib(validator=attr.validators.instance_of(dict))
+    top_repositories = attr.ib(validator=attr.validators.deep_iterable(
+        attr.validators.instance_of(Repository), attr.validators.instance_of(tuple)))
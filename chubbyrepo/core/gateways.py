@@ -1,6 +1,9 @@
-from typing import List
+import asyncio
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
-from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.entities import (
+    OrganizationAggregateStats, OrganizationStats, OrganizationStatsSnapshot, Repository
+)
 
 
 class DoesNotExist(Exception):
@@ -8,11 +11,108 @@ class DoesNotExist(Exception):
     pass
 
 
+class RateLimitExceeded(Exception):
+    """Exception to be raised when the gateway has no upstream budget left.
+    `retry_after` tells, in seconds, when it is worth trying again.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(Exception):
+    """Exception to be raised when the upstream service can't answer in time
+    or is known to be failing. `retry_after`, when known, tells in seconds when
+    it is worth trying again. `fallback`, when set, is an outdated result that
+    can be served meanwhile, but never cached as a fresh one.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, fallback=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.fallback = fallback
+
+
+class Overloaded(UpstreamUnavailable):
+    """Exception to be raised when too many upstream calls are already in
+    flight or waiting, and the call is shed instead of queued.
+    """
+
+
 class StatsGateway:
     def organization_stats(self, name: str) -> OrganizationStats:
         raise NotImplementedError
 
+    def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, DoesNotExist]]:
+        """Return stats, or the DoesNotExist error raised, for each organization name.
+
+        Gateways able to fetch many organizations at once should override it.
+        """
+        results = {}
+        for name in names:
+            try:
+                results[name] = self.organization_stats(name)
+            except DoesNotExist as exc:
+                results[name] = exc
+        return results
+
+
+class AggregateStatsGateway:
+    def organization_aggregate_stats(self, name: str) -> OrganizationAggregateStats:
+        raise NotImplementedError
+
+
+class StatsHistoryGateway:
+    def organization_stats_history(self, name: str, limit: int) -> List[OrganizationStatsSnapshot]:
+        """Return up to `limit` past snapshots of the organization stats, most
+        recent first. Raise DoesNotExist when none was recorded.
+        """
+        raise NotImplementedError
+
 
 class RepositoryGateway:
-    def chubbiest_repositories(self, limit: int) -> List[Repository]:
+    def chubbiest_repositories(self, limit: int) -> Iterable[Repository]:
+        raise NotImplementedError
+
+    def chubbiest_repositories_page(self, first: int, after: Optional[str] = None
+                                    ) -> Tuple[List[Repository], Optional[str]]:
+        """Return up to `first` repositories ranked after the `after` cursor and
+        the cursor of the next page, None after the last one.
+        """
+        raise NotImplementedError
+
+    def chubbiest_owned_repositories(self, limit: int) -> List[Tuple[Optional[str], Repository]]:
+        """Return the `limit` most starred repositories with the login of their
+        owner, None when it isn't known.
+        """
+        return [(None, repository) for repository in self.chubbiest_repositories(limit)]
+
+
+class LeaderboardGateway:
+    def chubbiest_repositories_snapshot(self, limit: int) -> Optional[Tuple[List[Repository], float]]:
+        """Return the `limit` chubbiest repositories from a precomputed snapshot
+        and the snapshot age in seconds, or None when it can't answer.
+        """
+        raise NotImplementedError
+
+
+class AsyncStatsGateway:
+    async def organization_stats(self, name: str) -> OrganizationStats:
+        raise NotImplementedError
+
+    async def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, DoesNotExist]]:
+        """Return stats, or the DoesNotExist error raised, for each organization name.
+
+        Gateways able to fetch many organizations at once should override it.
+        """
+        results = await asyncio.gather(*[self.organization_stats(name) for name in names], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, DoesNotExist):
+                raise result
+        return dict(zip(names, results))
+
+
+class AsyncRepositoryGateway:
+    async def chubbiest_repositories(self, limit: int) -> List[Repository]:
         raise NotImplementedError
@@ -4,11 +4,15 @@ Interactor are the place where we implement classes that query the repository,
 apply business rules, logic, and whatever transformation we need for our data,
 and return the results
 """
-from typing import Union
+from typing import Dict, Iterator, Optional, Union
 
-from chubbyrepo.core.gateways import DoesNotExist, RepositoryGateway, StatsGateway
+from chubbyrepo.core.gateways import (
+    AggregateStatsGateway, AsyncRepositoryGateway, AsyncStatsGateway, DoesNotExist, LeaderboardGateway, Overloaded,
+    RateLimitExceeded, RepositoryGateway, StatsGateway, StatsHistoryGateway, UpstreamUnavailable
+)
 from chubbyrepo.core.requests import (
-    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsRequest, ValidRequest
+    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsBatchRequest, OrganizationStatsHistoryRequest,
+    OrganizationStatsRequest, ValidRequest
 )
 from chubbyrepo.core.responses import ResponseFailure, ResponseSuccess
 
@@ -21,32 +25,145 @@ class Interactor:
             return ResponseFailure.build_from_invalid_request(request_object)
         try:
             return self._process_request(request_object)
-        except DoesNotExist as exc:
-            return ResponseFailure.build_resource_error("{}".format(exc))
         except Exception as exc:
-            return ResponseFailure.build_system_error("{}: {}".format(exc.__class__.__name__, "{}".format(exc)))
+            return self._build_failure(exc)
 
     def _process_request(self, request_object: ValidRequest) -> ResponseSuccess:
         raise NotImplementedError("process_request() not implemented by Interactor class")
 
+    @staticmethod
+    def _build_failure(exc: Exception) -> ResponseFailure:
+        if isinstance(exc, DoesNotExist):
+            return ResponseFailure.build_resource_error("{}".format(exc))
+        if isinstance(exc, RateLimitExceeded):
+            return ResponseFailure.build_rate_limit_error("{}".format(exc), exc.retry_after)
+        if isinstance(exc, Overloaded):
+            return ResponseFailure.build_overloaded_error("{}".format(exc), exc.retry_after)
+        if isinstance(exc, UpstreamUnavailable):
+            return ResponseFailure.build_service_unavailable_error("{}".format(exc), exc.retry_after)
+        return ResponseFailure.build_system_error("{}: {}".format(exc.__class__.__name__, "{}".format(exc)))
+
+
+class AsyncInteractor(Interactor):
+    """Base class for ChubbyRepo interactors running on top of async gateways."""
+
+    async def execute(self, request_object: Union[ValidRequest, InvalidRequest]
+                      ) -> Union[ResponseSuccess, ResponseFailure]:
+        if not request_object:
+            return ResponseFailure.build_from_invalid_request(request_object)
+        try:
+            return await self._process_request(request_object)
+        except Exception as exc:
+            return self._build_failure(exc)
+
+    async def _process_request(self, request_object: ValidRequest) -> ResponseSuccess:
+        raise NotImplementedError("process_request() not implemented by AsyncInteractor class")
+
 
 class OrganizationStatsInteractor(Interactor):
-    """Return organization stats given a organization name."""
+    """Return organization stats given a organization name. With full detail
+    the stats aggregate every repository of the organization.
+    """
 
-    def __init__(self, gateway: StatsGateway):
+    def __init__(self, gateway: StatsGateway, aggregate_gateway: Optional[AggregateStatsGateway] = None):
         self.gateway = gateway
+        self.aggregate_gateway = aggregate_gateway
 
     def _process_request(self, request_object: OrganizationStatsRequest):
+        if request_object.detail == OrganizationStatsRequest.DETAIL_FULL:
+            if self.aggregate_gateway is None:
+                return ResponseFailure.build_parameters_error('detail: Full detail is not available')
+            aggregate_stats = self.aggregate_gateway.organization_aggregate_stats(request_object.organization_name)
+            return ResponseSuccess(aggregate_stats.asdict())
         repository_stats = self.gateway.organization_stats(request_object.organization_name)
         return ResponseSuccess(repository_stats.asdict())
 
 
+class OrganizationStatsBatchInteractor(Interactor):
+    """Return stats for many organizations. Each organization gets its own
+    success or failure so one unknown name doesn't fail the whole batch.
+    """
+
+    def __init__(self, gateway: StatsGateway):
+        self.gateway = gateway
+
+    def _process_request(self, request_object: OrganizationStatsBatchRequest):
+        results = self.gateway.organization_stats_many(request_object.organization_names)
+        return self._build_response(request_object, results)
+
+    @staticmethod
+    def _build_response(request_object: OrganizationStatsBatchRequest, results: Dict) -> ResponseSuccess:
+        value = {}
+        for name in request_object.organization_names:
+            if isinstance(results[name], Exception):
+                value[name] = Interactor._build_failure(results[name]).value
+            else:
+                value[name] = {'type': ResponseSuccess.SUCCESS, 'value': results[name].asdict()}
+        return ResponseSuccess(value)
+
+
+class OrganizationStatsHistoryInteractor(Interactor):
+    """Return past organization stats snapshots, most recent first."""
+
+    def __init__(self, gateway: StatsHistoryGateway):
+        self.gateway = gateway
+
+    def _process_request(self, request_object: OrganizationStatsHistoryRequest):
+        snapshots = self.gateway.organization_stats_history(request_object.organization_name, request_object.limit)
+        return ResponseSuccess([s.asdict() for s in snapshots])
+
+
 class ChubbiestRepositoriesInteractor(Interactor):
-    """Get most starred repositories."""
+    """Get most starred repositories. Served from the leaderboard snapshot,
+    when there is a fresh one, and from the gateway otherwise.
+    """
 
-    def __init__(self, gateway: RepositoryGateway):
+    def __init__(self, gateway: RepositoryGateway, leaderboard: Optional[LeaderboardGateway] = None):
         self.gateway = gateway
+        self.leaderboard = leaderboard
 
     def _process_request(self, request_object: ChubbiestRepositoriesRequest):
+        if self.leaderboard is not None:
+            snapshot = self.leaderboard.chubbiest_repositories_snapshot(request_object.limit)
+            if snapshot is not None:
+                chubbiest_repositories, age = snapshot
+                return ResponseSuccess([r.asdict() for r in chubbiest_repositories], {'snapshot_age': age})
         chubbiest_repositories = self.gateway.chubbiest_repositories(request_object.limit)
+        if isinstance(chubbiest_repositories, Iterator):
+            # Lazy on purpose, big limits are streamed to the client as they are fetched
+            return ResponseSuccess(r.asdict() for r in chubbiest_repositories)
+        # Cached or fetched at once, answered whole so it can be cached by clients too
+        return ResponseSuccess([r.asdict() for r in chubbiest_repositories])
+
+
+class AsyncOrganizationStatsInteractor(AsyncInteractor):
+    """Return organization stats given a organization name."""
+
+    def __init__(self, gateway: AsyncStatsGateway):
+        self.gateway = gateway
+
+    async def _process_request(self, request_object: OrganizationStatsRequest):
+        repository_stats = await self.gateway.organization_stats(request_object.organization_name)
+        return ResponseSuccess(repository_stats.asdict())
+
+
+class AsyncOrganizationStatsBatchInteractor(AsyncInteractor):
+    """Return stats for many organizations, each one with its own success or failure."""
+
+    def __init__(self, gateway: AsyncStatsGateway):
+        self.gateway = gateway
+
+    async def _process_request(self, request_object: OrganizationStatsBatchRequest):
+        results = await self.gateway.organization_stats_many(request_object.organization_names)
+        return OrganizationStatsBatchInteractor._build_response(request_object, results)
+
+
+class AsyncChubbiestRepositoriesInteractor(AsyncInteractor):
+    """Get most starred repositories."""
+
+    def __init__(self, gateway: AsyncRepositoryGateway):
+        self.gateway = gateway
+
+    async def _process_request(self, request_object: ChubbiestRepositoriesRequest):
+        chubbiest_repositories = await self.gateway.chubbiest_repositories(request_object.limit)
         return ResponseSuccess([r.asdict() for r in chubbiest_repositories])
@@ -4,7 +4,8 @@ Requests are objects created from incoming calls, thus they shall deal with
 things like incorrect values, missing parameters, wrong formats, etc. and
 transport data from outside the application into the interactors layer.
 """
-from typing import Dict, Optional, Union
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
 
 
 class InvalidRequest:
@@ -37,8 +38,13 @@ class ValidRequest:
 class OrganizationStatsRequest(ValidRequest):
     """RepositoriesStats interactor request."""
 
-    def __init__(self, organization_name: str):
+    DETAIL_SUMMARY = 'summary'
+    DETAIL_FULL = 'full'
+    DETAILS = (DETAIL_SUMMARY, DETAIL_FULL)
+
+    def __init__(self, organization_name: str, detail: str = DETAIL_SUMMARY):
         self.organization_name = organization_name
+        self.detail = detail
 
     @classmethod
     def from_dict(cls, adict):
@@ -50,15 +56,82 @@ class OrganizationStatsRequest(ValidRequest):
         if 'organization_name' in adict and not isinstance(adict['organization_name'], str):
             invalid_request.add_error('organization_name', 'Is not string')
 
+        detail = adict.get('detail') or cls.DETAIL_SUMMARY
+        if detail not in cls.DETAILS:
+            invalid_request.add_error('detail', 'Must be one of {}'.format(', '.join(cls.DETAILS)))
+
+        if invalid_request.has_errors():
+            return invalid_request
+
+        return OrganizationStatsRequest(organization_name=adict['organization_name'], detail=detail)
+
+
+class OrganizationStatsHistoryRequest(ValidRequest):
+    """OrganizationStatsHistory interactor request."""
+
+    MAX_LIMIT = 100
+
+    def __init__(self, organization_name: str, limit: int = 10):
+        self.organization_name = organization_name
+        self.limit = limit
+
+    @classmethod
+    def from_dict(cls, adict):
+        invalid_request = InvalidRequest()
+
+        if 'organization_name' not in adict:
+            invalid_request.add_error('organization_name', 'Is required')
+        elif not isinstance(adict['organization_name'], str):
+            invalid_request.add_error('organization_name', 'Is not string')
+
+        try:
+            limit = int(adict.get('limit', 10))
+        except ValueError:
+            invalid_request.add_error('limit', 'Is not integer')
+        else:
+            if not (1 <= limit <= cls.MAX_LIMIT):
+                invalid_request.add_error('limit', 'Must be between 1 and {}, both included'.format(cls.MAX_LIMIT))
+
         if invalid_request.has_errors():
             return invalid_request
 
-        return OrganizationStatsRequest(organization_name=adict['organization_name'])
+        return OrganizationStatsHistoryRequest(organization_name=adict['organization_name'], limit=limit)
+
+
+class OrganizationStatsBatchRequest(ValidRequest):
+    """OrganizationStatsBatch interactor request."""
+
+    MAX_ORGANIZATIONS = 500
+
+    def __init__(self, organization_names: List[str]):
+        # Duplicated names are fetched only once
+        self.organization_names = list(OrderedDict.fromkeys(organization_names))
+
+    @classmethod
+    def from_dict(cls, adict):
+        invalid_request = InvalidRequest()
+        organization_names = adict.get('organization_names')
+
+        if organization_names is None:
+            invalid_request.add_error('organization_names', 'Is required')
+        elif not isinstance(organization_names, list) or not all(isinstance(n, str) for n in organization_names):
+            invalid_request.add_error('organization_names', 'Is not a list of strings')
+        elif not (1 <= len(organization_names) <= cls.MAX_ORGANIZATIONS):
+            invalid_request.add_error(
+                'organization_names', 'Must contain between 1 and {}, both included'.format(cls.MAX_ORGANIZATIONS))
+
+        if invalid_request.has_errors():
+            return invalid_request
+
+        return OrganizationStatsBatchRequest(organization_names=organization_names)
 
 
 class ChubbiestRepositoriesRequest(ValidRequest):
     """ChubbiestRepositories interactor request."""
 
+    # Github search never returns more than 1000 results
+    MAX_LIMIT = 1000
+
     def __init__(self, limit: Optional[int]=None):
         self.limit = limit or 10
 
@@ -71,8 +144,8 @@ class ChubbiestRepositoriesRequest(ValidRequest):
         except ValueError:
             invalid_request.add_error('limit', 'Is not integer')
         else:
-            if not (1 <= adict['limit'] <= 100):
-                invalid_request.add_error('limit', 'Must be between 1 and 100, both included')
+            if not (1 <= adict['limit'] <= cls.MAX_LIMIT):
+                invalid_request.add_error('limit', 'Must be between 1 and {}, both included'.format(cls.MAX_LIMIT))
 
         if invalid_request.has_errors():
             return invalid_request
@@ -9,13 +9,16 @@ from chubbyrepo.core.requests import InvalidRequest
 
 
 class ResponseSuccess:
-    """Contain interactor response data."""
+    """Contain interactor response data and, optionally, metadata about how
+    it was obtained (e.g. its age when served from a snapshot).
+    """
 
     SUCCESS = 'SUCCESS'
 
-    def __init__(self, value: Optional[Any]):
+    def __init__(self, value: Optional[Any], metadata: Optional[Dict[str, Any]] = None):
         self.type = self.SUCCESS
         self.value = value
+        self.metadata = metadata or {}
 
 
 class ResponseFailure:
@@ -23,15 +26,24 @@ class ResponseFailure:
         * RESOURCE_ERROR: errors related to the resources contained in the repository.
         * PARAMETERS_ERROR: errors that occur when the request parameters are wrong or missing.
         * SYSTEM_ERROR: errors that happen in the underlying system at operating system level.
+        * RATE_LIMIT_ERROR: errors that happen when upstream services budget is exhausted.
+        * SERVICE_UNAVAILABLE: errors that happen when upstream services are too slow or failing.
+        * OVERLOADED: errors that happen when the request is shed, as too many are already waiting on upstream.
+
+    `retry_after`, when set, tells in seconds when the request is worth retrying.
     """
 
     RESOURCE_ERROR = 'RESOURCE_ERROR'
     PARAMETERS_ERROR = 'PARAMETERS_ERROR'
     SYSTEM_ERROR = 'SYSTEM_ERROR'
+    RATE_LIMIT_ERROR = 'RATE_LIMIT_ERROR'
+    SERVICE_UNAVAILABLE = 'SERVICE_UNAVAILABLE'
+    OVERLOADED = 'OVERLOADED'
 
-    def __init__(self, error_type: str, message: Union[str, Exception]):
+    def __init__(self, error_type: str, message: Union[str, Exception], retry_after: Optional[float] = None):
         self.type = error_type
         self.message = self._format_message(message)
+        self.retry_after = retry_after
 
     @property
     def value(self) -> Dict[str, str]:
@@ -58,6 +70,21 @@ class ResponseFailure:
     def build_parameters_error(cls, message: Optional[Union[str, Exception]]) -> 'ResponseFailure':
         return cls(cls.PARAMETERS_ERROR, message)
 
+    @classmethod
+    def build_rate_limit_error(cls, message: Optional[Union[str, Exception]],
+                               retry_after: Optional[float] = None) -> 'ResponseFailure':
+        return cls(cls.RATE_LIMIT_ERROR, message, retry_after)
+
+    @classmethod
+    def build_service_unavailable_error(cls, message: Optional[Union[str, Exception]],
+                                        retry_after: Optional[float] = None) -> 'ResponseFailure':
+        return cls(cls.SERVICE_UNAVAILABLE, message, retry_after)
+
+    @classmethod
+    def build_overloaded_error(cls, message: Optional[Union[str, Exception]],
+                               retry_after: Optional[float] = None) -> 'ResponseFailure':
+        return cls(cls.OVERLOADED, message, retry_after)
+
     @classmethod
     def build_from_invalid_request(cls, invalid_request: InvalidRequest) -> 'ResponseFailure':
         message = "\n".join(["{}: {}".format(err['parameter'], err['message']) for err in invalid_request.errors])
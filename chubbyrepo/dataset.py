@@ -0,0 +1,217 @@
+"""Offline repositories dataset, indexed in memory.
+
+Both endpoints can be answered from a local dump of repositories instead of
+Github, for analytics or to ride out Github outages. The dump is a JSON lines
+file, or a directory of `*.jsonl` part files, with a repository per line as
+Github REST API returns them:
+
+    {"owner": {"login": "acme_corp"}, "name": "chubby", "stargazers_count": 10}
+
+where `owner` may also be the login itself. Private repositories are skipped.
+
+Loading builds two indexes: every repository in parallel arrays sorted by
+stars, for the chubbiest repositories, and per owner its repositories count
+and chubbiest repository, for the organization stats. Reloads run in a
+background thread per worker and only parse the part files changed since the
+previous load, and only sort their repositories into the ones of the other
+parts, already sorted in the previous index; the new indexes are swapped in at
+once, so requests keep being answered from the previous ones until then.
+"""
+import glob
+import itertools
+import json
+import logging
+import operator
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import DoesNotExist
+
+try:
+    from orjson import loads
+except ImportError:
+    loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetPart:
+    """Repositories of a part file, in file order, and their owners' stats as
+    `(repositories count, chubbiest name, chubbiest stars)`. Repositories are
+    only kept until merged into an index.
+    """
+
+    __slots__ = ('id', 'signature', 'names', 'stars', 'owners', 'skipped')
+
+    _ids = itertools.count()
+
+    def __init__(self, signature: Tuple[int, int]):
+        self.id = next(self._ids)
+        self.signature = signature
+        self.names = []  # type: Optional[List[str]]
+        self.stars = array('q')  # type: Optional[array]
+        self.owners = {}  # type: Dict[str, Tuple[int, str, int]]
+        self.skipped = 0
+
+    @classmethod
+    def load(cls, path: str) -> 'DatasetPart':
+        stat = os.stat(path)
+        part = cls((stat.st_mtime_ns, stat.st_size))
+        names, stars, owners = part.names, part.stars, part.owners
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    row = loads(line)
+                    owner, name, count = row['owner'], row['name'], row['stargazers_count']
+                    if isinstance(owner, dict):
+                        owner = owner['login']
+                    key = owner.lower()
+                    if not isinstance(name, str) or not isinstance(count, int):
+                        raise TypeError(name, count)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    # Blank lines, or a dump still being written
+                    part.skipped += bool(line.strip())
+                    continue
+                if row.get('private'):
+                    continue
+                names.append(name)
+                stars.append(count)
+                stats = owners.get(key)
+                if stats is None:
+                    owners[key] = (1, name, count)
+                else:
+                    owners[key] = (stats[0] + 1, name, count) if count > stats[2] else (stats[0] + 1,) + stats[1:]
+        return part
+
+
+class DatasetIndex:
+    """Indexes over every part of a dataset, read only once built.
+
+    Repositories of the parts also in the `previous` index are taken from it,
+    the other parts' are merged in and released, so every repository is held
+    once. Ties are ranked by part path, then by file order.
+    """
+
+    __slots__ = ('parts', 'names', 'stars', 'part_ids', 'owners', 'loaded_at')
+
+    def __init__(self, parts: Dict[str, DatasetPart], previous: Optional['DatasetIndex'] = None):
+        self.parts = parts
+        previous_ids = set() if previous is None else {part.id for part in previous.parts.values()}
+        ids = [part.id for _, part in sorted(parts.items())]
+        kept = previous_ids.intersection(ids)
+        names, stars, part_ids = [], array('q'), array('I')
+        if kept:
+            selected = list(map(kept.__contains__, previous.part_ids))
+            names.extend(itertools.compress(previous.names, selected))
+            stars.extend(itertools.compress(previous.stars, selected))
+            part_ids.extend(itertools.compress(previous.part_ids, selected))
+        for part in parts.values():
+            if part.id not in previous_ids:
+                names.extend(part.names)
+                stars.extend(part.stars)
+                part_ids.extend(itertools.repeat(part.id, len(part.stars)))
+            part.names = part.stars = None
+        # Rows taken from the previous index are already sorted, the sort only merges the new ones in.
+        # Ties are ranked by part path, then in file order
+        ranks = {part_id: len(ids) - rank for rank, part_id in enumerate(ids)}
+        keys = list(map(operator.add, map(operator.mul, stars, itertools.repeat(len(ids) + 1)),
+                        map(ranks.__getitem__, part_ids)))
+        order = sorted(range(len(keys)), key=keys.__getitem__, reverse=True)
+        self.names = [names[i] for i in order]
+        self.stars = array('q', map(stars.__getitem__, order))
+        self.part_ids = array('I', map(part_ids.__getitem__, order))
+        if len(parts) == 1:
+            self.owners = next(iter(parts.values())).owners
+        else:
+            self.owners = {}
+            for part in parts.values():
+                for key, (count, name, most_stars) in part.owners.items():
+                    stats = self.owners.get(key)
+                    if stats is not None:
+                        count += stats[0]
+                        if stats[2] >= most_stars:
+                            name, most_stars = stats[1:]
+                    self.owners[key] = (count, name, most_stars)
+        self.loaded_at = time.time()
+
+
+class RepositoryDataset:
+    """Repositories dataset at `path`, a JSON lines file or a directory of
+    them. Empty until loaded with `reload`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = DatasetIndex({})
+        self._lock = threading.Lock()
+        self._reloader_pid = None
+
+    def __len__(self) -> int:
+        return len(self._index.names)
+
+    def part_paths(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, '*.jsonl')))
+        return [self.path]
+
+    def reload(self) -> bool:
+        """Load the part files changed since the last load and swap the new
+        indexes in. Return whether anything changed.
+        """
+        with self._lock:
+            started = time.perf_counter()
+            previous = self._index.parts
+            parts = {}
+            for path in self.part_paths():
+                part = previous.get(path)
+                stat = os.stat(path)
+                if part is None or part.signature != (stat.st_mtime_ns, stat.st_size):
+                    part = DatasetPart.load(path)
+                    if part.skipped:
+                        logger.warning('Skipped %d invalid lines of %s', part.skipped, path)
+                parts[path] = part
+            if parts.keys() == previous.keys() and all(parts[path] is previous[path] for path in parts):
+                return False
+            index = DatasetIndex(parts, self._index)
+            # Readers take the index once per lookup, they see the old or the new one
+            self._index = index
+            logger.info('Loaded %d repositories of %d owners from %s in %.2fs', len(index.names), len(index.owners),
+                        self.path, time.perf_counter() - started)
+            return True
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        stats = self._index.owners.get(name.lower())
+        if stats is None:
+            raise DoesNotExist('Could not resolve to an Organization with the login of \'{}\'.'.format(name))
+        count, chubby_name, chubby_stars = stats
+        return OrganizationStats.trusted(count, Repository.trusted(chubby_name, chubby_stars))
+
+    def chubbiest_repositories(self, start: int, stop: int) -> List[Repository]:
+        index, trusted = self._index, Repository.trusted
+        return [trusted(name, stars) for name, stars in zip(index.names[start:stop], index.stars[start:stop])]
+
+    def start_reloader(self, interval: float):
+        """Start, once per process, a daemon thread reloading the dataset every
+        `interval` seconds. Safe to call on every request.
+        """
+        # Threads don't survive forks, workers need their own
+        if self._reloader_pid == os.getpid():
+            return
+        with self._lock:
+            if self._reloader_pid == os.getpid():
+                return
+            threading.Thread(target=self._reload_forever, args=(interval,), daemon=True,
+                             name='dataset-reloader').start()
+            self._reloader_pid = os.getpid()
+
+    def _reload_forever(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception('Dataset reload failed')
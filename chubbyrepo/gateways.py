@@ -1,54 +1,973 @@
-from typing import List
+import asyncio
+import contextvars
+import json
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 
 import requests
 from flask import current_app
+from requests import HTTPError, Timeout
 
-from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo import metrics, resilience, tracing
+from chubbyrepo.aggregates import OrganizationAggregate
+from chubbyrepo.batching import AsyncMicroBatcher
+from chubbyrepo.cache import BaseCache
+from chubbyrepo.core.entities import (
+    OrganizationAggregateStats, OrganizationStats, OrganizationStatsSnapshot, Repository
+)
+from chubbyrepo.core.gateways import AggregateStatsGateway as BaseAggregateStatsGateway
+from chubbyrepo.core.gateways import AsyncRepositoryGateway as BaseAsyncRepositoryGateway
+from chubbyrepo.core.gateways import AsyncStatsGateway as BaseAsyncStatsGateway
 from chubbyrepo.core.gateways import RepositoryGateway as BaseRepositoryGateway
 from chubbyrepo.core.gateways import StatsGateway as BaseStatsGateway
-from chubbyrepo.core.gateways import DoesNotExist
+from chubbyrepo.core.gateways import DoesNotExist, RateLimitExceeded, StatsHistoryGateway, UpstreamUnavailable
+from chubbyrepo.dataset import RepositoryDataset
+from chubbyrepo.ratelimit import TokenState, UpstreamScheduler
+from chubbyrepo.singleflight import AsyncSingleFlight, SingleFlight
+from chubbyrepo.store import SnapshotStore
+from chubbyrepo.transport import RETRY_STATUSES, timeout
+from chubbyrepo.ttl import AdaptiveTTL
+
+SERVER_ERRORS = range(500, 600)
+# First field selected by a GraphQL document, past its alias if any
+DOCUMENT_FIELD = re.compile(r'{\s*(?:\w+\s*:\s*)?(\w+)')
+# Selected by every document, so the upstream scheduler learns the cost of each query
+RATE_LIMIT_FIELDS = 'rateLimit { cost remaining resetAt}'
+# Chubbiest repository of organizations without public repositories
+NO_REPOSITORY = Repository.trusted('', 0)
 
 
 class GithubGraphQLGateway:
     """Base class for all Github based gateways."""
-    url = 'https://api.github.com/graphql'
 
     @classmethod
-    def execute(cls, document, *args, **kwargs):
-        errors, data = cls._get_result(document, *args, **kwargs)
+    def execute(cls, document, variable_values=None):
+        """Run the GraphQL document. Identical concurrent queries are coalesced
+        into a single upstream call when single-flight is enabled.
+        """
+        single_flight = current_app.extensions.get('single_flight')
+        if single_flight is None:
+            return cls._execute(document, variable_values)
+        return single_flight.do(single_flight.key(document, variable_values),
+                                lambda: cls._execute(document, variable_values))
+
+    @classmethod
+    def _execute(cls, document, variable_values=None):
+        errors, data = cls._get_result(document, variable_values)
+        cls._raise_for_errors(errors)
+        return data
+
+    @staticmethod
+    def _raise_for_errors(errors: Optional[List[Dict]]):
         if errors:
             if errors[0].get('type') == 'NOT_FOUND':
                 raise DoesNotExist(str(errors[0].get('message')))
             raise Exception(str(errors[0].get('message')))
-        return data
 
     @classmethod
     def _get_result(cls, document, variable_values=None):
+        variables = json.dumps(variable_values or {})
+        with tracing.span('github.graphql', gateway=cls.__name__, document=cls._document_name(document),
+                          variables_bytes=len(variables)) as span:
+            errors, data, response_bytes = cls._get_result_payload(document, variable_values)
+            if span is not None:
+                span.set_attribute('response_bytes', response_bytes)
+                span.set_attribute('graphql_errors', len(errors or ()))
+            return errors, data
+
+    @staticmethod
+    def _document_name(document: str) -> str:
+        """Name a GraphQL document after its first field, e.g. `organization`."""
+        match = DOCUMENT_FIELD.search(document)
+        return match.group(1) if match else 'query'
+
+    @classmethod
+    def _get_result_payload(cls, document, variable_values=None):
         payload = {
             'query': document,
             'variables': variable_values or {}
         }
-        request = requests.post(cls.url, json=payload, auth=('token', current_app.config['GITHUB_API_KEY']))
-        request.raise_for_status()
-        result = request.json()
+        session = current_app.extensions['github_session']
+        scheduler = current_app.extensions['upstream_scheduler']
+        gateway = cls.__name__
+        # When Github rejects a token for its rate limit, rotate to the next one
+        for _ in scheduler.tokens:
+            token = scheduler.acquire()
+            started = time.perf_counter()
+            try:
+                request = cls._post(session, payload, token)
+            except Exception as exc:
+                metrics.UPSTREAM_ERRORS.inc(gateway, exc.__class__.__name__)
+                raise
+            metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - started, gateway)
+            metrics.UPSTREAM_RESPONSE_SIZE.observe(len(request.content), gateway)
+            if not cls._is_rate_limited(request):
+                break
+            metrics.UPSTREAM_ERRORS.inc(gateway, 'rate_limited')
+            scheduler.exhaust(token, cls._retry_after(request))
+        else:
+            raise RateLimitExceeded('Github rate limit exhausted', cls._retry_after(request) or 60)
+        scheduler.update(token, request.headers)
+        try:
+            request.raise_for_status()
+        except HTTPError:
+            metrics.UPSTREAM_ERRORS.inc(gateway, 'http_{}'.format(request.status_code))
+            raise
+        errors, data = cls._parse_result(request.json())
+        if errors:
+            metrics.UPSTREAM_ERRORS.inc(gateway, 'graphql')
+        if isinstance(data, dict) and data.get('rateLimit'):
+            scheduler.update(token, rate_limit=data['rateLimit'])
+        return errors, data, len(request.content)
+
+    @staticmethod
+    def _post(session, payload: Dict, token: TokenState):
+        """POST the query within the request deadline, once admitted, through
+        the circuit breaker and hedged when enabled.
+        """
+        resilience.check_deadline()
+        admission = current_app.extensions['admission_controller']
+        if admission is not None:
+            admission.acquire()
+        return GithubGraphQLGateway._post_admitted(session, payload, token)
+
+    @staticmethod
+    def _post_admitted(session, payload: Dict, token: TokenState):
+        """POST the query holding an admission slot, when enabled, released
+        once the first POST is over, even when a hedge answered before it.
+        """
+        config = current_app.config
+        left = resilience.time_left()
+        # Absolute, since hedged posts run in other threads, out of the request context
+        ends = None if left is None else time.monotonic() + left
+        extensions = current_app.extensions
+        breaker, hedger = extensions['circuit_breaker'], extensions['upstream_hedger']
+        admission, scheduler = extensions['admission_controller'], extensions['upstream_scheduler']
+
+        def post():
+            # Retried here rather than by the transport, so every attempt and backoff fits within the deadline
+            retries, attempt = config['GITHUB_RETRIES'], 0
+            # The last attempt returns or raises
+            while True:
+                connect_timeout, read_timeout = timeout(config)
+                if ends is not None:
+                    left = ends - time.monotonic()
+                    if left <= 0:
+                        raise UpstreamUnavailable('Request deadline exceeded')
+                    connect_timeout, read_timeout = min(connect_timeout, left), min(read_timeout, left)
+                try:
+                    response = session.post(config['GITHUB_GRAPHQL_URL'], json=payload, auth=('token', token.token),
+                                            timeout=(connect_timeout, read_timeout))
+                except (requests.ConnectionError, Timeout):
+                    if attempt == retries:
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUSES or attempt == retries:
+                        return response
+                backoff = config['GITHUB_RETRY_BACKOFF'] * 2 ** attempt
+                if ends is not None and time.monotonic() + backoff >= ends:
+                    raise UpstreamUnavailable('Request deadline exceeded')
+                time.sleep(backoff)
+                attempt += 1
+
+        def reserve_hedge():
+            # The duplicate takes its own admission slot and rate limit budget, or isn't sent
+            if admission is not None and not admission.try_acquire():
+                return None
+            if not scheduler.try_acquire(token):
+                if admission is not None:
+                    admission.release()
+                return None
+            if admission is None:
+                return post
+
+            def hedge():
+                try:
+                    return post()
+                finally:
+                    admission.release()
+
+            return hedge
+
+        def primary():
+            try:
+                return post()
+            finally:
+                if admission is not None:
+                    admission.release()
+
+        if breaker is not None:
+            try:
+                breaker.allow()
+            except UpstreamUnavailable:
+                if admission is not None:
+                    admission.release()
+                raise
+        try:
+            response = primary() if hedger is None else hedger.call(primary, reserve_hedge)
+        except UpstreamUnavailable:
+            # Only raised once the caller's deadline is over, which says nothing about Github
+            if breaker is not None:
+                breaker.record_inconclusive()
+            raise
+        except Exception as exc:
+            transport_error = isinstance(exc, (requests.ConnectionError, requests.exceptions.RetryError, Timeout))
+            if transport_error and ends is not None and time.monotonic() >= ends:
+                if breaker is not None:
+                    breaker.record_inconclusive()
+                raise UpstreamUnavailable('Request deadline exceeded') from exc
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        if breaker is not None:
+            if response.status_code in SERVER_ERRORS:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        return response
+
+    @staticmethod
+    def _is_rate_limited(response) -> bool:
+        return response.status_code in (403, 429) and (
+            response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers)
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        if response.headers.get('Retry-After'):
+            return float(response.headers['Retry-After'])
+        if response.headers.get('X-RateLimit-Reset'):
+            return max(float(response.headers['X-RateLimit-Reset']) - time.time(), 0)
+        return None
+
+    @staticmethod
+    def _parse_result(result: Dict) -> Tuple[Optional[List[Dict]], Optional[Dict]]:
         assert 'errors' in result or 'data' in result, 'Received non-compatible response "{}"'.format(result)
         return result.get('errors'), result.get('data')
 
 
 class StatsGateway(GithubGraphQLGateway, BaseStatsGateway):
+    repositories_fields = 'repositories(first: 1, orderBy: {field: STARGAZERS, direction: DESC}) { nodes { name ' \
+                          'stargazers { totalCount}} totalCount}'
+    document = 'query($org_name:String!) { organization(login: $org_name) { ' + repositories_fields + '} ' + \
+               RATE_LIMIT_FIELDS + '}'
+    # Oldest first, so a scan can be continued later to visit only new repositories
+    repositories_page_document = 'query($org_name: String!, $after: String) { organization(login: $org_name) { ' \
+                                 'repositories(first: 100, after: $after, orderBy: {field: CREATED_AT, direction: ' \
+                                 'ASC}) { totalCount pageInfo { endCursor hasNextPage } nodes { name stargazers ' \
+                                 '{ totalCount}}}} ' + RATE_LIMIT_FIELDS + '}'
+
     @classmethod
     def organization_stats(cls, name: str) -> OrganizationStats:
-        document = 'query($org_name:String!) { organization(login: $org_name) { repositories(first: 1, orderBy: {' \
-                   'field: STARGAZERS, direction: DESC}) { nodes { name stargazers { totalCount}} totalCount}}}'
-        result = cls.execute(document, {"org_name": name})['organization']['repositories']
-        chubby_repo = Repository(result['nodes'][0]['name'], result['nodes'][0]['stargazers']['totalCount'])
-        return OrganizationStats(result['totalCount'], chubby_repo)
+        """Fetch the organization, batched with the lookups of other
+        organizations made concurrently when micro-batching is enabled.
+        """
+        batcher = current_app.extensions.get('stats_batcher')
+        if batcher is not None:
+            return batcher.load(name, cls.organization_stats_many)
+        result = cls.execute(cls.document, {"org_name": name})['organization']['repositories']
+        return cls._build_organization_stats(result)
+
+    @classmethod
+    def organization_repositories_pages(cls, name: str, after: Optional[str] = None
+                                        ) -> Iterator[Tuple[List[Repository], int, Optional[str]]]:
+        """Yield the organization repositories page by page, starting after the
+        `after` cursor, with the repositories count and the page cursor.
+        """
+        trusted = Repository.trusted
+        while True:
+            result = cls.execute(cls.repositories_page_document, {"org_name": name, "after": after})
+            result = result['organization']['repositories']
+            page_info = result['pageInfo']
+            repositories = [trusted(n['name'], n['stargazers']['totalCount']) for n in result['nodes']]
+            yield repositories, result['totalCount'], page_info['endCursor']
+            if not page_info['hasNextPage']:
+                return
+            after = page_info['endCursor']
+
+    @classmethod
+    def organization_stats_many(cls, names: List[str]) -> Dict[str, Union[OrganizationStats, Exception]]:
+        """Fetch many organizations packing them, as aliased fields, in as few
+        GraphQL documents as `GITHUB_BATCH_SIZE` allows. Errors of a single
+        organization, such as DoesNotExist, are returned as its result.
+        """
+        results = {}
+        for batch in cls._batches(names, current_app.config['GITHUB_BATCH_SIZE']):
+            document, aliases = cls._batch_document(batch)
+            errors, data = cls._get_result(document, aliases)
+            results.update(cls._build_batch_results(aliases, errors, data))
+        return results
+
+    @staticmethod
+    def _batches(names: List[str], batch_size: int) -> List[List[str]]:
+        return [names[start:start + batch_size] for start in range(0, len(names), batch_size)]
+
+    @classmethod
+    def _batch_document(cls, names: List[str]) -> Tuple[str, Dict[str, str]]:
+        aliases = {'org{}'.format(i): name for i, name in enumerate(names)}
+        document = 'query({}) {{ {} {} }}'.format(
+            ', '.join('${}:String!'.format(alias) for alias in aliases),
+            ' '.join('{0}: organization(login: ${0}) {{ {1}}}'.format(alias, cls.repositories_fields)
+                     for alias in aliases), RATE_LIMIT_FIELDS)
+        return document, aliases
+
+    @classmethod
+    def _build_batch_results(cls, aliases: Dict[str, str], errors: Optional[List[Dict]],
+                             data: Optional[Dict]) -> Dict[str, Union[OrganizationStats, Exception]]:
+        results = {}
+        for error in errors or []:
+            alias = (error.get('path') or [None])[0]
+            if alias not in aliases:
+                raise Exception(str(error.get('message')))
+            # Only the organization of the alias failed, e.g. forbidden by its SAML enforcement
+            error_class = DoesNotExist if error.get('type') == 'NOT_FOUND' else Exception
+            results.setdefault(aliases[alias], error_class(str(error.get('message'))))
+        for alias, name in aliases.items():
+            if name not in results:
+                results[name] = cls._build_organization_stats(data[alias]['repositories'])
+        return results
+
+    @staticmethod
+    def _build_organization_stats(result: Dict) -> OrganizationStats:
+        # Github GraphQL schema already guarantees the types checked by the entity validators
+        nodes = result['nodes']
+        chubby_repo = Repository.trusted(nodes[0]['name'], nodes[0]['stargazers']['totalCount']) if nodes \
+            else NO_REPOSITORY
+        return OrganizationStats.trusted(result['totalCount'], chubby_repo)
 
 
 class RepositoryGateway(GithubGraphQLGateway, BaseRepositoryGateway):
+    document = 'query($limit: Int!) { search(type: REPOSITORY, query: "stars:>1", first: $limit) { edges { node ' \
+               '{ ... on Repository { name stargazers { totalCount}}}}} ' + RATE_LIMIT_FIELDS + '}'
+    page_document = 'query($limit: Int!, $after: String) { search(type: REPOSITORY, query: "stars:>1", ' \
+                    'first: $limit, after: $after) { pageInfo { endCursor hasNextPage } edges { node ' \
+                    '{ ... on Repository { name owner { login } stargazers { totalCount}}}}} ' + RATE_LIMIT_FIELDS + '}'
+    # Github search returns at most 100 nodes per page
+    page_size = 100
+
+    @classmethod
+    def chubbiest_repositories(cls, limit: int) -> Iterable[Repository]:
+        """Return the `limit` most starred repositories. Limits bigger than a
+        page are paginated lazily: the first page is fetched right away, so
+        errors are raised here, and the following ones while iterating.
+        """
+        if limit <= cls.page_size:
+            return cls._build_repositories(cls.execute(cls.document, {"limit": limit}))
+        repositories, cursor = cls.chubbiest_repositories_page(cls.page_size)
+        return cls._iter_chubbiest_repositories(limit, repositories, cursor)
+
+    @classmethod
+    def chubbiest_repositories_page(cls, first: int, after: Optional[str] = None
+                                    ) -> Tuple[List[Repository], Optional[str]]:
+        """Return a page of repositories and the cursor of the next one, if any."""
+        result = cls.execute(cls.page_document, {"limit": first, "after": after})
+        page_info = result['search']['pageInfo']
+        return cls._build_repositories(result), page_info['endCursor'] if page_info['hasNextPage'] else None
+
+    @classmethod
+    def chubbiest_owned_repositories(cls, limit: int) -> List[Tuple[Optional[str], Repository]]:
+        owned, cursor = [], None
+        while len(owned) < limit:
+            result = cls.execute(cls.page_document, {"limit": min(cls.page_size, limit - len(owned)), "after": cursor})
+            owners = [edge['node']['owner']['login'] for edge in result['search']['edges']]
+            owned.extend(zip(owners, cls._build_repositories(result)))
+            page_info = result['search']['pageInfo']
+            if not page_info['hasNextPage']:
+                break
+            cursor = page_info['endCursor']
+        return owned
+
     @classmethod
-    def chubbiest_repositories(cls, limit: int) -> List[Repository]:
-        document = 'query($limit: Int!) { search(type: REPOSITORY, query: "stars:>1", first: $limit) { edges { node ' \
-                   '{ ... on Repository { name stargazers { totalCount}}}}}}'
-        result = cls.execute(document, {"limit": limit})
-        return [Repository(r['node']['name'], r['node']['stargazers']['totalCount']) for r in result['search']['edges']]
+    def _iter_chubbiest_repositories(cls, limit: int, repositories: List[Repository],
+                                     cursor: Optional[str]) -> Iterator[Repository]:
+        app = current_app._get_current_object()
+
+        def fetch_page(first, after):
+            with app.app_context():
+                return cls.chubbiest_repositories_page(first, after)
+
+        remaining = limit
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                repositories = repositories[:remaining]
+                remaining -= len(repositories)
+                next_page = None
+                if cursor is not None and remaining > 0:
+                    # Prefetch the next page while the current one is consumed
+                    # Within the context of the request, for its deadline, priority and trace
+                    next_page = executor.submit(contextvars.copy_context().run, fetch_page,
+                                                min(cls.page_size, remaining), cursor)
+                yield from repositories
+                if next_page is None:
+                    return
+                repositories, cursor = next_page.result()
+
+    @staticmethod
+    def _build_repositories(result: Dict) -> List[Repository]:
+        trusted = Repository.trusted
+        return [trusted(r['node']['name'], r['node']['stargazers']['totalCount']) for r in result['search']['edges']]
+
+
+class AsyncGithubGraphQLGateway:
+    """Base class for all Github based gateways running on asyncio."""
+
+    def __init__(self, client, config: Mapping, single_flight: Optional[AsyncSingleFlight] = None,
+                 scheduler: Optional[UpstreamScheduler] = None):
+        self.client = client
+        self.config = config
+        self.single_flight = single_flight
+        self.scheduler = scheduler if scheduler is not None else UpstreamScheduler.from_config(config)
+
+    async def execute(self, document, variable_values=None):
+        if self.single_flight is None:
+            return await self._execute(document, variable_values)
+        return await self.single_flight.do(self.single_flight.key(document, variable_values),
+                                           lambda: self._execute(document, variable_values))
+
+    async def _execute(self, document, variable_values=None):
+        errors, data = await self._get_result(document, variable_values)
+        GithubGraphQLGateway._raise_for_errors(errors)
+        return data
+
+    async def _get_result(self, document, variable_values=None):
+        payload = {
+            'query': document,
+            'variables': variable_values or {}
+        }
+        # When Github rejects a token for its rate limit, rotate to the next one
+        for _ in self.scheduler.tokens:
+            token = await self.scheduler.acquire_async()
+            response = await self._post(payload, token.token)
+            if not GithubGraphQLGateway._is_rate_limited(response):
+                break
+            self.scheduler.exhaust(token, GithubGraphQLGateway._retry_after(response))
+        else:
+            raise RateLimitExceeded('Github rate limit exhausted', GithubGraphQLGateway._retry_after(response) or 60)
+        self.scheduler.update(token, response.headers)
+        response.raise_for_status()
+        errors, data = GithubGraphQLGateway._parse_result(response.json())
+        if isinstance(data, dict) and data.get('rateLimit'):
+            self.scheduler.update(token, rate_limit=data['rateLimit'])
+        return errors, data
+
+    async def _post(self, payload: Dict, token: Optional[str]):
+        retries, attempt = self.config['GITHUB_RETRIES'], 0
+        # The last attempt returns
+        while True:
+            response = await self.client.post(self.config['GITHUB_GRAPHQL_URL'], json=payload,
+                                              auth=('token', token or ''))
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            await asyncio.sleep(self.config['GITHUB_RETRY_BACKOFF'] * 2 ** attempt)
+            attempt += 1
+
+
+class AsyncStatsGateway(AsyncGithubGraphQLGateway, BaseAsyncStatsGateway):
+    def __init__(self, client, config: Mapping, single_flight: Optional[AsyncSingleFlight] = None,
+                 batcher: Optional[AsyncMicroBatcher] = None, scheduler: Optional[UpstreamScheduler] = None):
+        super().__init__(client, config, single_flight, scheduler)
+        self.batcher = batcher
+
+    async def organization_stats(self, name: str) -> OrganizationStats:
+        if self.batcher is not None:
+            return await self.batcher.load(name, self.organization_stats_many)
+        result = (await self.execute(StatsGateway.document, {"org_name": name}))['organization']['repositories']
+        return StatsGateway._build_organization_stats(result)
+
+    async def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, Exception]]:
+        """Fetch many organizations as aliased fields, sending every batch concurrently."""
+        batches = StatsGateway._batches(names, self.config['GITHUB_BATCH_SIZE'])
+        results = {}
+        for batch_results in await asyncio.gather(*[self._organization_stats_batch(batch) for batch in batches]):
+            results.update(batch_results)
+        return results
+
+    async def _organization_stats_batch(self, names: List[str]) -> Dict[str, Union[OrganizationStats, Exception]]:
+        document, aliases = StatsGateway._batch_document(names)
+        errors, data = await self._get_result(document, aliases)
+        return StatsGateway._build_batch_results(aliases, errors, data)
+
+
+class AsyncRepositoryGateway(AsyncGithubGraphQLGateway, BaseAsyncRepositoryGateway):
+    async def chubbiest_repositories(self, limit: int) -> List[Repository]:
+        """Return the `limit` most starred repositories, page by page past
+        the Github page size.
+        """
+        page_size = RepositoryGateway.page_size
+        if limit <= page_size:
+            result = await self.execute(RepositoryGateway.document, {"limit": limit})
+            return RepositoryGateway._build_repositories(result)
+        repositories, cursor = [], None
+        while len(repositories) < limit:
+            result = await self.execute(RepositoryGateway.page_document,
+                                        {"limit": min(page_size, limit - len(repositories)), "after": cursor})
+            repositories.extend(RepositoryGateway._build_repositories(result))
+            page_info = result['search']['pageInfo']
+            if not page_info['hasNextPage']:
+                break
+            cursor = page_info['endCursor']
+        return repositories[:limit]
+
+
+class CachedStatsGateway(BaseStatsGateway):
+    """Serve organization stats from the shared cache, falling back to the
+    wrapped gateway. With a `stale_ttl`, stats are also served up to that many
+    seconds after they expired while the wrapped gateway is unavailable, and
+    otherwise its own fallback, if any, neither of them cached again. With
+    an `adaptive_ttl`, every organization gets its own TTL, `ttl` being only
+    the first one. Stats fetched are taken as just fetched upstream and
+    observed by it, unless `observe_fetches` is off for wrapped gateways
+    observing the stats they fetch themselves, such as PersistentStatsGateway.
+    """
+
+    def __init__(self, gateway: BaseStatsGateway, cache: BaseCache, ttl: int, stale_ttl: int = 0,
+                 adaptive_ttl: Optional[AdaptiveTTL] = None, observe_fetches: bool = True):
+        self.gateway = gateway
+        self.cache = cache
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.adaptive_ttl = adaptive_ttl
+        self.observe_fetches = observe_fetches
+
+    @staticmethod
+    def cache_key(name: str) -> str:
+        # Github logins are case insensitive
+        return 'organization_stats:{}'.format(name.lower())
+
+    @staticmethod
+    def stale_cache_key(name: str) -> str:
+        return 'organization_stats_stale:{}'.format(name.lower())
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        cached = self.cache.get(self.cache_key(name))
+        metrics.CACHE_REQUESTS.inc('organization_stats', 'miss' if cached is None else 'hit')
+        if cached is not None:
+            return OrganizationStats.from_dict(json.loads(cached))
+        try:
+            organization_stats = self.gateway.organization_stats(name)
+        except UpstreamUnavailable as exc:
+            stale = self._stale(name)
+            if stale is not None:
+                return stale
+            if exc.fallback is None:
+                raise
+            return exc.fallback
+        self._set(name, organization_stats)
+        return organization_stats
+
+    def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, DoesNotExist]]:
+        results, missing = {}, []
+        for name in names:
+            cached = self.cache.get(self.cache_key(name))
+            metrics.CACHE_REQUESTS.inc('organization_stats', 'miss' if cached is None else 'hit')
+            if cached is not None:
+                results[name] = OrganizationStats.from_dict(json.loads(cached))
+            else:
+                missing.append(name)
+        if missing:
+            try:
+                fetched = self.gateway.organization_stats_many(missing)
+            except UpstreamUnavailable:
+                stale = {name: self._stale(name) for name in missing}
+                if None in stale.values():
+                    raise
+                results.update(stale)
+                return results
+            for name, result in fetched.items():
+                if isinstance(result, OrganizationStats):
+                    self._set(name, result)
+                results[name] = result
+        return results
+
+    def cached(self, name: str) -> Optional[OrganizationStats]:
+        """Return the cached stats, None when not cached. Never calls the wrapped gateway."""
+        cached = self.cache.get(self.cache_key(name))
+        return None if cached is None else OrganizationStats.from_dict(json.loads(cached))
+
+    def update(self, name: str, organization_stats: OrganizationStats):
+        """Replace the cached stats, e.g. with stats known to have changed
+        upstream, until the TTL of the last fetch expires.
+        """
+        self._set(name, organization_stats, fetched=False)
+
+    def invalidate(self, name: str):
+        self.cache.delete(self.cache_key(name))
+        self.cache.delete(self.stale_cache_key(name))
+
+    def _set(self, name: str, organization_stats: OrganizationStats, fetched: bool = True):
+        value = organization_stats.asdict()
+        ttl = self.ttl
+        if self.adaptive_ttl is not None:
+            if fetched and self.observe_fetches:
+                ttl = self.adaptive_ttl.ttl(name.lower(), value, self.ttl)
+            else:
+                ttl = self.adaptive_ttl.remaining(name.lower(), self.ttl)
+        elif not fetched:
+            ttl = self._remaining(name)
+        # Kept along the stats, for updates to keep the TTL left
+        value = json.dumps(dict(value, expires_at=time.time() + ttl))
+        if ttl > 0:
+            self.cache.set(self.cache_key(name), value, ttl)
+        if self.stale_ttl:
+            self.cache.set(self.stale_cache_key(name), value, max(ttl, 0) + self.stale_ttl)
+
+    def _remaining(self, name: str) -> int:
+        """Return the seconds left until the cached stats expire, the full TTL
+        when not cached, or cached before expiries were kept along.
+        """
+        cached = self.cache.get(self.cache_key(name))
+        expires_at = None if cached is None else json.loads(cached).get('expires_at')
+        return self.ttl if expires_at is None else round(expires_at - time.time())
+
+    def _stale(self, name: str) -> Optional[OrganizationStats]:
+        if not self.stale_ttl:
+            return None
+        cached = self.cache.get(self.stale_cache_key(name))
+        metrics.CACHE_REQUESTS.inc('organization_stats_stale', 'miss' if cached is None else 'hit')
+        return None if cached is None else OrganizationStats.from_dict(json.loads(cached))
+
+
+class NotFoundCachedStatsGateway(BaseStatsGateway):
+    """Remember for `ttl` seconds the organizations the wrapped gateway didn't
+    find, answering DoesNotExist for them without asking it again.
+
+    They are remembered in a bounded cache of the worker, so made up names
+    can't fill the shared cache. `forget` drops an organization as soon as it
+    is known to exist: with a `shared_cache` it also bumps the organization
+    generation there, and every worker drops the entries remembered with an
+    older one.
+    """
+
+    def __init__(self, gateway: BaseStatsGateway, cache: BaseCache, ttl: int, shared_cache: Optional[BaseCache] = None):
+        self.gateway = gateway
+        self.cache = cache
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+
+    @staticmethod
+    def cache_key(name: str) -> str:
+        return 'organization_not_found:{}'.format(name.lower())
+
+    @staticmethod
+    def generation_key(name: str) -> str:
+        return 'organization_not_found_generation:{}'.format(name.lower())
+
+    def forget(self, name: str):
+        self.cache.delete(self.cache_key(name))
+        if self.shared_cache is not None:
+            # Only needed while other workers may still remember it
+            self.shared_cache.set(self.generation_key(name), uuid.uuid4().hex, self.ttl)
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        generation = self._raise_if_not_found(name)
+        try:
+            return self.gateway.organization_stats(name)
+        except DoesNotExist as exc:
+            self._remember(name, exc, generation)
+            raise
+
+    def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, Exception]]:
+        results, missing, generations = {}, [], {}
+        for name in names:
+            try:
+                generations[name] = self._raise_if_not_found(name)
+                missing.append(name)
+            except DoesNotExist as exc:
+                results[name] = exc
+        if missing:
+            for name, result in self.gateway.organization_stats_many(missing).items():
+                if isinstance(result, DoesNotExist):
+                    self._remember(name, result, generations.get(name))
+                results[name] = result
+        return results
+
+    def _generation(self, name: str) -> Optional[str]:
+        return None if self.shared_cache is None else self.shared_cache.get(self.generation_key(name))
+
+    def _remember(self, name: str, exc: DoesNotExist, generation: Optional[str]):
+        # With the generation read before asking, a forget meanwhile isn't missed
+        self.cache.set(self.cache_key(name), json.dumps([generation, str(exc)]), self.ttl)
+
+    def _raise_if_not_found(self, name: str) -> Optional[str]:
+        """Raise DoesNotExist when remembered, otherwise return the current generation."""
+        cached = self.cache.get(self.cache_key(name))
+        generation = self._generation(name)
+        if cached is not None:
+            cached_generation, message = json.loads(cached)
+            if cached_generation == generation:
+                metrics.CACHE_REQUESTS.inc('organization_not_found', 'hit')
+                raise DoesNotExist(message)
+            self.cache.delete(self.cache_key(name))
+        metrics.CACHE_REQUESTS.inc('organization_not_found', 'miss')
+        return generation
+
+
+class CachedRepositoryGateway(BaseRepositoryGateway):
+    """Serve chubbiest repositories from the shared cache, falling back to the wrapped gateway.
+
+    A single ranked list is cached, with the cursor where it ends, and every
+    limit up to its length is answered slicing it. Bigger limits extend it,
+    fetching whole pages from the cursor, so every limit shares the same
+    upstream queries until it expires `ttl` seconds after its first page, or
+    as long as `adaptive_ttl` tells from the changes of that page.
+    """
+
+    cache_key = 'chubbiest_repositories'
+
+    def __init__(self, gateway: BaseRepositoryGateway, cache: BaseCache, ttl: int, page_size: int = 100,
+                 adaptive_ttl: Optional[AdaptiveTTL] = None):
+        self.gateway = gateway
+        self.cache = cache
+        self.ttl = ttl
+        self.page_size = page_size
+        self.adaptive_ttl = adaptive_ttl
+
+    def chubbiest_repositories(self, limit: int) -> Iterable[Repository]:
+        cached = self.cache.get(self.cache_key)
+        if cached is None:
+            metrics.CACHE_REQUESTS.inc('chubbiest_repositories', 'miss')
+            return self._extend(limit, [], None, time.time(), self.ttl)
+        cached = json.loads(cached)
+        repositories = [Repository.from_dict(r) for r in cached['repositories']]
+        if len(repositories) >= limit or cached['cursor'] is None:
+            metrics.CACHE_REQUESTS.inc('chubbiest_repositories', 'hit')
+            return repositories[:limit]
+        metrics.CACHE_REQUESTS.inc('chubbiest_repositories', 'partial')
+        return self._extend(limit, repositories, cached['cursor'], cached['fetched_at'], cached.get('ttl', self.ttl))
+
+    def chubbiest_repositories_page(self, first: int, after: Optional[str] = None
+                                    ) -> Tuple[List[Repository], Optional[str]]:
+        return self.gateway.chubbiest_repositories_page(first, after)
+
+    def _extend(self, limit: int, repositories: List[Repository], cursor: Optional[str],
+                fetched_at: float, ttl: int) -> Iterable[Repository]:
+        """Fetch the next page right away, so errors are raised here, and the
+        following ones, if needed, while iterating.
+        """
+        page, next_cursor = self.gateway.chubbiest_repositories_page(self.page_size, cursor)
+        if cursor is None and self.adaptive_ttl is not None:
+            ttl = self.adaptive_ttl.ttl('top', [[r.name, r.stars] for r in page], self.ttl, fetched_at)
+        repositories, cursor = repositories + page, next_cursor
+        if len(repositories) >= limit or cursor is None:
+            self._set(repositories, cursor, fetched_at, ttl)
+            return repositories[:limit]
+        return self._iter_extended(limit, repositories, cursor, fetched_at, ttl)
+
+    def _iter_extended(self, limit: int, repositories: List[Repository], cursor: Optional[str],
+                       fetched_at: float, ttl: int) -> Iterator[Repository]:
+        yield from repositories
+        while len(repositories) < limit and cursor is not None:
+            page, cursor = self.gateway.chubbiest_repositories_page(self.page_size, cursor)
+            yield from page[:limit - len(repositories)]
+            # The whole page is cached, so the list still ends where the cursor points
+            repositories = repositories + page
+        self._set(repositories, cursor, fetched_at, ttl)
+
+    def _set(self, repositories: List[Repository], cursor: Optional[str], fetched_at: float, ttl: int):
+        remaining = int(fetched_at + ttl - time.time())
+        if remaining <= 0:
+            return
+        value = {'repositories': [r.asdict() for r in repositories], 'cursor': cursor, 'fetched_at': fetched_at,
+                 'ttl': ttl}
+        self.cache.set(self.cache_key, json.dumps(value), remaining)
+
+
+class PersistentStatsGateway(BaseStatsGateway, StatsHistoryGateway):
+    """Record every organization stats fetched by the wrapped gateway in the
+    snapshot store, and serve the latest snapshot while younger than `max_age`
+    seconds. Older ones are only the fallback of UpstreamUnavailable while the
+    wrapped gateway is unavailable.
+    Latest snapshots of up to `memory_size` organizations are also kept in
+    memory, starting with the hottest ones on `warm_start`. With an
+    `adaptive_ttl`, every stats fetched is observed by it with its fetch time,
+    and snapshots are only served within the TTL of their organization.
+    """
+
+    def __init__(self, gateway: BaseStatsGateway, store: SnapshotStore, max_age: float, memory_size: int = 1000,
+                 adaptive_ttl: Optional[AdaptiveTTL] = None):
+        self.gateway = gateway
+        self.store = store
+        self.max_age = max_age
+        self.memory_size = memory_size
+        self.adaptive_ttl = adaptive_ttl
+        self._memory = OrderedDict()  # type: Dict[str, OrganizationStatsSnapshot]
+        self._lock = threading.Lock()
+
+    def warm_start(self, window: float) -> int:
+        """Load the latest snapshots of the organizations fetched more often in
+        the last `window` seconds and return how many.
+        """
+        hottest = self.store.hottest(self.memory_size, time.time() - window)
+        for name, snapshot in reversed(hottest):
+            self._remember(name, snapshot)
+        return len(hottest)
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        snapshot = self._fresh_snapshot(name)
+        if snapshot is not None:
+            return snapshot.organization_stats
+        try:
+            organization_stats = self.gateway.organization_stats(name)
+        except UpstreamUnavailable as exc:
+            snapshot = self.store.latest(name)
+            if snapshot is None:
+                raise
+            metrics.CACHE_REQUESTS.inc('organization_stats_snapshot', 'stale')
+            raise UpstreamUnavailable(str(exc), exc.retry_after, snapshot.organization_stats) from exc
+        self._fetched(name, self.store.record(name, organization_stats))
+        return organization_stats
+
+    def organization_stats_many(self, names: List[str]) -> Dict[str, Union[OrganizationStats, DoesNotExist]]:
+        results, missing = {}, []
+        for name in names:
+            snapshot = self._fresh_snapshot(name)
+            if snapshot is not None:
+                results[name] = snapshot.organization_stats
+            else:
+                missing.append(name)
+        if missing:
+            fetched = self.gateway.organization_stats_many(missing)
+            found = [(name, result) for name, result in fetched.items() if isinstance(result, OrganizationStats)]
+            for (name, _), snapshot in zip(found, self.store.record_many(found)):
+                self._fetched(name, snapshot)
+            results.update(fetched)
+        return results
+
+    def record(self, name: str, organization_stats: OrganizationStats):
+        """Record stats known to be current, e.g. adjusted after a change upstream."""
+        self._remember(name, self.store.record(name, organization_stats))
+
+    def organization_stats_history(self, name: str, limit: int) -> List[OrganizationStatsSnapshot]:
+        snapshots = self.store.history(name, limit)
+        if not snapshots:
+            raise DoesNotExist('No stats recorded for organization {}'.format(name))
+        return snapshots
+
+    def _fresh_snapshot(self, name: str) -> Optional[OrganizationStatsSnapshot]:
+        with self._lock:
+            snapshot = self._memory.get(self.store.key(name))
+        if snapshot is None or self._is_stale(name, snapshot):
+            # Maybe recorded by another worker or before a restart
+            snapshot = self.store.latest(name)
+            if snapshot is None or self._is_stale(name, snapshot):
+                metrics.CACHE_REQUESTS.inc('organization_stats_snapshot', 'miss')
+                return None
+            self._remember(name, snapshot)
+        metrics.CACHE_REQUESTS.inc('organization_stats_snapshot', 'hit')
+        return snapshot
+
+    def _is_stale(self, name: str, snapshot: OrganizationStatsSnapshot) -> bool:
+        if time.time() - snapshot.fetched_at > self.max_age:
+            return True
+        if self.adaptive_ttl is None:
+            return False
+        # A no-op unless fetched by another worker, or before the adaptive TTL state expired
+        self._observe(name, snapshot)
+        return self.adaptive_ttl.remaining(self.store.key(name), self.max_age) <= 0
+
+    def _fetched(self, name: str, snapshot: OrganizationStatsSnapshot):
+        self._remember(name, snapshot)
+        if self.adaptive_ttl is not None:
+            self._observe(name, snapshot)
+
+    def _observe(self, name: str, snapshot: OrganizationStatsSnapshot):
+        self.adaptive_ttl.observe(self.store.key(name), snapshot.organization_stats.asdict(), self.max_age,
+                                  snapshot.fetched_at)
+
+    def _remember(self, name: str, snapshot: OrganizationStatsSnapshot):
+        key = self.store.key(name)
+        with self._lock:
+            self._memory[key] = snapshot
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+
+class AggregateStatsGateway(BaseAggregateStatsGateway):
+    """Aggregate every repository of an organization, streaming its pages.
+
+    Aggregates are kept in the shared cache and served for `ttl` seconds.
+    After that they are refreshed incrementally, scanning only the repositories
+    created since, until they are `rescan_interval` seconds old and a full scan
+    catches up with stars changes and deleted repositories. Scans are saved
+    after every page, unfinished ones are never served and are continued by
+    the next request.
+    """
+
+    def __init__(self, gateway: StatsGateway, cache: BaseCache, ttl: int, rescan_interval: int, top_k: int = 10,
+                 relative_accuracy: float = 0.01, percentiles: Sequence[int] = (50, 90, 99),
+                 single_flight: Optional[SingleFlight] = None):
+        self.gateway = gateway
+        self.cache = cache
+        self.ttl = ttl
+        self.rescan_interval = rescan_interval
+        self.top_k = top_k
+        self.relative_accuracy = relative_accuracy
+        self.percentiles = percentiles
+        self.single_flight = single_flight
+
+    @staticmethod
+    def cache_key(name: str) -> str:
+        return 'organization_aggregate:{}'.format(name.lower())
+
+    def organization_aggregate_stats(self, name: str) -> OrganizationAggregateStats:
+        cached = self.cache.get(self.cache_key(name))
+        metrics.CACHE_REQUESTS.inc('organization_aggregate', 'miss' if cached is None else 'hit')
+        aggregate = OrganizationAggregate.from_dict(json.loads(cached)) if cached is not None else None
+        if aggregate is not None and aggregate.updated_at and time.time() - aggregate.updated_at <= self.ttl:
+            return aggregate.organization_aggregate_stats()
+        if self.single_flight is None:
+            state = self._refresh(name, aggregate)
+        else:
+            # Scans can take many pages, concurrent requests wait for the same one
+            state = self.single_flight.do(self.cache_key(name), lambda: self._refresh(name, aggregate))
+        return OrganizationAggregate.from_dict(state).organization_aggregate_stats()
+
+    def _refresh(self, name: str, aggregate: Optional[OrganizationAggregate]) -> Dict:
+        now = time.time()
+        if aggregate is None or now - aggregate.full_scan_at > self.rescan_interval:
+            aggregate = OrganizationAggregate(self.top_k, self.relative_accuracy, self.percentiles)
+            aggregate.full_scan_at = now
+        for repositories, total_count, cursor in self.gateway.organization_repositories_pages(name, aggregate.cursor):
+            aggregate.update(repositories, total_count, cursor)
+            # Saved after every page, a scan cut short by the request deadline is
+            # continued from its cursor by the next request instead of restarting
+            self.cache.set(self.cache_key(name), json.dumps(aggregate.to_dict()), self.rescan_interval)
+        aggregate.updated_at = now
+        state = aggregate.to_dict()
+        self.cache.set(self.cache_key(name), json.dumps(state), self.rescan_interval)
+        return state
+
+
+class DatasetStatsGateway(BaseStatsGateway):
+    """Organization stats answered from the repositories dataset, without
+    calling Github.
+    """
+
+    def __init__(self, dataset: RepositoryDataset):
+        self.dataset = dataset
+
+    def organization_stats(self, name: str) -> OrganizationStats:
+        return self.dataset.organization_stats(name)
+
+
+class DatasetRepositoryGateway(BaseRepositoryGateway):
+    """Chubbiest repositories answered from the repositories dataset, without
+    calling Github. Cursors are offsets in its ranking.
+    """
+
+    def __init__(self, dataset: RepositoryDataset):
+        self.dataset = dataset
+
+    def chubbiest_repositories(self, limit: int) -> Iterable[Repository]:
+        return self.dataset.chubbiest_repositories(0, limit)
+
+    def chubbiest_repositories_page(self, first: int, after: Optional[str] = None
+                                    ) -> Tuple[List[Repository], Optional[str]]:
+        start = int(after or 0)
+        repositories = self.dataset.chubbiest_repositories(start, start + first)
+        return repositories, str(start + first) if start + first < len(self.dataset) else None
@@ -0,0 +1,215 @@
+"""Precomputed chubbiest repositories leaderboard.
+
+The chubbiest repositories only change slowly and are the same for every
+caller, so a snapshot of the top N repositories is kept in memory and any
+`limit` up to N is served by slicing it, without upstream calls on the request
+path. Snapshots are refreshed by the background thread of a single worker at
+a time or by the `flask refresh-leaderboard` command, and are published in the
+shared cache so every worker and replica can adopt the freshest one.
+
+Webhook edits, such as stars changes, are applied by the worker processing the
+event to the latest published snapshot and published again. The other workers
+poll the shared cache, so they adopt edits within `poll_interval` seconds.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from chubbyrepo.cache import BaseCache
+from chubbyrepo.core.entities import Repository
+from chubbyrepo.core.gateways import LeaderboardGateway, RepositoryGateway
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard(LeaderboardGateway):
+    """Snapshot of the `size` chubbiest repositories, served while younger
+    than `max_staleness` seconds.
+    """
+
+    cache_key = 'leaderboard'
+
+    def __init__(self, gateway: RepositoryGateway, size: int, max_staleness: float,
+                 cache: Optional[BaseCache] = None, poll_interval: float = 5):
+        self.gateway = gateway
+        self.size = size
+        self.max_staleness = max_staleness
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self._snapshot = None
+        self._polled_at = 0
+        self._refresher = None
+        self._refresher_pid = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def refresh(self) -> int:
+        """Fetch a new snapshot, publish it in the shared cache and return its size."""
+        owned = self.gateway.chubbiest_owned_repositories(self.size)
+        self._publish(time.time(), [r for _, r in owned], [o and o.lower() for o, _ in owned])
+        return len(owned)
+
+    def update_stars(self, owner: str, name: str, stars: int):
+        """Move a repository whose stars changed to its place in the snapshot.
+
+        The snapshot stays a right prefix of the ranking: a repository falling
+        below the last one is dropped, since repositories out of the snapshot
+        may be ahead of it, and one out of it only enters above the last one.
+        Repositories are matched by owner and name.
+        """
+        owner = owner.lower()
+        self._edit(name, lambda entries: self._moved(entries, owner, name, stars))
+
+    def remove(self, owner: str, name: str):
+        owner = owner.lower()
+        self._edit(name, lambda entries: [(o, r) for o, r in entries if (o, r.name) != (owner, name)])
+
+    def rename(self, owner: str, name: str, new_name: str, new_owner: Optional[str] = None):
+        """Rename a repository, or transfer it to `new_owner`."""
+        owner = owner.lower()
+        new_owner = owner if new_owner is None else new_owner.lower()
+        self._edit(name, lambda entries: [(new_owner, Repository.trusted(new_name, r.stars))
+                                          if (o, r.name) == (owner, name) else (o, r) for o, r in entries])
+
+    @staticmethod
+    def _moved(entries: List[Tuple[str, Repository]], owner: str, name: str,
+               stars: int) -> List[Tuple[str, Repository]]:
+        others = [(o, r) for o, r in entries if (o, r.name) != (owner, name)]
+        if not others or stars < others[-1][1].stars or (
+                len(others) == len(entries) and stars == others[-1][1].stars):
+            return others
+        position = next((i for i, (_, r) in enumerate(others) if r.stars < stars), len(others))
+        return others[:position] + [(owner, Repository.trusted(name, stars))] + others[position:]
+
+    def _edit(self, name: str, edit):
+        """Apply `edit` to the `(owner, repository)` entries of the fresh
+        snapshot, if any, keeping its age. The latest published snapshot is
+        edited, so edits of other workers are kept, and published again.
+        Edits are skipped when a repository named `name` has no known owner,
+        as it may be the one edited.
+        """
+        with self._lock:
+            snapshot = (self.cache is not None and self._adopt()) or self._fresh_snapshot()
+            if snapshot is None:
+                return
+            fetched_at, repositories, owners = snapshot
+            if any(o is None and r.name == name for o, r in zip(owners, repositories)):
+                return
+            entries = edit(list(zip(owners, repositories)))[:self.size]
+            self._publish(fetched_at, [r for _, r in entries], [o for o, _ in entries])
+
+    def _publish(self, fetched_at: float, repositories: List[Repository], owners: List[Optional[str]]):
+        self._snapshot = fetched_at, repositories, owners
+        ttl = int(fetched_at + self.max_staleness - time.time())
+        if self.cache is not None and ttl > 0:
+            value = {'fetched_at': fetched_at, 'repositories': [r.asdict() for r in repositories], 'owners': owners}
+            self.cache.set(self.cache_key, json.dumps(value), ttl)
+
+    def chubbiest_repositories_snapshot(self, limit: int) -> Optional[Tuple[List[Repository], float]]:
+        snapshot = self._fresh_snapshot()
+        if snapshot is None:
+            return None
+        fetched_at, repositories, _ = snapshot
+        if limit > len(repositories):
+            return None
+        return repositories[:limit], time.time() - fetched_at
+
+    def _fresh_snapshot(self) -> Optional[Tuple[float, List[Repository], List[Optional[str]]]]:
+        snapshot = self._snapshot
+        if snapshot is not None and time.time() - snapshot[0] > self.max_staleness:
+            snapshot = None
+        if self.cache is None or time.monotonic() - self._polled_at < self.poll_interval:
+            return snapshot
+        # Polled even while fresh, for the edits published by other workers
+        return self._adopt() or snapshot
+
+    def _adopt(self) -> Optional[Tuple[float, List[Repository], List[Optional[str]]]]:
+        """Adopt the snapshot published by another worker or by the CLI
+        command, unless it is stale or older than the current one.
+        """
+        self._polled_at = time.monotonic()
+        cached = self.cache.get(self.cache_key)
+        if cached is None:
+            return None
+        cached = json.loads(cached)
+        if time.time() - cached['fetched_at'] > self.max_staleness:
+            return None
+        if self._snapshot is not None and cached['fetched_at'] < self._snapshot[0]:
+            return None
+        repositories = [Repository.from_dict(r) for r in cached['repositories']]
+        self._snapshot = cached['fetched_at'], repositories, cached.get('owners') or [None] * len(repositories)
+        return self._snapshot
+
+    def start_refresher(self, app, interval: float):
+        """Start, once per process, a daemon thread refreshing the snapshot
+        every `interval` seconds, unless another worker refreshed it since.
+        Safe to call on every request: threads don't survive forks, so it is
+        started again in forked workers.
+        """
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._stopped.clear()
+            self._refresher = threading.Thread(target=self._refresh_forever, args=(app, interval), daemon=True,
+                                               name='leaderboard-refresher')
+            self._refresher.start()
+            self._refresher_pid = os.getpid()
+
+    def stop_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                self._stopped.set()
+                self._refresher.join()
+                self._refresher, self._refresher_pid = None, None
+
+    def _refresh_forever(self, app, interval: float):
+        while True:
+            wait = interval
+            with app.app_context():
+                try:
+                    wait = self._refresh_in(interval)
+                    if wait <= 0:
+                        self.refresh()
+                        wait = interval
+                except Exception:
+                    logger.exception('Leaderboard refresh failed')
+            if self._stopped.wait(wait):
+                return
+
+    def _refresh_in(self, interval: float) -> float:
+        """Return the seconds until the snapshot shared by every worker is
+        `interval` seconds old, 0 when this worker is the one to refresh it.
+        """
+        snapshot = self._snapshot
+        if self.cache is not None and (snapshot is None or time.time() - snapshot[0] >= interval):
+            snapshot = self._adopt() or snapshot
+        if snapshot is not None and time.time() - snapshot[0] < interval:
+            return snapshot[0] + interval - time.time()
+        # Only one worker refreshes it, the others adopt it
+        if self.cache is not None and not self.cache.add(self.cache_key + ':refresh', '1', max(int(interval), 1)):
+            return interval
+        return 0
+
+
+@click.command('refresh-leaderboard')
+@click.option('--loop', is_flag=True, help='Keep refreshing every LEADERBOARD_REFRESH_INTERVAL seconds.')
+@with_appcontext
+def refresh_leaderboard_command(loop):
+    """Refresh the chubbiest repositories snapshot shared by every worker."""
+    leaderboard = current_app.extensions['container'].get('leaderboard')
+    if leaderboard is None:
+        raise click.ClickException('Leaderboard is disabled, see LEADERBOARD_ENABLED setting')
+    while True:
+        click.echo('Leaderboard refreshed with {} repositories'.format(leaderboard.refresh()))
+        if not loop:
+            return
+        time.sleep(current_app.config['LEADERBOARD_REFRESH_INTERVAL'])
@@ -0,0 +1,465 @@
+"""Prometheus style instrumentation exposed on `/metrics`.
+
+Metrics are recorded in per-thread shards, so observing a value never takes a
+lock, and shards are summed up when metrics are collected. Shards of finished
+threads are folded into the metric totals, so threads created per request
+don't pile up.
+
+Under a pre-forking server every worker has its own metrics. Setting
+`METRICS_MULTIPROC_DIR` to a directory shared by the workers makes each one
+flush its metrics there every `METRICS_FLUSH_INTERVAL` seconds, and `/metrics`
+aggregates the files of every worker. Counters and histograms of dead workers
+are folded into a file of their own, so totals never go back.
+"""
+import bisect
+import fcntl
+import glob
+import json
+import math
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from flask import Blueprint, Response, current_app, g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+BATCH_WAIT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+TTL_BUCKETS = (30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# How the samples of a family are merged across processes
+MERGES = {'sum': lambda total, value: total + value, 'max': max, 'min': min}
+
+
+class _ShardHolder:
+    """Lives in a thread local, it is released when its thread finishes."""
+
+    __slots__ = ('values', '__weakref__')
+
+    def __init__(self, values: Dict):
+        self.values = values
+
+
+class Metric:
+    """Base class for metrics with labels, recorded in per-thread shards."""
+
+    type = None  # type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # type: List[Dict]
+        self._retired = {}  # type: Dict
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict:
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._local.holder = _ShardHolder({})
+            with self._lock:
+                self._shards.append(holder.values)
+            weakref.finalize(holder, self._retire, holder.values)
+        return holder.values
+
+    def _retire(self, values: Dict):
+        with self._lock:
+            # By identity, shards of different threads may hold equal values
+            self._shards = [shard for shard in self._shards if shard is not values]
+            for key, value in values.items():
+                self._retired[key] = self._merge(self._retired.get(key), value)
+
+    def samples(self) -> Dict[Tuple[str, ...], object]:
+        """Return the value recorded for every combination of labels."""
+        with self._lock:
+            merged = dict(self._retired)
+            for shard in self._shards:
+                # Copying a dict is atomic, the owner thread may be writing to it
+                for key, value in dict(shard).items():
+                    merged[key] = self._merge(merged.get(key), value)
+        return merged
+
+    def _merge(self, total, value):
+        raise NotImplementedError
+
+    def _key(self, labelvalues: Sequence) -> Tuple[str, ...]:
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+        return tuple(str(v) for v in labelvalues)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1):
+        shard, key = self._shard(), self._key(labelvalues)
+        shard[key] = shard.get(key, 0) + amount
+
+    def _merge(self, total, value):
+        return (total or 0) + value
+
+
+class Histogram(Metric):
+    """Counts observations per bucket. Values are [bucket counts..., sum, count]."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        shard, key = self._shard(), self._key(labelvalues)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def _merge(self, total, value):
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+
+class Registry:
+    """Metrics exposed together, plus callbacks reading counters kept elsewhere."""
+
+    def __init__(self):
+        self._metrics = OrderedDict()  # type: Dict[str, Metric]
+        self._callbacks = OrderedDict()  # type: Dict[str, Tuple[str, str, Sequence[str], Callable, str]]
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def register_callback(self, name: str, documentation: str, labelnames: Sequence[str],
+                          callback: Callable[[], Dict[Tuple[str, ...], float]], type: str = 'counter',
+                          merge: str = 'sum'):
+        """Expose values returned by `callback` on each collection, merged
+        across processes as told by `merge`, one of `MERGES`. Registering an
+        existing name replaces its callback.
+        """
+        with self._lock:
+            self._callbacks[name] = (type, documentation, tuple(labelnames), callback, merge)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return every metric family with its samples, ready to be JSON encoded."""
+        with self._lock:
+            metrics, callbacks = list(self._metrics.values()), list(self._callbacks.items())
+        families = OrderedDict()
+        for metric in metrics:
+            families[metric.name] = {
+                'type': metric.type, 'help': metric.documentation, 'labelnames': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', [])), 'merge': 'sum',
+                'samples': [[list(key), value] for key, value in metric.samples().items()],
+            }
+        for name, (type, documentation, labelnames, callback, merge) in callbacks:
+            families[name] = {'type': type, 'help': documentation, 'labelnames': list(labelnames), 'buckets': [],
+                              'merge': merge, 'samples': [[list(key), value] for key, value in callback().items()]}
+        return families
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'chubbyrepo_http_requests_total', 'HTTP requests by endpoint and status code.', ['endpoint', 'status']))
+HTTP_REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'chubbyrepo_http_request_duration_seconds', 'Time to build HTTP responses by endpoint and status code.',
+    ['endpoint', 'status']))
+STREAM_ERRORS = REGISTRY.register(Counter(
+    'chubbyrepo_stream_errors_total', 'Streamed responses ended by an error after their status was sent, by endpoint '
+    'and error type.', ['endpoint', 'type']))
+INTERACTOR_LATENCY = REGISTRY.register(Histogram(
+    'chubbyrepo_interactor_duration_seconds', 'Interactor execute time by interactor and response type.',
+    ['interactor', 'type']))
+UPSTREAM_LATENCY = REGISTRY.register(Histogram(
+    'chubbyrepo_upstream_duration_seconds', 'Github GraphQL call time by gateway.', ['gateway']))
+UPSTREAM_RESPONSE_SIZE = REGISTRY.register(Histogram(
+    'chubbyrepo_upstream_response_bytes', 'Github GraphQL response payload size by gateway.', ['gateway'],
+    buckets=SIZE_BUCKETS))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    'chubbyrepo_upstream_errors_total', 'Failed Github GraphQL calls by gateway and reason.', ['gateway', 'reason']))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    'chubbyrepo_cache_requests_total', 'Cache lookups by cached resource and result.', ['resource', 'result']))
+CACHE_REFRESHES = REGISTRY.register(Counter(
+    'chubbyrepo_cache_refreshes_total', 'Values fetched again for the cache by resource and whether they changed since '
+    'their previous fetch.', ['resource', 'result']))
+CACHE_TTL = REGISTRY.register(Histogram(
+    'chubbyrepo_cache_ttl_seconds', 'Adaptive TTLs given to cached values by resource.', ['resource'],
+    buckets=TTL_BUCKETS))
+WEBHOOK_EVENTS = REGISTRY.register(Counter(
+    'chubbyrepo_webhook_events_total', 'Github webhook events by event and how they were handled.',
+    ['event', 'result']))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'chubbyrepo_batch_size', 'Keys loaded per micro-batch by batcher.', ['batcher'], buckets=BATCH_SIZE_BUCKETS))
+BATCH_WAIT = REGISTRY.register(Histogram(
+    'chubbyrepo_batch_wait_seconds', 'Time lookups waited for their micro-batch to be sent by batcher.', ['batcher'],
+    buckets=BATCH_WAIT_BUCKETS))
+
+
+def exposition(families: Dict[str, Dict]) -> str:
+    """Render metric families in the Prometheus text format."""
+    lines = []
+    for name, family in families.items():
+        lines.append('# HELP {} {}'.format(name, family['help']))
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+        labelnames = family['labelnames']
+        for labelvalues, value in sorted(family['samples']):
+            labels = list(zip(labelnames, labelvalues))
+            if family['type'] != 'histogram':
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + [math.inf], value[:-2]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', _number(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value[-2])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), _number(value[-1])))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, v in labels)
+    return '{' + ','.join('{}="{}"'.format(k, v) for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def aggregate(snapshots: List[Dict[str, Dict]]) -> Dict[str, Dict]:
+    """Merge snapshots of several processes. Histograms are summed bucket by
+    bucket, other families as told by their `merge`: counters and gauges of
+    work in progress are summed, gauges of budgets keep the lowest value and
+    gauges of states the highest, so a state any process is in shows up.
+    """
+    families = OrderedDict()
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            merged = families.setdefault(name, dict(family, samples={}))
+            for labelvalues, value in family['samples']:
+                key = tuple(labelvalues)
+                total = merged['samples'].get(key)
+                if total is None:
+                    merged['samples'][key] = value
+                elif family['type'] == 'histogram':
+                    merged['samples'][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    merged['samples'][key] = MERGES[family.get('merge', 'sum')](total, value)
+    for family in families.values():
+        family['samples'] = [[list(k), v] for k, v in family['samples'].items()]
+    return families
+
+
+class MultiprocessWriter:
+    """Flush this process metrics to `directory`, once per process, so they can
+    be aggregated by any worker. Files not flushed for `stale_intervals`
+    intervals by a process no longer running belong to workers gone, restarted
+    or dead: their counters and histograms are folded into the retired file,
+    since Prometheus would take lower totals for counter resets, and they are
+    deleted.
+    """
+
+    retired_name = 'retired_metrics.json'
+
+    def __init__(self, registry: Registry, directory: str, interval: float, stale_intervals: int = 3):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.stale_intervals = stale_intervals
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, 'metrics_{}.json'.format(os.getpid()))
+
+    @property
+    def retired_path(self) -> str:
+        return os.path.join(self.directory, self.retired_name)
+
+    def flush(self):
+        self._write(self.path, self.registry.snapshot())
+
+    @staticmethod
+    def _write(path: str, families: Dict[str, Dict]):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(families, f)
+        os.replace(tmp_path, path)
+
+    def start(self):
+        """Start the flushing thread, again in forked workers."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            threading.Thread(target=self._flush_forever, daemon=True, name='metrics-writer').start()
+            self._pid = os.getpid()
+
+    def _flush_forever(self):
+        while True:
+            self.flush()
+            time.sleep(self.interval)
+
+    def collect(self) -> Dict[str, Dict]:
+        self.flush()
+        snapshots = []
+        stale_before = time.time() - self.stale_intervals * self.interval
+        for path in sorted(glob.glob(os.path.join(self.directory, 'metrics_*.json'))):
+            try:
+                if os.path.getmtime(path) < stale_before and not _is_running(_pid_of(path)):
+                    self._retire(path)
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                # Retired meanwhile by another worker
+                continue
+        snapshots.append(self._retired())
+        return aggregate(snapshots)
+
+    def _retired(self) -> Dict[str, Dict]:
+        try:
+            with open(self.retired_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _retire(self, path: str):
+        """Fold the counters and histograms of the file into the retired file
+        and delete it, under a lock shared by every worker so it is done once.
+        """
+        with open(self.retired_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Raises FileNotFoundError when retired meanwhile by another worker
+            with open(path) as f:
+                families = json.load(f)
+            # Gauges of dead workers are dropped
+            totals = {name: family for name, family in families.items() if family['type'] in ('counter', 'histogram')}
+            self._write(self.retired_path, aggregate([self._retired(), totals]))
+            os.remove(path)
+
+
+def _pid_of(path: str) -> int:
+    return int(os.path.basename(path)[len('metrics_'):-len('.json')])
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        return True
+    return True
+
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose metrics in the Prometheus text format."""
+    writer = current_app.extensions['metrics_writer']
+    families = writer.collect() if writer is not None else REGISTRY.snapshot()
+    return Response(exposition(families), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """Record request metrics and serve `/metrics`, when `METRICS_ENABLED`."""
+    app.extensions['metrics_writer'] = None
+    if not app.config['METRICS_ENABLED']:
+        return
+    if app.config['METRICS_MULTIPROC_DIR']:
+        writer = app.extensions['metrics_writer'] = MultiprocessWriter(
+            REGISTRY, app.config['METRICS_MULTIPROC_DIR'], app.config['METRICS_FLUSH_INTERVAL'])
+        app.before_request(writer.start)
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
+    app.register_blueprint(metrics_blueprint)
+
+    # counters kept by the upstream coalescing and scheduling
+    single_flight, scheduler = app.extensions['single_flight'], app.extensions['upstream_scheduler']
+    if single_flight is not None:
+        REGISTRY.register_callback(
+            'chubbyrepo_singleflight_calls_total', 'Upstream queries executed or coalesced with an in-flight one.',
+            ['result'], lambda: {(result,): count for result, count in single_flight.counters().items()})
+    REGISTRY.register_callback(
+        'chubbyrepo_upstream_token_events_total', 'Calls, throttled and rate limited calls and cost points per token.',
+        ['token', 'event'], lambda: {(token, event): count for token, counters in scheduler.counters().items()
+                                     for event, count in counters.items() if event != 'remaining'})
+    hedger, breaker = app.extensions['upstream_hedger'], app.extensions['circuit_breaker']
+    if hedger is not None:
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_hedged_calls_total', 'Duplicate upstream calls sent or skipped without admission '
+            'slot or rate limit budget, and won or lost against the original one.', ['result'],
+            lambda: {(result,): count for result, count in hedger.counters().items()})
+    if breaker is not None:
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_circuit_breaker_state', 'Whether the upstream circuit breaker is in each state.',
+            ['state'], lambda: {(state,): int(breaker.state == state) for state in breaker.STATES}, type='gauge',
+            merge='max')
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_circuit_breaker_events_total', 'Times the upstream circuit opened and calls it '
+            'rejected.', ['event'], lambda: {(event,): count for event, count in breaker.counters().items()})
+    admission = app.extensions['admission_controller']
+    if admission is not None:
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_admission_queue_depth', 'Upstream calls waiting for a slot.', [],
+            lambda: {(): admission.queue_depth()}, type='gauge')
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_admission_in_flight', 'Upstream calls holding a slot.', [],
+            lambda: {(): admission.in_flight}, type='gauge')
+        REGISTRY.register_callback(
+            'chubbyrepo_upstream_admission_events_total', 'Upstream calls admitted, queued, shed and timed out '
+            'waiting for a slot.', ['event'],
+            lambda: {(event,): count for event, count in admission.counters().items()})
+    adaptive_ttls = app.extensions['adaptive_ttls']
+    if adaptive_ttls:
+        REGISTRY.register_callback(
+            'chubbyrepo_cache_key_ttl_seconds', 'Adaptive TTL of the last fetched keys by resource.',
+            ['resource', 'key'], lambda: {(resource, key): ttl for resource, policy in adaptive_ttls.items()
+                                          for key, (_, ttl, _) in policy.recent().items()}, type='gauge', merge='max')
+        REGISTRY.register_callback(
+            'chubbyrepo_cache_key_age_seconds', 'Time since the last fetched keys were fetched by resource.',
+            ['resource', 'key'], lambda: {(resource, key): time.time() - at
+                                          for resource, policy in adaptive_ttls.items()
+                                          for key, (at, _, _) in policy.recent().items()}, type='gauge', merge='min')
+        REGISTRY.register_callback(
+            'chubbyrepo_cache_key_velocity', 'Changes per second of the last fetched keys by resource.',
+            ['resource', 'key'], lambda: {(resource, key): velocity for resource, policy in adaptive_ttls.items()
+                                          for key, (_, _, velocity) in policy.recent().items()}, type='gauge',
+            merge='max')
+    REGISTRY.register_callback(
+        'chubbyrepo_upstream_token_remaining', 'Budget points left per token, as last reported by Github.',
+        ['token'], lambda: {(token,): counters['remaining'] for token, counters in scheduler.counters().items()
+                            if counters['remaining'] is not None}, type='gauge', merge='min')
+
+
+def _start_timer():
+    g.metrics_started_at = time.perf_counter()
+
+
+def _observe_request(response: Response) -> Response:
+    started = g.pop('metrics_started_at', None)
+    if started is not None and request.endpoint != 'metrics.metrics':
+        endpoint, status = request.endpoint or 'unmatched', response.status_code
+        HTTP_REQUESTS.inc(endpoint, status)
+        HTTP_REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint, status)
+    return response
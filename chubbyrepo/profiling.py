@@ -0,0 +1,287 @@
+"""On-demand CPU and memory profiling of live workers, served on `/profiling`.
+
+Requests sent with the `PROFILING_SECRET` in the `X-Profile` header are
+profiled, as well as a `PROFILING_SAMPLE_RATIO` of the other ones. Their CPU
+time is profiled with cProfile, or by sampling their stack every
+`PROFILING_INTERVAL` seconds, and the memory they allocate and still hold when
+they end is traced with tracemalloc. Profiles are aggregated per endpoint in
+each worker, and downloaded with the same header: pstats files for cProfile,
+collapsed stacks, ready for flamegraphs, for the sampled stacks and the
+allocations.
+
+With profiling disabled, or without a secret, nothing is registered and
+requests run untouched.
+"""
+import cProfile
+import collections
+import functools
+import hmac
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+from flask import Blueprint, Flask, Response, abort, current_app, g, jsonify, request
+
+HEADER = 'X-Profile'
+MODES = ('cprofile', 'sampling')
+
+
+class EndpointProfile:
+    """Profiles of the requests to an endpoint, aggregated."""
+
+    def __init__(self):
+        self.requests = 0
+        self.stats = None  # pstats.Stats of cProfile
+        self.stacks = collections.Counter()  # sampled stacks
+        self.allocations = collections.Counter()  # bytes held per allocation stack
+
+    def summary(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'cpu_calls': self.stats.total_calls if self.stats is not None else 0,
+            'cpu_samples': sum(self.stacks.values()),
+            'allocated_bytes': sum(self.allocations.values()),
+        }
+
+
+class _Session:
+    __slots__ = ('thread_id', 'profile', 'stacks', 'memory')
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.profile = None
+        self.stacks = None
+        self.memory = False
+
+
+class Profiler:
+    """Profile requests of this worker and aggregate their profiles per
+    endpoint.
+
+    In `sampling` mode a single thread samples the stacks of the requests
+    being profiled. Allocations are traced for a single request at once:
+    tracemalloc is process wide, so they include the ones of concurrent
+    requests.
+    """
+
+    def __init__(self, mode: str = 'cprofile', sample_ratio: float = 0, interval: float = 0.005,
+                 memory: bool = True, memory_frames: int = 32):
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode {!r}'.format(mode))
+        self.mode = mode
+        self.sample_ratio = sample_ratio
+        self.interval = interval
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self._profiles = collections.defaultdict(EndpointProfile)  # type: Dict[str, EndpointProfile]
+        self._sampled = {}  # stacks Counter per thread id being sampled
+        self._sampling = threading.Event()
+        self._sampler_pid = None
+        self._memory_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def should_profile(self, forced: bool = False) -> bool:
+        return forced or (self.sample_ratio > 0 and random.random() < self.sample_ratio)
+
+    def start(self) -> _Session:
+        session = _Session(threading.get_ident())
+        if self.memory and not tracemalloc.is_tracing() and self._memory_lock.acquire(blocking=False):
+            session.memory = True
+            tracemalloc.start(self.memory_frames)
+        if self.mode == 'cprofile':
+            session.profile = cProfile.Profile()
+            try:
+                session.profile.enable()
+            except (ValueError, RuntimeError):
+                # Another profiler is active, or being installed
+                session.profile = None
+        else:
+            session.stacks = collections.Counter()
+            self._start_sampler()
+            with self._lock:
+                self._sampled[session.thread_id] = session.stacks
+                self._sampling.set()
+        return session
+
+    def stop(self, session: _Session, endpoint: str):
+        if session.profile is not None:
+            session.profile.disable()
+        if session.stacks is not None:
+            with self._lock:
+                self._sampled.pop(session.thread_id, None)
+                if not self._sampled:
+                    self._sampling.clear()
+        allocations = None
+        if session.memory:
+            try:
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)))
+                allocations = snapshot.statistics('traceback')
+            finally:
+                tracemalloc.stop()
+                self._memory_lock.release()
+        with self._lock:
+            profile = self._profiles[endpoint]
+            profile.requests += 1
+            if session.profile is not None:
+                if profile.stats is None:
+                    profile.stats = pstats.Stats(session.profile)
+                else:
+                    profile.stats.add(session.profile)
+            if session.stacks is not None:
+                profile.stacks.update(session.stacks)
+            for statistic in allocations or ():
+                profile.allocations[';'.join(
+                    '{}:{}'.format(_short(frame.filename), frame.lineno) for frame in statistic.traceback
+                )] += statistic.size
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {endpoint: profile.summary() for endpoint, profile in self._profiles.items()}
+
+    def pstats(self, endpoint: str) -> Optional[bytes]:
+        """Return the endpoint cProfile stats, in the pstats file format."""
+        with self._lock:
+            profile = self._profiles.get(endpoint)
+            if profile is None or profile.stats is None:
+                return None
+            return marshal.dumps(profile.stats.stats)
+
+    def collapsed(self, endpoint: str, kind: str = 'cpu') -> Optional[str]:
+        """Return the endpoint sampled stacks, or its allocations in bytes,
+        as collapsed stacks.
+        """
+        with self._lock:
+            profile = self._profiles.get(endpoint)
+            stacks = None if profile is None else profile.stacks if kind == 'cpu' else profile.allocations
+            if not stacks:
+                return None
+            return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+    def reset(self):
+        with self._lock:
+            self._profiles.clear()
+
+    def _start_sampler(self):
+        # Threads don't survive forks, workers need their own
+        if self._sampler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sampler_pid == os.getpid():
+                return
+            threading.Thread(target=self._sample_forever, daemon=True, name='profiling-sampler').start()
+            self._sampler_pid = os.getpid()
+
+    def _sample_forever(self):
+        while True:
+            self._sampling.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._sampled.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_collapse(frame)] += 1
+
+    @classmethod
+    def from_config(cls, config) -> Optional['Profiler']:
+        if not config['PROFILING_ENABLED'] or not config['PROFILING_SECRET']:
+            return None
+        return cls(mode=config['PROFILING_MODE'], sample_ratio=config['PROFILING_SAMPLE_RATIO'],
+                   interval=config['PROFILING_INTERVAL'], memory=config['PROFILING_MEMORY'],
+                   memory_frames=config['PROFILING_MEMORY_FRAMES'])
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, _short(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+@functools.lru_cache(maxsize=4096)
+def _short(filename: str) -> str:
+    """Strip the longest `sys.path` entry from the filename."""
+    prefixes = [path for path in sys.path if path and filename.startswith(path.rstrip(os.sep) + os.sep)]
+    return filename[len(max(prefixes, key=len).rstrip(os.sep)) + 1:] if prefixes else filename
+
+
+def _authorized() -> bool:
+    return hmac.compare_digest(request.headers.get(HEADER, ''), current_app.config['PROFILING_SECRET'])
+
+
+profiling_blueprint = Blueprint('profiling', __name__)
+
+
+@profiling_blueprint.before_request
+def check_secret():
+    # Don't even tell profiling is there
+    if not _authorized():
+        abort(404)
+
+
+@profiling_blueprint.route('/profiling', methods=['GET'])
+def profiles():
+    """List the endpoints profiled by this worker."""
+    profiler = current_app.extensions['profiler']
+    return jsonify({'pid': os.getpid(), 'mode': profiler.mode, 'endpoints': profiler.summary()})
+
+
+@profiling_blueprint.route('/profiling', methods=['DELETE'])
+def reset_profiles():
+    """Drop the profiles of this worker."""
+    current_app.extensions['profiler'].reset()
+    return Response(status=204)
+
+
+@profiling_blueprint.route('/profiling/<name>/cpu.pstats', methods=['GET'])
+def cpu_pstats(name):
+    """Download the endpoint cProfile stats, to be loaded with `pstats`."""
+    data = current_app.extensions['profiler'].pstats(name)
+    if data is None:
+        abort(404)
+    return Response(data, content_type='application/octet-stream', headers={
+        'Content-Disposition': 'attachment; filename="{}.{}.pstats"'.format(name, os.getpid())})
+
+
+@profiling_blueprint.route('/profiling/<name>/<any(cpu, memory):kind>.collapsed', methods=['GET'])
+def collapsed_stacks(name, kind):
+    """Download the endpoint sampled stacks, or allocations, as collapsed
+    stacks to be rendered with `flamegraph.pl` or speedscope.
+    """
+    data = current_app.extensions['profiler'].collapsed(name, kind)
+    if data is None:
+        abort(404)
+    return Response(data, content_type='text/plain; charset=utf-8')
+
+
+def init_profiling(app: Flask):
+    """Profile requests and serve `/profiling`, when `PROFILING_ENABLED` and
+    a `PROFILING_SECRET` is set.
+    """
+    profiler = app.extensions['profiler'] = Profiler.from_config(app.config)
+    if profiler is None:
+        return
+
+    @app.before_request
+    def start_profile():
+        if request.blueprint == 'profiling':
+            return
+        if profiler.should_profile(forced=HEADER in request.headers and _authorized()):
+            g.profiling_session = profiler.start()
+
+    @app.teardown_request
+    def stop_profile(exc):
+        session = g.pop('profiling_session', None)
+        if session is not None:
+            profiler.stop(session, request.endpoint or 'unmatched')
+
+    app.register_blueprint(profiling_blueprint)
@@ -0,0 +1,174 @@
+"""Rate limit aware scheduling of upstream calls.
+
+Github grants every token a budget of points per hour and reports what is left
+in every response, both in the `X-RateLimit-*` headers and in the
+`rateLimit { cost remaining resetAt }` GraphQL field, selected by every
+gateway document along with the cost of the query. The scheduler keeps track
+of that budget for each configured token, rotates calls to the token with the
+most budget left and paces them with a token bucket so the budget lasts until
+it is reset instead of running out early. The ASGI application keeps its own.
+"""
+import asyncio
+import calendar
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from chubbyrepo.core.gateways import RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.resilience import time_left
+
+
+class TokenBucket:
+    """Allow `rate` calls per second with bursts of up to `capacity` calls.
+    A `rate` of None means calls are not paced.
+    """
+
+    def __init__(self, capacity: int, rate: Optional[float] = None):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take one token and return the seconds to wait before using it."""
+        now = time.monotonic()
+        if self.rate is None:
+            self.updated_at = now
+            return 0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate if self.rate > 0 else float('inf')
+
+    def cancel(self):
+        """Give back a token reserved but not used."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class TokenState:
+    """Upstream budget known for a single API token."""
+
+    def __init__(self, name: str, token: Optional[str], burst: int):
+        self.name = name
+        self.token = token
+        self.remaining = None
+        self.reset_at = None
+        self.bucket = TokenBucket(burst)
+        self.counters = {'calls': 0, 'throttled': 0, 'rate_limited': 0, 'cost': 0}
+
+    def available(self, now: float, reserve: int) -> bool:
+        if self.reset_at is not None and self.reset_at <= now:
+            # The budget window is over, Github restored the full budget
+            self.remaining, self.reset_at, self.bucket.rate = None, None, None
+        return self.remaining is None or self.remaining > reserve
+
+
+class UpstreamScheduler:
+    """Pick the token to use for each upstream call, waiting when needed."""
+
+    def __init__(self, tokens: List[Optional[str]], reserve: int = 0, burst: int = 10, max_wait: float = 1):
+        self.tokens = [TokenState('token{}'.format(i), token, burst) for i, token in enumerate(tokens)]
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> 'UpstreamScheduler':
+        return cls(config['GITHUB_API_KEYS'] or [config['GITHUB_API_KEY']],
+                   reserve=config['GITHUB_RATE_LIMIT_RESERVE'], burst=config['GITHUB_RATE_LIMIT_BURST'],
+                   max_wait=config['GITHUB_RATE_LIMIT_MAX_WAIT'])
+
+    def acquire(self) -> TokenState:
+        """Return the token with more budget left, after waiting for its pace.
+        Raise RateLimitExceeded if no token can be used soon enough, and
+        UpstreamUnavailable if not before the request deadline.
+        """
+        state, wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return state
+
+    async def acquire_async(self) -> TokenState:
+        """Same as `acquire`, without blocking the event loop while waiting."""
+        state, wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return state
+
+    def _reserve(self) -> Tuple[TokenState, float]:
+        with self._lock:
+            now = time.time()
+            available = [t for t in self.tokens if t.available(now, self.reserve)]
+            if not available:
+                retry_after = min(t.reset_at or now + 60 for t in self.tokens) - now
+                raise RateLimitExceeded('Github rate limit exhausted', max(retry_after, 0))
+            state = max(available, key=lambda t: float('inf') if t.remaining is None else t.remaining)
+            wait = state.bucket.reserve()
+            if wait > self.max_wait:
+                state.bucket.cancel()
+                state.counters['rate_limited'] += 1
+                raise RateLimitExceeded('Github rate limit almost exhausted', wait)
+            left = time_left()
+            if wait > 0 and left is not None and wait >= left:
+                # The caller would be gone before the call is even sent
+                state.bucket.cancel()
+                raise UpstreamUnavailable('Request deadline exceeded')
+            state.counters['calls'] += 1
+            if wait > 0:
+                state.counters['throttled'] += 1
+        return state, wait
+
+    def try_acquire(self, state: TokenState) -> bool:
+        """Take budget for another call with `state` if it can be made right
+        away, for extra calls such as hedges. Return whether it was taken.
+        """
+        with self._lock:
+            if not state.available(time.time(), self.reserve):
+                return False
+            if state.bucket.reserve() > 0:
+                state.bucket.cancel()
+                return False
+            state.counters['calls'] += 1
+            return True
+
+    def update(self, state: TokenState, headers: Optional[Mapping] = None, rate_limit: Optional[Mapping] = None):
+        """Record the budget reported by Github in response headers or in the
+        `rateLimit` GraphQL field.
+        """
+        remaining, reset_at = None, None
+        if headers and headers.get('X-RateLimit-Remaining') is not None:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset_at = float(headers.get('X-RateLimit-Reset') or 0) or None
+        if rate_limit:
+            remaining = int(rate_limit['remaining'])
+            reset_at = _parse_datetime(rate_limit['resetAt'])
+            with self._lock:
+                state.counters['cost'] += int(rate_limit.get('cost', 0))
+        if remaining is None:
+            return
+        with self._lock:
+            state.remaining, state.reset_at = remaining, reset_at
+            if reset_at is not None:
+                # Spread the remaining budget evenly until the window is reset
+                state.bucket.rate = max(remaining - self.reserve, 0) / max(reset_at - time.time(), 1)
+
+    def exhaust(self, state: TokenState, retry_after: Optional[float] = None):
+        """Mark a token as out of budget after Github rejected a call with it."""
+        with self._lock:
+            state.remaining = 0
+            if retry_after is not None:
+                state.reset_at = time.time() + retry_after
+            elif state.reset_at is None:
+                state.reset_at = time.time() + 60
+            state.counters['rate_limited'] += 1
+
+    def counters(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {t.name: dict(t.counters, remaining=t.remaining) for t in self.tokens}
+
+
+def _parse_datetime(value: str) -> float:
+    """Return the epoch of a Github UTC datetime such as 2017-10-30T21:53:28Z."""
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
@@ -0,0 +1,370 @@
+"""Protection of the API workers against a slow or failing Github.
+
+* Deadlines: every API request gets a deadline, kept in a context variable,
+  that bounds the timeouts of the upstream calls made on its behalf.
+* Hedging: when an upstream call takes longer than the recently observed p95
+  latency, a duplicate is sent and the first answer wins, cutting the tail.
+* Circuit breaking: after repeated upstream failures calls fail right away for
+  a while, instead of piling up workers waiting on Github.
+* Admission control: only so many upstream calls are in flight at once, a few
+  more wait for a slot for a short while, by priority, and the rest are shed
+  right away.
+"""
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional, TypeVar
+
+from chubbyrepo.core.gateways import Overloaded, UpstreamUnavailable
+
+T = TypeVar('T')
+
+_deadline = contextvars.ContextVar('chubbyrepo_deadline', default=None)
+_priority = contextvars.ContextVar('chubbyrepo_priority', default=1)
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Run the block with a deadline `seconds` from now. An earlier deadline
+    already set is kept, and no deadline is set when `seconds` is None.
+    """
+    if seconds is None:
+        yield
+        return
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(current, at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> Optional[float]:
+    """Return the seconds left until the current deadline, None without one."""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+@contextmanager
+def priority(value: int):
+    """Run the block with upstream calls admitted with `value` priority,
+    lower values first. Calls made out of any block get 1.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def carry(items: Iterable[T]) -> Iterator[T]:
+    """Iterate `items` within the deadline and priority current when called,
+    for results produced lazily, after the block that set them exited.
+    """
+    context = contextvars.copy_context()
+    iterator = iter(items)
+
+    def iterate():
+        done = object()
+        while True:
+            item = context.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    return iterate()
+
+
+def check_deadline():
+    """Raise UpstreamUnavailable when the current deadline is over."""
+    left = time_left()
+    if left is not None and left <= 0:
+        raise UpstreamUnavailable('Request deadline exceeded')
+
+
+class Hedger:
+    """Send a duplicate of the calls slower than the `quantile` of the last
+    `window` latencies, and return the first answer.
+
+    Hedges only start after `min_samples` latencies were observed and never
+    wait less than `min_delay` seconds. The duplicate costs rate limit budget
+    too, so it is only worth it for the slowest calls, and callers can skip it
+    when they can't spare that budget.
+    """
+
+    def __init__(self, quantile: float = 0.95, min_delay: float = 0.05, window: int = 1000, min_samples: int = 100,
+                 max_workers: int = 16):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self._latencies = deque(maxlen=window)
+        self._delay = None
+        self._observed = 0
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._counters = {'sent': 0, 'skipped': 0, 'won': 0, 'lost': 0}
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional['Hedger']:
+        if not config['UPSTREAM_HEDGE_ENABLED']:
+            return None
+        return cls(config['UPSTREAM_HEDGE_QUANTILE'], config['UPSTREAM_HEDGE_MIN_DELAY'],
+                   min_samples=config['UPSTREAM_HEDGE_MIN_SAMPLES'], max_workers=config['UPSTREAM_HEDGE_MAX_WORKERS'])
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._observed += 1
+            # Sorting the window on every call would be wasteful, the quantile moves slowly
+            if len(self._latencies) >= self.min_samples and (self._delay is None or self._observed % 50 == 0):
+                latencies = sorted(self._latencies)
+                self._delay = max(latencies[int(self.quantile * (len(latencies) - 1))], self.min_delay)
+
+    def delay(self) -> Optional[float]:
+        """Return the seconds to wait before hedging, None until known."""
+        return self._delay
+
+    def call(self, fn: Callable[[], T], reserve: Optional[Callable[[], Optional[Callable[[], T]]]] = None) -> T:
+        """Return `fn()`, hedged with a duplicate when it is slow. With a
+        `reserve`, the duplicate runs the function it returns, once it took the
+        resources the duplicate needs, and is skipped when it returns None.
+        """
+        delay = self._delay
+        left = time_left()
+        if delay is None or (left is not None and left <= delay):
+            return self._timed(fn)
+        executor = self._get_executor()
+        primary = executor.submit(self._timed, fn)
+        try:
+            return primary.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+        pending, hedge, error = {primary}, None, None
+        duplicate = fn if reserve is None else reserve()
+        if duplicate is None:
+            self._increment('skipped')
+        else:
+            hedge = executor.submit(self._timed, duplicate)
+            pending.add(hedge)
+            self._increment('sent')
+        while pending:
+            done, pending = futures.wait(pending, timeout=time_left(), return_when=futures.FIRST_COMPLETED)
+            if not done:
+                raise UpstreamUnavailable('Request deadline exceeded')
+            for future in done:
+                if future.exception() is None:
+                    if hedge is not None:
+                        self._increment('won' if future is hedge else 'lost')
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def _timed(self, fn: Callable[[], T]) -> T:
+        started = time.perf_counter()
+        result = fn()
+        self.observe(time.perf_counter() - started)
+        return result
+
+    def _increment(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _get_executor(self) -> futures.ThreadPoolExecutor:
+        # Threads don't survive forks, workers need their own pool
+        if self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor_pid != os.getpid():
+                    self._executor = futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='upstream-hedge')
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+
+class CircuitBreaker:
+    """Fail calls right away for `reset_timeout` seconds after
+    `failure_threshold` consecutive failures. Then a single probe call is let
+    through: its success closes the circuit again, its failure reopens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self._counters = {'opened': 0, 'rejected': 0}
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional['CircuitBreaker']:
+        if not config['UPSTREAM_BREAKER_ENABLED']:
+            return None
+        return cls(config['UPSTREAM_BREAKER_FAILURES'], config['UPSTREAM_BREAKER_RESET_TIMEOUT'])
+
+    def allow(self):
+        """Raise UpstreamUnavailable unless a call can be made now."""
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+                if retry_after > 0:
+                    self._counters['rejected'] += 1
+                    raise UpstreamUnavailable('Github is unavailable', retry_after)
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    self._counters['rejected'] += 1
+                    raise UpstreamUnavailable('Github is unavailable', self.reset_timeout)
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.state, self._failures, self._probing = self.CLOSED, 0, False
+
+    def record_inconclusive(self):
+        """Forget a call that ended without telling whether Github is healthy,
+        such as one cut by its caller's deadline, so another probe can be sent.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._counters['opened'] += 1
+                self.state, self._opened_at = self.OPEN, time.monotonic()
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+
+class _Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+
+
+class AdmissionController:
+    """Let at most `max_concurrency` upstream calls run at once. Up to
+    `max_queue` more wait for a slot, for at most `queue_timeout` seconds and
+    within their deadline, and are admitted by priority, then in order.
+
+    Calls finding the queue full are shed right away with Overloaded, unless
+    a waiting call with a worse priority can be shed in their place.
+    """
+
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 32, queue_timeout: float = 0.5,
+                 retry_after: float = 1):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        # Heap of (priority, sequence, waiter)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._counters = {'admitted': 0, 'queued': 0, 'shed': 0, 'timed_out': 0}
+
+    @classmethod
+    def from_config(cls, config: Mapping) -> Optional['AdmissionController']:
+        if not config['ADMISSION_ENABLED']:
+            return None
+        return cls(config['ADMISSION_MAX_CONCURRENCY'], config['ADMISSION_MAX_QUEUE'],
+                   config['ADMISSION_QUEUE_TIMEOUT'], config['ADMISSION_RETRY_AFTER'])
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return len(self._waiting)
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    @contextmanager
+    def admit(self):
+        """Run the block holding a slot, raising Overloaded when shed."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self):
+        """Take a slot, waiting for one when needed, raising Overloaded when
+        shed. For calls outliving their caller, which `release` it when over.
+        """
+        self._acquire(_priority.get())
+
+    def try_acquire(self) -> bool:
+        """Take a slot if one is free right now, without queueing, for extra
+        calls such as hedges. Return whether it was taken, to `release` then.
+        """
+        with self._lock:
+            if self.in_flight >= self.max_concurrency or self._waiting:
+                return False
+            self.in_flight += 1
+            self._counters['admitted'] += 1
+            return True
+
+    def _acquire(self, priority: int):
+        with self._lock:
+            if self.in_flight < self.max_concurrency and not self._waiting:
+                self.in_flight += 1
+                self._counters['admitted'] += 1
+                return
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting, default=None)
+                if worst is None or worst[0] <= priority:
+                    self._counters['shed'] += 1
+                    raise Overloaded('Too many requests waiting on Github', self.retry_after)
+                # Shed the waiting call with the worst priority instead
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                self._counters['shed'] += 1
+                worst[2].event.set()
+            waiter = _Waiter()
+            heapq.heappush(self._waiting, (priority, next(self._sequence), waiter))
+            self._counters['queued'] += 1
+        left = time_left()
+        waiter.event.wait(self.queue_timeout if left is None else max(min(self.queue_timeout, left), 0))
+        with self._lock:
+            if waiter.admitted:
+                return
+            if not waiter.event.is_set():
+                self._waiting = [item for item in self._waiting if item[2] is not waiter]
+                heapq.heapify(self._waiting)
+                self._counters['timed_out'] += 1
+        raise Overloaded('Too many requests waiting on Github', self.retry_after)
+
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                # The slot is handed over to the next call, in_flight doesn't change
+                waiter = heapq.heappop(self._waiting)[2]
+                waiter.admitted = True
+                self._counters['admitted'] += 1
+                waiter.event.set()
+            else:
+                self.in_flight -= 1
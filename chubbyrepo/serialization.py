@@ -0,0 +1,50 @@
+"""Fast JSON encoding of API responses.
+
+When `orjson` is installed, Flask encodes responses with it instead of the
+standard library `json` module, which is several times faster on the lists of
+repositories returned by the API. Keys are always sorted so equal payloads get
+the same body and ETag whatever the encoder.
+"""
+from typing import Any
+
+from flask.json.provider import DefaultJSONProvider
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def __init__(self, app):
+        import orjson
+        super().__init__(app)
+        self._orjson = orjson
+
+    def dumps_bytes(self, obj: Any, indent: bool = False) -> bytes:
+        options = self._orjson.OPT_SORT_KEYS | (self._orjson.OPT_INDENT_2 if indent else 0)
+        return self._orjson.dumps(obj, default=self.default, option=options)
+
+    def dumps(self, obj: Any, **kwargs) -> str:
+        if kwargs:
+            # Options only known by the standard library encoder
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs) -> Any:
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return self._orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Pretty printed in debug mode, as the default provider does
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self.dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+def init_json_provider(app):
+    """Use orjson to encode JSON when enabled with `JSON_FAST_ENCODER` and installed."""
+    if not app.config['JSON_FAST_ENCODER']:
+        return
+    try:
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        app.logger.info('orjson is not installed, using the standard library JSON encoder')
@@ -0,0 +1,177 @@
+"""Coalescing of identical in-flight upstream calls.
+
+Concurrent callers asking for the same key wait on a single execution and
+share its result or its exception. Optionally, a lock in the shared cache
+extends the coalescing across processes: only the process holding the lock
+calls upstream, the others poll the cache for the published outcome, errors
+raised again with their type when known. Callers run the call themselves when
+the cache is unavailable.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from chubbyrepo.cache import BaseCache
+from chubbyrepo.core.gateways import DoesNotExist, Overloaded, RateLimitExceeded, UpstreamUnavailable
+
+# Errors published with their type, the others are raised again as Exception
+ERRORS = {error.__name__: error for error in (DoesNotExist, RateLimitExceeded, UpstreamUnavailable, Overloaded)}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time within the process (and across
+    processes when a shared `cache` is given).
+    """
+
+    def __init__(self, cache: Optional[BaseCache] = None, lock_timeout: float = 10, poll_interval: float = 0.05):
+        self.cache = cache
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = {'executed': 0, 'coalesced': 0, 'coalesced_remote': 0}
+
+    @staticmethod
+    def key(document: str, variable_values: Optional[Dict] = None) -> str:
+        """Return a stable key for a GraphQL document and its variables."""
+        raw = json.dumps([document, variable_values or {}], sort_keys=True)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def counters(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run(key, fn)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _increment(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _run(self, key: str, fn: Callable[[], Any]) -> Any:
+        if self.cache is None:
+            self._increment('executed')
+            return fn()
+
+        lock_key, result_key = 'singleflight:lock:' + key, 'singleflight:result:' + key
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            added = self.cache.add(lock_key, '1', self.lock_timeout)
+            if added:
+                break
+            if added is None:
+                # No lock can be taken, nor any outcome published
+                self._increment('executed')
+                return fn()
+            outcome = self.cache.get(result_key)
+            if outcome is not None:
+                self._increment('coalesced_remote')
+                return self._decode(outcome)
+            if time.monotonic() >= deadline:
+                # The lock holder died or is too slow, stop waiting for it
+                self._increment('executed')
+                return fn()
+            time.sleep(self.poll_interval)
+
+        self.cache.delete(result_key)
+        self._increment('executed')
+        try:
+            result = fn()
+        except Exception as exc:
+            self.cache.set(result_key, json.dumps(self._encode_error(exc)), self.lock_timeout)
+            raise
+        else:
+            self.cache.set(result_key, json.dumps({'result': result}), self.lock_timeout)
+            return result
+        finally:
+            self.cache.delete(lock_key)
+
+    @staticmethod
+    def _encode_error(exc: Exception) -> Dict:
+        error = next((cls.__name__ for cls in type(exc).__mro__ if ERRORS.get(cls.__name__) is cls), None)
+        return {'error': str(exc), 'type': error, 'retry_after': getattr(exc, 'retry_after', None)}
+
+    @staticmethod
+    def _decode(outcome: str) -> Any:
+        outcome = json.loads(outcome)
+        if 'error' in outcome:
+            error = ERRORS.get(outcome.get('type'))
+            if error is None or error is DoesNotExist:
+                raise (error or Exception)(outcome['error'])
+            raise error(outcome['error'], outcome.get('retry_after'))
+        return outcome['result']
+
+
+class AsyncSingleFlight:
+    """Coroutine flavour of SingleFlight: coalesce identical calls awaited
+    concurrently within one event loop.
+
+    Calls run in their own task, awaited by every caller, so a cancelled
+    caller doesn't cancel the others. The call is only cancelled once no
+    caller is left waiting for it.
+    """
+
+    key = staticmethod(SingleFlight.key)
+
+    def __init__(self):
+        self._calls = {}  # type: Dict[str, List]
+        self._counters = {'executed': 0, 'coalesced': 0}
+
+    def counters(self) -> Dict[str, int]:
+        return dict(self._counters)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            # The task and how many callers wait for it
+            call = self._calls[key] = [asyncio.ensure_future(fn()), 0]
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+            self._counters['executed'] += 1
+        else:
+            self._counters['coalesced'] += 1
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if not call[1] and not task.done():
+                self._forget(key, call)
+                task.cancel()
+
+    def _forget(self, key: str, call: List):
+        if self._calls.get(key) is call:
+            del self._calls[key]
@@ -0,0 +1,123 @@
+"""Persistent store of organization stats snapshots.
+
+Every organization stats fetched from Github is recorded, with its fetch time,
+in a local SQLite database, so a restarted process can serve fresh enough
+results without going upstream and past snapshots can be listed. SQLite runs
+in WAL mode so readers don't block the writer and several worker processes can
+share the same file.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from chubbyrepo.core.entities import OrganizationStats, OrganizationStatsSnapshot, Repository
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS organization_stats_snapshots (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    repositories_count INTEGER NOT NULL,
+    chubby_repository_name TEXT NOT NULL,
+    chubby_repository_stars INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS organization_stats_snapshots_name_fetched_at
+    ON organization_stats_snapshots (name, fetched_at);
+"""
+
+COLUMNS = 'fetched_at, repositories_count, chubby_repository_name, chubby_repository_stars'
+
+
+class SnapshotStore:
+    """SQLite store of `OrganizationStatsSnapshot`, one connection per thread.
+
+    With a `retention`, snapshots older than `retention` seconds are pruned
+    every `prune_every` snapshots recorded by the process.
+    """
+
+    def __init__(self, path: str, timeout: float = 5, retention: Optional[float] = None, prune_every: int = 1000):
+        self.path = path
+        self.timeout = timeout
+        self.retention = retention
+        self.prune_every = prune_every
+        self._recorded = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be shared with forked workers either
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, uri=self.path.startswith('file:'))
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    @staticmethod
+    def key(name: str) -> str:
+        # Github logins are case insensitive
+        return name.lower()
+
+    def record(self, name: str, organization_stats: OrganizationStats,
+               fetched_at: Optional[float] = None) -> OrganizationStatsSnapshot:
+        return self.record_many([(name, organization_stats)], fetched_at)[0]
+
+    def record_many(self, results: List[Tuple[str, OrganizationStats]],
+                    fetched_at: Optional[float] = None) -> List[OrganizationStatsSnapshot]:
+        """Record stats fetched at the same time, in a single transaction."""
+        fetched_at = time.time() if fetched_at is None else float(fetched_at)
+        rows = [(self.key(name), fetched_at, stats.repositories_count, stats.chubby_repository.name,
+                 stats.chubby_repository.stars) for name, stats in results]
+        connection = self._connection()
+        with connection:
+            connection.executemany('INSERT INTO organization_stats_snapshots (name, {}) VALUES (?, ?, ?, ?, ?)'
+                                   .format(COLUMNS), rows)
+        if self.retention is not None:
+            with self._lock:
+                self._recorded += len(rows)
+                due = self._recorded >= self.prune_every
+                if due:
+                    self._recorded = 0
+            if due:
+                self.prune(time.time() - self.retention)
+        return [OrganizationStatsSnapshot.trusted(fetched_at, stats) for _, stats in results]
+
+    def latest(self, name: str) -> Optional[OrganizationStatsSnapshot]:
+        snapshots = self.history(name, 1)
+        return snapshots[0] if snapshots else None
+
+    def history(self, name: str, limit: int) -> List[OrganizationStatsSnapshot]:
+        """Return up to `limit` snapshots of an organization, most recent first."""
+        rows = self._connection().execute(
+            'SELECT {} FROM organization_stats_snapshots WHERE name = ? ORDER BY fetched_at DESC LIMIT ?'
+            .format(COLUMNS), (self.key(name), limit))
+        return [self._build_snapshot(row) for row in rows]
+
+    def hottest(self, limit: int, since: float) -> List[Tuple[str, OrganizationStatsSnapshot]]:
+        """Return the latest snapshot of the `limit` organizations fetched more
+        often since the `since` epoch.
+        """
+        rows = self._connection().execute(
+            'SELECT s.name, {} FROM organization_stats_snapshots s JOIN ('
+            '  SELECT name, MAX(fetched_at) AS last_fetched_at, COUNT(*) AS fetches'
+            '  FROM organization_stats_snapshots WHERE fetched_at >= ?'
+            '  GROUP BY name ORDER BY fetches DESC LIMIT ?'
+            ') h ON s.name = h.name AND s.fetched_at = h.last_fetched_at ORDER BY h.fetches DESC'
+            .format(', '.join('s.' + c for c in COLUMNS.split(', '))), (since, limit))
+        return [(row[0], self._build_snapshot(row[1:])) for row in rows]
+
+    def prune(self, before: float) -> int:
+        """Delete snapshots fetched before the `before` epoch, return how many."""
+        connection = self._connection()
+        with connection:
+            return connection.execute('DELETE FROM organization_stats_snapshots WHERE fetched_at < ?',
+                                      (before,)).rowcount
+
+    @staticmethod
+    def _build_snapshot(row: Tuple) -> OrganizationStatsSnapshot:
+        fetched_at, repositories_count, chubby_repository_name, chubby_repository_stars = row
+        return OrganizationStatsSnapshot.trusted(fetched_at, OrganizationStats.trusted(
+            repositories_count, Repository.trusted(chubby_repository_name, chubby_repository_stars)))
@@ -0,0 +1,228 @@
+"""Request tracing through the API, interactor and gateway layers.
+
+Every sampled API request gets a trace: a span for its view, with child spans
+for the request validation, the interactor and every Github call, recording
+their durations and a few attributes. The incoming W3C `traceparent` header is
+continued, keeping the trace id and the caller sampling decision, so spans can
+be joined with the ones of the calling services.
+
+Finished spans are handed to an exporter: `stdout` and `file` write them as
+JSON lines, any other can be plugged in with its import path. Only a
+`TRACING_SAMPLE_RATIO` of the requests is traced; out of a sampled trace spans
+are not even created, and with tracing disabled nothing is instrumented.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+from flask import Flask, g, request
+from werkzeug.utils import import_string
+
+# Version, trace id, parent id and flags. Later versions may append fields
+TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+INVALID_TRACE_ID = '0' * 32
+INVALID_PARENT_ID = '0' * 16
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('chubbyrepo_span', default=None)
+
+
+class Span:
+    """Timed operation of a trace, with its attributes."""
+
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'status', 'start', '_started')
+
+    def __init__(self, tracer: 'Tracer', trace_id: str, parent_id: Optional[str], name: str,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.status = 'ok'
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def child(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> 'Span':
+        return Span(self.tracer, self.trace_id, self.span_id, name, attributes)
+
+    def end(self):
+        duration = time.perf_counter() - self._started
+        try:
+            self.tracer.exporter.export({
+                'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'start': self.start, 'duration': duration, 'status': self.status, 'attributes': self.attributes,
+            })
+        except Exception:
+            # Spans are lost, but never the request they trace
+            logger.warning('Exporting span %s failed', self.name, exc_info=True)
+
+    def traceparent(self) -> str:
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+
+class StdoutExporter:
+    """Write every span as a JSON line to the standard output."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict):
+        line = json.dumps(span, default=str) + '\n'
+        with self._lock:
+            (self.stream or sys.stdout).write(line)
+
+
+class FileExporter(StdoutExporter):
+    """Append every span as a JSON line to the file at `path`."""
+
+    def __init__(self, path: str):
+        super().__init__(open(path, 'a', buffering=1))
+
+
+class Tracer:
+    """Start traces for a `sample_ratio` of the requests, or as decided by
+    the caller, and export their spans with `exporter`.
+    """
+
+    def __init__(self, exporter, sample_ratio: float = 0.01):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None,
+                    attributes: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+        """Return the root span of a new trace, continuing `traceparent` when
+        valid, or None when not sampled.
+        """
+        parsed = parse_traceparent(traceparent)
+        if parsed is not None:
+            trace_id, parent_id, sampled = parsed
+            if not sampled:
+                return None
+            return Span(self, trace_id, parent_id, name, attributes)
+        if random.random() >= self.sample_ratio:
+            return None
+        return Span(self, '{:032x}'.format(random.getrandbits(128)), None, name, attributes)
+
+
+def parse_traceparent(traceparent: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """Return the trace id, the parent id and the sampled flag of a W3C
+    `traceparent` header, None when missing or invalid.
+    """
+    match = TRACEPARENT.match(traceparent or '')
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, extra = match.groups()
+    if version == 'ff' or (version == '00' and extra) or trace_id == INVALID_TRACE_ID or \
+            parent_id == INVALID_PARENT_ID:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Run the block in a child span of the current one. Yield None, and do
+    nothing, out of a sampled trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.status = 'error'
+        child.set_attribute('error', exc.__class__.__name__)
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def instrument(obj: Any, *method_names: str) -> Any:
+    """Trace calls to the given methods of `obj`, in spans named after its
+    class and the method, and return it.
+    """
+    for method_name in method_names:
+        method = getattr(obj, method_name)
+        setattr(obj, method_name, _traced(method, '{}.{}'.format(type(obj).__name__, method_name)))
+    return obj
+
+
+def _traced(fn, name: str):
+    @functools.wraps(fn)
+    def traced(*args, **kwargs):
+        if _current.get() is None:
+            return fn(*args, **kwargs)
+        with span(name):
+            return fn(*args, **kwargs)
+    return traced
+
+
+def build_exporter(app: Flask):
+    exporter = app.config['TRACING_EXPORTER']
+    if exporter == 'stdout':
+        return StdoutExporter()
+    if exporter == 'file':
+        path = app.config['TRACING_FILE']
+        if not os.path.isabs(path):
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, path)
+        return FileExporter(path)
+    return import_string(exporter)(app.config)
+
+
+def init_tracing(app: Flask):
+    """Trace a sample of the requests, when `TRACING_ENABLED`."""
+    app.extensions['tracer'] = None
+    if not app.config['TRACING_ENABLED']:
+        return
+    tracer = app.extensions['tracer'] = Tracer(build_exporter(app), app.config['TRACING_SAMPLE_RATIO'])
+
+    @app.before_request
+    def start_trace():
+        root = tracer.start_trace('{} {}'.format(request.method, request.endpoint or 'unmatched'),
+                                  request.headers.get('traceparent'), {'http.path': request.path})
+        if root is not None:
+            g.trace_span, g.trace_token = root, _current.set(root)
+
+    @app.after_request
+    def record_status(response):
+        root = g.get('trace_span')
+        if root is not None:
+            root.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                root.status = 'error'
+        return response
+
+    @app.teardown_request
+    def end_trace(exc):
+        root = g.pop('trace_span', None)
+        if root is not None:
+            try:
+                _current.reset(g.pop('trace_token'))
+            except ValueError:
+                # Set in another context, e.g. of a streamed response
+                _current.set(None)
+            root.end()
@@ -0,0 +1,42 @@
+"""HTTP transport shared by the Github gateways.
+
+The session is built once per application in `create_app` and reused by every
+request, so upstream calls share a keep-alive connection pool instead of paying
+a new TCP and TLS handshake each time. The async client plays the same role for
+the ASGI application.
+"""
+from typing import Mapping
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = (502, 503)
+
+
+def build_session(config: Mapping) -> requests.Session:
+    """Return a pooled `requests.Session` configured from the app config.
+
+    Calls are not retried by the session: the gateways retry `RETRY_STATUSES`
+    and connection errors themselves, within the request deadline.
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['GITHUB_POOL_SIZE'], max_retries=0)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+def build_async_client(config: Mapping):
+    """Return a pooled `httpx.AsyncClient` for the async gateways."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=config['ASYNC_GITHUB_MAX_CONNECTIONS'],
+                          max_keepalive_connections=config['ASYNC_GITHUB_MAX_CONNECTIONS'])
+    client_timeout = httpx.Timeout(config['GITHUB_READ_TIMEOUT'], connect=config['GITHUB_CONNECT_TIMEOUT'])
+    return httpx.AsyncClient(limits=limits, timeout=client_timeout, headers={'Accept-Encoding': 'gzip, deflate'})
+
+
+def timeout(config: Mapping):
+    """Return the (connect, read) timeout tuple used for upstream calls."""
+    return config['GITHUB_CONNECT_TIMEOUT'], config['GITHUB_READ_TIMEOUT']
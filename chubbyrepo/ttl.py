@@ -0,0 +1,146 @@
+"""Cache TTLs adapted to how fast each cached value changes.
+
+A fixed TTL fetches dormant organizations again long after anything changed,
+and serves viral ones stale for just as long. `AdaptiveTTL` remembers per
+cache key, in the shared cache, the last value fetched and the moving average
+of its velocity: how much it changed per second between successive fetches,
+counted in stars, repositories and repositories entering the ranking. The next
+TTL is the time the value takes to change `tolerance` times at that velocity,
+within `min_ttl` and `max_ttl`. Every fetch finding the value unchanged shrinks
+the velocity, so quiet keys back off towards `max_ttl` while fast moving ones
+stay close to `min_ttl`.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from chubbyrepo import metrics
+from chubbyrepo.cache import BaseCache
+
+RESOURCES = ('organization_stats', 'chubbiest_repositories')
+
+
+def organization_stats_changes(old: Dict, new: Dict) -> float:
+    """Repositories added or removed, stars of the chubbiest repository, and
+    one more when another repository took its place.
+    """
+    old_chubby, new_chubby = old['chubby_repository'], new['chubby_repository']
+    return (abs(new['repositories_count'] - old['repositories_count']) +
+            abs(new_chubby['stars'] - old_chubby['stars']) + (old_chubby['name'] != new_chubby['name']))
+
+
+def ranking_changes(old: List[List], new: List[List]) -> float:
+    """Stars of the repositories ranked both times, and one per repository
+    entering the ranking.
+    """
+    old_stars = dict(old)
+    changes = 0
+    for name, stars in new:
+        previous = old_stars.get(name)
+        changes += 1 if previous is None else abs(stars - previous)
+    return changes
+
+
+CHANGES = {'organization_stats': organization_stats_changes, 'chubbiest_repositories': ranking_changes}
+
+
+class AdaptiveTTL:
+    """TTLs of the `resource` cached values, from their velocity weighting
+    the last fetch by `smoothing`. The state of a key is kept `history_ttl`
+    seconds after its last fetch, and the TTLs of the `metrics_keys` last
+    fetched keys are reported in `/metrics`.
+    """
+
+    def __init__(self, cache: BaseCache, resource: str, min_ttl: int, max_ttl: int, tolerance: float = 1,
+                 smoothing: float = 0.5, history_ttl: int = 7 * 24 * 3600, metrics_keys: int = 100):
+        self.cache = cache
+        self.resource = resource
+        self.changes = CHANGES[resource]
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.history_ttl = history_ttl
+        self.metrics_keys = metrics_keys
+        self._recent = OrderedDict()  # (fetched at, ttl, velocity) per key
+        self._lock = threading.Lock()
+
+    def state_key(self, key: str) -> str:
+        return 'ttl_state:{}:{}'.format(self.resource, key)
+
+    def ttl(self, key: str, value: Any, default: int, now: Optional[float] = None) -> int:
+        """Record `value` as just fetched upstream for `key` and return the
+        seconds to cache it, `default` within bounds while its velocity is
+        unknown.
+        """
+        now = time.time() if now is None else now
+        return self._remaining(self.observe(key, value, default, now), default, now)
+
+    def observe(self, key: str, value: Any, default: int, at: Optional[float] = None) -> Dict:
+        """Record `value` as fetched upstream at `at` for `key` and return the
+        key state. Fetches not newer than the last one recorded, e.g. served
+        from a snapshot, leave it unchanged.
+        """
+        at = time.time() if at is None else at
+        state = self._state(key)
+        if state is not None and at <= state['at']:
+            return state
+        velocity, result = None, 'first'
+        if state is not None:
+            velocity = state['velocity']
+            changes = self.changes(state['value'], value)
+            result = 'changed' if changes else 'unchanged'
+            observed = changes / (at - state['at'])
+            velocity = observed if velocity is None else (
+                self.smoothing * observed + (1 - self.smoothing) * velocity)
+        state = {'at': at, 'value': value, 'velocity': velocity}
+        self.cache.set(self.state_key(key), json.dumps(state), self.history_ttl)
+        ttl = self.bounded(velocity, default)
+        metrics.CACHE_REFRESHES.inc(self.resource, result)
+        metrics.CACHE_TTL.observe(ttl, self.resource)
+        with self._lock:
+            self._recent[key] = at, ttl, velocity or 0
+            self._recent.move_to_end(key)
+            if len(self._recent) > self.metrics_keys:
+                self._recent.popitem(last=False)
+        return state
+
+    def remaining(self, key: str, default: int, now: Optional[float] = None) -> int:
+        """Return the seconds left until the value last fetched for `key` is
+        due again, possibly negative, or `default` within bounds when it was
+        never fetched.
+        """
+        return self._remaining(self._state(key), default, time.time() if now is None else now)
+
+    def _state(self, key: str) -> Optional[Dict]:
+        cached = self.cache.get(self.state_key(key))
+        return json.loads(cached) if cached is not None else None
+
+    def _remaining(self, state: Optional[Dict], default: int, now: float) -> int:
+        if state is None:
+            return self.bounded(None, default)
+        return round(state['at'] + self.bounded(state['velocity'], default) - now)
+
+    def bounded(self, velocity: Optional[float], default: int) -> int:
+        if velocity is None:
+            return min(max(default, self.min_ttl), self.max_ttl)
+        if velocity <= 0:
+            return self.max_ttl
+        return int(min(max(self.tolerance / velocity, self.min_ttl), self.max_ttl))
+
+    def recent(self) -> Dict[str, Tuple[float, int, float]]:
+        """Return when the last fetched keys were fetched, their TTL and velocity."""
+        with self._lock:
+            return dict(self._recent)
+
+
+def build_adaptive_ttls(config: Mapping, cache: BaseCache) -> Dict[str, AdaptiveTTL]:
+    """Adaptive TTL per resource, none unless `ADAPTIVE_TTL_ENABLED`."""
+    if not config['ADAPTIVE_TTL_ENABLED']:
+        return {}
+    return {resource: AdaptiveTTL(cache, resource, config['ADAPTIVE_TTL_MIN'][resource],
+                                  config['ADAPTIVE_TTL_MAX'][resource], config['ADAPTIVE_TTL_TOLERANCE'][resource],
+                                  config['ADAPTIVE_TTL_SMOOTHING'], metrics_keys=config['ADAPTIVE_TTL_METRICS_KEYS'])
+            for resource in RESOURCES}
@@ -0,0 +1,197 @@
+"""Github webhooks keeping cached stats fresh without polling.
+
+Organizations send `star`, `repository` and `public` events to
+`/webhooks/github`. Deliveries are checked against their HMAC signature,
+answered right away and queued, then applied in background to the cached
+organization stats and to the chubbiest repositories leaderboard. Events carry
+the current stars of the repository, so most of them are applied in place;
+Github is only queried again when the stats can't be known from the event,
+e.g. when the chubbiest repository lost stars or went away.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import queue
+import threading
+from typing import Dict, Optional
+
+from flask import Flask
+
+from chubbyrepo import metrics
+from chubbyrepo.cache import BaseCache
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import DoesNotExist
+from chubbyrepo.core.gateways import StatsGateway as BaseStatsGateway
+from chubbyrepo.gateways import CachedStatsGateway, NotFoundCachedStatsGateway, PersistentStatsGateway
+from chubbyrepo.leaderboard import Leaderboard
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('star', 'repository', 'public')
+ADDED = ('created', 'publicized')
+REMOVED = ('deleted', 'privatized')
+# Redeliveries are answered but not applied twice, within this many seconds
+DELIVERY_TTL = 24 * 3600
+
+
+def verify_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """Check the `X-Hub-Signature-256` header, the HMAC SHA-256 of the body."""
+    if not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest('sha256=' + expected, signature)
+
+
+def adjust_organization_stats(stats: OrganizationStats, event: str, action: Optional[str],
+                              repository: Repository, changes: Dict) -> Optional[OrganizationStats]:
+    """Return the organization stats after the event, None when they can't be
+    told without asking Github again.
+    """
+    chubby = stats.chubby_repository
+    count = stats.repositories_count
+    if event == 'star' or (event == 'repository' and action in ADDED) or event == 'public':
+        # Made public repositories also get a `repository` event, counted there
+        if event == 'repository':
+            count += 1
+        if repository.name == chubby.name:
+            # Another repository may be ahead now
+            return None if repository.stars < chubby.stars else OrganizationStats.trusted(count, repository)
+        return OrganizationStats.trusted(count, repository if repository.stars > chubby.stars else chubby)
+    if event == 'repository' and action in REMOVED:
+        if repository.name == chubby.name:
+            return None
+        return OrganizationStats.trusted(max(count - 1, 0), chubby)
+    if event == 'repository' and action == 'renamed':
+        old_name = changes.get('repository', {}).get('name', {}).get('from')
+        return OrganizationStats.trusted(count, repository) if old_name == chubby.name else stats
+    if event == 'repository' and action == 'transferred':
+        return None
+    return stats
+
+
+class WebhookProcessor:
+    """Apply webhook events to the cached stats and the leaderboard, from a
+    background thread fed by a queue of up to `queue_size` events.
+
+    Only the organizations whose stats are cached are adjusted or queried
+    again, any other would be fetched anyway on its next lookup. With the
+    snapshot store, adjusted stats are recorded there too.
+    """
+
+    def __init__(self, app: Flask, stats_gateway: CachedStatsGateway, upstream_gateway: BaseStatsGateway,
+                 cache: BaseCache, snapshots: Optional[PersistentStatsGateway] = None,
+                 not_found: Optional[NotFoundCachedStatsGateway] = None, leaderboard: Optional[Leaderboard] = None,
+                 queue_size: int = 1000, in_background: bool = True):
+        self.app = app
+        self.stats_gateway = stats_gateway
+        self.upstream_gateway = upstream_gateway
+        self.cache = cache
+        self.snapshots = snapshots
+        self.not_found = not_found
+        self.leaderboard = leaderboard
+        self.in_background = in_background
+        self._queue = queue.Queue(queue_size)
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, delivery: Optional[str], event: str, payload: Dict) -> bool:
+        """Queue the event, or apply it right away when not `in_background`.
+        Return False when the queue is full.
+        """
+        if event not in EVENTS or not isinstance(payload.get('repository'), dict):
+            metrics.WEBHOOK_EVENTS.inc(event, 'ignored')
+            return True
+        if delivery and not self.cache.add('webhook_delivery:' + delivery, '1', DELIVERY_TTL):
+            metrics.WEBHOOK_EVENTS.inc(event, 'duplicate')
+            return True
+        if not self.in_background:
+            self.process(event, payload)
+            return True
+        self._start_worker()
+        try:
+            self._queue.put_nowait((event, payload))
+        except queue.Full:
+            metrics.WEBHOOK_EVENTS.inc(event, 'dropped')
+            if delivery:
+                # Let Github redeliver it
+                self.cache.delete('webhook_delivery:' + delivery)
+            return False
+        return True
+
+    def process(self, event: str, payload: Dict):
+        try:
+            result = self._apply(event, payload.get('action'), payload['repository'], payload.get('changes') or {})
+        except Exception:
+            logger.exception('Webhook %s event failed', event)
+            result = 'failed'
+        metrics.WEBHOOK_EVENTS.inc(event, result)
+
+    def _apply(self, event: str, action: Optional[str], payload: Dict, changes: Dict) -> str:
+        organization = payload['owner']['login']
+        repository = Repository.trusted(payload['name'], payload.get('stargazers_count', 0))
+        if self.not_found is not None:
+            self.not_found.forget(organization)
+        if payload.get('private') and action != 'privatized':
+            # Private repositories aren't counted nor ranked
+            return 'ignored'
+        previous_owner = None
+        if event == 'repository' and action == 'transferred':
+            previous_owner = changes.get('owner', {}).get('from', {})
+            previous_owner = (previous_owner.get('organization') or previous_owner.get('user') or {}).get('login')
+        self._update_leaderboard(event, action, organization, repository, changes, previous_owner)
+        if previous_owner and self.stats_gateway.cached(previous_owner) is not None:
+            self._requery(previous_owner)
+        stats = self.stats_gateway.cached(organization)
+        if stats is None:
+            return 'ignored'
+        adjusted = adjust_organization_stats(stats, event, action, repository, changes)
+        if adjusted is None:
+            self._requery(organization)
+            return 'requeried'
+        if adjusted != stats:
+            self.stats_gateway.update(organization, adjusted)
+            if self.snapshots is not None:
+                self.snapshots.record(organization, adjusted)
+        return 'applied'
+
+    def _update_leaderboard(self, event: str, action: Optional[str], organization: str, repository: Repository,
+                            changes: Dict, previous_owner: Optional[str]):
+        if self.leaderboard is None:
+            return
+        if event == 'star' or event == 'public' or action in ADDED:
+            self.leaderboard.update_stars(organization, repository.name, repository.stars)
+        elif action in REMOVED:
+            self.leaderboard.remove(organization, repository.name)
+        elif action == 'renamed':
+            old_name = changes.get('repository', {}).get('name', {}).get('from')
+            if old_name:
+                self.leaderboard.rename(organization, old_name, repository.name)
+        elif previous_owner:
+            self.leaderboard.rename(previous_owner, repository.name, repository.name, organization)
+
+    def _requery(self, organization: str):
+        try:
+            stats = self.upstream_gateway.organization_stats(organization)
+        except DoesNotExist:
+            self.stats_gateway.invalidate(organization)
+            return
+        self.stats_gateway.update(organization, stats)
+        if self.snapshots is not None:
+            self.snapshots.record(organization, stats)
+
+    def _start_worker(self):
+        # Threads don't survive forks, workers need their own
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            threading.Thread(target=self._work, daemon=True, name='webhook-processor').start()
+            self._worker_pid = os.getpid()
+
+    def _work(self):
+        while True:
+            event, payload = self._queue.get()
+            with self.app.app_context():
+                self.process(event, payload)
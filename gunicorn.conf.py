@@ -0,0 +1,19 @@
+"""Gunicorn settings, run with `gunicorn -c gunicorn.conf.py`.
+
+The app is loaded once in the master process, so the container components,
+including the snapshot store warm start, are built before forking the workers
+and shared with them copy-on-write.
+"""
+import os
+
+wsgi_app = 'run:app'
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Already loaded by the master, this doesn't load it again
+    app = server.app.wsgi()
+    app.extensions['container'].after_fork()
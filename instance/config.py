@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config(object):
@@ -6,20 +7,164 @@ class Config(object):
     DEBUG = False
     TESTING = False
     SECRET_KEY = 'SUPER SECRET KEY'
-    CACHE_TYPE = 'redis'
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'redis')
     CACHE_REDIS_HOST = 'chubby-cache'
+    CACHE_REDIS_PORT = 6379
+    CACHE_REDIS_DB = 0
+    CACHE_KEY_PREFIX = 'chubbyrepo:'
+    # Seconds each endpoint result is kept in cache
+    CACHE_TTL_ORGANIZATION_STATS = 300
+    CACHE_TTL_CHUBBIEST_REPOSITORIES = 600
+    # Adapt each cached value TTL to how fast it changed between its last fetches: a TTL lasts as long as
+    # ADAPTIVE_TTL_TOLERANCE changes in stars, repositories or ranking take at the velocity observed, a moving average
+    # weighting the last fetch ADAPTIVE_TTL_SMOOTHING, within ADAPTIVE_TTL_MIN and ADAPTIVE_TTL_MAX seconds. TTLs of
+    # the ADAPTIVE_TTL_METRICS_KEYS last fetched keys are exposed in metrics
+    ADAPTIVE_TTL_ENABLED = False
+    ADAPTIVE_TTL_MIN = {'organization_stats': 30, 'chubbiest_repositories': 60}
+    ADAPTIVE_TTL_MAX = {'organization_stats': 1800, 'chubbiest_repositories': 3600}
+    ADAPTIVE_TTL_TOLERANCE = {'organization_stats': 0.1, 'chubbiest_repositories': 100}
+    ADAPTIVE_TTL_SMOOTHING = 0.5
+    ADAPTIVE_TTL_METRICS_KEYS = 100
+    # Seconds organizations not found are remembered, in memory, and how many of them at most. 0 disables it
+    CACHE_TTL_ORGANIZATION_NOT_FOUND = 60
+    NOT_FOUND_CACHE_SIZE = 10000
+    # Seconds clients and CDNs may reuse each endpoint response, per view name
+    CACHE_CONTROL_MAX_AGE = {
+        'organization_stats': 60,
+        'chubbiest_repositories': 300,
+        'organization_stats_history': 60,
+    }
+    # Full detail organization stats: top repositories, stars percentiles and relative error of their sketch. They are
+    # served for CACHE_TTL_ORGANIZATION_AGGREGATE_STATS, then refreshed scanning only the repositories created since,
+    # and fully rescanned every ORGANIZATION_AGGREGATE_RESCAN_INTERVAL. Seconds.
+    ORGANIZATION_AGGREGATE_TOP_K = 10
+    ORGANIZATION_AGGREGATE_PERCENTILES = (50, 90, 99)
+    ORGANIZATION_AGGREGATE_RELATIVE_ACCURACY = 0.01
+    CACHE_TTL_ORGANIZATION_AGGREGATE_STATS = 3600
+    ORGANIZATION_AGGREGATE_RESCAN_INTERVAL = 24 * 3600
+    # Directory of the files written by the app, outside of the source tree. Mount a volume there to keep them
+    DATA_DIR = os.getenv('DATA_DIR', os.path.join(tempfile.gettempdir(), 'chubbyrepo'))
+    # Organization stats snapshots recorded in SQLite, relative paths are in DATA_DIR. The latest one is served while
+    # younger than SNAPSHOT_STORE_MAX_AGE, and the ones of the organizations fetched more often in the last
+    # SNAPSHOT_STORE_PRELOAD_WINDOW are loaded in memory at startup. Snapshots older than SNAPSHOT_STORE_RETENTION are
+    # pruned at startup and every SNAPSHOT_STORE_PRUNE_EVERY snapshots recorded by a worker. Seconds.
+    SNAPSHOT_STORE_PATH = os.getenv('SNAPSHOT_STORE_PATH', 'snapshots.sqlite3')
+    SNAPSHOT_STORE_MAX_AGE = 300
+    SNAPSHOT_STORE_MEMORY_SIZE = 1000
+    SNAPSHOT_STORE_PRELOAD_WINDOW = 24 * 3600
+    SNAPSHOT_STORE_RETENTION = 30 * 24 * 3600
+    SNAPSHOT_STORE_PRUNE_EVERY = 1000
+    # Serve Prometheus metrics on /metrics, aggregated across workers sharing METRICS_MULTIPROC_DIR
+    METRICS_ENABLED = True
+    METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR')
+    METRICS_FLUSH_INTERVAL = 5
+    # Trace a TRACING_SAMPLE_RATIO of the requests, unless sampled by the caller traceparent, exporting spans to
+    # 'stdout', 'file' (TRACING_FILE in the instance folder) or the import path of an exporter taking the config
+    TRACING_ENABLED = False
+    TRACING_SAMPLE_RATIO = 0.01
+    TRACING_EXPORTER = 'stdout'
+    TRACING_FILE = 'spans.jsonl'
+    # Profile requests sent with PROFILING_SECRET in the X-Profile header, and a PROFILING_SAMPLE_RATIO of the others,
+    # with 'cprofile' or by 'sampling' their stack every PROFILING_INTERVAL seconds, and trace the memory they allocate
+    # when PROFILING_MEMORY. Profiles of each worker are downloaded from /profiling, with the same header
+    PROFILING_ENABLED = False
+    PROFILING_SECRET = os.getenv('PROFILING_SECRET')
+    PROFILING_SAMPLE_RATIO = 0
+    PROFILING_MODE = 'cprofile'
+    PROFILING_INTERVAL = 0.005
+    PROFILING_MEMORY = True
+    PROFILING_MEMORY_FRAMES = 32
+    # Encode responses with orjson, when installed
+    JSON_FAST_ENCODER = True
+    # Coalesce identical in-flight Github queries, across processes when distributed
+    SINGLEFLIGHT_ENABLED = True
+    SINGLEFLIGHT_DISTRIBUTED = False
+    SINGLEFLIGHT_LOCK_TIMEOUT = 10
+    SINGLEFLIGHT_POLL_INTERVAL = 0.05
+    # Chubbiest repositories served from a snapshot refreshed in background, seconds
+    LEADERBOARD_ENABLED = True
+    LEADERBOARD_SIZE = 1000
+    LEADERBOARD_REFRESH_IN_BACKGROUND = True
+    LEADERBOARD_REFRESH_INTERVAL = 300
+    LEADERBOARD_MAX_STALENESS = 900
+    # Secret of the Github webhooks sent to /webhooks/github, disabled when unset, and events queued for processing
+    GITHUB_WEBHOOK_SECRET = os.getenv('GITHUB_WEBHOOK_SECRET')
+    GITHUB_WEBHOOK_QUEUE_SIZE = 1000
+    GITHUB_WEBHOOK_PROCESS_IN_BACKGROUND = True
+    # Build every gateway and interactor in create_app instead of on first use, and the callables, or their import
+    # paths, building some of them in place of the defaults, per component name
+    CONTAINER_PRELOAD = True
+    CONTAINER_PROVIDERS = {}
+    # Answer organization stats and chubbiest repositories from 'github', or from a 'dataset' of repositories: a JSON
+    # lines file, or a directory of them, at DATASET_PATH in the instance folder, reloaded every DATASET_RELOAD_INTERVAL
+    # seconds (0 never). Full detail organization stats still come from Github
+    GATEWAY_BACKEND = os.getenv('GATEWAY_BACKEND', 'github')
+    DATASET_PATH = os.getenv('DATASET_PATH', 'repositories.jsonl')
+    DATASET_RELOAD_INTERVAL = 300
+    # Github GraphQL endpoint, pointed to a local stub by the benchmarks
+    GITHUB_GRAPHQL_URL = os.getenv('GITHUB_GRAPHQL_URL', 'https://api.github.com/graphql')
     GITHUB_API_KEY = os.getenv('GITHUB_API_KEY')
+    # Comma separated pool of tokens to rotate across, GITHUB_API_KEY is used when empty
+    GITHUB_API_KEYS = [key for key in os.getenv('GITHUB_API_KEYS', '').split(',') if key]
+    # Budget points kept untouched per token, max burst of calls and max seconds a call waits for budget
+    GITHUB_RATE_LIMIT_RESERVE = 50
+    GITHUB_RATE_LIMIT_BURST = 10
+    GITHUB_RATE_LIMIT_MAX_WAIT = 2
+    # Seconds an API request may wait on Github, bounding its upstream timeouts, None for no deadline
+    REQUEST_DEADLINE = 15
+    # Duplicate upstream calls slower than the UPSTREAM_HEDGE_QUANTILE of the recent ones, once
+    # UPSTREAM_HEDGE_MIN_SAMPLES were seen, waiting at least UPSTREAM_HEDGE_MIN_DELAY seconds
+    UPSTREAM_HEDGE_ENABLED = False
+    UPSTREAM_HEDGE_QUANTILE = 0.95
+    UPSTREAM_HEDGE_MIN_DELAY = 0.05
+    UPSTREAM_HEDGE_MIN_SAMPLES = 100
+    UPSTREAM_HEDGE_MAX_WORKERS = 16
+    # Fail upstream calls right away for UPSTREAM_BREAKER_RESET_TIMEOUT seconds after UPSTREAM_BREAKER_FAILURES
+    # consecutive failures, serving organization stats up to CACHE_STALE_TTL_ORGANIZATION_STATS seconds past their TTL
+    UPSTREAM_BREAKER_ENABLED = True
+    UPSTREAM_BREAKER_FAILURES = 5
+    UPSTREAM_BREAKER_RESET_TIMEOUT = 30
+    CACHE_STALE_TTL_ORGANIZATION_STATS = 3600
+    # Upstream calls in flight at once per worker, and waiting for a slot up to ADMISSION_QUEUE_TIMEOUT seconds, by
+    # priority per endpoint (lower first, 1 by default); the rest are shed with 503
+    ADMISSION_ENABLED = True
+    ADMISSION_MAX_CONCURRENCY = 16
+    ADMISSION_MAX_QUEUE = 32
+    ADMISSION_QUEUE_TIMEOUT = 0.5
+    ADMISSION_RETRY_AFTER = 1
+    ADMISSION_PRIORITIES = {'organization_stats': 0, 'chubbiest_repositories': 0}
+    # Upstream transport: connections kept alive per worker, timeouts in seconds
+    GITHUB_POOL_SIZE = int(os.getenv('GITHUB_POOL_SIZE', 10))
+    GITHUB_CONNECT_TIMEOUT = 3.05
+    GITHUB_READ_TIMEOUT = 10
+    GITHUB_RETRIES = 3
+    GITHUB_RETRY_BACKOFF = 0.3
+    # Upstream connections kept by the ASGI application, per process
+    ASYNC_GITHUB_MAX_CONNECTIONS = 1000
+    # Organizations packed in a single GraphQL document by batch queries
+    GITHUB_BATCH_SIZE = 50
+    # Queue single organization lookups for up to GITHUB_MICRO_BATCH_WINDOW seconds, or until
+    # GITHUB_MICRO_BATCH_MAX_SIZE are waiting, and fetch them in a single batch query
+    GITHUB_MICRO_BATCH_ENABLED = False
+    GITHUB_MICRO_BATCH_WINDOW = 0.005
+    GITHUB_MICRO_BATCH_MAX_SIZE = 50
 
 
 class DevelopmentConfig(Config):
     """Configurations for Development."""
     DEBUG = True
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'simple')
 
 
 class TestingConfig(Config):
     """Configurations for Testing"""
     DEBUG = True
     TESTING = True
+    CACHE_TYPE = 'simple'
+    SNAPSHOT_STORE_PATH = None
+    LEADERBOARD_REFRESH_IN_BACKGROUND = False
+    CONTAINER_PRELOAD = False
+    GITHUB_WEBHOOK_PROCESS_IN_BACKGROUND = False
 
 
 class ProductionConfig(Config):
@@ -4,11 +4,12 @@ import pytest
 from flask import url_for
 
 
-@mock.patch('requests.post')
+@mock.patch('requests.Session.post')
 def test_get_chubbiest_repositories(mock_post, client):
     mock_post.return_value.json.return_value = {
         'data': {
             'search': {
+                'pageInfo': {'endCursor': None, 'hasNextPage': False},
                 'edges': [
                     {'node': {'name': 'react', 'stargazers': {'totalCount': 79799}}},
                     {'node': {'name': 'd3', 'stargazers': {'totalCount': 69548}}},
@@ -41,11 +42,12 @@ def test_get_chubbiest_repositories(mock_post, client):
     assert http_response.mimetype == 'application/json'
 
 
-@mock.patch('requests.post')
+@mock.patch('requests.Session.post')
 def test_get_chubbiest_repositories_with_limit(mock_post, client):
     mock_post.return_value.json.return_value = {
         'data': {
             'search': {
+                'pageInfo': {'endCursor': None, 'hasNextPage': False},
                 'edges': [
                     {'node': {'name': 'react', 'stargazers': {'totalCount': 79799}}},
                 ]
@@ -60,8 +62,8 @@ def test_get_chubbiest_repositories_with_limit(mock_post, client):
 
 @pytest.mark.parametrize('limit,expected_json', [
     ('asdf', {'message': 'limit: Is not integer', 'type': 'PARAMETERS_ERROR'}),
-    (0, {'message': 'limit: Must be between 1 and 100, both included', 'type': 'PARAMETERS_ERROR'}),
-    ('101', {'message': 'limit: Must be between 1 and 100, both included', 'type': 'PARAMETERS_ERROR'}),
+    (0, {'message': 'limit: Must be between 1 and 1000, both included', 'type': 'PARAMETERS_ERROR'}),
+    ('1001', {'message': 'limit: Must be between 1 and 1000, both included', 'type': 'PARAMETERS_ERROR'}),
 ])
 def test_get_chubbiest_repositories_invalid_limit(client, limit, expected_json):
     http_response = client.get(url_for('api.chubbiest_repositories'), query_string={'limit': limit})
@@ -3,7 +3,7 @@ from unittest import mock
 from flask import url_for
 
 
-@mock.patch('requests.post')
+@mock.patch('requests.Session.post')
 def test_org_stats(mock_post, client):
     mock_post.return_value.json.return_value = {
         'data': {
@@ -27,7 +27,7 @@ def test_org_stats(mock_post, client):
     assert http_response.mimetype == 'application/json'
 
 
-@mock.patch('requests.post')
+@mock.patch('requests.Session.post')
 def test_org_stats_not_found(mock_post, client):
     mock_post.return_value.json.return_value = {
         "data": {"organization": None},
@@ -48,3 +48,37 @@ def test_org_stats_not_found(mock_post, client):
     }
     assert http_response.status_code == 404
     assert http_response.mimetype == 'application/json'
+
+
+@mock.patch('requests.Session.post')
+def test_org_stats_batch(mock_post, client):
+    mock_post.return_value.json.return_value = {
+        'data': {
+            'org0': {
+                'repositories': {
+                    'nodes': [{'name': 'dj-txmoney', 'stargazers': {'totalCount': 4}}],
+                    'totalCount': 4
+                }
+            },
+            'org1': None
+        },
+        'errors': [{
+            'message': "Could not resolve to an Organization with the login of '3434'.",
+            'type': 'NOT_FOUND',
+            'path': ['org1'],
+        }]
+    }
+    http_response = client.post(url_for('api.organization_stats_batch'),
+                                json={'organization_names': ['Txerpa', '3434']})
+    assert http_response.json == {
+        'Txerpa': {
+            'type': 'SUCCESS',
+            'value': {'chubby_repository': {'name': 'dj-txmoney', 'stars': 4}, 'repositories_count': 4}
+        },
+        '3434': {
+            'type': 'RESOURCE_ERROR',
+            'message': "Could not resolve to an Organization with the login of '3434'."
+        }
+    }
+    assert http_response.status_code == 200
+    assert mock_post.call_count == 1
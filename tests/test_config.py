@@ -5,16 +5,23 @@ from chubbyrepo import create_app
 
 
 @pytest.mark.parametrize("environ, expected_config", [
-    ("development", {'SECRET_KEY': 'SUPER SECRET KEY', 'DEBUG': True, 'TESTING': False}),
-    ("testing", {'SECRET_KEY': 'SUPER SECRET KEY', 'DEBUG': True, 'TESTING': True}),
-    ("production", {'SECRET_KEY': None, 'DEBUG': False, 'TESTING': False}),
+    ("development", {'SECRET_KEY': 'SUPER SECRET KEY', 'DEBUG': True, 'TESTING': False, 'CACHE_TYPE': 'simple'}),
+    ("testing", {'SECRET_KEY': 'SUPER SECRET KEY', 'DEBUG': True, 'TESTING': True, 'CACHE_TYPE': 'simple'}),
+    ("production", {'SECRET_KEY': None, 'DEBUG': False, 'TESTING': False, 'CACHE_TYPE': 'redis'}),
 ])
 def test_config(environ, expected_config):
     app = create_app(environ)
     assert app.config['SECRET_KEY'] == expected_config['SECRET_KEY']
     assert expected_config['DEBUG'] is app.config['DEBUG']
     assert expected_config['TESTING'] is app.config['TESTING']
-    assert app.config['CACHE_TYPE'] == 'redis'
+    assert app.config['CACHE_TYPE'] == expected_config['CACHE_TYPE']
     assert app.config['CACHE_REDIS_HOST'] == 'chubby-cache'
     assert app.config['GITHUB_API_KEY'] is None
+    assert app.config['GITHUB_GRAPHQL_URL'] == 'https://api.github.com/graphql'
     assert current_app is not None
+
+
+def test_config_overrides():
+    app = create_app('testing', {'GITHUB_GRAPHQL_URL': 'http://127.0.0.1:8080/graphql', 'GITHUB_BATCH_SIZE': 10})
+    assert app.config['GITHUB_GRAPHQL_URL'] == 'http://127.0.0.1:8080/graphql'
+    assert app.config['GITHUB_BATCH_SIZE'] == 10
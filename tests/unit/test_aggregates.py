@@ -0,0 +1,75 @@
+import json
+import random
+
+import pytest
+
+from chubbyrepo.aggregates import OrganizationAggregate, QuantileSketch, TopK
+from chubbyrepo.core.entities import OrganizationAggregateStats, Repository
+
+
+class TestQuantileSketch:
+    def test_quantile_relative_error(self):
+        values = sorted(random.Random(42).randint(1, 100000) for _ in range(10000))
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in values:
+            sketch.add(value)
+        for q in (0.5, 0.9, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            assert sketch.quantile(q) == pytest.approx(expected, rel=0.01)
+
+    def test_quantile_with_zeros(self):
+        sketch = QuantileSketch()
+        for value in (0, 0, 0, 10):
+            sketch.add(value)
+        assert sketch.quantile(0.5) == 0
+        assert sketch.quantile(1) == pytest.approx(10, rel=0.01)
+
+    def test_quantile_empty(self):
+        assert QuantileSketch().quantile(0.5) is None
+
+    def test_bins_are_bounded(self):
+        sketch = QuantileSketch(max_bins=10)
+        for value in range(1, 1000):
+            sketch.add(value)
+        assert len(sketch.bins) == 10
+        assert sketch.quantile(1) == pytest.approx(999, rel=0.01)
+
+    def test_to_dict(self):
+        sketch = QuantileSketch()
+        for value in (0, 5, 500):
+            sketch.add(value)
+        restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+        assert restored.bins == sketch.bins
+        assert restored.quantile(0.9) == sketch.quantile(0.9)
+
+
+def test_top_k():
+    top = TopK(2)
+    for name, stars in (('a', 5), ('b', 50), ('c', 1), ('d', 20)):
+        top.add(name, stars)
+    assert top.repositories() == (Repository('b', 50), Repository('d', 20))
+
+
+class TestOrganizationAggregate:
+    def test_update(self):
+        aggregate = OrganizationAggregate(top_k=1, percentiles=(50,))
+        aggregate.update([Repository('a', 10), Repository('b', 30)], 3, 'cursor-1')
+        aggregate.update([Repository('c', 20)], 3, 'cursor-2')
+        aggregate.update([], 3, None)
+        assert aggregate.cursor == 'cursor-2'
+        stats = aggregate.organization_aggregate_stats()
+        assert stats == OrganizationAggregateStats(3, 60, {'p50': 20}, (Repository('b', 30),))
+
+    def test_organization_aggregate_stats_empty(self):
+        stats = OrganizationAggregate(percentiles=(50, 99)).organization_aggregate_stats()
+        assert stats == OrganizationAggregateStats(0, 0, {'p50': None, 'p99': None}, ())
+
+    def test_to_dict(self):
+        aggregate = OrganizationAggregate(top_k=2)
+        aggregate.update([Repository('a', 10), Repository('b', 30), Repository('c', 20)], 3, 'cursor-1')
+        aggregate.full_scan_at = aggregate.updated_at = 1500000000.0
+        restored = OrganizationAggregate.from_dict(json.loads(json.dumps(aggregate.to_dict())))
+        assert restored.organization_aggregate_stats() == aggregate.organization_aggregate_stats()
+        assert (restored.cursor, restored.full_scan_at) == ('cursor-1', 1500000000.0)
+        restored.update([Repository('d', 25)], 4, 'cursor-2')
+        assert restored.organization_aggregate_stats().top_repositories == (Repository('b', 30), Repository('d', 25))
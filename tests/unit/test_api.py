@@ -1,8 +1,16 @@
+import hashlib
+import hmac
+import json
 from unittest import mock
 
+import pytest
+
 from flask import url_for
 
-from chubbyrepo.core.responses import ResponseSuccess
+from chubbyrepo import create_app, resilience
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import UpstreamUnavailable
+from chubbyrepo.core.responses import ResponseFailure, ResponseSuccess
 
 
 @mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
@@ -15,6 +23,71 @@ def test_get_organization_stats(mock_interactor, client):
     assert http_response.mimetype == 'application/json'
 
 
+@mock.patch('chubbyrepo.gateways.StatsGateway.organization_repositories_pages')
+def test_get_organization_stats_full_detail(mock_pages, client):
+    mock_pages.return_value = iter([([Repository('repo-a', 10), Repository('repo-b', 5)], 2, 'c1')])
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp', detail='full'))
+    assert http_response.status_code == 200
+    assert http_response.json['total_stars'] == 15
+    assert http_response.json['top_repositories'] == [{'name': 'repo-a', 'stars': 10}, {'name': 'repo-b', 'stars': 5}]
+    mock_pages.assert_called_once_with('acme_corp', None)
+
+
+def test_get_organization_stats_invalid_detail(client):
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp', detail='everything'))
+    assert http_response.status_code == 400
+    assert http_response.json == {'type': 'PARAMETERS_ERROR', 'message': 'detail: Must be one of summary, full'}
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_get_organization_stats_rate_limited(mock_interactor, client):
+    mock_interactor.return_value = ResponseFailure.build_rate_limit_error('Github rate limit exhausted', 29.2)
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.json == {'type': 'RATE_LIMIT_ERROR', 'message': 'Github rate limit exhausted'}
+    assert http_response.status_code == 429
+    assert http_response.headers['Retry-After'] == '30'
+
+
+@mock.patch('requests.Session.post')
+def test_get_organization_stats_upstream_unavailable(mock_request, app, client):
+    breaker = app.extensions['circuit_breaker']
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.status_code == 503
+    assert http_response.json == {'type': 'SERVICE_UNAVAILABLE', 'message': 'Github is unavailable'}
+    assert http_response.headers['Retry-After'] == '30'
+    mock_request.assert_not_called()
+
+
+@mock.patch('requests.Session.post')
+def test_get_organization_stats_shed(mock_request, app, client):
+    admission = app.extensions['admission_controller']
+    admission.max_concurrency, admission.max_queue = 0, 0
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.status_code == 503
+    assert http_response.json == {'type': 'OVERLOADED', 'message': 'Too many requests waiting on Github'}
+    assert http_response.headers['Retry-After'] == '1'
+    mock_request.assert_not_called()
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsBatchInteractor.execute')
+def test_post_organization_stats_batch(mock_interactor, client):
+    organization_stats_data = {'acme_corp': {'type': 'SUCCESS', 'value': {'name': 'Acme Corp.', 'stars': 200}}}
+    mock_interactor.return_value = ResponseSuccess(organization_stats_data)
+    http_response = client.post(url_for('api.organization_stats_batch'), json={'organization_names': ['acme_corp']})
+    assert http_response.json == organization_stats_data
+    assert http_response.status_code == 200
+    assert http_response.mimetype == 'application/json'
+
+
+@pytest.mark.parametrize('body', [None, ['acme_corp']])
+def test_post_organization_stats_batch_without_names(client, body):
+    http_response = client.post(url_for('api.organization_stats_batch'), json=body)
+    assert http_response.json == {'message': 'organization_names: Is required', 'type': 'PARAMETERS_ERROR'}
+    assert http_response.status_code == 400
+
+
 @mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
 def test_get_chubbiest_repositories(mock_interactor, client):
     chubbiest_repos = [{'name': 'Acme Corp.', 'stars': 200}]
@@ -33,3 +106,216 @@ def test_get_chubbiest_repositories_with_limit(mock_interactor, client):
     assert http_response.json == chubbiest_repos
     assert http_response.status_code == 200
     assert http_response.mimetype == 'application/json'
+
+
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_streamed(mock_interactor, client):
+    chubbiest_repos = [{'name': 'Acme Corp.', 'stars': 200}, {'name': 'Sirius', 'stars': 100}]
+    mock_interactor.return_value = ResponseSuccess(r for r in chubbiest_repos)
+    http_response = client.get(url_for('api.chubbiest_repositories'))
+    assert http_response.json == chubbiest_repos
+    assert http_response.mimetype == 'application/json'
+
+
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_streamed_as_ndjson(mock_interactor, client):
+    chubbiest_repos = [{'name': 'Acme Corp.', 'stars': 200}, {'name': 'Sirius', 'stars': 100}]
+    mock_interactor.return_value = ResponseSuccess(r for r in chubbiest_repos)
+    http_response = client.get(url_for('api.chubbiest_repositories'), headers={'Accept': 'application/x-ndjson'})
+    assert [json.loads(line) for line in http_response.data.splitlines()] == chubbiest_repos
+    assert http_response.mimetype == 'application/x-ndjson'
+
+
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_streamed_within_deadline(mock_interactor, app, client):
+    app.config['REQUEST_DEADLINE'] = 10
+    app.config['ADMISSION_PRIORITIES'] = {'chubbiest_repositories': 0}
+
+    def repositories():
+        for name in ('Acme Corp.', 'Sirius'):
+            yield {'name': name, 'time_left': resilience.time_left() is not None,
+                   'priority': resilience._priority.get()}
+
+    mock_interactor.return_value = ResponseSuccess(repositories())
+    http_response = client.get(url_for('api.chubbiest_repositories'))
+    assert http_response.json == [{'name': 'Acme Corp.', 'time_left': True, 'priority': 0},
+                                  {'name': 'Sirius', 'time_left': True, 'priority': 0}]
+
+
+@pytest.mark.parametrize('accept', ['application/json', 'application/x-ndjson'])
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_stream_error(mock_interactor, client, accept):
+    def repositories():
+        yield {'name': 'Acme Corp.', 'stars': 200}
+        raise UpstreamUnavailable('Request deadline exceeded')
+
+    mock_interactor.return_value = ResponseSuccess(repositories())
+    http_response = client.get(url_for('api.chubbiest_repositories'), headers={'Accept': accept})
+    assert http_response.status_code == 200
+    error = {'error': {'type': 'SERVICE_UNAVAILABLE', 'message': 'Request deadline exceeded'}}
+    if accept == 'application/x-ndjson':
+        lines = [json.loads(line) for line in http_response.data.splitlines()]
+        assert lines == [{'name': 'Acme Corp.', 'stars': 200}, error]
+    else:
+        # Unterminated, so it doesn't parse as a shorter ranking
+        body = http_response.data.decode()
+        assert body.startswith('[') and not body.endswith(']')
+        assert json.loads(body + ']') == [{'name': 'Acme Corp.', 'stars': 200}, error]
+
+
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_from_snapshot(mock_interactor, client):
+    chubbiest_repos = [{'name': 'Acme Corp.', 'stars': 200}]
+    mock_interactor.return_value = ResponseSuccess(chubbiest_repos, {'snapshot_age': 42.7})
+    http_response = client.get(url_for('api.chubbiest_repositories'))
+    assert http_response.json == chubbiest_repos
+    assert http_response.headers['X-Snapshot-Age'] == '42'
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_get_organization_stats_is_cacheable(mock_interactor, client, config):
+    mock_interactor.return_value = ResponseSuccess({'name': 'Acme Corp.', 'stars': 200})
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    etag, is_weak = http_response.get_etag()
+    assert etag and not is_weak
+    assert http_response.cache_control.public
+    assert http_response.cache_control.max_age == config['CACHE_CONTROL_MAX_AGE']['organization_stats']
+
+    mock_interactor.return_value = ResponseSuccess({'stars': 200, 'name': 'Acme Corp.'})
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'),
+                               headers={'If-None-Match': '"{}"'.format(etag)})
+    assert http_response.status_code == 304
+    assert http_response.data == b''
+
+    mock_interactor.return_value = ResponseSuccess({'name': 'Acme Corp.', 'stars': 201})
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'),
+                               headers={'If-None-Match': '"{}"'.format(etag)})
+    assert http_response.status_code == 200
+    assert http_response.get_etag()[0] != etag
+
+
+@mock.patch('chubbyrepo.core.interactors.ChubbiestRepositoriesInteractor.execute')
+def test_get_chubbiest_repositories_is_cacheable(mock_interactor, client, config):
+    mock_interactor.return_value = ResponseSuccess([{'name': 'Acme Corp.', 'stars': 200}])
+    http_response = client.get(url_for('api.chubbiest_repositories'))
+    assert http_response.get_etag()[0]
+    assert http_response.cache_control.max_age == config['CACHE_CONTROL_MAX_AGE']['chubbiest_repositories']
+
+
+@mock.patch('chubbyrepo.gateways.RepositoryGateway.chubbiest_repositories_page')
+def test_get_chubbiest_repositories_from_cache_is_cacheable(mock_page, client, config):
+    mock_page.return_value = [Repository('Acme Corp.', 200)], None
+    http_response = client.get(url_for('api.chubbiest_repositories'))
+    assert http_response.json == [{'name': 'Acme Corp.', 'stars': 200}]
+    etag = http_response.get_etag()[0]
+    assert etag
+    assert http_response.cache_control.max_age == config['CACHE_CONTROL_MAX_AGE']['chubbiest_repositories']
+    http_response = client.get(url_for('api.chubbiest_repositories'), headers={'If-None-Match': '"{}"'.format(etag)})
+    assert http_response.status_code == 304
+    mock_page.assert_called_once()
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_get_without_max_age_is_only_validated(mock_interactor, app, client):
+    app.config['CACHE_CONTROL_MAX_AGE'] = {}
+    mock_interactor.return_value = ResponseSuccess({'name': 'Acme Corp.', 'stars': 200})
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.get_etag()[0]
+    assert http_response.cache_control.max_age is None
+    assert not http_response.cache_control.public
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_get_organization_stats_failures_are_not_cacheable(mock_interactor, client):
+    mock_interactor.return_value = ResponseFailure.build_resource_error('Not found')
+    http_response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.status_code == 404
+    assert http_response.get_etag() == (None, None)
+    assert http_response.cache_control.max_age is None
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsBatchInteractor.execute')
+def test_post_organization_stats_batch_is_not_cacheable(mock_interactor, client):
+    mock_interactor.return_value = ResponseSuccess({})
+    http_response = client.post(url_for('api.organization_stats_batch'), json={'organization_names': ['acme_corp']})
+    assert http_response.get_etag() == (None, None)
+
+
+def test_get_organization_stats_history(tmpdir):
+    app = create_app('testing', {'SNAPSHOT_STORE_PATH': str(tmpdir.join('snapshots.sqlite3'))})
+    app.extensions['container'].get('stats_snapshots').store.record(
+        'acme_corp', OrganizationStats(4, Repository('repo-test', 10)), fetched_at=1500000000)
+    with app.test_request_context():
+        http_response = app.test_client().get(url_for('api.organization_stats_history', org_name='Acme_Corp',
+                                                      limit=5))
+    assert http_response.status_code == 200
+    assert http_response.json == [{'fetched_at': 1500000000.0, 'organization_stats': {
+        'repositories_count': 4, 'chubby_repository': {'name': 'repo-test', 'stars': 10}}}]
+    assert http_response.cache_control.max_age == app.config['CACHE_CONTROL_MAX_AGE']['organization_stats_history']
+
+
+def test_get_organization_stats_history_disabled(client):
+    http_response = client.get(url_for('api.organization_stats_history', org_name='acme_corp'))
+    assert http_response.status_code == 404
+    assert http_response.json == {'type': 'RESOURCE_ERROR', 'message': 'Organization stats history is disabled'}
+
+
+def sign(body: bytes, secret: str = 'secret') -> str:
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def test_post_github_webhook():
+    app = create_app('testing', {'GITHUB_WEBHOOK_SECRET': 'secret'})
+    stats_gateway = app.extensions['container'].get('stats_gateway')
+    with app.test_request_context():
+        stats_gateway.update('acme_corp', OrganizationStats(4, Repository('repo-test', 10)))
+        body = json.dumps({'action': 'created', 'repository': {
+            'name': 'repo-new', 'stargazers_count': 11, 'owner': {'login': 'acme_corp'}}}).encode()
+        http_response = app.test_client().post(url_for('api.github_webhook'), data=body, headers={
+            'Content-Type': 'application/json', 'X-GitHub-Event': 'star', 'X-GitHub-Delivery': '1',
+            'X-Hub-Signature-256': sign(body)})
+        assert http_response.status_code == 202
+        assert stats_gateway.cached('acme_corp') == OrganizationStats(4, Repository('repo-new', 11))
+
+
+def test_post_github_webhook_with_invalid_signature():
+    app = create_app('testing', {'GITHUB_WEBHOOK_SECRET': 'secret'})
+    with app.test_request_context():
+        http_response = app.test_client().post(url_for('api.github_webhook'), data=b'{}', headers={
+            'X-GitHub-Event': 'star', 'X-Hub-Signature-256': sign(b'{}', 'other')})
+    assert http_response.status_code == 400
+    assert http_response.json == {'type': 'PARAMETERS_ERROR', 'message': 'Invalid signature'}
+
+
+def test_post_github_webhook_with_invalid_payload():
+    app = create_app('testing', {'GITHUB_WEBHOOK_SECRET': 'secret'})
+    with app.test_request_context():
+        http_response = app.test_client().post(url_for('api.github_webhook'), data=b'[', headers={
+            'X-GitHub-Event': 'star', 'X-Hub-Signature-256': sign(b'[')})
+    assert http_response.status_code == 400
+    assert http_response.json == {'type': 'PARAMETERS_ERROR', 'message': 'Invalid payload'}
+
+
+def test_post_github_webhook_with_unknown_event():
+    app = create_app('testing', {'GITHUB_WEBHOOK_SECRET': 'secret'})
+    body = json.dumps({'action': 'opened', 'issue': {}}).encode()
+    with app.test_request_context():
+        http_response = app.test_client().post(url_for('api.github_webhook'), data=body, headers={
+            'Content-Type': 'application/json', 'X-GitHub-Event': 'issues', 'X-Hub-Signature-256': sign(body)})
+    assert http_response.status_code == 202
+
+
+def test_post_github_webhook_with_full_queue():
+    app = create_app('testing', {'GITHUB_WEBHOOK_SECRET': 'secret'})
+    body = json.dumps({'repository': {'name': 'repo-a', 'owner': {'login': 'acme_corp'}}}).encode()
+    with app.test_request_context(), mock.patch('chubbyrepo.webhooks.WebhookProcessor.submit', return_value=False):
+        http_response = app.test_client().post(url_for('api.github_webhook'), data=body, headers={
+            'Content-Type': 'application/json', 'X-GitHub-Event': 'star', 'X-Hub-Signature-256': sign(body)})
+    assert http_response.status_code == 503
+    assert http_response.headers['Retry-After'] == '1'
+
+
+def test_post_github_webhook_disabled(client):
+    http_response = client.post(url_for('api.github_webhook'), data=b'{}')
+    assert http_response.status_code == 404
+    assert http_response.json == {'type': 'RESOURCE_ERROR', 'message': 'Github webhooks are disabled'}
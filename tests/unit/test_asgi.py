@@ -0,0 +1,135 @@
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+
+from chubbyrepo.asgi import create_asgi_app
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import DoesNotExist, RateLimitExceeded
+
+
+def call(app, method, path, query_string=b'', body=b''):
+    """Run one HTTP request through the ASGI app and return (status, headers, json body)."""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string}
+    asyncio.run(app(scope, receive, send))
+    return messages[0]['status'], dict(messages[0]['headers']), json.loads(messages[1]['body'])
+
+
+@pytest.fixture
+def asgi_app():
+    return create_asgi_app('testing')
+
+
+@mock.patch('chubbyrepo.gateways.AsyncStatsGateway.organization_stats')
+def test_organization_stats(mock_organization_stats, asgi_app):
+    mock_organization_stats.return_value = OrganizationStats(4, Repository('dj-txmoney', 4))
+    status, headers, body = call(asgi_app, 'GET', '/organizations/Txerpa/stats')
+    assert status == 200
+    assert headers[b'content-type'] == b'application/json'
+    assert body == {'chubby_repository': {'name': 'dj-txmoney', 'stars': 4}, 'repositories_count': 4}
+    mock_organization_stats.assert_awaited_once_with('Txerpa')
+
+
+@mock.patch('chubbyrepo.gateways.AsyncStatsGateway.organization_stats')
+def test_organization_stats_not_found(mock_organization_stats, asgi_app):
+    mock_organization_stats.side_effect = DoesNotExist('Not found')
+    status, _, body = call(asgi_app, 'GET', '/organizations/3434/stats')
+    assert status == 404
+    assert body == {'type': 'RESOURCE_ERROR', 'message': 'Not found'}
+
+
+@mock.patch('chubbyrepo.gateways.AsyncStatsGateway.organization_stats')
+def test_organization_stats_rate_limited(mock_organization_stats, asgi_app):
+    mock_organization_stats.side_effect = RateLimitExceeded('Github rate limit exhausted', 30)
+    status, headers, _ = call(asgi_app, 'GET', '/organizations/3434/stats')
+    assert status == 429
+    assert headers[b'retry-after'] == b'30'
+
+
+@mock.patch('chubbyrepo.gateways.AsyncStatsGateway.organization_stats_many')
+def test_organization_stats_batch(mock_organization_stats_many, asgi_app):
+    mock_organization_stats_many.return_value = {'3434': DoesNotExist('Not found')}
+    status, _, body = call(asgi_app, 'POST', '/organizations/stats', body=b'{"organization_names": ["3434"]}')
+    assert status == 200
+    assert body == {'3434': {'type': 'RESOURCE_ERROR', 'message': 'Not found'}}
+
+
+def test_organization_stats_batch_invalid_body(asgi_app):
+    status, _, body = call(asgi_app, 'POST', '/organizations/stats', body=b'not json')
+    assert status == 400
+    assert body == {'type': 'PARAMETERS_ERROR', 'message': 'organization_names: Is required'}
+
+
+@mock.patch('chubbyrepo.gateways.AsyncRepositoryGateway.chubbiest_repositories')
+def test_chubbiest_repositories(mock_chubbiest_repositories, asgi_app):
+    mock_chubbiest_repositories.return_value = [Repository('react', 79799)]
+    status, _, body = call(asgi_app, 'GET', '/chubbiest_repositories', query_string=b'limit=1')
+    assert status == 200
+    assert body == [{'name': 'react', 'stars': 79799}]
+    mock_chubbiest_repositories.assert_awaited_once_with(1)
+
+
+@pytest.mark.parametrize('method,path,expected_status', [
+    ('GET', '/unknown', 404),
+    ('POST', '/chubbiest_repositories', 405),
+])
+def test_unknown_routes(asgi_app, method, path, expected_status):
+    status, _, _ = call(asgi_app, method, path)
+    assert status == expected_status
+
+
+def test_lifespan(asgi_app):
+    messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert asgi_app.client is None
+
+
+def test_lifespan_without_startup(asgi_app):
+    messages = iter([{'type': 'lifespan.unknown'}, {'type': 'lifespan.shutdown'}])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(asgi_app({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.shutdown.complete']
+
+
+def test_other_scopes_are_ignored(asgi_app):
+    send = mock.AsyncMock()
+    asyncio.run(asgi_app({'type': 'websocket'}, mock.AsyncMock(), send))
+    send.assert_not_called()
+
+
+@mock.patch('chubbyrepo.gateways.AsyncRepositoryGateway.chubbiest_repositories')
+@mock.patch('chubbyrepo.gateways.AsyncStatsGateway.organization_stats')
+def test_requests_share_client_and_stats_gateway(mock_organization_stats, mock_chubbiest_repositories, asgi_app):
+    mock_organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+    mock_chubbiest_repositories.return_value = [Repository('react', 79799)]
+    for _ in range(2):
+        assert call(asgi_app, 'GET', '/organizations/acme_corp/stats')[0] == 200
+        assert call(asgi_app, 'GET', '/chubbiest_repositories')[0] == 200
+    stats_gateway = asgi_app.stats_gateway
+    assert asgi_app._stats_gateway() is stats_gateway
+    assert stats_gateway.client is asgi_app.client
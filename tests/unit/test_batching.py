@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+
+from chubbyrepo import metrics
+from chubbyrepo.batching import AsyncMicroBatcher, MicroBatcher
+from chubbyrepo.core.gateways import DoesNotExist, RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.resilience import deadline
+
+
+def load_concurrently(batcher, fn, keys):
+    """Load every key from its own thread and return the results, or the errors, by key."""
+    outcomes = {}
+
+    def load(key):
+        try:
+            outcomes[key] = batcher.load(key, fn)
+        except Exception as exc:
+            outcomes[key] = exc
+
+    threads = [threading.Thread(target=load, args=(key,)) for key in keys]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def batch_function(keys):
+    return {key: DoesNotExist('Not found') if key == 'missing' else key.upper() for key in keys}
+
+
+def test_concurrent_loads_are_batched():
+    fn = mock.Mock(side_effect=batch_function)
+    outcomes = load_concurrently(MicroBatcher(window=0.2, max_size=3), fn, ['a', 'b', 'c'])
+    assert outcomes == {'a': 'A', 'b': 'B', 'c': 'C'}
+    fn.assert_called_once()
+    assert sorted(fn.call_args[0][0]) == ['a', 'b', 'c']
+
+
+def test_batch_is_sent_after_window():
+    fn = mock.Mock(side_effect=batch_function)
+    assert MicroBatcher(window=0.001, max_size=50).load('a', fn) == 'A'
+    fn.assert_called_once_with(['a'])
+
+
+def test_batch_is_sent_when_full():
+    fn = mock.Mock(side_effect=batch_function)
+    batcher = MicroBatcher(window=10, max_size=2)
+    outcomes = load_concurrently(batcher, fn, ['a', 'b', 'c', 'd'])
+    assert outcomes == {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+    assert fn.call_count == 2
+
+
+def test_same_key_is_loaded_once():
+    fn = mock.Mock(side_effect=batch_function)
+    outcomes = load_concurrently(MicroBatcher(window=0.2, max_size=3), fn, ['a', 'a', 'b'])
+    assert outcomes == {'a': 'A', 'b': 'B'}
+    fn.assert_called_once()
+    assert sorted(fn.call_args[0][0]) == ['a', 'b']
+
+
+def test_errors_are_returned_to_their_callers():
+    fn = mock.Mock(side_effect=batch_function)
+    outcomes = load_concurrently(MicroBatcher(window=0.2, max_size=2), fn, ['a', 'missing'])
+    assert outcomes['a'] == 'A'
+    assert isinstance(outcomes['missing'], DoesNotExist)
+
+
+def test_batch_failure_is_raised_to_every_caller():
+    fn = mock.Mock(side_effect=RateLimitExceeded('Boom', 30))
+    outcomes = load_concurrently(MicroBatcher(window=0.2, max_size=2), fn, ['a', 'b'])
+    assert [(str(error), error.retry_after) for error in outcomes.values()] == [('Boom', 30), ('Boom', 30)]
+    assert all(isinstance(error, RateLimitExceeded) for error in outcomes.values())
+    # Every caller raises its own copy
+    assert outcomes['a'] is not outcomes['b']
+    assert outcomes['a'].__cause__ is outcomes['b'].__cause__
+
+
+def test_same_key_errors_are_not_shared():
+    fn = mock.Mock(side_effect=batch_function)
+    batcher = MicroBatcher(window=0.2, max_size=50)
+    errors = []
+
+    def load():
+        try:
+            batcher.load('missing', fn)
+        except DoesNotExist as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=load) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    fn.assert_called_once_with(['missing'])
+    assert len(errors) == 2 and errors[0] is not errors[1]
+
+
+def test_followers_wait_within_their_deadline():
+    release = threading.Event()
+    batcher = MicroBatcher(window=0.01, max_size=50)
+
+    def blocked(keys):
+        release.wait(1)
+        return batch_function(keys)
+
+    leader = threading.Thread(target=batcher.load, args=('a', blocked))
+    leader.start()
+    try:
+        with deadline(0.05), pytest.raises(UpstreamUnavailable):
+            batcher.load('b', blocked)
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_batch_size_and_wait_are_observed():
+    samples = metrics.BATCH_SIZE.samples().get(('MicroBatcher',), [0] * 10)
+    load_concurrently(MicroBatcher(window=0.2, max_size=2), batch_function, ['a', 'b'])
+    assert metrics.BATCH_SIZE.samples()[('MicroBatcher',)][-1] == samples[-1] + 1
+    assert metrics.BATCH_SIZE.samples()[('MicroBatcher',)][-2] == samples[-2] + 2
+    assert metrics.BATCH_WAIT.samples()[('MicroBatcher',)][-1] >= 2
+
+
+def test_from_config():
+    config = {'GITHUB_MICRO_BATCH_ENABLED': True, 'GITHUB_MICRO_BATCH_WINDOW': 0.01, 'GITHUB_MICRO_BATCH_MAX_SIZE': 20}
+    for batcher in (MicroBatcher.from_config(config), AsyncMicroBatcher.from_config(config)):
+        assert (batcher.window, batcher.max_size) == (0.01, 20)
+    for batcher_class in (MicroBatcher, AsyncMicroBatcher):
+        assert batcher_class.from_config(dict(config, GITHUB_MICRO_BATCH_ENABLED=False)) is None
+
+
+class TestAsyncMicroBatcher:
+    @staticmethod
+    def fn():
+        async def batch(keys):
+            return batch_function(keys)
+        return mock.AsyncMock(side_effect=batch)
+
+    def test_concurrent_loads_are_batched(self):
+        batcher, fn = AsyncMicroBatcher(window=0.01, max_size=50), self.fn()
+
+        async def main():
+            return await asyncio.gather(*[batcher.load(key, fn) for key in ('a', 'b', 'a')])
+
+        assert asyncio.run(main()) == ['A', 'B', 'A']
+        fn.assert_awaited_once_with(['a', 'b'])
+
+    def test_batch_is_sent_when_full(self):
+        batcher, fn = AsyncMicroBatcher(window=10, max_size=2), self.fn()
+
+        async def main():
+            return await asyncio.gather(*[batcher.load(key, fn) for key in ('a', 'b', 'c', 'd')])
+
+        assert asyncio.run(main()) == ['A', 'B', 'C', 'D']
+        assert fn.await_count == 2
+
+    def test_errors_are_returned_to_their_callers(self):
+        batcher, fn = AsyncMicroBatcher(window=0.01, max_size=50), self.fn()
+
+        async def main():
+            return await asyncio.gather(batcher.load('a', fn), batcher.load('missing', fn), return_exceptions=True)
+
+        found, missing = asyncio.run(main())
+        assert found == 'A'
+        assert isinstance(missing, DoesNotExist)
+
+    def test_batch_failure_is_raised_to_every_caller(self):
+        batcher, fn = AsyncMicroBatcher(window=0.01, max_size=50), mock.AsyncMock(side_effect=Exception('Boom'))
+
+        async def main():
+            return await asyncio.gather(batcher.load('a', fn), batcher.load('b', fn), return_exceptions=True)
+
+        first, second = asyncio.run(main())
+        assert (str(first), str(second)) == ('Boom', 'Boom')
+        assert first is not second
+
+    def test_cancelled_caller_does_not_cancel_the_batch(self):
+        batcher, fn = AsyncMicroBatcher(window=0.01, max_size=50), self.fn()
+
+        async def main():
+            cancelled = asyncio.ensure_future(batcher.load('a', fn))
+            other = asyncio.ensure_future(batcher.load('b', fn))
+            await asyncio.sleep(0)
+            cancelled.cancel()
+            return await other
+
+        assert asyncio.run(main()) == 'B'
+        fn.assert_awaited_once_with(['a', 'b'])
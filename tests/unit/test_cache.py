@@ -0,0 +1,111 @@
+from unittest import mock
+
+import pytest
+import redis
+
+from chubbyrepo.cache import LRUCache, RedisCache, SimpleCache, build_cache
+
+
+class TestSimpleCache:
+    def test_get_set_delete(self):
+        cache = SimpleCache()
+        assert cache.get('key') is None
+        cache.set('key', 'value', 10)
+        assert cache.get('key') == 'value'
+        cache.delete('key')
+        assert cache.get('key') is None
+
+    @mock.patch('chubbyrepo.cache.time.monotonic')
+    def test_expired_entries(self, mock_monotonic):
+        cache = SimpleCache()
+        mock_monotonic.return_value = 100
+        cache.set('key', 'value', 10)
+        mock_monotonic.return_value = 110
+        assert cache.get('key') is None
+
+    @mock.patch('chubbyrepo.cache.time.monotonic')
+    def test_add(self, mock_monotonic):
+        cache = SimpleCache()
+        mock_monotonic.return_value = 100
+        assert cache.add('key', 'first', 10) is True
+        assert cache.add('key', 'second', 10) is False
+        assert cache.get('key') == 'first'
+        mock_monotonic.return_value = 110
+        assert cache.add('key', 'third', 10) is True
+        assert cache.get('key') == 'third'
+
+
+class TestLRUCache:
+    def test_get_set_delete(self):
+        cache = LRUCache(10)
+        assert cache.get('key') is None
+        cache.set('key', 'value', 10)
+        assert cache.get('key') == 'value'
+        cache.delete('key')
+        assert cache.get('key') is None
+
+    @mock.patch('chubbyrepo.cache.time.monotonic')
+    def test_expired_entries(self, mock_monotonic):
+        cache = LRUCache(10)
+        mock_monotonic.return_value = 100
+        cache.set('key', 'value', 10)
+        mock_monotonic.return_value = 110
+        assert cache.get('key') is None
+        assert len(cache) == 0
+
+    def test_least_recently_used_are_evicted(self):
+        cache = LRUCache(2)
+        cache.set('a', '1', 10)
+        cache.set('b', '2', 10)
+        cache.get('a')
+        cache.set('c', '3', 10)
+        assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('1', None, '3')
+        assert len(cache) == 2
+
+    def test_add(self):
+        cache = LRUCache(10)
+        assert cache.add('key', 'first', 10) is True
+        assert cache.add('key', 'second', 10) is False
+        assert cache.get('key') == 'first'
+
+
+class TestRedisCache:
+    @pytest.fixture
+    def cache(self):
+        with mock.patch('redis.Redis') as mock_redis:
+            cache = RedisCache('chubby-cache', key_prefix='prefix:')
+        mock_redis.assert_called_once_with(host='chubby-cache', port=6379, db=0, socket_timeout=0.5,
+                                           decode_responses=True)
+        return cache
+
+    def test_operations(self, cache):
+        cache._client.get.return_value = 'value'
+        assert cache.get('key') == 'value'
+        cache._client.get.assert_called_once_with('prefix:key')
+        cache.set('key', 'value', 10)
+        cache._client.set.assert_called_once_with('prefix:key', 'value', ex=10)
+        cache._client.set.return_value = None
+        assert cache.add('key', 'value', 10) is False
+        cache._client.set.assert_called_with('prefix:key', 'value', ex=10, nx=True)
+        cache.delete('key')
+        cache._client.delete.assert_called_once_with('prefix:key')
+
+    def test_errors_are_misses(self, cache):
+        for method in ('get', 'set', 'delete'):
+            getattr(cache._client, method).side_effect = redis.ConnectionError('down')
+        assert cache.get('key') is None
+        assert cache.add('key', 'value', 10) is None
+        cache.set('key', 'value', 10)
+        cache.delete('key')
+
+
+@pytest.mark.parametrize('cache_type,expected_class', [('simple', SimpleCache), ('redis', RedisCache)])
+def test_build_cache(config, cache_type, expected_class):
+    config['CACHE_TYPE'] = cache_type
+    assert isinstance(build_cache(config), expected_class)
+
+
+def test_build_unknown_cache(config):
+    config['CACHE_TYPE'] = 'memcached'
+    with pytest.raises(ValueError):
+        build_cache(config)
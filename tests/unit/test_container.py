@@ -0,0 +1,139 @@
+from unittest import mock
+
+import pytest
+
+from flask import url_for
+
+from chubbyrepo import create_app
+from chubbyrepo.cache import LRUCache
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.interactors import OrganizationStatsInteractor
+from chubbyrepo.core.responses import ResponseSuccess
+from chubbyrepo.gateways import (
+    CachedStatsGateway, DatasetRepositoryGateway, DatasetStatsGateway, NotFoundCachedStatsGateway, StatsGateway
+)
+
+
+def test_components_are_built_once(app):
+    container = app.extensions['container']
+    interactor = container.get('organization_stats_interactor')
+    assert isinstance(interactor, OrganizationStatsInteractor)
+    assert isinstance(interactor.gateway, CachedStatsGateway)
+    assert isinstance(interactor.gateway.gateway, NotFoundCachedStatsGateway)
+    assert isinstance(interactor.gateway.gateway.gateway, StatsGateway)
+    assert container.get('organization_stats_interactor') is interactor
+    assert container.get('organization_stats_batch_interactor').gateway is interactor.gateway
+
+
+def test_disabled_components(app):
+    assert app.extensions['container'].get('stats_snapshots') is None
+    assert app.extensions['container'].get('organization_stats_history_interactor') is None
+
+
+def test_component_built_meanwhile_by_another_thread(app):
+    container, interactor = app.extensions['container'], mock.Mock()
+    with mock.patch.object(container, '_lock') as mock_lock:
+        mock_lock.__enter__.side_effect = lambda: container._components.update(
+            organization_stats_interactor=interactor)
+        assert container.get('organization_stats_interactor') is interactor
+
+
+def test_leaderboard_disabled():
+    app = create_app('testing', {'LEADERBOARD_ENABLED': False})
+    assert app.extensions['container'].get('leaderboard') is None
+    assert app.extensions['container'].get('chubbiest_repositories_interactor').leaderboard is None
+
+
+def test_not_found_cache_disabled():
+    app = create_app('testing', {'CACHE_TTL_ORGANIZATION_NOT_FOUND': 0})
+    assert isinstance(app.extensions['container'].get('stats_gateway').gateway, StatsGateway)
+
+
+def test_not_found_cache_is_per_worker(app):
+    not_found_gateway = app.extensions['container'].get('not_found_stats_gateway')
+    assert isinstance(not_found_gateway.cache, LRUCache)
+    assert not_found_gateway.cache.max_size == app.config['NOT_FOUND_CACHE_SIZE']
+    assert not_found_gateway.shared_cache is app.extensions['cache']
+
+
+def test_dataset_backend(tmpdir):
+    tmpdir.join('repositories.jsonl').write(
+        '{"owner": "acme_corp", "name": "chubby", "stargazers_count": 10}\n'
+        '{"owner": "acme_corp", "name": "repo-a", "stargazers_count": 5}\n')
+    app = create_app('testing', {'GATEWAY_BACKEND': 'dataset', 'DATASET_PATH': str(tmpdir.join('repositories.jsonl'))})
+    container = app.extensions['container']
+    assert isinstance(container.get('upstream_stats_gateway'), DatasetStatsGateway)
+    assert isinstance(container.get('upstream_repository_gateway'), DatasetRepositoryGateway)
+    assert isinstance(container.get('aggregate_stats_gateway').gateway, StatsGateway)
+    with app.test_request_context():
+        client = app.test_client()
+        response = client.get(url_for('api.organization_stats', org_name='acme_corp'))
+        assert response.json == {'repositories_count': 2, 'chubby_repository': {'name': 'chubby', 'stars': 10}}
+        response = client.get(url_for('api.chubbiest_repositories', limit=1))
+        assert response.json == [{'name': 'chubby', 'stars': 10}]
+
+
+def test_unknown_gateway_backend():
+    app = create_app('testing', {'GATEWAY_BACKEND': 'nope'})
+    with pytest.raises(ValueError):
+        app.extensions['container'].get('stats_gateway')
+
+
+def test_unknown_component(app):
+    with pytest.raises(ValueError):
+        app.extensions['container'].get('nope')
+    with pytest.raises(ValueError):
+        app.extensions['container'].override(nope=None)
+
+
+def test_preload(tmpdir):
+    app = create_app('testing', {'CONTAINER_PRELOAD': True,
+                                 'SNAPSHOT_STORE_PATH': str(tmpdir.join('snapshots.sqlite3'))})
+    assert set(app.extensions['container']._components) == set(app.extensions['container'].COMPONENTS)
+
+
+def test_snapshots_in_data_dir(tmpdir):
+    app = create_app('testing', {'DATA_DIR': str(tmpdir.join('data')), 'SNAPSHOT_STORE_PATH': 'snapshots.sqlite3'})
+    store = app.extensions['container'].get('stats_snapshots').store
+    assert store.path == str(tmpdir.join('data', 'snapshots.sqlite3'))
+    assert store.retention == app.config['SNAPSHOT_STORE_RETENTION']
+
+
+def test_snapshots_at_uri(tmpdir):
+    path = 'file:{}?mode=rwc'.format(tmpdir.join('snapshots.sqlite3'))
+    app = create_app('testing', {'DATA_DIR': str(tmpdir.join('data')), 'SNAPSHOT_STORE_PATH': path})
+    assert app.extensions['container'].get('stats_snapshots').store.path == path
+    assert not tmpdir.join('data').check()
+
+
+def test_providers_from_config():
+    gateway = mock.Mock()
+    gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+    app = create_app('testing', {'CONTAINER_PROVIDERS': {'upstream_stats_gateway': lambda container: gateway}})
+    with app.test_request_context():
+        response = app.test_client().get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert response.json == {'repositories_count': 4, 'chubby_repository': {'name': 'repo-test', 'stars': 10}}
+    gateway.organization_stats.assert_called_once_with('acme_corp')
+
+
+def test_providers_of_unknown_components():
+    with pytest.raises(ValueError):
+        create_app('testing', {'CONTAINER_PROVIDERS': {'nope': 'unittest.mock.Mock'}})
+
+
+def test_providers_from_import_path():
+    app = create_app('testing', {'CONTAINER_PROVIDERS': {'leaderboard': 'unittest.mock.Mock'}})
+    assert isinstance(app.extensions['container'].get('leaderboard'), mock.Mock)
+
+
+def test_override(app, client):
+    interactor = mock.Mock()
+    interactor.execute.return_value = ResponseSuccess({'fake': True})
+    app.extensions['container'].override(organization_stats_interactor=interactor)
+    assert client.get(url_for('api.organization_stats', org_name='acme_corp')).json == {'fake': True}
+
+
+def test_after_fork(app):
+    session = app.extensions['github_session']
+    app.extensions['container'].after_fork()
+    assert app.extensions['github_session'] is not session
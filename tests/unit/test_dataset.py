@@ -0,0 +1,162 @@
+import importlib
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from chubbyrepo import dataset as dataset_module
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import DoesNotExist
+from chubbyrepo.dataset import RepositoryDataset
+
+
+def write_rows(path, rows, mtime=None):
+    with open(str(path), 'w') as f:
+        for row in rows:
+            f.write((row if isinstance(row, str) else json.dumps(row)) + '\n')
+    if mtime is not None:
+        os.utime(str(path), (mtime, mtime))
+
+
+def row(owner, name, stars, **extra):
+    return dict({'owner': {'login': owner}, 'name': name, 'stargazers_count': stars}, **extra)
+
+
+@pytest.fixture
+def dataset(tmpdir):
+    path = tmpdir.join('repositories.jsonl')
+    write_rows(path, [
+        row('acme_corp', 'repo-a', 5), row('acme_corp', 'chubby', 10), {'owner': 'other', 'name': 'big',
+                                                                        'stargazers_count': 100},
+        row('acme_corp', 'secret', 1000, private=True), '', '{"owner": "acme_corp", "name": "trunc',
+        row('acme_corp', 'repo-b', '7'),
+    ])
+    dataset = RepositoryDataset(str(path))
+    assert dataset.reload()
+    return dataset
+
+
+def test_indexes_organizations(dataset):
+    assert dataset.organization_stats('acme_corp') == OrganizationStats(2, Repository('chubby', 10))
+    assert dataset.organization_stats('ACME_Corp') == OrganizationStats(2, Repository('chubby', 10))
+    assert dataset.organization_stats('other') == OrganizationStats(1, Repository('big', 100))
+    with pytest.raises(DoesNotExist):
+        dataset.organization_stats('missing')
+
+
+def test_ranks_repositories(dataset):
+    assert len(dataset) == 3
+    assert dataset.chubbiest_repositories(0, 2) == [Repository('big', 100), Repository('chubby', 10)]
+    assert dataset.chubbiest_repositories(2, 10) == [Repository('repo-a', 5)]
+
+
+def test_skips_invalid_lines(dataset):
+    part, = dataset._index.parts.values()
+    assert part.skipped == 2
+
+
+def test_is_empty_until_loaded(tmpdir):
+    dataset = RepositoryDataset(str(tmpdir.join('repositories.jsonl')))
+    assert len(dataset) == 0
+    with pytest.raises(DoesNotExist):
+        dataset.organization_stats('acme_corp')
+
+
+def test_reloads_changed_file(dataset):
+    index = dataset._index
+    assert not dataset.reload()
+    assert dataset._index is index
+    write_rows(dataset.path, [row('acme_corp', 'repo-a', 50)])
+    assert dataset.reload()
+    assert dataset.organization_stats('acme_corp') == OrganizationStats(1, Repository('repo-a', 50))
+    # Lookups already made keep the index they started with
+    assert index.owners['acme_corp'] == (2, 'chubby', 10)
+
+
+def test_merges_part_files(tmpdir):
+    write_rows(tmpdir.join('part-1.jsonl'), [row('acme_corp', 'repo-a', 5), row('other', 'big', 100)], 1000)
+    write_rows(tmpdir.join('part-2.jsonl'), [row('acme_corp', 'chubby', 10)], 1000)
+    write_rows(tmpdir.join('ignored.txt'), [row('acme_corp', 'huge', 1000)])
+    dataset = RepositoryDataset(str(tmpdir))
+    dataset.reload()
+    assert dataset.organization_stats('acme_corp') == OrganizationStats(2, Repository('chubby', 10))
+    assert [r.name for r in dataset.chubbiest_repositories(0, 10)] == ['big', 'chubby', 'repo-a']
+
+
+def test_reloads_only_changed_parts(tmpdir):
+    write_rows(tmpdir.join('part-1.jsonl'), [row('acme_corp', 'repo-a', 5)], 1000)
+    write_rows(tmpdir.join('part-2.jsonl'), [row('acme_corp', 'chubby', 10)], 1000)
+    dataset = RepositoryDataset(str(tmpdir))
+    dataset.reload()
+    parts = dict(dataset._index.parts)
+    write_rows(tmpdir.join('part-2.jsonl'), [row('acme_corp', 'chubby', 20)], 2000)
+    os.remove(str(tmpdir.join('part-1.jsonl')))
+    write_rows(tmpdir.join('part-3.jsonl'), [row('other', 'big', 100)], 1000)
+    assert dataset.reload()
+    assert set(dataset._index.parts) == {str(tmpdir.join('part-2.jsonl')), str(tmpdir.join('part-3.jsonl'))}
+    assert dataset._index.parts[str(tmpdir.join('part-2.jsonl'))] is not parts[str(tmpdir.join('part-2.jsonl'))]
+    assert dataset.organization_stats('acme_corp') == OrganizationStats(1, Repository('chubby', 20))
+    assert dataset.organization_stats('other') == OrganizationStats(1, Repository('big', 100))
+
+
+def test_merged_ranking_matches_a_full_load(tmpdir):
+    write_rows(tmpdir.join('part-1.jsonl'), [row('a', 'a-1', 5), row('a', 'a-2', 10), row('a', 'a-3', 5)], 1000)
+    write_rows(tmpdir.join('part-2.jsonl'), [row('b', 'b-1', 5), row('b', 'b-2', 20)], 1000)
+    write_rows(tmpdir.join('part-3.jsonl'), [row('c', 'c-1', 10)], 1000)
+    dataset = RepositoryDataset(str(tmpdir))
+    dataset.reload()
+    assert [r.name for r in dataset.chubbiest_repositories(0, 10)] == ['b-2', 'a-2', 'c-1', 'a-1', 'a-3', 'b-1']
+    assert all(part.names is None for part in dataset._index.parts.values())
+    write_rows(tmpdir.join('part-2.jsonl'), [row('b', 'b-1', 5), row('b', 'b-2', 10)], 2000)
+    assert dataset.reload()
+    ranking = [r.name for r in dataset.chubbiest_repositories(0, 10)]
+    assert ranking == ['a-2', 'b-2', 'c-1', 'a-1', 'a-3', 'b-1']
+    full_load = RepositoryDataset(str(tmpdir))
+    full_load.reload()
+    assert [r.name for r in full_load.chubbiest_repositories(0, 10)] == ranking
+
+
+def test_merged_owners_keep_the_first_part_chubbiest_on_ties(tmpdir):
+    write_rows(tmpdir.join('part-1.jsonl'), [row('acme_corp', 'first', 10)])
+    write_rows(tmpdir.join('part-2.jsonl'), [row('acme_corp', 'second', 10), row('acme_corp', 'small', 1)])
+    dataset = RepositoryDataset(str(tmpdir))
+    dataset.reload()
+    assert dataset.organization_stats('acme_corp') == OrganizationStats(3, Repository('first', 10))
+
+
+def test_loads_without_orjson(tmpdir):
+    try:
+        with mock.patch.dict('sys.modules', {'orjson': None}):
+            importlib.reload(dataset_module)
+        assert dataset_module.loads is json.loads
+        write_rows(tmpdir.join('repositories.jsonl'), [row('acme_corp', 'chubby', 10)])
+        dataset = dataset_module.RepositoryDataset(str(tmpdir.join('repositories.jsonl')))
+        dataset.reload()
+        assert dataset.organization_stats('acme_corp') == OrganizationStats(1, Repository('chubby', 10))
+    finally:
+        importlib.reload(dataset_module)
+
+
+def test_start_reloader_once_per_process(dataset):
+    with mock.patch('threading.Thread') as mock_thread:
+        dataset.start_reloader(10)
+        dataset.start_reloader(10)
+    mock_thread.assert_called_once_with(target=dataset._reload_forever, args=(10,), daemon=True,
+                                        name='dataset-reloader')
+    # Started meanwhile by another thread
+    dataset._reloader_pid = None
+    with mock.patch('threading.Thread') as mock_thread, mock.patch.object(dataset, '_lock') as mock_lock:
+        mock_lock.__enter__.side_effect = lambda: setattr(dataset, '_reloader_pid', os.getpid())
+        dataset.start_reloader(10)
+    mock_thread.assert_not_called()
+
+
+def test_reloader_survives_errors(dataset):
+    os.remove(dataset.path)
+    with mock.patch('time.sleep', side_effect=[None, None, SystemExit]) as mock_sleep, \
+            mock.patch.object(dataset, 'reload', wraps=dataset.reload) as mock_reload, pytest.raises(SystemExit):
+        dataset._reload_forever(10)
+    mock_sleep.assert_called_with(10)
+    assert mock_reload.call_count == 2
+    assert len(dataset) == 3
@@ -1,7 +1,9 @@
 import attr
 import pytest
 
-from chubbyrepo.core.entities import Entity
+from chubbyrepo.core.entities import (
+    Entity, OrganizationAggregateStats, OrganizationStats, OrganizationStatsSnapshot, Repository
+)
 
 
 @pytest.fixture()
@@ -17,3 +19,47 @@ def some_entity():
 def test_asdict(some_entity):
     entity_dict = some_entity.asdict()
     assert entity_dict == attr.asdict(some_entity)
+
+
+def test_organization_stats_from_dict():
+    organization_stats = OrganizationStats(4, Repository('repo-test', 10))
+    assert OrganizationStats.from_dict(organization_stats.asdict()) == organization_stats
+
+
+def test_asdict_nested_entities():
+    organization_stats = OrganizationStats(4, Repository('repo-test', 10))
+    assert organization_stats.asdict() == attr.asdict(organization_stats)
+
+
+def test_entities_are_frozen():
+    repository = Repository('repo-test', 10)
+    with pytest.raises(attr.exceptions.FrozenInstanceError):
+        repository.stars = 11
+    assert not hasattr(repository, '__dict__')
+
+
+def test_validated_construction():
+    with pytest.raises(TypeError):
+        Repository('repo-test', '10')
+
+
+def test_trusted_skips_validators():
+    repository = Repository.trusted('repo-test', '10')
+    assert repository.stars == '10'
+
+
+def test_trusted(some_entity):
+    organization_stats = OrganizationStats.trusted(4, Repository.trusted('repo-test', 10))
+    assert organization_stats == OrganizationStats(4, Repository('repo-test', 10))
+    assert type(some_entity).trusted('nah', 'what') == some_entity
+
+
+def test_organization_stats_snapshot_asdict():
+    snapshot = OrganizationStatsSnapshot(1500000000.0, OrganizationStats(4, Repository('repo-test', 10)))
+    assert snapshot.asdict() == attr.asdict(snapshot)
+
+
+def test_organization_aggregate_stats_asdict():
+    stats = OrganizationAggregateStats(2, 15, {'p50': 5}, (Repository('repo-a', 10), Repository('repo-b', 5)))
+    assert stats.asdict() == {'repositories_count': 2, 'total_stars': 15, 'stars_percentiles': {'p50': 5},
+                              'top_repositories': [{'name': 'repo-a', 'stars': 10}, {'name': 'repo-b', 'stars': 5}]}
@@ -1,18 +1,50 @@
+import asyncio
+import base64
+import json
+import socket
+import threading
+import time
 from unittest import mock
 
+import httpx
 import pytest
+import requests
 
-from chubbyrepo.core.entities import OrganizationStats, Repository
-from chubbyrepo.core.gateways import DoesNotExist
-from chubbyrepo.gateways import GithubGraphQLGateway, RepositoryGateway, StatsGateway
+from chubbyrepo import metrics
+from chubbyrepo.batching import AsyncMicroBatcher, MicroBatcher
+from chubbyrepo.core.entities import OrganizationAggregateStats, OrganizationStats, Repository
+from chubbyrepo.core.gateways import AsyncStatsGateway as BaseAsyncStatsGateway
+from chubbyrepo.core.gateways import RepositoryGateway as BaseRepositoryGateway
+from chubbyrepo.core.gateways import StatsGateway as BaseStatsGateway
+from chubbyrepo.core.gateways import DoesNotExist, RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.dataset import RepositoryDataset
+from chubbyrepo.cache import LRUCache, SimpleCache
+from chubbyrepo.gateways import (
+    AggregateStatsGateway, AsyncGithubGraphQLGateway, AsyncRepositoryGateway, AsyncStatsGateway,
+    CachedRepositoryGateway, CachedStatsGateway, DatasetRepositoryGateway, DatasetStatsGateway, GithubGraphQLGateway,
+    NotFoundCachedStatsGateway, PersistentStatsGateway, RepositoryGateway, StatsGateway
+)
+from chubbyrepo.ratelimit import UpstreamScheduler
+from chubbyrepo.resilience import AdmissionController, CircuitBreaker, Hedger, deadline
+from chubbyrepo.singleflight import AsyncSingleFlight
+from chubbyrepo.store import SnapshotStore
+from chubbyrepo.ttl import AdaptiveTTL
 
 
+@pytest.mark.usefixtures('app')
 class TestGithubGraphQLGateway:
     @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
     def test_execute(self, mock_get_result):
         mock_get_result.return_value = None, {'data': 'test'}
         assert GithubGraphQLGateway.execute('document') == {'data': 'test'}
-        mock_get_result.assert_called_once_with('document')
+        mock_get_result.assert_called_once_with('document', None)
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
+    def test_execute_without_single_flight(self, mock_get_result, app):
+        app.extensions['single_flight'] = None
+        mock_get_result.return_value = None, {'data': 'test'}
+        assert GithubGraphQLGateway.execute('document', {'org_name': 'test'}) == {'data': 'test'}
+        mock_get_result.assert_called_once_with('document', {'org_name': 'test'})
 
     @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
     def test_execute_with_errors(self, mock_get_result):
@@ -32,26 +64,273 @@ class TestGithubGraphQLGateway:
             GithubGraphQLGateway.execute('document')
         assert str(e.value) == 'Could not resolve to an Organization with the login of \'3434\'.'
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_get_result(self, mock_request, config):
         mock_request.return_value.json.return_value = {'data': 'data', 'errors': 'errors'}
         assert GithubGraphQLGateway._get_result('document') == ('errors', 'data')
         mock_request.assert_called_once_with(
-            GithubGraphQLGateway.url, json={'query': 'document', 'variables': {}},
-            auth=('token', config['GITHUB_API_KEY']))
+            config['GITHUB_GRAPHQL_URL'], json={'query': 'document', 'variables': {}},
+            auth=('token', config['GITHUB_API_KEY']),
+            timeout=(config['GITHUB_CONNECT_TIMEOUT'], config['GITHUB_READ_TIMEOUT']))
 
-    @mock.patch('requests.post')
-    @mock.patch('chubbyrepo.gateways.current_app')
-    def test_get_incompatible_result(self, mock_current_app, mock_request):
+    @mock.patch('requests.Session.post')
+    def test_get_incompatible_result(self, mock_request, config):
         mock_request.return_value.json.return_value = {'incompatible': 'response'}
         with pytest.raises(AssertionError) as e:
             assert GithubGraphQLGateway._get_result('document')
         assert str(e.value) == 'Received non-compatible response "{\'incompatible\': \'response\'}"'
 
+    @mock.patch('requests.Session.post')
+    def test_get_result_rotates_rate_limited_tokens(self, mock_request, app):
+        app.config['GITHUB_API_KEYS'] = ['a', 'b']
+        app.extensions['upstream_scheduler'] = UpstreamScheduler.from_config(app.config)
+        limited = mock.Mock(status_code=403, content=b'', headers={'X-RateLimit-Remaining': '0', 'Retry-After': '30'})
+        ok = mock.Mock(status_code=200, content=b'', headers={'X-RateLimit-Remaining': '4000'})
+        ok.json.return_value = {'data': 'data'}
+        mock_request.side_effect = [limited, ok]
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert [c[1]['auth'] for c in mock_request.call_args_list] == [('token', 'a'), ('token', 'b')]
+        assert app.extensions['upstream_scheduler'].counters()['token0']['rate_limited'] == 1
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_with_every_token_rate_limited(self, mock_request, app):
+        mock_request.return_value = mock.Mock(status_code=429, content=b'', headers={'Retry-After': '30'})
+        errors = metrics.UPSTREAM_ERRORS.samples().get(('GithubGraphQLGateway', 'rate_limited'), 0)
+        with pytest.raises(RateLimitExceeded) as e:
+            GithubGraphQLGateway._get_result('document')
+        assert e.value.retry_after == 30
+        assert metrics.UPSTREAM_ERRORS.samples()[('GithubGraphQLGateway', 'rate_limited')] == errors + 1
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_tracks_graphql_rate_limit(self, mock_request, app):
+        mock_request.return_value = mock.Mock(status_code=200, content=b'', headers={})
+        mock_request.return_value.json.return_value = {
+            'data': {'rateLimit': {'cost': 1, 'remaining': 42, 'resetAt': '2030-01-01T00:00:00Z'}}}
+        GithubGraphQLGateway._get_result('document')
+        assert app.extensions['upstream_scheduler'].tokens[0].remaining == 42
+        assert app.extensions['upstream_scheduler'].counters()['token0']['cost'] == 1
+
+    def test_documents_select_rate_limit(self):
+        documents = [StatsGateway.document, StatsGateway.repositories_page_document,
+                     StatsGateway._batch_document(['a', 'b'])[0], RepositoryGateway.document,
+                     RepositoryGateway.page_document]
+        for document in documents:
+            assert document.count('{') == document.count('}')
+            assert document.rstrip(' }').endswith('rateLimit { cost remaining resetAt')
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_within_deadline(self, mock_request, config):
+        mock_request.return_value.json.return_value = {'data': 'data'}
+        with deadline(1):
+            GithubGraphQLGateway._get_result('document')
+        connect_timeout, read_timeout = mock_request.call_args[1]['timeout']
+        assert 0 < connect_timeout <= 1 and 0 < read_timeout <= 1
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_past_deadline(self, mock_request):
+        with deadline(0):
+            with pytest.raises(UpstreamUnavailable):
+                GithubGraphQLGateway._get_result('document')
+        mock_request.assert_not_called()
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_timed_out_by_deadline(self, mock_request):
+        def post(*args, **kwargs):
+            time.sleep(0.01)
+            raise requests.Timeout()
+
+        mock_request.side_effect = post
+        with deadline(0.01):
+            with pytest.raises(UpstreamUnavailable) as e:
+                GithubGraphQLGateway._get_result('document')
+        assert str(e.value) == 'Request deadline exceeded'
+
+    @mock.patch('time.sleep')
+    @mock.patch('requests.Session.post')
+    def test_get_result_retried(self, mock_request, mock_sleep, config):
+        ok = mock.Mock(status_code=200, content=b'', headers={})
+        ok.json.return_value = {'data': 'data'}
+        mock_request.side_effect = [requests.ConnectionError(), mock.Mock(status_code=502), ok]
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert mock_sleep.call_args_list == [mock.call(config['GITHUB_RETRY_BACKOFF']),
+                                             mock.call(config['GITHUB_RETRY_BACKOFF'] * 2)]
+
+    def test_get_result_from_stalled_upstream(self, app):
+        stalled = socket.socket()
+        stalled.bind(('127.0.0.1', 0))
+        # Connections are accepted by the kernel backlog and never answered
+        stalled.listen(8)
+        app.config['GITHUB_GRAPHQL_URL'] = 'http://127.0.0.1:{}/graphql'.format(stalled.getsockname()[1])
+        started = time.monotonic()
+        try:
+            with deadline(0.3), pytest.raises(UpstreamUnavailable) as e:
+                GithubGraphQLGateway._get_result('document')
+        finally:
+            stalled.close()
+        assert str(e.value) == 'Request deadline exceeded'
+        assert time.monotonic() - started < 1
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_opens_circuit_breaker(self, mock_request, app):
+        app.config['UPSTREAM_BREAKER_FAILURES'] = 2
+        app.config['GITHUB_RETRIES'] = 0
+        app.extensions['circuit_breaker'] = CircuitBreaker.from_config(app.config)
+        mock_request.return_value = mock.Mock(status_code=502, content=b'', headers={})
+        mock_request.return_value.raise_for_status.side_effect = requests.HTTPError()
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                GithubGraphQLGateway._get_result('document')
+        with pytest.raises(UpstreamUnavailable) as e:
+            GithubGraphQLGateway._get_result('document')
+        assert e.value.retry_after > 0
+        assert mock_request.call_count == 2
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_hedged(self, mock_request, app):
+        hedger = app.extensions['upstream_hedger'] = mock.Mock()
+        hedger.call.side_effect = lambda fn, reserve: fn()
+        mock_request.return_value.json.return_value = {'data': 'data'}
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert hedger.call.call_count == 1
+
+    @pytest.mark.parametrize('max_concurrency, hedged', [(1, False), (2, True)])
+    @mock.patch('requests.Session.post')
+    def test_get_result_hedge_takes_an_admission_slot(self, mock_request, app, max_concurrency, hedged):
+        hedger = app.extensions['upstream_hedger'] = Hedger(min_delay=0.01, min_samples=1)
+        hedger.observe(0.001)
+        app.extensions['admission_controller'] = AdmissionController(max_concurrency, max_queue=0)
+        response = mock.Mock(status_code=200, content=b'', headers={})
+        response.json.return_value = {'data': 'data'}
+        mock_request.side_effect = lambda *args, **kwargs: time.sleep(0.05) or response
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert hedger.counters()['sent' if hedged else 'skipped'] == 1
+        assert mock_request.call_count == (2 if hedged else 1)
+        # The losing call holds its slot until it is over
+        hedger._get_executor().shutdown()
+        assert app.extensions['admission_controller'].in_flight == 0
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_hedge_answering_first_leaves_the_primary_slot_taken(self, mock_request, app):
+        hedger = app.extensions['upstream_hedger'] = Hedger(min_delay=0.01, min_samples=1)
+        hedger.observe(0.001)
+        admission = app.extensions['admission_controller'] = AdmissionController(2, max_queue=0)
+        released = threading.Event()
+        response = mock.Mock(status_code=200, content=b'', headers={})
+        response.json.return_value = {'data': 'data'}
+        calls = []
+
+        def post(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == 1:
+                released.wait(1)
+            return response
+
+        mock_request.side_effect = post
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert hedger.counters()['won'] == 1
+        # The primary call is still running
+        assert admission.in_flight == 1
+        released.set()
+        hedger._get_executor().shutdown()
+        assert admission.in_flight == 0
+
+    @pytest.mark.parametrize('admission_enabled', [True, False])
+    @mock.patch('requests.Session.post')
+    def test_get_result_hedge_needs_rate_limit_budget(self, mock_request, app, admission_enabled):
+        hedger = app.extensions['upstream_hedger'] = mock.Mock()
+        reserved = []
+        hedger.call.side_effect = lambda fn, reserve: reserved.append(reserve()) or fn()
+        if not admission_enabled:
+            app.extensions['admission_controller'] = None
+        mock_request.return_value.json.return_value = {'data': 'data'}
+        with mock.patch.object(app.extensions['upstream_scheduler'], 'try_acquire', side_effect=[False, True]):
+            for _ in range(2):
+                assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        assert reserved[0] is None
+        assert reserved[1]() is mock_request.return_value
+        assert mock_request.call_count == 3
+        if admission_enabled:
+            assert app.extensions['admission_controller'].in_flight == 0
+
+    @pytest.mark.parametrize('admission_enabled', [True, False])
+    @mock.patch('requests.Session.post')
+    def test_get_result_rejected_by_circuit_breaker_gives_its_slot_back(self, mock_request, app, admission_enabled):
+        app.extensions['circuit_breaker'] = breaker = CircuitBreaker(failure_threshold=1)
+        if not admission_enabled:
+            app.extensions['admission_controller'] = None
+        breaker.record_failure()
+        with pytest.raises(UpstreamUnavailable):
+            GithubGraphQLGateway._get_result('document')
+        if admission_enabled:
+            assert app.extensions['admission_controller'].in_flight == 0
+        mock_request.assert_not_called()
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_connection_errors_open_circuit_breaker(self, mock_request, app):
+        app.config['GITHUB_RETRIES'] = 0
+        app.extensions['circuit_breaker'] = breaker = CircuitBreaker(failure_threshold=1)
+        mock_request.side_effect = requests.ConnectionError()
+        with pytest.raises(requests.ConnectionError):
+            GithubGraphQLGateway._get_result('document')
+        assert breaker.state == CircuitBreaker.OPEN
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_without_admission_nor_circuit_breaker(self, mock_request, app):
+        app.config['GITHUB_RETRIES'] = 0
+        app.extensions['admission_controller'] = app.extensions['circuit_breaker'] = None
+        ok = mock.Mock(status_code=200, content=b'', headers={})
+        ok.json.return_value = {'data': 'data'}
+        mock_request.side_effect = [ok, requests.ConnectionError()]
+        assert GithubGraphQLGateway._get_result('document') == (None, 'data')
+        with pytest.raises(requests.ConnectionError):
+            GithubGraphQLGateway._get_result('document')
+
+        def post(*args, **kwargs):
+            time.sleep(0.02)
+            raise requests.Timeout()
+
+        mock_request.side_effect = post
+        with deadline(0.01), pytest.raises(UpstreamUnavailable):
+            GithubGraphQLGateway._get_result('document')
+        # Admitted right before the deadline, hedged posts may start after it
+        with deadline(0.01):
+            time.sleep(0.02)
+            with pytest.raises(UpstreamUnavailable) as e:
+                GithubGraphQLGateway._post_admitted(requests.Session(), {}, mock.Mock())
+        assert str(e.value) == 'Request deadline exceeded'
+        assert mock_request.call_count == 3
+
+    @mock.patch('requests.Session.post')
+    def test_get_result_deadline_exceeded_leaves_circuit_breaker_closed(self, mock_request, app):
+        app.config['GITHUB_RETRIES'] = 0
+        app.extensions['circuit_breaker'] = breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+
+        def post(*args, **kwargs):
+            time.sleep(0.02)
+            raise requests.Timeout()
+
+        mock_request.side_effect = post
+        with deadline(0.01), pytest.raises(UpstreamUnavailable):
+            GithubGraphQLGateway._get_result('document')
+        assert breaker.state == CircuitBreaker.CLOSED
+        # Nor keeps another probe from being sent
+        breaker.record_failure()
+        with deadline(0.01), pytest.raises(UpstreamUnavailable):
+            GithubGraphQLGateway._get_result('document')
+        breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert app.extensions['admission_controller'].in_flight == 0
+
+    def test_retry_after(self):
+        assert GithubGraphQLGateway._retry_after(mock.Mock(headers={'Retry-After': '5'})) == 5
+        reset = str(int(time.time()) + 100)
+        assert 98 <= GithubGraphQLGateway._retry_after(mock.Mock(headers={'X-RateLimit-Reset': reset})) <= 100
+        assert GithubGraphQLGateway._retry_after(mock.Mock(headers={})) is None
+
 
 class TestStatsGateway:
     @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
-    def test_organization_stats(self, mock_execute):
+    def test_organization_stats(self, mock_execute, app):
         mock_execute.return_value = {
             'organization': {
                 'repositories': {
@@ -63,8 +342,134 @@ class TestStatsGateway:
         assert StatsGateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
         mock_execute.assert_called_once_with(
             'query($org_name:String!) { organization(login: $org_name) { repositories(first: 1, orderBy: {'
-            'field: STARGAZERS, direction: DESC}) { nodes { name stargazers { totalCount}} totalCount}}}',
-            {"org_name": 'test'})
+            'field: STARGAZERS, direction: DESC}) { nodes { name stargazers { totalCount}} totalCount}} '
+            'rateLimit { cost remaining resetAt}}', {"org_name": 'test'})
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
+    def test_organization_stats_many(self, mock_get_result, config):
+        config['GITHUB_BATCH_SIZE'] = 2
+        mock_get_result.side_effect = [
+            ([{'message': "Could not resolve to an Organization with the login of '3434'.", 'type': 'NOT_FOUND',
+               'path': ['org1']}],
+             {'org0': {'repositories': {'nodes': [{'name': 'repo-a', 'stargazers': {'totalCount': 10}}],
+                                        'totalCount': 4}},
+              'org1': None}),
+            (None, {'org0': {'repositories': {'nodes': [{'name': 'repo-c', 'stargazers': {'totalCount': 3}}],
+                                              'totalCount': 1}}}),
+        ]
+        results = StatsGateway.organization_stats_many(['a', '3434', 'c'])
+        assert results['a'] == OrganizationStats(4, Repository('repo-a', 10))
+        assert isinstance(results['3434'], DoesNotExist)
+        assert str(results['3434']) == "Could not resolve to an Organization with the login of '3434'."
+        assert results['c'] == OrganizationStats(1, Repository('repo-c', 3))
+        assert mock_get_result.call_count == 2
+        document, variables = mock_get_result.call_args_list[0][0]
+        assert document == (
+            'query($org0:String!, $org1:String!) { '
+            'org0: organization(login: $org0) { ' + StatsGateway.repositories_fields + '} '
+            'org1: organization(login: $org1) { ' + StatsGateway.repositories_fields + '} '
+            'rateLimit { cost remaining resetAt} }')
+        assert variables == {'org0': 'a', 'org1': '3434'}
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_organization_stats_without_repositories(self, mock_execute, app):
+        mock_execute.return_value = {'organization': {'repositories': {'nodes': [], 'totalCount': 0}}}
+        assert StatsGateway.organization_stats('empty') == OrganizationStats(0, Repository('', 0))
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
+    def test_organization_stats_many_with_errors(self, mock_get_result, config):
+        mock_get_result.return_value = [{'message': 'Something went wrong'}], None
+        with pytest.raises(Exception) as e:
+            StatsGateway.organization_stats_many(['a'])
+        assert str(e.value) == 'Something went wrong'
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
+    def test_organization_stats_many_with_organization_errors(self, mock_get_result, config):
+        mock_get_result.return_value = (
+            [{'message': 'SAML enforcement', 'type': 'FORBIDDEN', 'path': ['org0']}],
+            {'org0': None, 'org1': {'repositories': {'nodes': [], 'totalCount': 0}}})
+        results = StatsGateway.organization_stats_many(['forbidden', 'empty'])
+        assert type(results['forbidden']) is Exception
+        assert str(results['forbidden']) == 'SAML enforcement'
+        assert results['empty'] == OrganizationStats(0, Repository('', 0))
+
+    @mock.patch('chubbyrepo.gateways.StatsGateway.organization_stats_many')
+    def test_organization_stats_micro_batched(self, mock_organization_stats_many, app):
+        app.extensions['stats_batcher'] = MicroBatcher(window=0.001)
+        mock_organization_stats_many.return_value = {
+            'test': OrganizationStats(4, Repository('repo-test', 10)), '3434': DoesNotExist('Not found')}
+        assert StatsGateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
+        mock_organization_stats_many.assert_called_once_with(['test'])
+        with pytest.raises(DoesNotExist):
+            StatsGateway.organization_stats('3434')
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result')
+    def test_organization_stats_micro_batched_with_organization_errors(self, mock_get_result, app):
+        app.extensions['stats_batcher'] = MicroBatcher(window=0.2, max_size=2)
+        mock_get_result.side_effect = lambda document, aliases: (
+            [{'message': 'SAML enforcement', 'type': 'FORBIDDEN',
+              'path': [next(alias for alias, name in aliases.items() if name == 'forbidden')]}],
+            {alias: None if name == 'forbidden' else {'repositories': {'nodes': [], 'totalCount': 0}}
+             for alias, name in aliases.items()})
+        outcomes = {}
+
+        def load(name):
+            with app.app_context():
+                try:
+                    outcomes[name] = StatsGateway.organization_stats(name)
+                except Exception as exc:
+                    outcomes[name] = exc
+
+        threads = [threading.Thread(target=load, args=(name,)) for name in ('forbidden', 'empty')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        mock_get_result.assert_called_once()
+        assert str(outcomes['forbidden']) == 'SAML enforcement'
+        assert outcomes['empty'] == OrganizationStats(0, Repository('', 0))
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_organization_repositories_pages(self, mock_execute):
+        mock_execute.side_effect = [
+            {'organization': {'repositories': {
+                'totalCount': 2, 'pageInfo': {'endCursor': 'c1', 'hasNextPage': True},
+                'nodes': [{'name': 'repo-a', 'stargazers': {'totalCount': 10}}]}}},
+            {'organization': {'repositories': {
+                'totalCount': 2, 'pageInfo': {'endCursor': 'c2', 'hasNextPage': False},
+                'nodes': [{'name': 'repo-b', 'stargazers': {'totalCount': 5}}]}}},
+        ]
+        pages = list(StatsGateway.organization_repositories_pages('test', 'c0'))
+        assert pages == [([Repository('repo-a', 10)], 2, 'c1'), ([Repository('repo-b', 5)], 2, 'c2')]
+        assert [c[0][1] for c in mock_execute.call_args_list] == [
+            {'org_name': 'test', 'after': 'c0'}, {'org_name': 'test', 'after': 'c1'}]
+
+
+class TestBaseStatsGateway:
+    def test_organization_stats_many(self):
+        organization_stats = OrganizationStats(4, Repository('repo-test', 10))
+        gateway = BaseStatsGateway()
+        gateway.organization_stats = mock.Mock(side_effect=[organization_stats, DoesNotExist('Not found')])
+        results = gateway.organization_stats_many(['test', 'unknown'])
+        assert results['test'] == organization_stats
+        assert isinstance(results['unknown'], DoesNotExist)
+
+    def test_async_organization_stats_many(self):
+        organization_stats = OrganizationStats(4, Repository('repo-test', 10))
+        gateway = BaseAsyncStatsGateway()
+        gateway.organization_stats = mock.AsyncMock(side_effect=[organization_stats, DoesNotExist('Not found')])
+        results = asyncio.run(gateway.organization_stats_many(['test', 'unknown']))
+        assert results['test'] == organization_stats
+        assert isinstance(results['unknown'], DoesNotExist)
+        gateway.organization_stats = mock.AsyncMock(side_effect=Exception('Boom'))
+        with pytest.raises(Exception, match='Boom'):
+            asyncio.run(gateway.organization_stats_many(['test']))
+
+    def test_chubbiest_owned_repositories(self):
+        gateway = BaseRepositoryGateway()
+        gateway.chubbiest_repositories = mock.Mock(return_value=[Repository('repo-test', 10)])
+        assert gateway.chubbiest_owned_repositories(1) == [(None, Repository('repo-test', 10))]
+        gateway.chubbiest_repositories.assert_called_once_with(1)
 
 
 class TestRepositoryGateway:
@@ -86,4 +491,650 @@ class TestRepositoryGateway:
         ]
         mock_execute.assert_called_once_with(
             'query($limit: Int!) { search(type: REPOSITORY, query: "stars:>1", first: $limit) { edges { node '
-            '{ ... on Repository { name stargazers { totalCount}}}}}}', {"limit": 3})
+            '{ ... on Repository { name stargazers { totalCount}}}}} rateLimit { cost remaining resetAt}}',
+            {"limit": 3})
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_chubbiest_repositories_paginated(self, mock_execute, app):
+        def page(names, end_cursor, has_next_page):
+            return {'search': {
+                'pageInfo': {'endCursor': end_cursor, 'hasNextPage': has_next_page},
+                'edges': [{'node': {'name': name, 'stargazers': {'totalCount': 1}}} for name in names]
+            }}
+
+        mock_execute.side_effect = [
+            page(['repo-{}'.format(i) for i in range(100)], 'cursor-1', True),
+            page(['repo-{}'.format(i) for i in range(100, 200)], 'cursor-2', True),
+            page(['repo-200', 'repo-201'], 'cursor-3', True),
+        ]
+        repositories = RepositoryGateway.chubbiest_repositories(202)
+        assert mock_execute.call_count == 1
+        assert [r.name for r in repositories] == ['repo-{}'.format(i) for i in range(202)]
+        assert mock_execute.call_args_list == [
+            mock.call(RepositoryGateway.page_document, {'limit': 100, 'after': None}),
+            mock.call(RepositoryGateway.page_document, {'limit': 100, 'after': 'cursor-1'}),
+            mock.call(RepositoryGateway.page_document, {'limit': 2, 'after': 'cursor-2'}),
+        ]
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_chubbiest_repositories_paginated_stops_on_last_page(self, mock_execute, app):
+        mock_execute.return_value = {'search': {
+            'pageInfo': {'endCursor': 'cursor-1', 'hasNextPage': False},
+            'edges': [{'node': {'name': 'repo', 'stargazers': {'totalCount': 1}}}]
+        }}
+        assert list(RepositoryGateway.chubbiest_repositories(500)) == [Repository('repo', 1)]
+        assert mock_execute.call_count == 1
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_chubbiest_owned_repositories(self, mock_execute):
+        def page(names, end_cursor, has_next_page):
+            return {'search': {
+                'pageInfo': {'endCursor': end_cursor, 'hasNextPage': has_next_page},
+                'edges': [{'node': {'name': name, 'owner': {'login': 'acme'}, 'stargazers': {'totalCount': 1}}}
+                          for name in names]
+            }}
+
+        mock_execute.side_effect = [
+            page(['repo-{}'.format(i) for i in range(100)], 'cursor-1', True),
+            page(['repo-100'], 'cursor-2', False),
+        ]
+        owned = RepositoryGateway.chubbiest_owned_repositories(150)
+        assert owned == [('acme', Repository('repo-{}'.format(i), 1)) for i in range(101)]
+        assert mock_execute.call_args_list == [
+            mock.call(RepositoryGateway.page_document, {'limit': 100, 'after': None}),
+            mock.call(RepositoryGateway.page_document, {'limit': 50, 'after': 'cursor-1'}),
+        ]
+
+    @mock.patch('chubbyrepo.gateways.GithubGraphQLGateway.execute')
+    def test_chubbiest_owned_repositories_up_to_limit(self, mock_execute):
+        mock_execute.return_value = {'search': {
+            'pageInfo': {'endCursor': 'cursor-1', 'hasNextPage': True},
+            'edges': [{'node': {'name': 'repo', 'owner': {'login': 'acme'}, 'stargazers': {'totalCount': 1}}}]
+        }}
+        assert RepositoryGateway.chubbiest_owned_repositories(1) == [('acme', Repository('repo', 1))]
+        mock_execute.assert_called_once_with(RepositoryGateway.page_document, {'limit': 1, 'after': None})
+
+
+class TestCachedStatsGateway:
+    def test_organization_stats(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        cached_gateway = CachedStatsGateway(gateway, SimpleCache(), 60)
+        assert cached_gateway.organization_stats('Test') == OrganizationStats(4, Repository('repo-test', 10))
+        assert cached_gateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
+        gateway.organization_stats.assert_called_once_with('Test')
+
+    def test_organization_stats_not_found_is_not_cached(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = DoesNotExist('Not found')
+        cached_gateway = CachedStatsGateway(gateway, SimpleCache(), 60)
+        for _ in range(2):
+            with pytest.raises(DoesNotExist):
+                cached_gateway.organization_stats('test')
+        assert gateway.organization_stats.call_count == 2
+
+    def test_organization_stats_stale_while_unavailable(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        cache = SimpleCache()
+        cached_gateway = CachedStatsGateway(gateway, cache, 60, stale_ttl=3600)
+        cached_gateway.organization_stats('test')
+        cache.delete(CachedStatsGateway.cache_key('test'))
+        gateway.organization_stats.side_effect = UpstreamUnavailable('Github is unavailable')
+        gateway.organization_stats_many.side_effect = UpstreamUnavailable('Github is unavailable')
+        assert cached_gateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
+        assert cached_gateway.organization_stats_many(['test']) == {
+            'test': OrganizationStats(4, Repository('repo-test', 10))}
+        with pytest.raises(UpstreamUnavailable):
+            cached_gateway.organization_stats('other')
+
+    @pytest.mark.parametrize('stale_ttl', [0, 3600])
+    def test_organization_stats_many_unavailable_without_stale_stats(self, stale_ttl):
+        gateway = mock.Mock()
+        gateway.organization_stats_many.side_effect = UpstreamUnavailable('Github is unavailable')
+        cached_gateway = CachedStatsGateway(gateway, SimpleCache(), 60, stale_ttl=stale_ttl)
+        with pytest.raises(UpstreamUnavailable):
+            cached_gateway.organization_stats_many(['test'])
+
+    def test_organization_stats_many(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-a', 10))
+        gateway.organization_stats_many.return_value = {
+            'b': OrganizationStats(1, Repository('repo-b', 1)), 'c': DoesNotExist('Not found')
+        }
+        cached_gateway = CachedStatsGateway(gateway, SimpleCache(), 60)
+        cached_gateway.organization_stats('a')
+        results = cached_gateway.organization_stats_many(['a', 'b', 'c'])
+        gateway.organization_stats_many.assert_called_once_with(['b', 'c'])
+        assert results['a'] == OrganizationStats(4, Repository('repo-a', 10))
+        assert results['b'] == OrganizationStats(1, Repository('repo-b', 1))
+        assert isinstance(results['c'], DoesNotExist)
+        assert cached_gateway.organization_stats('b') == OrganizationStats(1, Repository('repo-b', 1))
+        assert gateway.organization_stats.call_count == 1
+
+    def test_organization_stats_many_all_cached(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-a', 10))
+        cached_gateway = CachedStatsGateway(gateway, SimpleCache(), 60)
+        cached_gateway.organization_stats('a')
+        assert cached_gateway.organization_stats_many(['a']) == {'a': OrganizationStats(4, Repository('repo-a', 10))}
+        gateway.organization_stats_many.assert_not_called()
+
+    def test_organization_stats_adaptive_ttl(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        cache = mock.Mock(**{'get.return_value': None})
+        adaptive_ttl = mock.Mock(**{'ttl.return_value': 1800})
+        cached_gateway = CachedStatsGateway(gateway, cache, 60, stale_ttl=3600, adaptive_ttl=adaptive_ttl)
+        cached_gateway.organization_stats('Test')
+        adaptive_ttl.ttl.assert_called_once_with('test', {
+            'repositories_count': 4, 'chubby_repository': {'name': 'repo-test', 'stars': 10}}, 60)
+        assert [c[0][2] for c in cache.set.call_args_list] == [1800, 5400]
+
+    def test_update_with_adaptive_ttl_is_not_a_fetch(self):
+        cache = mock.Mock()
+        adaptive_ttl = mock.Mock(**{'remaining.return_value': 20})
+        cached_gateway = CachedStatsGateway(mock.Mock(), cache, 60, stale_ttl=3600, adaptive_ttl=adaptive_ttl)
+        cached_gateway.update('Test', OrganizationStats(4, Repository('repo-test', 10)))
+        adaptive_ttl.ttl.assert_not_called()
+        adaptive_ttl.remaining.assert_called_once_with('test', 60)
+        assert [c[0][2] for c in cache.set.call_args_list] == [20, 3620]
+
+    @mock.patch('time.time', return_value=1000)
+    def test_update_keeps_the_ttl_left(self, mock_time):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        cache = SimpleCache()
+        cached_gateway = CachedStatsGateway(gateway, cache, 60, stale_ttl=3600)
+        cached_gateway.organization_stats('Test')
+        mock_time.return_value = 1040
+        with mock.patch.object(cache, 'set', wraps=cache.set) as mock_set:
+            cached_gateway.update('Test', OrganizationStats(5, Repository('repo-test', 10)))
+        assert [c[0][2] for c in mock_set.call_args_list] == [20, 3620]
+        assert json.loads(cache.get('organization_stats:test'))['expires_at'] == 1060
+        assert cached_gateway.cached('test') == OrganizationStats(5, Repository('repo-test', 10))
+
+    def test_update_of_stats_not_cached_or_cached_without_expiry(self):
+        cache = SimpleCache()
+        cached_gateway = CachedStatsGateway(mock.Mock(), cache, 60)
+        with mock.patch.object(cache, 'set', wraps=cache.set) as mock_set:
+            cached_gateway.update('a', OrganizationStats(4, Repository('repo-test', 10)))
+            cache.set('organization_stats:b', json.dumps(OrganizationStats(1, Repository('repo-b', 1)).asdict()), 60)
+            cached_gateway.update('b', OrganizationStats(2, Repository('repo-b', 1)))
+        assert [c[0][2] for c in mock_set.call_args_list] == [60, 60, 60]
+
+    def test_organization_stats_adaptive_ttl_observed_by_wrapped_gateway(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        cache = mock.Mock(**{'get.return_value': None})
+        adaptive_ttl = mock.Mock(**{'remaining.return_value': -5})
+        cached_gateway = CachedStatsGateway(gateway, cache, 60, stale_ttl=3600, adaptive_ttl=adaptive_ttl,
+                                            observe_fetches=False)
+        cached_gateway.organization_stats('Test')
+        adaptive_ttl.ttl.assert_not_called()
+        assert [c[0][2] for c in cache.set.call_args_list] == [3600]
+
+
+class TestPersistentStatsGateway:
+    @pytest.fixture
+    def store(self, tmpdir):
+        return SnapshotStore(str(tmpdir.join('snapshots.sqlite3')))
+
+    def test_organization_stats(self, store):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        persistent_gateway = PersistentStatsGateway(gateway, store, 60)
+        assert persistent_gateway.organization_stats('Test') == OrganizationStats(4, Repository('repo-test', 10))
+        assert persistent_gateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
+        gateway.organization_stats.assert_called_once_with('Test')
+        assert store.latest('test').organization_stats == OrganizationStats(4, Repository('repo-test', 10))
+
+    def test_organization_stats_adaptive_ttl(self, store):
+        adaptive_ttl = AdaptiveTTL(SimpleCache(), 'organization_stats', 60, 3600)
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        persistent_gateway = PersistentStatsGateway(gateway, store, 300, adaptive_ttl=adaptive_ttl)
+        persistent_gateway.organization_stats('Test')
+        fetched_at = store.latest('test').fetched_at
+        assert adaptive_ttl.remaining('test', 300, now=fetched_at) == 300
+
+    def test_organization_stats_snapshot_past_adaptive_ttl_is_stale(self, store):
+        adaptive_ttl = AdaptiveTTL(SimpleCache(), 'organization_stats', 60, 3600)
+        store.record('test', OrganizationStats(4, Repository('repo-test', 1)), time.time() - 200)
+        store.record('test', OrganizationStats(4, Repository('repo-test', 100)), time.time() - 100)
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 101))
+        persistent_gateway = PersistentStatsGateway(gateway, store, 300, adaptive_ttl=adaptive_ttl)
+        adaptive_ttl.observe('test', OrganizationStats(4, Repository('repo-test', 1)).asdict(), 300,
+                             time.time() - 200)
+        assert persistent_gateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 101))
+        gateway.organization_stats.assert_called_once_with('test')
+
+    def test_organization_stats_recorded_before_restart(self, store):
+        store.record('test', OrganizationStats(4, Repository('repo-test', 10)))
+        gateway = mock.Mock()
+        assert PersistentStatsGateway(gateway, store, 60).organization_stats('test') == OrganizationStats(
+            4, Repository('repo-test', 10))
+        assert not gateway.organization_stats.called
+
+    def test_organization_stats_too_old(self, store):
+        store.record('test', OrganizationStats(4, Repository('repo-test', 10)), fetched_at=time.time() - 120)
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(5, Repository('repo-test', 11))
+        persistent_gateway = PersistentStatsGateway(gateway, store, 60)
+        assert persistent_gateway.organization_stats('test') == OrganizationStats(5, Repository('repo-test', 11))
+        assert len(store.history('test', 10)) == 2
+
+    def test_organization_stats_too_old_while_unavailable(self, store):
+        store.record('test', OrganizationStats(4, Repository('repo-test', 10)), fetched_at=time.time() - 120)
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = UpstreamUnavailable('Github is unavailable')
+        persistent_gateway = PersistentStatsGateway(gateway, store, 60)
+        with pytest.raises(UpstreamUnavailable) as e:
+            persistent_gateway.organization_stats('test')
+        assert e.value.fallback == OrganizationStats(4, Repository('repo-test', 10))
+        with pytest.raises(UpstreamUnavailable) as e:
+            persistent_gateway.organization_stats('other')
+        assert e.value.fallback is None
+
+    def test_organization_stats_fallback_is_not_cached(self, store):
+        store.record('test', OrganizationStats(4, Repository('repo-test', 10)), fetched_at=time.time() - 7200)
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = UpstreamUnavailable('Github is unavailable')
+        cache = SimpleCache()
+        cached_gateway = CachedStatsGateway(PersistentStatsGateway(gateway, store, 60), cache, 60, stale_ttl=3600)
+        assert cached_gateway.organization_stats('test') == OrganizationStats(4, Repository('repo-test', 10))
+        assert cache.get(cached_gateway.cache_key('test')) is None
+        assert cache.get(cached_gateway.stale_cache_key('test')) is None
+        # Once Github is back, it is asked again
+        gateway.organization_stats.side_effect = None
+        gateway.organization_stats.return_value = OrganizationStats(5, Repository('repo-test', 11))
+        assert cached_gateway.organization_stats('test') == OrganizationStats(5, Repository('repo-test', 11))
+
+    def test_organization_stats_many(self, store):
+        store.record('a', OrganizationStats(4, Repository('repo-a', 10)))
+        gateway = mock.Mock()
+        gateway.organization_stats_many.return_value = {
+            'b': OrganizationStats(1, Repository('repo-b', 1)), 'c': DoesNotExist('Not found')
+        }
+        results = PersistentStatsGateway(gateway, store, 60).organization_stats_many(['a', 'b', 'c'])
+        gateway.organization_stats_many.assert_called_once_with(['b', 'c'])
+        assert results['a'] == OrganizationStats(4, Repository('repo-a', 10))
+        assert results['b'] == OrganizationStats(1, Repository('repo-b', 1))
+        assert isinstance(results['c'], DoesNotExist)
+        assert store.latest('b') is not None
+        assert store.latest('c') is None
+
+    def test_organization_stats_many_all_fresh(self, store):
+        store.record('a', OrganizationStats(4, Repository('repo-a', 10)))
+        gateway = mock.Mock()
+        results = PersistentStatsGateway(gateway, store, 60).organization_stats_many(['a'])
+        assert results == {'a': OrganizationStats(4, Repository('repo-a', 10))}
+        gateway.organization_stats_many.assert_not_called()
+
+    def test_record(self, store):
+        gateway = mock.Mock()
+        persistent_gateway = PersistentStatsGateway(gateway, store, 60)
+        persistent_gateway.record('test', OrganizationStats(5, Repository('repo-test', 11)))
+        assert persistent_gateway.organization_stats('test') == OrganizationStats(5, Repository('repo-test', 11))
+        assert store.latest('test').organization_stats == OrganizationStats(5, Repository('repo-test', 11))
+        gateway.organization_stats.assert_not_called()
+
+    def test_organization_stats_history(self, store):
+        store.record('test', OrganizationStats(4, Repository('repo-test', 10)), fetched_at=1)
+        store.record('test', OrganizationStats(5, Repository('repo-test', 11)), fetched_at=2)
+        history = PersistentStatsGateway(mock.Mock(), store, 60).organization_stats_history('test', 10)
+        assert [s.fetched_at for s in history] == [2.0, 1.0]
+
+    def test_organization_stats_history_not_recorded(self, store):
+        with pytest.raises(DoesNotExist):
+            PersistentStatsGateway(mock.Mock(), store, 60).organization_stats_history('test', 10)
+
+    def test_warm_start(self, store):
+        for name in ['hot', 'hot', 'hot', 'warm', 'warm', 'cold']:
+            store.record(name, OrganizationStats(4, Repository('repo-' + name, 10)))
+        persistent_gateway = PersistentStatsGateway(mock.Mock(), store, 60, memory_size=2)
+        assert persistent_gateway.warm_start(3600) == 2
+        assert list(persistent_gateway._memory) == ['warm', 'hot']
+
+    def test_memory_size(self, store):
+        gateway = mock.Mock()
+        gateway.organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        persistent_gateway = PersistentStatsGateway(gateway, store, 60, memory_size=2)
+        for name in ['a', 'b', 'c']:
+            persistent_gateway.organization_stats(name)
+        assert list(persistent_gateway._memory) == ['b', 'c']
+
+
+class TestAggregateStatsGateway:
+    @pytest.fixture
+    def gateway(self):
+        gateway = mock.Mock()
+        gateway.organization_repositories_pages.side_effect = lambda name, after: iter([
+            ([Repository('repo-a', 10), Repository('repo-b', 30)], 3, 'c1'), ([Repository('repo-c', 20)], 3, 'c2')])
+        return gateway
+
+    def test_organization_aggregate_stats(self, gateway):
+        aggregate_gateway = AggregateStatsGateway(gateway, SimpleCache(), 60, 3600, top_k=2, percentiles=(50,))
+        stats = aggregate_gateway.organization_aggregate_stats('Test')
+        top_repositories = (Repository('repo-b', 30), Repository('repo-c', 20))
+        assert stats == OrganizationAggregateStats(3, 60, {'p50': 20}, top_repositories)
+        assert aggregate_gateway.organization_aggregate_stats('test') == stats
+        gateway.organization_repositories_pages.assert_called_once_with('Test', None)
+
+    def test_organization_aggregate_stats_incremental_refresh(self, gateway):
+        aggregate_gateway = AggregateStatsGateway(gateway, SimpleCache(), 60, 3600, top_k=2)
+        aggregate_gateway.organization_aggregate_stats('test')
+        gateway.organization_repositories_pages.side_effect = lambda name, after: iter([
+            ([Repository('repo-d', 25)], 4, 'c3')])
+        with mock.patch('time.time', return_value=time.time() + 120):
+            stats = aggregate_gateway.organization_aggregate_stats('test')
+        gateway.organization_repositories_pages.assert_called_with('test', 'c2')
+        assert (stats.repositories_count, stats.total_stars) == (4, 85)
+        assert stats.top_repositories == (Repository('repo-b', 30), Repository('repo-d', 25))
+
+    def test_organization_aggregate_stats_full_rescan(self, gateway):
+        aggregate_gateway = AggregateStatsGateway(gateway, SimpleCache(), 60, 3600)
+        aggregate_gateway.organization_aggregate_stats('test')
+        with mock.patch('time.time', return_value=time.time() + 7200):
+            stats = aggregate_gateway.organization_aggregate_stats('test')
+        gateway.organization_repositories_pages.assert_called_with('test', None)
+        assert (stats.repositories_count, stats.total_stars) == (3, 60)
+
+    def test_organization_aggregate_stats_resumes_unfinished_scan(self, gateway):
+        def pages(name, after):
+            yield [Repository('repo-a', 10), Repository('repo-b', 30)], 3, 'c1'
+            raise UpstreamUnavailable('Request deadline exceeded')
+
+        gateway.organization_repositories_pages.side_effect = pages
+        aggregate_gateway = AggregateStatsGateway(gateway, SimpleCache(), 60, 3600, top_k=2)
+        with pytest.raises(UpstreamUnavailable):
+            aggregate_gateway.organization_aggregate_stats('test')
+        gateway.organization_repositories_pages.side_effect = lambda name, after: iter([
+            ([Repository('repo-c', 20)], 3, 'c2')])
+        stats = aggregate_gateway.organization_aggregate_stats('test')
+        gateway.organization_repositories_pages.assert_called_with('test', 'c1')
+        assert (stats.repositories_count, stats.total_stars) == (3, 60)
+
+    def test_organization_aggregate_stats_coalesced(self, gateway):
+        single_flight = mock.Mock()
+        single_flight.do.side_effect = lambda key, fn: fn()
+        aggregate_gateway = AggregateStatsGateway(gateway, SimpleCache(), 60, 3600, single_flight=single_flight)
+        aggregate_gateway.organization_aggregate_stats('Test')
+        assert single_flight.do.call_args[0][0] == 'organization_aggregate:test'
+
+
+class TestNotFoundCachedStatsGateway:
+    def test_organization_stats(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = DoesNotExist('Not found')
+        not_found_gateway = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60)
+        for name in ('Missing', 'missing'):
+            with pytest.raises(DoesNotExist) as e:
+                not_found_gateway.organization_stats(name)
+            assert str(e.value) == 'Not found'
+        gateway.organization_stats.assert_called_once_with('Missing')
+
+    def test_organization_stats_found_later(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = [DoesNotExist('Not found'), OrganizationStats(1, Repository('a', 1))]
+        not_found_gateway = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60)
+        with pytest.raises(DoesNotExist):
+            not_found_gateway.organization_stats('new')
+        not_found_gateway.forget('New')
+        assert not_found_gateway.organization_stats('new') == OrganizationStats(1, Repository('a', 1))
+
+    def test_organization_stats_forgotten_for_every_worker(self):
+        gateway = mock.Mock()
+        gateway.organization_stats.side_effect = [
+            DoesNotExist('Not found'), DoesNotExist('Not found'), OrganizationStats(1, Repository('a', 1))]
+        shared_cache = SimpleCache()
+        not_found_gateway = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60, shared_cache)
+        other_worker = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60, shared_cache)
+        for worker in (not_found_gateway, other_worker, other_worker):
+            with pytest.raises(DoesNotExist):
+                worker.organization_stats('new')
+        assert gateway.organization_stats.call_count == 2
+        # Only the generation of forgotten organizations is shared
+        assert shared_cache.get(NotFoundCachedStatsGateway.cache_key('new')) is None
+        not_found_gateway.forget('new')
+        assert other_worker.organization_stats('new') == OrganizationStats(1, Repository('a', 1))
+
+    def test_organization_stats_many(self):
+        gateway = mock.Mock()
+        gateway.organization_stats_many.return_value = {
+            'a': OrganizationStats(4, Repository('repo-a', 10)), 'b': DoesNotExist('Not found')}
+        not_found_gateway = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60)
+        not_found_gateway.organization_stats_many(['a', 'b'])
+        results = not_found_gateway.organization_stats_many(['a', 'b'])
+        assert gateway.organization_stats_many.call_args_list == [mock.call(['a', 'b']), mock.call(['a'])]
+        assert isinstance(results['b'], DoesNotExist)
+
+    def test_organization_stats_many_all_not_found(self):
+        gateway = mock.Mock()
+        gateway.organization_stats_many.return_value = {'b': DoesNotExist('Not found')}
+        not_found_gateway = NotFoundCachedStatsGateway(gateway, LRUCache(10), 60)
+        not_found_gateway.organization_stats_many(['b'])
+        assert isinstance(not_found_gateway.organization_stats_many(['b'])['b'], DoesNotExist)
+        gateway.organization_stats_many.assert_called_once_with(['b'])
+
+
+class TestCachedRepositoryGateway:
+    @pytest.fixture
+    def repositories(self):
+        return [Repository('repo-{}'.format(i), 1000 - i) for i in range(5)]
+
+    @pytest.fixture
+    def gateway(self, repositories):
+        pages = {None: (repositories[:2], 'c2'), 'c2': (repositories[2:4], 'c4'), 'c4': (repositories[4:], None)}
+        gateway = mock.Mock()
+        gateway.chubbiest_repositories_page.side_effect = lambda first, after: pages[after]
+        return gateway
+
+    def test_chubbiest_repositories(self, gateway, repositories):
+        cached_gateway = CachedRepositoryGateway(gateway, SimpleCache(), 60, page_size=2)
+        assert cached_gateway.chubbiest_repositories(1) == repositories[:1]
+        assert cached_gateway.chubbiest_repositories(2) == repositories[:2]
+        gateway.chubbiest_repositories_page.assert_called_once_with(2, None)
+
+    def test_chubbiest_repositories_page(self, gateway, repositories):
+        cached_gateway = CachedRepositoryGateway(gateway, SimpleCache(), 60, page_size=2)
+        assert cached_gateway.chubbiest_repositories_page(2, 'c2') == (repositories[2:4], 'c4')
+
+    def test_chubbiest_repositories_extended_from_cursor(self, gateway, repositories):
+        cached_gateway = CachedRepositoryGateway(gateway, SimpleCache(), 60, page_size=2)
+        cached_gateway.chubbiest_repositories(2)
+        assert cached_gateway.chubbiest_repositories(3) == repositories[:3]
+        assert gateway.chubbiest_repositories_page.call_args_list == [mock.call(2, None), mock.call(2, 'c2')]
+        assert cached_gateway.chubbiest_repositories(4) == repositories[:4]
+        assert gateway.chubbiest_repositories_page.call_count == 2
+
+    def test_chubbiest_repositories_cached_once_streamed(self, gateway, repositories):
+        cached_gateway = CachedRepositoryGateway(gateway, SimpleCache(), 60, page_size=2)
+        streamed = cached_gateway.chubbiest_repositories(10)
+        assert gateway.chubbiest_repositories_page.call_count == 1
+        assert list(streamed) == repositories
+        assert cached_gateway.chubbiest_repositories(10) == repositories
+        assert gateway.chubbiest_repositories_page.call_count == 3
+
+    def test_chubbiest_repositories_extension_keeps_first_page_expiry(self, gateway):
+        cache = SimpleCache()
+        cached_gateway = CachedRepositoryGateway(gateway, cache, 60, page_size=2)
+        cached_gateway.chubbiest_repositories(2)
+        with mock.patch('time.time', return_value=time.time() + 61):
+            cached_gateway.chubbiest_repositories(4)
+        assert json.loads(cache.get(cached_gateway.cache_key))['cursor'] == 'c2'
+
+    def test_chubbiest_repositories_adaptive_ttl(self, gateway, repositories):
+        cache = SimpleCache()
+        adaptive_ttl = mock.Mock(**{'ttl.return_value': 600})
+        cached_gateway = CachedRepositoryGateway(gateway, cache, 60, page_size=2, adaptive_ttl=adaptive_ttl)
+        cached_gateway.chubbiest_repositories(2)
+        adaptive_ttl.ttl.assert_called_once_with('top', [['repo-0', 1000], ['repo-1', 999]], 60, mock.ANY)
+        # Extensions keep the TTL of the first page
+        with mock.patch('time.time', return_value=time.time() + 61):
+            cached_gateway.chubbiest_repositories(4)
+        assert json.loads(cache.get(cached_gateway.cache_key))['cursor'] == 'c4'
+        assert adaptive_ttl.ttl.call_count == 1
+
+
+def async_client(*responses):
+    """Return an httpx client answering the given (status, json[, headers]) responses in order."""
+    requests = []
+    responses = iter(responses)
+
+    def handler(request):
+        requests.append(request)
+        status_code, body, *headers = next(responses)
+        return httpx.Response(status_code, json=body, headers=headers[0] if headers else None)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    client.sent_requests = requests
+    return client
+
+
+class TestAsyncGithubGraphQLGateway:
+    def test_execute(self, config):
+        client = async_client((200, {'data': {'key': 'value'}}))
+        gateway = AsyncGithubGraphQLGateway(client, config)
+        assert asyncio.run(gateway.execute('document', {'org_name': 'test'})) == {'key': 'value'}
+        assert json.loads(client.sent_requests[0].content) == {'query': 'document', 'variables': {'org_name': 'test'}}
+        assert client.sent_requests[0].headers['Authorization'].startswith('Basic ')
+
+    def test_execute_with_not_found_errors(self, config):
+        client = async_client((200, {'errors': [{'message': 'Not found', 'type': 'NOT_FOUND'}]}))
+        gateway = AsyncGithubGraphQLGateway(client, config, AsyncSingleFlight())
+        with pytest.raises(DoesNotExist):
+            asyncio.run(gateway.execute('document'))
+
+    @mock.patch('chubbyrepo.gateways.asyncio.sleep')
+    def test_get_result_retries_bad_gateway(self, mock_sleep, config):
+        client = async_client((502, {}), (200, {'data': 'data'}))
+        gateway = AsyncGithubGraphQLGateway(client, config)
+        assert asyncio.run(gateway._get_result('document')) == (None, 'data')
+        mock_sleep.assert_awaited_once_with(config['GITHUB_RETRY_BACKOFF'])
+
+    def test_get_result_raises_after_retries(self, config):
+        config['GITHUB_RETRIES'] = 0
+        gateway = AsyncGithubGraphQLGateway(async_client((503, {})), config)
+        with pytest.raises(httpx.HTTPStatusError):
+            asyncio.run(gateway._get_result('document'))
+
+    def test_get_result_rotates_rate_limited_tokens(self, config):
+        config['GITHUB_API_KEYS'] = ['a', 'b']
+        scheduler = UpstreamScheduler.from_config(config)
+        rate_limit = {'cost': 3, 'remaining': 42, 'resetAt': '2030-01-01T00:00:00Z'}
+        client = async_client((403, {}, {'X-RateLimit-Remaining': '0', 'Retry-After': '30'}),
+                              (200, {'data': {'rateLimit': rate_limit}}))
+        gateway = AsyncGithubGraphQLGateway(client, config, scheduler=scheduler)
+        asyncio.run(gateway._get_result('document'))
+        assert [r.headers['Authorization'] for r in client.sent_requests] == [
+            'Basic ' + base64.b64encode(b'token:a').decode(), 'Basic ' + base64.b64encode(b'token:b').decode()]
+        counters = scheduler.counters()
+        assert counters['token0']['rate_limited'] == 1
+        assert counters['token1']['cost'] == 3 and counters['token1']['remaining'] == 42
+
+    def test_get_result_with_every_token_rate_limited(self, config):
+        client = async_client((429, {}, {'Retry-After': '30'}))
+        gateway = AsyncGithubGraphQLGateway(client, config)
+        with pytest.raises(RateLimitExceeded) as e:
+            asyncio.run(gateway._get_result('document'))
+        assert e.value.retry_after == 30
+
+
+class TestAsyncStatsGateway:
+    def test_organization_stats(self, config):
+        client = async_client((200, {'data': {'organization': {'repositories': {
+            'nodes': [{'name': 'repo-test', 'stargazers': {'totalCount': 10}}], 'totalCount': 4}}}}))
+        gateway = AsyncStatsGateway(client, config)
+        assert asyncio.run(gateway.organization_stats('test')) == OrganizationStats(4, Repository('repo-test', 10))
+
+    def test_organization_stats_many(self, config):
+        config['GITHUB_BATCH_SIZE'] = 1
+        client = async_client(
+            (200, {'data': {'org0': {'repositories': {
+                'nodes': [{'name': 'repo-a', 'stargazers': {'totalCount': 10}}], 'totalCount': 4}}}}),
+            (200, {'data': {'org0': None},
+                   'errors': [{'message': 'Not found', 'type': 'NOT_FOUND', 'path': ['org0']}]}),
+        )
+        gateway = AsyncStatsGateway(client, config)
+        results = asyncio.run(gateway.organization_stats_many(['a', 'b']))
+        assert results['a'] == OrganizationStats(4, Repository('repo-a', 10))
+        assert isinstance(results['b'], DoesNotExist)
+        assert len(client.sent_requests) == 2
+
+    def test_organization_stats_micro_batched(self, config):
+        client = async_client((200, {'data': {
+            'org0': {'repositories': {'nodes': [{'name': 'repo-a', 'stargazers': {'totalCount': 10}}],
+                                      'totalCount': 4}},
+            'org1': {'repositories': {'nodes': [{'name': 'repo-b', 'stargazers': {'totalCount': 1}}],
+                                      'totalCount': 1}}}}))
+        gateway = AsyncStatsGateway(client, config, batcher=AsyncMicroBatcher(window=0.01))
+
+        async def main():
+            return await asyncio.gather(gateway.organization_stats('a'), gateway.organization_stats('b'))
+
+        assert asyncio.run(main()) == [OrganizationStats(4, Repository('repo-a', 10)),
+                                       OrganizationStats(1, Repository('repo-b', 1))]
+        assert len(client.sent_requests) == 1
+
+
+class TestAsyncRepositoryGateway:
+    def test_chubbiest_repositories(self, config):
+        client = async_client((200, {'data': {'search': {'edges': [
+            {'node': {'name': 'freeCodeCamp', 'stargazers': {'totalCount': 291350}}}]}}}))
+        gateway = AsyncRepositoryGateway(client, config)
+        assert asyncio.run(gateway.chubbiest_repositories(1)) == [Repository('freeCodeCamp', 291350)]
+
+    def test_chubbiest_repositories_paginated(self, config):
+        def page(first, has_next_page):
+            edges = [{'node': {'name': 'repo-{}'.format(i), 'stargazers': {'totalCount': 1000 - i}}}
+                     for i in range(first, first + 100)]
+            return 200, {'data': {'search': {'pageInfo': {'endCursor': 'cursor-{}'.format(first),
+                                                          'hasNextPage': has_next_page}, 'edges': edges}}}
+
+        client = async_client(page(0, True), page(100, True))
+        gateway = AsyncRepositoryGateway(client, config)
+        repositories = asyncio.run(gateway.chubbiest_repositories(150))
+        assert [r.name for r in repositories] == ['repo-{}'.format(i) for i in range(150)]
+        variables = [json.loads(r.content)['variables'] for r in client.sent_requests]
+        assert variables == [{'limit': 100, 'after': None}, {'limit': 50, 'after': 'cursor-0'}]
+
+    def test_chubbiest_repositories_paginated_stops_on_last_page(self, config):
+        client = async_client((200, {'data': {'search': {
+            'pageInfo': {'endCursor': 'cursor-1', 'hasNextPage': False},
+            'edges': [{'node': {'name': 'repo', 'stargazers': {'totalCount': 1}}}]
+        }}}))
+        gateway = AsyncRepositoryGateway(client, config)
+        assert asyncio.run(gateway.chubbiest_repositories(500)) == [Repository('repo', 1)]
+        assert len(client.sent_requests) == 1
+
+
+class TestDatasetGateways:
+    @pytest.fixture
+    def dataset(self, tmpdir):
+        path = tmpdir.join('repositories.jsonl')
+        rows = [{'owner': 'acme_corp', 'name': 'repo-{}'.format(i), 'stargazers_count': i} for i in range(5)]
+        path.write(''.join(json.dumps(row) + '\n' for row in rows))
+        dataset = RepositoryDataset(str(path))
+        dataset.reload()
+        return dataset
+
+    def test_organization_stats(self, dataset):
+        gateway = DatasetStatsGateway(dataset)
+        assert gateway.organization_stats('acme_corp') == OrganizationStats(5, Repository('repo-4', 4))
+        results = gateway.organization_stats_many(['acme_corp', 'missing'])
+        assert isinstance(results['missing'], DoesNotExist)
+
+    def test_chubbiest_repositories(self, dataset):
+        gateway = DatasetRepositoryGateway(dataset)
+        assert [r.stars for r in gateway.chubbiest_repositories(2)] == [4, 3]
+        page, cursor = gateway.chubbiest_repositories_page(2)
+        page, cursor = gateway.chubbiest_repositories_page(2, cursor)
+        assert ([r.stars for r in page], cursor) == ([2, 1], '4')
+        page, cursor = gateway.chubbiest_repositories_page(2, cursor)
+        assert ([r.stars for r in page], cursor) == ([0], None)
+
+    def test_cached_chubbiest_repositories(self, dataset):
+        gateway = CachedRepositoryGateway(DatasetRepositoryGateway(dataset), SimpleCache(), 60, page_size=2)
+        assert [r.stars for r in gateway.chubbiest_repositories(3)] == [4, 3, 2]
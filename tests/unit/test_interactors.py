@@ -1,11 +1,21 @@
+import asyncio
 from unittest import mock
 
 import pytest
 
-from chubbyrepo.core.entities import OrganizationStats, Repository
-from chubbyrepo.core.gateways import DoesNotExist
-from chubbyrepo.core.interactors import ChubbiestRepositoriesInteractor, Interactor, OrganizationStatsInteractor
-from chubbyrepo.core.requests import ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsRequest
+from chubbyrepo.core.entities import (
+    OrganizationAggregateStats, OrganizationStats, OrganizationStatsSnapshot, Repository
+)
+from chubbyrepo.core.gateways import DoesNotExist, Overloaded, RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.core.interactors import (
+    AsyncChubbiestRepositoriesInteractor, AsyncInteractor, AsyncOrganizationStatsBatchInteractor,
+    AsyncOrganizationStatsInteractor, ChubbiestRepositoriesInteractor, Interactor, OrganizationStatsBatchInteractor,
+    OrganizationStatsHistoryInteractor, OrganizationStatsInteractor
+)
+from chubbyrepo.core.requests import (
+    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsBatchRequest, OrganizationStatsHistoryRequest,
+    OrganizationStatsRequest
+)
 from chubbyrepo.core.responses import ResponseFailure
 
 
@@ -49,6 +59,34 @@ class TestInteractor:
         assert response.type == ResponseFailure.RESOURCE_ERROR
         assert response.message == 'somemessage'
 
+    def test_can_manage_rate_limit_exception_from_process_request(self):
+        interactor = Interactor()
+        interactor._process_request = mock.Mock()
+        interactor._process_request.side_effect = RateLimitExceeded('Github rate limit exhausted', 30)
+        response = interactor.execute(mock.Mock)
+        assert not response
+        assert response.type == ResponseFailure.RATE_LIMIT_ERROR
+        assert response.message == 'Github rate limit exhausted'
+        assert response.retry_after == 30
+
+    def test_can_manage_upstream_unavailable_exception_from_process_request(self):
+        interactor = Interactor()
+        interactor._process_request = mock.Mock()
+        interactor._process_request.side_effect = UpstreamUnavailable('Github is unavailable', 12)
+        response = interactor.execute(mock.Mock)
+        assert response.type == ResponseFailure.SERVICE_UNAVAILABLE
+        assert response.message == 'Github is unavailable'
+        assert response.retry_after == 12
+
+    def test_can_manage_overloaded_exception_from_process_request(self):
+        interactor = Interactor()
+        interactor._process_request = mock.Mock()
+        interactor._process_request.side_effect = Overloaded('Too many requests waiting on Github', 1)
+        response = interactor.execute(mock.Mock)
+        assert response.type == ResponseFailure.OVERLOADED
+        assert response.message == 'Too many requests waiting on Github'
+        assert response.retry_after == 1
+
 
 class TestOrganizationStatsInteractor:
     @pytest.fixture
@@ -65,6 +103,75 @@ class TestOrganizationStatsInteractor:
         gateway.organization_stats.assert_called_with('Sirius Cybernetics Corp.')
         assert response.value == organization_stats_entity.asdict()
 
+    def test_execute_full_detail(self):
+        aggregate_stats = OrganizationAggregateStats(2, 15, {'p50': 5}, (Repository('Test', 10),))
+        aggregate_gateway = mock.Mock()
+        aggregate_gateway.organization_aggregate_stats.return_value = aggregate_stats
+        interactor = OrganizationStatsInteractor(mock.Mock(), aggregate_gateway)
+        request = OrganizationStatsRequest.from_dict({'organization_name': 'acme', 'detail': 'full'})
+        response = interactor.execute(request)
+        aggregate_gateway.organization_aggregate_stats.assert_called_once_with('acme')
+        assert response.value == aggregate_stats.asdict()
+
+    def test_execute_full_detail_not_available(self):
+        interactor = OrganizationStatsInteractor(mock.Mock())
+        request = OrganizationStatsRequest.from_dict({'organization_name': 'acme', 'detail': 'full'})
+        response = interactor.execute(request)
+        assert response.type == ResponseFailure.PARAMETERS_ERROR
+        assert response.message == 'detail: Full detail is not available'
+
+
+class TestOrganizationStatsHistoryInteractor:
+    def test_execute(self):
+        snapshot = OrganizationStatsSnapshot(1500000000.0, OrganizationStats(10, Repository('Test', 10)))
+        gateway = mock.Mock()
+        gateway.organization_stats_history.return_value = [snapshot]
+        interactor = OrganizationStatsHistoryInteractor(gateway)
+        request = OrganizationStatsHistoryRequest.from_dict({'organization_name': 'acme', 'limit': 5})
+        response = interactor.execute(request)
+        gateway.organization_stats_history.assert_called_once_with('acme', 5)
+        assert response.value == [{'fetched_at': 1500000000.0, 'organization_stats': {
+            'repositories_count': 10, 'chubby_repository': {'name': 'Test', 'stars': 10}}}]
+
+    def test_execute_without_history(self):
+        gateway = mock.Mock()
+        gateway.organization_stats_history.side_effect = DoesNotExist('No stats recorded for organization acme')
+        interactor = OrganizationStatsHistoryInteractor(gateway)
+        response = interactor.execute(OrganizationStatsHistoryRequest.from_dict({'organization_name': 'acme'}))
+        assert response.type == ResponseFailure.RESOURCE_ERROR
+
+
+class TestOrganizationStatsBatchInteractor:
+    def test_execute(self):
+        organization_stats = OrganizationStats(repositories_count=10, chubby_repository=Repository('Test', 10))
+        gateway = mock.Mock()
+        gateway.organization_stats_many.return_value = {
+            'Sirius Cybernetics Corp.': organization_stats,
+            'Unknown': DoesNotExist('Could not resolve to an Organization'),
+        }
+        interactor = OrganizationStatsBatchInteractor(gateway)
+        request = OrganizationStatsBatchRequest.from_dict(
+            {'organization_names': ['Sirius Cybernetics Corp.', 'Unknown']})
+        response = interactor.execute(request)
+        assert bool(response) is True
+        gateway.organization_stats_many.assert_called_with(['Sirius Cybernetics Corp.', 'Unknown'])
+        assert response.value == {
+            'Sirius Cybernetics Corp.': {'type': 'SUCCESS', 'value': organization_stats.asdict()},
+            'Unknown': {'type': 'RESOURCE_ERROR', 'message': 'Could not resolve to an Organization'},
+        }
+
+    def test_execute_with_organization_errors(self):
+        gateway = mock.Mock()
+        gateway.organization_stats_many.return_value = {
+            'Forbidden': Exception('SAML enforcement'),
+            'Limited': RateLimitExceeded('Github rate limit exhausted', 30),
+        }
+        request = OrganizationStatsBatchRequest.from_dict({'organization_names': ['Forbidden', 'Limited']})
+        response = OrganizationStatsBatchInteractor(gateway).execute(request)
+        assert bool(response) is True
+        assert response.value['Forbidden'] == {'type': 'SYSTEM_ERROR', 'message': 'Exception: SAML enforcement'}
+        assert response.value['Limited']['type'] == 'RATE_LIMIT_ERROR'
+
 
 class TestChubbiestRepositoriesInteractor:
     @pytest.fixture
@@ -83,3 +190,83 @@ class TestChubbiestRepositoriesInteractor:
         assert bool(response) is True
         gateway.chubbiest_repositories.assert_called_with(3)
         assert response.value == [r.asdict() for r in chubbiest_repositories_entities]
+
+    def test_execute_lazily(self, chubbiest_repositories_entities):
+        gateway = mock.Mock()
+        gateway.chubbiest_repositories.return_value = iter(chubbiest_repositories_entities)
+        request = ChubbiestRepositoriesRequest.from_dict({'limit': 3})
+        response = ChubbiestRepositoriesInteractor(gateway).execute(request)
+        assert not isinstance(response.value, list)
+        assert list(response.value) == [r.asdict() for r in chubbiest_repositories_entities]
+
+    def test_execute_from_leaderboard(self, chubbiest_repositories_entities):
+        gateway, leaderboard = mock.Mock(), mock.Mock()
+        leaderboard.chubbiest_repositories_snapshot.return_value = chubbiest_repositories_entities[:2], 12.5
+        interactor = ChubbiestRepositoriesInteractor(gateway, leaderboard)
+        response = interactor.execute(ChubbiestRepositoriesRequest.from_dict({'limit': 2}))
+        leaderboard.chubbiest_repositories_snapshot.assert_called_once_with(2)
+        gateway.chubbiest_repositories.assert_not_called()
+        assert response.value == [r.asdict() for r in chubbiest_repositories_entities[:2]]
+        assert response.metadata == {'snapshot_age': 12.5}
+
+    def test_execute_with_stale_leaderboard(self, chubbiest_repositories_entities):
+        gateway, leaderboard = mock.Mock(), mock.Mock()
+        gateway.chubbiest_repositories.return_value = chubbiest_repositories_entities
+        leaderboard.chubbiest_repositories_snapshot.return_value = None
+        interactor = ChubbiestRepositoriesInteractor(gateway, leaderboard)
+        response = interactor.execute(ChubbiestRepositoriesRequest.from_dict({'limit': 3}))
+        gateway.chubbiest_repositories.assert_called_once_with(3)
+        assert list(response.value) == [r.asdict() for r in chubbiest_repositories_entities]
+        assert response.metadata == {}
+
+
+class TestAsyncInteractor:
+    def test_cannot_process_valid_requests(self):
+        valid_request = mock.MagicMock()
+        valid_request.__bool__.return_value = True
+        response = asyncio.run(AsyncInteractor().execute(valid_request))
+        assert response.type == ResponseFailure.SYSTEM_ERROR
+        assert response.message == 'NotImplementedError: process_request() not implemented by AsyncInteractor class'
+
+    def test_can_process_invalid_requests_and_returns_response_failure(self):
+        invalid_request = InvalidRequest()
+        invalid_request.add_error('someparam', 'somemessage')
+        response = asyncio.run(AsyncInteractor().execute(invalid_request))
+        assert response.type == ResponseFailure.PARAMETERS_ERROR
+        assert response.message == 'someparam: somemessage'
+
+    def test_can_manage_not_found_exception_from_process_request(self):
+        interactor = AsyncInteractor()
+        interactor._process_request = mock.AsyncMock(side_effect=DoesNotExist('somemessage'))
+        response = asyncio.run(interactor.execute(mock.Mock))
+        assert response.type == ResponseFailure.RESOURCE_ERROR
+        assert response.message == 'somemessage'
+
+
+class TestAsyncOrganizationStatsInteractors:
+    def test_execute(self):
+        organization_stats = OrganizationStats(repositories_count=10, chubby_repository=Repository('Test', 10))
+        gateway = mock.Mock()
+        gateway.organization_stats = mock.AsyncMock(return_value=organization_stats)
+        request = OrganizationStatsRequest.from_dict({'organization_name': 'Sirius Cybernetics Corp.'})
+        response = asyncio.run(AsyncOrganizationStatsInteractor(gateway).execute(request))
+        gateway.organization_stats.assert_awaited_with('Sirius Cybernetics Corp.')
+        assert response.value == organization_stats.asdict()
+
+    def test_execute_batch(self):
+        gateway = mock.Mock()
+        gateway.organization_stats_many = mock.AsyncMock(return_value={'Unknown': DoesNotExist('Not found')})
+        request = OrganizationStatsBatchRequest.from_dict({'organization_names': ['Unknown']})
+        response = asyncio.run(AsyncOrganizationStatsBatchInteractor(gateway).execute(request))
+        assert response.value == {'Unknown': {'type': 'RESOURCE_ERROR', 'message': 'Not found'}}
+
+
+class TestAsyncChubbiestRepositoriesInteractor:
+    def test_execute(self):
+        repositories = [Repository(name='Test 1', stars=30)]
+        gateway = mock.Mock()
+        gateway.chubbiest_repositories = mock.AsyncMock(return_value=repositories)
+        request = ChubbiestRepositoriesRequest.from_dict({'limit': 1})
+        response = asyncio.run(AsyncChubbiestRepositoriesInteractor(gateway).execute(request))
+        gateway.chubbiest_repositories.assert_awaited_with(1)
+        assert response.value == [r.asdict() for r in repositories]
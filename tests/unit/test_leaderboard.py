@@ -0,0 +1,227 @@
+import json
+import os
+import time
+from unittest import mock
+
+import pytest
+
+from chubbyrepo.cache import SimpleCache
+from chubbyrepo.core.entities import Repository
+from chubbyrepo.leaderboard import Leaderboard
+
+
+@pytest.fixture
+def repositories():
+    return [Repository('repo-{}'.format(i), 100 - i) for i in range(5)]
+
+
+@pytest.fixture
+def gateway(repositories):
+    gateway = mock.Mock()
+    gateway.chubbiest_owned_repositories.return_value = [('Acme', r) for r in repositories]
+    return gateway
+
+
+class TestLeaderboard:
+    def test_serves_slices_of_the_snapshot(self, gateway, repositories):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        assert leaderboard.refresh() == 5
+        gateway.chubbiest_owned_repositories.assert_called_once_with(5)
+        snapshot, age = leaderboard.chubbiest_repositories_snapshot(3)
+        assert snapshot == repositories[:3]
+        assert 0 <= age < 1
+
+    def test_cannot_serve_without_snapshot(self, gateway):
+        assert Leaderboard(gateway, 5, 60).chubbiest_repositories_snapshot(3) is None
+
+    def test_cannot_serve_limits_bigger_than_snapshot(self, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.refresh()
+        assert leaderboard.chubbiest_repositories_snapshot(6) is None
+
+    def test_cannot_serve_stale_snapshot(self, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.refresh()
+        leaderboard._snapshot = (time.time() - 61,) + leaderboard._snapshot[1:]
+        assert leaderboard.chubbiest_repositories_snapshot(3) is None
+
+    def test_publishes_and_adopts_snapshots_through_cache(self, gateway, repositories):
+        cache = SimpleCache()
+        Leaderboard(gateway, 5, 60, cache=cache).refresh()
+        other_worker = Leaderboard(mock.Mock(), 5, 60, cache=cache)
+        snapshot, _ = other_worker.chubbiest_repositories_snapshot(5)
+        assert snapshot == repositories
+
+    def test_ignores_stale_snapshots_in_cache(self, repositories):
+        cache = SimpleCache()
+        value = {'fetched_at': time.time() - 61, 'repositories': [r.asdict() for r in repositories]}
+        cache.set(Leaderboard.cache_key, json.dumps(value), 60)
+        assert Leaderboard(mock.Mock(), 5, 60, cache=cache).chubbiest_repositories_snapshot(5) is None
+
+    def test_polls_cache_at_most_every_poll_interval(self):
+        cache = mock.Mock()
+        cache.get.return_value = None
+        leaderboard = Leaderboard(mock.Mock(), 5, 60, cache=cache, poll_interval=60)
+        for _ in range(3):
+            assert leaderboard.chubbiest_repositories_snapshot(5) is None
+        cache.get.assert_called_once_with(Leaderboard.cache_key)
+
+    def test_start_refresher_once_per_process(self, app, gateway, repositories):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.start_refresher(app, 10)
+        leaderboard.start_refresher(app, 10)
+        leaderboard.stop_refresher()
+        gateway.chubbiest_owned_repositories.assert_called_once_with(5)
+        assert leaderboard.chubbiest_repositories_snapshot(5)[0] == repositories
+
+    def test_refresher_started_by_another_thread_is_not_started_again(self, app, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        with mock.patch('threading.Thread') as mock_thread, mock.patch.object(leaderboard, '_lock') as mock_lock:
+            mock_lock.__enter__.side_effect = lambda: setattr(leaderboard, '_refresher_pid', os.getpid())
+            leaderboard.start_refresher(app, 10)
+        mock_thread.assert_not_called()
+
+    def test_stop_refresher_not_started(self, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.stop_refresher()
+        assert not leaderboard._stopped.is_set()
+
+    def test_refresher_survives_errors(self, app):
+        gateway = mock.Mock()
+        gateway.chubbiest_owned_repositories.side_effect = [Exception('Boom'), []]
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.start_refresher(app, 0.01)
+        while gateway.chubbiest_owned_repositories.call_count < 2:
+            time.sleep(0.01)
+        leaderboard.stop_refresher()
+
+    def test_refresher_skips_snapshots_refreshed_by_other_workers(self, app, gateway):
+        cache = SimpleCache()
+        Leaderboard(gateway, 5, 60, cache=cache).refresh()
+        other_gateway = mock.Mock()
+        other_worker = Leaderboard(other_gateway, 5, 60, cache=cache)
+        assert 9 < other_worker._refresh_in(10) <= 10
+        other_worker.start_refresher(app, 10)
+        other_worker.stop_refresher()
+        other_gateway.chubbiest_owned_repositories.assert_not_called()
+        assert other_worker._snapshot is not None
+
+    def test_single_worker_refreshes_stale_snapshots(self, gateway):
+        cache = SimpleCache()
+        leaderboard = Leaderboard(gateway, 5, 60, cache=cache)
+        other_worker = Leaderboard(gateway, 5, 60, cache=cache)
+        assert leaderboard._refresh_in(10) == 0
+        assert other_worker._refresh_in(10) == 10
+
+
+class TestRefreshLeaderboardCommand:
+    def test_refresh(self, app, repositories):
+        leaderboard = app.extensions['container'].get('leaderboard')
+        leaderboard.gateway = mock.Mock()
+        leaderboard.gateway.chubbiest_owned_repositories.return_value = [('acme', r) for r in repositories]
+        result = app.test_cli_runner().invoke(args=['refresh-leaderboard'])
+        assert result.exit_code == 0
+        assert result.output == 'Leaderboard refreshed with 5 repositories\n'
+        assert app.extensions['cache'].get(Leaderboard.cache_key) is not None
+
+    @mock.patch('chubbyrepo.leaderboard.time.sleep')
+    def test_refresh_loop(self, mock_sleep, app, repositories):
+        mock_sleep.side_effect = [None, KeyboardInterrupt]
+        leaderboard = app.extensions['container'].get('leaderboard')
+        leaderboard.gateway = mock.Mock()
+        leaderboard.gateway.chubbiest_owned_repositories.return_value = [('acme', r) for r in repositories]
+        app.test_cli_runner().invoke(args=['refresh-leaderboard', '--loop'])
+        assert leaderboard.gateway.chubbiest_owned_repositories.call_count == 2
+
+    def test_refresh_disabled(self, app):
+        app.extensions['container'].override(leaderboard=None)
+        result = app.test_cli_runner().invoke(args=['refresh-leaderboard'])
+        assert result.exit_code == 1
+        assert 'Leaderboard is disabled' in result.output
+
+
+class TestLeaderboardUpdates:
+    @pytest.fixture
+    def leaderboard(self, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60, cache=SimpleCache())
+        leaderboard.refresh()
+        return leaderboard
+
+    @staticmethod
+    def names(leaderboard):
+        return [r.name for r in leaderboard._snapshot[1]]
+
+    def test_update_stars_moves_repository(self, leaderboard):
+        leaderboard.update_stars('acme', 'repo-3', 100)
+        assert self.names(leaderboard) == ['repo-0', 'repo-3', 'repo-1', 'repo-2', 'repo-4']
+        assert leaderboard._snapshot[1][1] == Repository('repo-3', 100)
+
+    def test_update_stars_drops_repository_falling_below_the_last(self, leaderboard):
+        leaderboard.update_stars('acme', 'repo-1', 10)
+        assert self.names(leaderboard) == ['repo-0', 'repo-2', 'repo-3', 'repo-4']
+
+    def test_update_stars_enters_repository_above_the_last(self, leaderboard):
+        leaderboard.update_stars('acme', 'other', 97)
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3', 'other']
+        leaderboard.update_stars('acme', 'another', 97)
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3', 'other']
+
+    def test_update_stars_matches_owner(self, leaderboard):
+        leaderboard.update_stars('other', 'repo-1', 10)
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3', 'repo-4']
+        leaderboard.update_stars('other', 'repo-3', 100)
+        assert self.names(leaderboard) == ['repo-0', 'repo-3', 'repo-1', 'repo-2', 'repo-3']
+        assert leaderboard._snapshot[2] == ['acme', 'other', 'acme', 'acme', 'acme']
+
+    def test_remove_and_rename(self, leaderboard):
+        leaderboard.remove('other', 'repo-0')
+        leaderboard.remove('ACME', 'repo-0')
+        leaderboard.rename('acme', 'repo-1', 'renamed')
+        leaderboard.rename('acme', 'repo-2', 'repo-2', 'new_owner')
+        assert self.names(leaderboard) == ['renamed', 'repo-2', 'repo-3', 'repo-4']
+        assert leaderboard._snapshot[2] == ['acme', 'new_owner', 'acme', 'acme']
+
+    def test_updates_of_repositories_without_known_owner_are_ignored(self, repositories):
+        gateway = mock.Mock()
+        gateway.chubbiest_owned_repositories.return_value = [(None, r) for r in repositories]
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.refresh()
+        leaderboard.update_stars('acme', 'repo-3', 100)
+        leaderboard.remove('acme', 'repo-0')
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3', 'repo-4']
+        leaderboard.update_stars('acme', 'other', 97)
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3', 'other']
+
+    def test_updates_are_published_keeping_snapshot_age(self, leaderboard):
+        fetched_at = leaderboard._snapshot[0]
+        leaderboard.remove('acme', 'repo-0')
+        cached = json.loads(leaderboard.cache.get(Leaderboard.cache_key))
+        assert cached['fetched_at'] == fetched_at
+        assert len(cached['repositories']) == 4
+        assert cached['owners'] == ['acme'] * 4
+
+    def test_updates_reach_workers_with_a_fresh_snapshot(self, leaderboard):
+        other_worker = Leaderboard(mock.Mock(), 5, 60, cache=leaderboard.cache, poll_interval=0)
+        assert other_worker.chubbiest_repositories_snapshot(5)
+        leaderboard.remove('acme', 'repo-0')
+        snapshot, _ = other_worker.chubbiest_repositories_snapshot(4)
+        assert [r.name for r in snapshot] == ['repo-1', 'repo-2', 'repo-3', 'repo-4']
+
+    def test_updates_of_every_worker_are_kept(self, leaderboard):
+        other_worker = Leaderboard(mock.Mock(), 5, 60, cache=leaderboard.cache, poll_interval=60)
+        other_worker.chubbiest_repositories_snapshot(5)
+        leaderboard.remove('acme', 'repo-0')
+        other_worker.remove('acme', 'repo-1')
+        leaderboard.remove('acme', 'repo-2')
+        assert self.names(leaderboard) == ['repo-3', 'repo-4']
+
+    def test_older_published_snapshots_are_not_adopted(self, leaderboard, repositories):
+        value = {'fetched_at': leaderboard._snapshot[0] - 1, 'repositories': [r.asdict() for r in repositories[:1]]}
+        leaderboard.cache.set(Leaderboard.cache_key, json.dumps(value), 60)
+        leaderboard.remove('acme', 'repo-4')
+        assert self.names(leaderboard) == ['repo-0', 'repo-1', 'repo-2', 'repo-3']
+
+    def test_updates_without_snapshot_are_ignored(self, gateway):
+        leaderboard = Leaderboard(gateway, 5, 60)
+        leaderboard.update_stars('acme', 'repo-0', 1000)
+        assert leaderboard._snapshot is None
@@ -0,0 +1,255 @@
+import math
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from chubbyrepo import create_app, metrics
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.metrics import Counter, Histogram, MultiprocessWriter, Registry, aggregate, exposition
+
+
+class TestCounter:
+    def test_inc(self):
+        counter = Counter('requests_total', 'Requests.', ['status'])
+        counter.inc(200)
+        counter.inc(200, amount=2)
+        counter.inc(404)
+        assert counter.samples() == {('200',): 3, ('404',): 1}
+
+    def test_inc_with_wrong_labels(self):
+        with pytest.raises(ValueError):
+            Counter('requests_total', 'Requests.', ['status']).inc()
+
+    def test_inc_from_many_threads(self):
+        counter = Counter('requests_total', 'Requests.')
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.samples() == {(): 8000}
+
+    def test_finished_threads_shards_are_retired(self):
+        counter = Counter('requests_total', 'Requests.')
+        thread = threading.Thread(target=counter.inc)
+        thread.start()
+        thread.join()
+        counter.inc()
+        assert counter.samples() == {(): 2}
+        assert len(counter._shards) == 1
+
+
+class TestHistogram:
+    def test_observe(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=[0.1, 1])
+        histogram.observe(0.05, 'stats')
+        histogram.observe(0.1, 'stats')
+        histogram.observe(5, 'stats')
+        assert histogram.samples() == {('stats',): [2, 0, 1, 5.15, 3]}
+
+
+class TestRegistry:
+    def test_snapshot(self):
+        registry = Registry()
+        counter = registry.register(Counter('requests_total', 'Requests.', ['status']))
+        counter.inc(200)
+        registry.register_callback('coalesced_total', 'Coalesced.', ['result'], lambda: {('executed',): 4})
+        assert registry.snapshot() == {
+            'requests_total': {'type': 'counter', 'help': 'Requests.', 'labelnames': ['status'], 'buckets': [],
+                               'merge': 'sum', 'samples': [[['200'], 1]]},
+            'coalesced_total': {'type': 'counter', 'help': 'Coalesced.', 'labelnames': ['result'], 'buckets': [],
+                                'merge': 'sum', 'samples': [[['executed'], 4]]},
+        }
+
+
+def test_exposition():
+    histogram = Histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=[0.1, 1])
+    histogram.observe(0.05, 'stats')
+    histogram.observe(5, 'stats')
+    registry = Registry()
+    registry.register(histogram)
+    registry.register(Counter('requests_total', 'Requests.', ['path'])).inc('/a"b')
+    assert exposition(registry.snapshot()) == '\n'.join([
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="stats",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="stats",le="1"} 1',
+        'latency_seconds_bucket{endpoint="stats",le="+Inf"} 2',
+        'latency_seconds_sum{endpoint="stats"} 5.05',
+        'latency_seconds_count{endpoint="stats"} 2',
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{path="/a\\"b"} 1',
+    ]) + '\n'
+
+
+def test_aggregate():
+    family = {'type': 'counter', 'help': '', 'labelnames': ['status'], 'buckets': []}
+    histogram = {'type': 'histogram', 'help': '', 'labelnames': [], 'buckets': [1]}
+    gauge = {'type': 'gauge', 'help': '', 'labelnames': [], 'buckets': []}
+    state = dict(gauge, labelnames=['state'], merge='max')
+    merged = aggregate([
+        {'c': dict(family, samples=[[['200'], 1]]), 'h': dict(histogram, samples=[[[], [1, 0, 0.5, 1]]]),
+         'queue': dict(gauge, merge='sum', samples=[[[], 3]]), 'budget': dict(gauge, merge='min', samples=[[[], 10]]),
+         'state': dict(state, samples=[[['open'], 1], [['closed'], 0]])},
+        {'c': dict(family, samples=[[['200'], 2], [['404'], 1]]), 'h': dict(histogram, samples=[[[], [0, 1, 3, 1]]]),
+         'queue': dict(gauge, merge='sum', samples=[[[], 0]]), 'budget': dict(gauge, merge='min', samples=[[[], 4]]),
+         'state': dict(state, samples=[[['open'], 0], [['closed'], 1]])},
+    ])
+    assert merged['c']['samples'] == [[['200'], 3], [['404'], 1]]
+    assert merged['h']['samples'] == [[[], [1, 1, 3.5, 2]]]
+    # An idle worker doesn't hide the others queue, nor a closed circuit an open one
+    assert merged['queue']['samples'] == [[[], 3]]
+    assert merged['budget']['samples'] == [[[], 4]]
+    assert merged['state']['samples'] == [[['open'], 1], [['closed'], 1]]
+
+
+def test_multiprocess_writer(tmpdir):
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests.')).inc()
+    other_worker = Registry()
+    other_worker.register(Counter('requests_total', 'Requests.')).inc(amount=2)
+    writer = MultiprocessWriter(registry, str(tmpdir), 5)
+    with mock.patch('os.getpid', return_value=1):
+        MultiprocessWriter(other_worker, str(tmpdir), 5).flush()
+    assert writer.collect()['requests_total']['samples'] == [[[], 3]]
+    assert os.path.exists(writer.path)
+
+
+def flush_as(registry, directory, pid, age=0):
+    """Flush the registry as the worker `pid` did `age` seconds ago."""
+    with mock.patch('os.getpid', return_value=pid):
+        writer = MultiprocessWriter(registry, directory, 5)
+        writer.flush()
+    os.utime(writer.path.replace(str(os.getpid()), str(pid)), (time.time() - age, time.time() - age))
+    return os.path.join(directory, 'metrics_{}.json'.format(pid))
+
+
+def test_multiprocess_writer_folds_gone_workers_totals(tmpdir):
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests.')).inc()
+    gone_worker = Registry()
+    gone_worker.register(Counter('requests_total', 'Requests.')).inc(amount=2)
+    gone_worker.register(Histogram('latency_seconds', 'Latency.', buckets=[1])).observe(0.5)
+    gone_worker.register_callback('in_flight', 'In flight.', [], lambda: {(): 3}, type='gauge')
+    writer = MultiprocessWriter(registry, str(tmpdir), 5)
+    gone_path = flush_as(gone_worker, str(tmpdir), 1, age=60)
+    with mock.patch('chubbyrepo.metrics._is_running', return_value=False):
+        for _ in range(2):
+            families = writer.collect()
+            assert families['requests_total']['samples'] == [[[], 3]]
+            assert families['latency_seconds']['samples'] == [[[], [1, 0, 0.5, 1]]]
+            assert 'in_flight' not in families
+    assert not os.path.exists(gone_path)
+    assert os.path.exists(writer.retired_path)
+
+
+def test_multiprocess_writer_keeps_stale_files_of_running_workers(tmpdir):
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests.')).inc()
+    stale_path = flush_as(registry, str(tmpdir), 1, age=60)
+    with mock.patch('chubbyrepo.metrics._is_running', return_value=True):
+        assert MultiprocessWriter(registry, str(tmpdir), 5).collect()['requests_total']['samples'] == [[[], 2]]
+    assert os.path.exists(stale_path)
+
+
+def test_multiprocess_writer_skips_files_retired_by_other_workers(tmpdir):
+    registry = Registry()
+    registry.register(Counter('requests_total', 'Requests.')).inc()
+    writer = MultiprocessWriter(registry, str(tmpdir), 5)
+    flush_as(registry, str(tmpdir), 1, age=60)
+    with mock.patch('chubbyrepo.metrics._is_running', return_value=False), \
+            mock.patch('os.path.getmtime', side_effect=FileNotFoundError):
+        assert writer.collect() == {}
+    with mock.patch('chubbyrepo.metrics._is_running', return_value=False), \
+            mock.patch('json.load', side_effect=[FileNotFoundError, {}]):
+        assert writer.collect() == {}
+
+
+def test_is_running():
+    assert metrics._is_running(os.getpid())
+    with mock.patch('os.kill', side_effect=ProcessLookupError):
+        assert not metrics._is_running(12345)
+    with mock.patch('os.kill', side_effect=PermissionError):
+        assert metrics._is_running(1)
+
+
+def test_multiprocess_writer_start(tmpdir):
+    writer = MultiprocessWriter(Registry(), str(tmpdir.join('metrics')), 5)
+    with mock.patch('threading.Thread') as mock_thread:
+        writer.start()
+        writer.start()
+    mock_thread.assert_called_once_with(target=writer._flush_forever, daemon=True, name='metrics-writer')
+    assert os.path.isdir(writer.directory)
+    # Started meanwhile by another thread
+    writer._pid = None
+    with mock.patch('threading.Thread') as mock_thread, mock.patch.object(writer, '_lock') as mock_lock:
+        mock_lock.__enter__.side_effect = lambda: setattr(writer, '_pid', os.getpid())
+        writer.start()
+    mock_thread.assert_not_called()
+
+
+def test_multiprocess_writer_flushes_forever(tmpdir):
+    writer = MultiprocessWriter(Registry(), str(tmpdir), 5)
+    with mock.patch('time.sleep', side_effect=[None, SystemExit]) as mock_sleep, pytest.raises(SystemExit):
+        writer._flush_forever()
+    mock_sleep.assert_called_with(5)
+    assert os.path.exists(writer.path)
+
+
+class TestMetricsEndpoint:
+    @mock.patch('chubbyrepo.gateways.StatsGateway.organization_stats')
+    def test_request_metrics(self, mock_stats, client):
+        mock_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        before = metrics.HTTP_REQUESTS.samples().get(('api.organization_stats', '200'), 0)
+        client.get('/organizations/metrics-org/stats')
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.content_type == metrics.CONTENT_TYPE
+        assert metrics.HTTP_REQUESTS.samples()[('api.organization_stats', '200')] == before + 1
+        body = response.get_data(as_text=True)
+        assert 'chubbyrepo_http_requests_total{endpoint="api.organization_stats",status="200"}' in body
+        assert 'chubbyrepo_interactor_duration_seconds_count{interactor="OrganizationStatsInteractor",' \
+               'type="SUCCESS"}' in body
+        assert 'chubbyrepo_cache_requests_total{resource="organization_stats",result="miss"}' in body
+        assert 'chubbyrepo_upstream_token_events_total{token="token0",event="calls"} 0' in body
+        assert 'chubbyrepo_upstream_circuit_breaker_state{state="closed"} 1' in body
+        assert 'chubbyrepo_upstream_admission_queue_depth 0' in body
+
+    @mock.patch('chubbyrepo.gateways.StatsGateway.organization_stats')
+    def test_adaptive_ttl_metrics(self, mock_stats):
+        mock_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+        app = create_app('testing', {'ADAPTIVE_TTL_ENABLED': True})
+        client = app.test_client()
+        client.get('/organizations/Adaptive-Org/stats')
+        body = client.get('/metrics').get_data(as_text=True)
+        assert 'chubbyrepo_cache_key_ttl_seconds{resource="organization_stats",key="adaptive-org"} 300' in body
+        assert 'chubbyrepo_cache_key_age_seconds{resource="organization_stats",key="adaptive-org"}' in body
+        assert 'chubbyrepo_cache_refreshes_total{resource="organization_stats",result="first"}' in body
+
+    def test_multiprocess_metrics(self, tmpdir):
+        app = create_app('testing', {
+            'METRICS_MULTIPROC_DIR': str(tmpdir), 'UPSTREAM_HEDGE_ENABLED': True, 'SINGLEFLIGHT_ENABLED': False,
+            'UPSTREAM_BREAKER_ENABLED': False, 'ADMISSION_ENABLED': False})
+        with mock.patch('threading.Thread'):
+            body = app.test_client().get('/metrics').get_data(as_text=True)
+        assert os.path.exists(app.extensions['metrics_writer'].path)
+        assert 'chubbyrepo_upstream_hedged_calls_total{result="sent"} 0' in body
+
+    def test_metrics_disabled(self):
+        app = create_app('testing', {'METRICS_ENABLED': False})
+        assert app.test_client().get('/metrics').status_code == 404
+
+
+def test_number_format():
+    assert metrics._number(math.inf) == '+Inf'
+    assert metrics._number(0.25) == '0.25'
+    assert metrics._number(3.0) == '3'
@@ -0,0 +1,198 @@
+import collections
+import marshal
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+from flask import url_for
+
+from chubbyrepo import create_app
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.profiling import Profiler
+
+SECRET = 'profiling-secret'
+
+
+def busy(n=2000):
+    return sum(i * i for i in range(n))
+
+
+def allocate():
+    return [str(i) * 10 for i in range(1000)]
+
+
+def profile(profiler, fn, endpoint='api.organization_stats'):
+    session = profiler.start()
+    try:
+        return fn()
+    finally:
+        profiler.stop(session, endpoint)
+
+
+class TestProfiler:
+    def test_samples_ratio_of_requests(self):
+        assert not Profiler(sample_ratio=0).should_profile()
+        assert Profiler(sample_ratio=0).should_profile(forced=True)
+        assert Profiler(sample_ratio=1).should_profile()
+
+    def test_aggregates_cprofile_stats_per_endpoint(self):
+        profiler = Profiler(memory=False)
+        profile(profiler, busy)
+        profile(profiler, busy)
+        profile(profiler, busy, 'api.chubbiest_repositories')
+        summary = profiler.summary()
+        assert summary['api.organization_stats']['requests'] == 2
+        assert summary['api.chubbiest_repositories']['requests'] == 1
+        stats = marshal.loads(profiler.pstats('api.organization_stats'))
+        (calls, *_), = [value for (_, _, name), value in stats.items() if name == 'busy']
+        assert calls == 2
+        assert profiler.collapsed('api.organization_stats') is None
+
+    def test_samples_stacks(self):
+        profiler = Profiler(mode='sampling', interval=0.001, memory=False)
+
+        def slow():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                busy(100)
+
+        profile(profiler, slow)
+        stacks = profiler.collapsed('api.organization_stats').splitlines()
+        assert stacks
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in stacks)
+        assert any('slow (' in line for line in stacks)
+        assert profiler.pstats('api.organization_stats') is None
+
+    def test_samples_concurrent_requests_with_a_single_sampler(self):
+        profiler = Profiler(mode='sampling', memory=False)
+        with mock.patch('threading.Thread') as mock_thread, mock.patch('threading.get_ident', side_effect=[1, 2]):
+            first = profiler.start()
+            second = profiler.start()
+            mock_thread.assert_called_once_with(target=profiler._sample_forever, daemon=True,
+                                                name='profiling-sampler')
+            profiler.stop(first, 'api.organization_stats')
+            assert profiler._sampling.is_set()
+            profiler.stop(second, 'api.organization_stats')
+            assert not profiler._sampling.is_set()
+        # Started meanwhile by another thread
+        profiler._sampler_pid = None
+        with mock.patch('threading.Thread') as mock_thread, mock.patch.object(profiler, '_lock') as mock_lock:
+            mock_lock.__enter__.side_effect = lambda: setattr(profiler, '_sampler_pid', os.getpid())
+            profiler._start_sampler()
+        mock_thread.assert_not_called()
+
+    def test_samples_only_running_threads(self):
+        profiler = Profiler(mode='sampling', memory=False)
+        # The thread of an ended request, not yet removed
+        profiler._sampled = {threading.get_ident(): collections.Counter(), -1: collections.Counter()}
+        with mock.patch('time.sleep', side_effect=[None, SystemExit]), pytest.raises(SystemExit):
+            profiler._sampling.set()
+            profiler._sample_forever()
+        assert sum(profiler._sampled[threading.get_ident()].values()) == 1
+        assert not profiler._sampled[-1]
+
+    def test_skips_cpu_profile_when_another_profiler_is_active(self):
+        profiler = Profiler(memory=False)
+        with mock.patch('cProfile.Profile') as mock_profile:
+            mock_profile.return_value.enable.side_effect = ValueError('Another profiling tool is already active')
+            profile(profiler, busy)
+        assert profiler.summary()['api.organization_stats'] == {
+            'requests': 1, 'cpu_calls': 0, 'cpu_samples': 0, 'allocated_bytes': 0}
+        assert profiler.pstats('api.organization_stats') is None
+
+    def test_traces_allocations(self):
+        profiler = Profiler(memory=True, memory_frames=5)
+        held = profile(profiler, allocate)
+        allocations = profiler.collapsed('api.organization_stats', 'memory')
+        assert 'test_profiling.py' in allocations
+        assert profiler.summary()['api.organization_stats']['allocated_bytes'] >= len(held) * 40
+
+    def test_traces_allocations_of_a_single_request_at_once(self):
+        profiler = Profiler(memory=True)
+        first = profiler.start()
+        second = profiler.start()
+        assert (first.memory, second.memory) == (True, False)
+        profiler.stop(second, 'api.organization_stats')
+        profiler.stop(first, 'api.organization_stats')
+        third = profiler.start()
+        profiler.stop(third, 'api.organization_stats')
+        assert third.memory
+
+    def test_reset(self):
+        profiler = Profiler(memory=False)
+        profile(profiler, busy)
+        profiler.reset()
+        assert profiler.summary() == {}
+
+    def test_rejects_unknown_mode(self):
+        with pytest.raises(ValueError):
+            Profiler(mode='perf')
+
+    def test_profiles_concurrent_requests(self):
+        profiler = Profiler(memory=False)
+        threads = [threading.Thread(target=profile, args=(profiler, busy)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert profiler.summary()['api.organization_stats']['requests'] == 4
+
+
+@pytest.fixture
+def profiled_app():
+    return create_app('testing', {'PROFILING_ENABLED': True, 'PROFILING_SECRET': SECRET})
+
+
+@mock.patch('chubbyrepo.gateways.StatsGateway.organization_stats')
+def test_profiles_requests_with_secret_header(mock_organization_stats, profiled_app):
+    mock_organization_stats.return_value = OrganizationStats(4, Repository('repo-test', 10))
+    client = profiled_app.test_client()
+    with profiled_app.test_request_context():
+        url = url_for('api.organization_stats', org_name='acme_corp')
+        assert client.get(url).status_code == 200
+        assert profiled_app.extensions['profiler'].summary() == {}
+        client.get(url, headers={'X-Profile': 'wrong'})
+        assert profiled_app.extensions['profiler'].summary() == {}
+        client.get(url, headers={'X-Profile': SECRET})
+
+        http_response = client.get(url_for('profiling.profiles'), headers={'X-Profile': SECRET})
+        assert http_response.json['mode'] == 'cprofile'
+        assert http_response.json['endpoints']['api.organization_stats']['requests'] == 1
+
+        http_response = client.get(url_for('profiling.cpu_pstats', name='api.organization_stats'),
+                                   headers={'X-Profile': SECRET})
+        assert http_response.status_code == 200
+        assert isinstance(marshal.loads(http_response.data), dict)
+        assert 'attachment' in http_response.headers['Content-Disposition']
+
+        http_response = client.get(url_for('profiling.collapsed_stacks', name='api.organization_stats',
+                                           kind='memory'), headers={'X-Profile': SECRET})
+        assert http_response.status_code == 200
+        assert http_response.content_type == 'text/plain; charset=utf-8'
+
+        http_response = client.get(url_for('profiling.collapsed_stacks', name='api.organization_stats',
+                                           kind='cpu'), headers={'X-Profile': SECRET})
+        assert http_response.status_code == 404
+
+        http_response = client.get(url_for('profiling.cpu_pstats', name='api.chubbiest_repositories'),
+                                   headers={'X-Profile': SECRET})
+        assert http_response.status_code == 404
+
+        assert client.delete(url_for('profiling.reset_profiles'), headers={'X-Profile': SECRET}).status_code == 204
+        assert profiled_app.extensions['profiler'].summary() == {}
+
+
+def test_profiles_are_hidden_without_secret(profiled_app):
+    client = profiled_app.test_client()
+    with profiled_app.test_request_context():
+        assert client.get(url_for('profiling.profiles')).status_code == 404
+        assert client.get(url_for('profiling.profiles'), headers={'X-Profile': 'wrong'}).status_code == 404
+
+
+@pytest.mark.parametrize('overrides', [{}, {'PROFILING_ENABLED': True}])
+def test_profiling_disabled(overrides):
+    app = create_app('testing', overrides)
+    assert app.extensions['profiler'] is None
+    assert app.test_client().get('/profiling', headers={'X-Profile': 'None'}).status_code == 404
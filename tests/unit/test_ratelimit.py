@@ -0,0 +1,155 @@
+import asyncio
+import time
+from unittest import mock
+
+import pytest
+
+from chubbyrepo.core.gateways import RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.ratelimit import TokenBucket, UpstreamScheduler
+from chubbyrepo.resilience import deadline
+
+
+class TestTokenBucket:
+    def test_unpaced(self):
+        bucket = TokenBucket(1)
+        assert [bucket.reserve() for _ in range(5)] == [0] * 5
+
+    @mock.patch('chubbyrepo.ratelimit.time.monotonic')
+    def test_paced(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        bucket = TokenBucket(2, rate=1)
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 0
+        assert bucket.reserve() == 1
+        bucket.cancel()
+        mock_monotonic.return_value = 101
+        assert bucket.reserve() == 0
+
+    def test_zero_rate(self):
+        bucket = TokenBucket(1, rate=0)
+        bucket.reserve()
+        assert bucket.reserve() == float('inf')
+
+
+class TestUpstreamScheduler:
+    def test_from_config(self, config):
+        config['GITHUB_API_KEYS'] = ['a', 'b']
+        scheduler = UpstreamScheduler.from_config(config)
+        assert [t.token for t in scheduler.tokens] == ['a', 'b']
+        assert scheduler.reserve == config['GITHUB_RATE_LIMIT_RESERVE']
+        config['GITHUB_API_KEYS'] = []
+        assert [t.token for t in UpstreamScheduler.from_config(config).tokens] == [config['GITHUB_API_KEY']]
+
+    def test_rotates_to_token_with_more_budget(self):
+        scheduler = UpstreamScheduler(['a', 'b'])
+        reset = str(int(time.time()) + 3600)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': reset})
+        scheduler.update(scheduler.tokens[1], {'X-RateLimit-Remaining': '4000', 'X-RateLimit-Reset': reset})
+        assert scheduler.acquire().token == 'b'
+        assert scheduler.counters()['token1']['calls'] == 1
+        assert scheduler.counters()['token1']['remaining'] == 4000
+
+    def test_update_from_graphql_rate_limit(self):
+        scheduler = UpstreamScheduler(['a'])
+        rate_limit = {'cost': 1, 'remaining': 42, 'resetAt': '2030-01-01T00:00:00Z'}
+        scheduler.update(scheduler.tokens[0], rate_limit=rate_limit)
+        assert scheduler.tokens[0].remaining == 42
+        assert scheduler.tokens[0].reset_at == 1893456000
+        assert scheduler.counters()['token0']['cost'] == 1
+
+    def test_update_without_budget_information(self):
+        scheduler = UpstreamScheduler(['a'])
+        scheduler.update(scheduler.tokens[0], {})
+        assert scheduler.tokens[0].remaining is None
+
+    def test_update_without_reset(self):
+        scheduler = UpstreamScheduler(['a'])
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '10'})
+        assert (scheduler.tokens[0].remaining, scheduler.tokens[0].reset_at) == (10, None)
+        assert scheduler.tokens[0].bucket.rate is None
+
+    def test_exhausted_tokens_raise_rate_limit_exceeded(self):
+        scheduler = UpstreamScheduler(['a', 'b'], reserve=5)
+        scheduler.exhaust(scheduler.tokens[0], retry_after=30)
+        reset = str(int(time.time()) + 60)
+        scheduler.update(scheduler.tokens[1], {'X-RateLimit-Remaining': '5', 'X-RateLimit-Reset': reset})
+        with pytest.raises(RateLimitExceeded) as e:
+            scheduler.acquire()
+        assert 29 <= e.value.retry_after <= 30
+        assert scheduler.counters()['token0']['rate_limited'] == 1
+
+    def test_budget_is_restored_after_reset(self):
+        scheduler = UpstreamScheduler(['a'])
+        scheduler.exhaust(scheduler.tokens[0])
+        scheduler.tokens[0].reset_at = time.time() - 1
+        assert scheduler.acquire().token == 'a'
+
+    @mock.patch('chubbyrepo.ratelimit.time.sleep')
+    def test_paces_calls(self, mock_sleep):
+        scheduler = UpstreamScheduler(['a'], burst=1, max_wait=10)
+        reset = str(int(time.time()) + 1000)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '1000', 'X-RateLimit-Reset': reset})
+        scheduler.acquire()
+        scheduler.acquire()
+        assert mock_sleep.call_count == 1
+        assert 0 < mock_sleep.call_args[0][0] <= 1.1
+        assert scheduler.counters()['token0']['throttled'] == 1
+
+    @mock.patch('chubbyrepo.ratelimit.asyncio.sleep')
+    def test_paces_calls_without_blocking(self, mock_sleep):
+        scheduler = UpstreamScheduler(['a'], burst=1, max_wait=10)
+        reset = str(int(time.time()) + 1000)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '1000', 'X-RateLimit-Reset': reset})
+
+        async def acquire_twice():
+            await scheduler.acquire_async()
+            return await scheduler.acquire_async()
+
+        assert asyncio.run(acquire_twice()).token == 'a'
+        assert mock_sleep.call_count == 1
+        assert 0 < mock_sleep.call_args[0][0] <= 1.1
+
+    @mock.patch('chubbyrepo.ratelimit.time.sleep')
+    def test_refuses_waiting_past_the_deadline(self, mock_sleep):
+        scheduler = UpstreamScheduler(['a'], burst=1, max_wait=10)
+        reset = str(int(time.time()) + 1000)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '1000', 'X-RateLimit-Reset': reset})
+        with deadline(0.1):
+            scheduler.acquire()
+            with pytest.raises(UpstreamUnavailable) as e:
+                scheduler.acquire()
+        assert str(e.value) == 'Request deadline exceeded'
+        mock_sleep.assert_not_called()
+        # The token given back is used by the next call, allowed to wait
+        with deadline(10):
+            scheduler.acquire()
+        assert 0 < mock_sleep.call_args[0][0] <= 1.1
+        assert scheduler.counters()['token0']['calls'] == 2
+
+    def test_refuses_waiting_longer_than_max_wait(self):
+        scheduler = UpstreamScheduler(['a'], burst=1, max_wait=1)
+        reset = str(int(time.time()) + 1000)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': reset})
+        scheduler.acquire()
+        with pytest.raises(RateLimitExceeded):
+            scheduler.acquire()
+
+    def test_try_acquire_never_waits(self):
+        scheduler = UpstreamScheduler(['a'], burst=1)
+        reset = str(int(time.time()) + 1000)
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': reset})
+        assert scheduler.try_acquire(scheduler.tokens[0])
+        assert not scheduler.try_acquire(scheduler.tokens[0])
+        assert scheduler.counters()['token0']['calls'] == 1
+
+    def test_try_acquire_needs_budget(self):
+        scheduler = UpstreamScheduler(['a'])
+        scheduler.exhaust(scheduler.tokens[0])
+        assert not scheduler.try_acquire(scheduler.tokens[0])
+
+    def test_exhaust_keeps_known_reset(self):
+        scheduler = UpstreamScheduler(['a'])
+        reset = int(time.time()) + 1000
+        scheduler.update(scheduler.tokens[0], {'X-RateLimit-Remaining': '10', 'X-RateLimit-Reset': str(reset)})
+        scheduler.exhaust(scheduler.tokens[0])
+        assert (scheduler.tokens[0].remaining, scheduler.tokens[0].reset_at) == (0, reset)
@@ -1,7 +1,8 @@
 import pytest
 
 from chubbyrepo.core.requests import (
-    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsRequest, ValidRequest
+    ChubbiestRepositoriesRequest, InvalidRequest, OrganizationStatsBatchRequest, OrganizationStatsHistoryRequest,
+    OrganizationStatsRequest, ValidRequest
 )
 
 
@@ -42,6 +43,61 @@ class TestOrganizationStatsRequest:
         assert request.errors[0]['parameter'] == 'organization_name'
         assert bool(request) is False
 
+    @pytest.mark.parametrize('test_input, expected', [(None, 'summary'), ('summary', 'summary'), ('full', 'full')])
+    def test_build_from_dict_with_detail(self, test_input, expected):
+        request = OrganizationStatsRequest.from_dict({'organization_name': 'acme', 'detail': test_input})
+        assert request.detail == expected
+
+    def test_build_from_dict_with_invalid_detail(self):
+        request = OrganizationStatsRequest.from_dict({'organization_name': 'acme', 'detail': 'everything'})
+        assert request.errors == [{'parameter': 'detail', 'message': 'Must be one of summary, full'}]
+
+
+class TestOrganizationStatsHistoryRequest:
+    def test_build_from_dict(self):
+        request = OrganizationStatsHistoryRequest.from_dict({'organization_name': 'Sirius Cybernetics Corp.',
+                                                             'limit': '20'})
+        assert request.organization_name == 'Sirius Cybernetics Corp.'
+        assert request.limit == 20
+        assert bool(request) is True
+
+    def test_build_from_dict_default_limit(self):
+        assert OrganizationStatsHistoryRequest.from_dict({'organization_name': 'acme'}).limit == 10
+
+    @pytest.mark.parametrize('test_input, error', [
+        ({'limit': 5}, {'parameter': 'organization_name', 'message': 'Is required'}),
+        ({'organization_name': 1}, {'parameter': 'organization_name', 'message': 'Is not string'}),
+        ({'organization_name': 'acme', 'limit': 'ten'}, {'parameter': 'limit', 'message': 'Is not integer'}),
+        ({'organization_name': 'acme', 'limit': 101},
+         {'parameter': 'limit', 'message': 'Must be between 1 and 100, both included'}),
+    ])
+    def test_build_from_dict_with_invalid_parameters(self, test_input, error):
+        request = OrganizationStatsHistoryRequest.from_dict(test_input)
+        assert request.errors == [error]
+        assert bool(request) is False
+
+
+class TestOrganizationStatsBatchRequest:
+    def test_build(self):
+        request = OrganizationStatsBatchRequest(organization_names=['acme', 'sirius', 'acme'])
+        assert request.organization_names == ['acme', 'sirius']
+        assert bool(request) is True
+
+    def test_build_from_dict(self):
+        request = OrganizationStatsBatchRequest.from_dict({'organization_names': ['acme', 'sirius']})
+        assert request.organization_names == ['acme', 'sirius']
+        assert bool(request) is True
+
+    @pytest.mark.parametrize('test_input', [
+        {}, {'organization_names': 'acme'}, {'organization_names': ['acme', 1]}, {'organization_names': []},
+        {'organization_names': ['org'] * 501},
+    ])
+    def test_build_from_dict_with_invalid_organization_names(self, test_input):
+        request = OrganizationStatsBatchRequest.from_dict(test_input)
+        assert request.has_errors()
+        assert request.errors[0]['parameter'] == 'organization_names'
+        assert bool(request) is False
+
 
 class TestChubbiestRepositoriesRequest:
     @pytest.mark.parametrize('test_input,expected', [(2, 2), (None, 10)])
@@ -56,7 +112,7 @@ class TestChubbiestRepositoriesRequest:
         assert request.limit == expected
         assert bool(request) is True
 
-    @pytest.mark.parametrize("test_input", [0, 101, 'asdfg'])
+    @pytest.mark.parametrize("test_input", [0, 1001, 'asdfg'])
     def test_build_from_dict_with_invalid_limit(self, test_input):
         request = ChubbiestRepositoriesRequest.from_dict({'limit': test_input})
         assert request.has_errors()
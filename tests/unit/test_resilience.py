@@ -0,0 +1,338 @@
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from chubbyrepo.core.gateways import Overloaded, UpstreamUnavailable
+from chubbyrepo.resilience import (
+    AdmissionController, CircuitBreaker, Hedger, _priority, carry, check_deadline, deadline, priority, time_left
+)
+
+
+class TestDeadline:
+    def test_time_left(self):
+        assert time_left() is None
+        with deadline(10):
+            assert 9 < time_left() <= 10
+        assert time_left() is None
+
+    def test_earlier_deadline_is_kept(self):
+        with deadline(1):
+            with deadline(10):
+                assert time_left() <= 1
+            with deadline(0.5):
+                assert time_left() <= 0.5
+
+    def test_without_deadline(self):
+        with deadline(None):
+            assert time_left() is None
+            check_deadline()
+
+    def test_carry(self):
+        def items():
+            for item in (1, 2):
+                yield item, time_left() is not None, _priority.get()
+
+        with deadline(10), priority(0):
+            carried = carry(items())
+        assert time_left() is None
+        assert list(carried) == [(1, True, 0), (2, True, 0)]
+
+    def test_check_deadline(self):
+        with deadline(0):
+            with pytest.raises(UpstreamUnavailable):
+                check_deadline()
+
+
+class TestHedger:
+    @pytest.fixture
+    def hedger(self):
+        hedger = Hedger(min_delay=0.01, min_samples=10)
+        for _ in range(10):
+            hedger.observe(0.001)
+        return hedger
+
+    def test_delay(self):
+        hedger = Hedger(quantile=0.5, min_delay=0, min_samples=3)
+        hedger.observe(1)
+        hedger.observe(2)
+        assert hedger.delay() is None
+        hedger.observe(3)
+        assert hedger.delay() == 2
+
+    def test_fast_calls_are_not_hedged(self, hedger):
+        fn = mock.Mock(return_value='result')
+        assert hedger.call(fn) == 'result'
+        assert fn.call_count == 1
+        assert hedger.counters()['sent'] == 0
+
+    def test_slow_calls_are_hedged(self, hedger):
+        calls = []
+        released = threading.Event()
+
+        def fn():
+            calls.append(None)
+            if len(calls) == 1:
+                released.wait(1)
+                return 'primary'
+            return 'hedge'
+
+        assert hedger.call(fn) == 'hedge'
+        released.set()
+        assert hedger.counters() == {'sent': 1, 'skipped': 0, 'won': 1, 'lost': 0}
+
+    def test_failed_hedge_waits_for_primary(self, hedger):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.05)
+                return 'primary'
+            raise ValueError('hedge failed')
+
+        assert hedger.call(fn) == 'primary'
+        assert hedger.counters() == {'sent': 1, 'skipped': 0, 'won': 0, 'lost': 1}
+
+    def test_hedge_runs_what_reserve_returns(self, hedger):
+        def fn():
+            time.sleep(0.05)
+            return 'primary'
+
+        assert hedger.call(fn, lambda: lambda: 'hedge') == 'hedge'
+        assert hedger.counters() == {'sent': 1, 'skipped': 0, 'won': 1, 'lost': 0}
+
+    def test_hedge_skipped_without_reserve(self, hedger):
+        def fn():
+            time.sleep(0.05)
+            return 'primary'
+
+        assert hedger.call(fn, lambda: None) == 'primary'
+        assert hedger.counters() == {'sent': 0, 'skipped': 1, 'won': 0, 'lost': 0}
+
+    def test_not_hedged_past_deadline(self, hedger):
+        fn = mock.Mock(return_value='result')
+        with deadline(0.001):
+            assert hedger.call(fn) == 'result'
+        assert hedger.counters()['sent'] == 0
+
+    def test_deadline_exceeded_while_hedged(self, hedger):
+        released = threading.Event()
+        with deadline(0.05), pytest.raises(UpstreamUnavailable) as e:
+            hedger.call(lambda: released.wait(1))
+        released.set()
+        assert str(e.value) == 'Request deadline exceeded'
+        assert hedger.counters()['sent'] == 1
+
+    def test_raises_last_error_when_primary_and_hedge_fail(self, hedger):
+        calls = []
+
+        def fn():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.05)
+                raise ValueError('primary failed')
+            raise ValueError('hedge failed')
+
+        with pytest.raises(ValueError) as e:
+            hedger.call(fn)
+        assert str(e.value) == 'primary failed'
+        assert hedger.counters() == {'sent': 1, 'skipped': 0, 'won': 0, 'lost': 0}
+
+    def test_executor_created_once_per_process(self, hedger):
+        assert hedger._get_executor() is hedger._get_executor()
+        # Created meanwhile by another thread
+        executor, hedger._executor_pid = hedger._executor, None
+        with mock.patch('concurrent.futures.ThreadPoolExecutor') as mock_executor, \
+                mock.patch.object(hedger, '_lock') as mock_lock:
+            mock_lock.__enter__.side_effect = lambda: setattr(hedger, '_executor_pid', os.getpid())
+            assert hedger._get_executor() is executor
+        mock_executor.assert_not_called()
+
+    def test_from_config(self, config):
+        assert Hedger.from_config(dict(config, UPSTREAM_HEDGE_ENABLED=False)) is None
+        hedger = Hedger.from_config(dict(config, UPSTREAM_HEDGE_ENABLED=True))
+        assert (hedger.quantile, hedger.min_delay) == (config['UPSTREAM_HEDGE_QUANTILE'],
+                                                       config['UPSTREAM_HEDGE_MIN_DELAY'])
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(UpstreamUnavailable) as e:
+            breaker.allow()
+        assert 29 < e.value.retry_after <= 30
+        assert breaker.counters() == {'opened': 1, 'rejected': 1}
+
+    def test_half_open_lets_a_single_probe_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(UpstreamUnavailable):
+            breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0)
+        for _ in range(3):
+            breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.counters()['opened'] == 2
+
+    def test_failures_while_open_keep_it_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+        # A call let through before the circuit opened
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.counters()['opened'] == 1
+
+    def test_inconclusive_probe_lets_another_one_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_inconclusive()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.allow()
+        assert breaker.counters()['rejected'] == 0
+
+    def test_from_config(self, config):
+        assert CircuitBreaker.from_config(dict(config, UPSTREAM_BREAKER_ENABLED=False)) is None
+        breaker = CircuitBreaker.from_config(dict(config, UPSTREAM_BREAKER_ENABLED=True))
+        assert breaker.failure_threshold == config['UPSTREAM_BREAKER_FAILURES']
+
+
+class TestAdmissionController:
+    @staticmethod
+    def hold(controller, release, priority_value=1):
+        """Start a thread holding a slot until `release` is set, or waiting for one."""
+        admitted = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                with priority(priority_value), controller.admit():
+                    admitted.set()
+                    release.wait(1)
+            except Overloaded as exc:
+                outcome['error'] = exc
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, admitted, outcome
+
+    @staticmethod
+    def wait_queued(controller, depth):
+        while controller.queue_depth() < depth:
+            time.sleep(0.001)
+
+    def test_try_acquire_takes_only_free_slots(self):
+        controller = AdmissionController(max_concurrency=1, max_queue=0)
+        assert controller.try_acquire()
+        assert controller.in_flight == 1
+        assert not controller.try_acquire()
+        controller.release()
+        assert controller.in_flight == 0
+
+    def test_admits_up_to_max_concurrency(self):
+        controller = AdmissionController(max_concurrency=2, max_queue=0)
+        with controller.admit(), controller.admit():
+            assert controller.in_flight == 2
+            with pytest.raises(Overloaded) as e:
+                with controller.admit():
+                    pass
+        assert e.value.retry_after == 1
+        assert controller.in_flight == 0
+        assert controller.counters() == {'admitted': 2, 'queued': 0, 'shed': 1, 'timed_out': 0}
+
+    def test_queued_calls_get_released_slots(self):
+        controller, release = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1), threading.Event()
+        holder, _, _ = self.hold(controller, release)
+        waiter, admitted, outcome = self.hold(controller, threading.Event())
+        self.wait_queued(controller, 1)
+        release.set()
+        assert admitted.wait(1)
+        holder.join()
+        waiter.join()
+        assert outcome == {}
+        assert controller.in_flight == 0
+
+    def test_queued_calls_time_out(self):
+        controller, release = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=0.01), threading.Event()
+        holder, _, _ = self.hold(controller, release)
+        with pytest.raises(Overloaded):
+            with controller.admit():
+                pass
+        release.set()
+        holder.join()
+        assert controller.counters()['timed_out'] == 1
+        assert controller.queue_depth() == 0
+
+    def test_queued_calls_wait_within_deadline(self):
+        controller, release = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=10), threading.Event()
+        holder, _, _ = self.hold(controller, release)
+        started = time.monotonic()
+        with deadline(0.01), pytest.raises(Overloaded):
+            with controller.admit():
+                pass
+        assert time.monotonic() - started < 1
+        release.set()
+        holder.join()
+
+    def test_higher_priority_calls_are_admitted_first(self):
+        controller, release = AdmissionController(max_concurrency=1, max_queue=2, queue_timeout=1), threading.Event()
+        holder, _, _ = self.hold(controller, release)
+        low_release = threading.Event()
+        low_release.set()
+        low, low_admitted, _ = self.hold(controller, low_release, priority_value=1)
+        self.wait_queued(controller, 1)
+        high_release = threading.Event()
+        high, high_admitted, _ = self.hold(controller, high_release, priority_value=0)
+        self.wait_queued(controller, 2)
+        release.set()
+        assert high_admitted.wait(1)
+        assert not low_admitted.is_set()
+        high_release.set()
+        for thread in (holder, low, high):
+            thread.join()
+
+    def test_full_queue_sheds_worse_priority_waiters(self):
+        controller, release = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1), threading.Event()
+        holder, _, _ = self.hold(controller, release)
+        low, _, low_outcome = self.hold(controller, threading.Event(), priority_value=1)
+        self.wait_queued(controller, 1)
+        released = threading.Event()
+        released.set()
+        high, high_admitted, _ = self.hold(controller, released, priority_value=0)
+        low.join()
+        assert isinstance(low_outcome['error'], Overloaded)
+        release.set()
+        assert high_admitted.wait(1)
+        holder.join()
+        high.join()
+        assert controller.counters()['shed'] == 1
+
+    def test_acquire_until_released(self):
+        controller = AdmissionController(max_concurrency=1, max_queue=0)
+        controller.acquire()
+        with pytest.raises(Overloaded):
+            controller.acquire()
+        controller.release()
+        assert controller.in_flight == 0
+
+    def test_from_config(self, config):
+        assert AdmissionController.from_config(dict(config, ADMISSION_ENABLED=False)) is None
+        controller = AdmissionController.from_config(dict(config, ADMISSION_ENABLED=True))
+        assert controller.max_concurrency == config['ADMISSION_MAX_CONCURRENCY']
@@ -15,6 +15,11 @@ class TestResponseSuccess:
     def test_contains_value(self, response_value):
         response = ResponseSuccess(response_value)
         assert response.value == response_value
+        assert response.metadata == {}
+
+    def test_contains_metadata(self, response_value):
+        response = ResponseSuccess(response_value, {'snapshot_age': 10})
+        assert response.metadata == {'snapshot_age': 10}
 
 
 class TestResponseFailure:
@@ -74,3 +79,24 @@ class TestResponseFailure:
         assert bool(response) is False
         assert response.type == ResponseFailure.SYSTEM_ERROR
         assert response.message == "test message"
+
+    def test_build_rate_limit_error(self):
+        response = ResponseFailure.build_rate_limit_error("test message", 30)
+        assert bool(response) is False
+        assert response.type == ResponseFailure.RATE_LIMIT_ERROR
+        assert response.message == "test message"
+        assert response.retry_after == 30
+
+    def test_build_service_unavailable_error(self):
+        response = ResponseFailure.build_service_unavailable_error("test message", 12)
+        assert bool(response) is False
+        assert response.type == ResponseFailure.SERVICE_UNAVAILABLE
+        assert response.message == "test message"
+        assert response.retry_after == 12
+
+    def test_build_overloaded_error(self):
+        response = ResponseFailure.build_overloaded_error("test message", 1)
+        assert bool(response) is False
+        assert response.type == ResponseFailure.OVERLOADED
+        assert response.message == "test message"
+        assert response.retry_after == 1
@@ -0,0 +1,44 @@
+from decimal import Decimal
+from unittest import mock
+
+from flask import json
+
+from chubbyrepo.serialization import OrjsonProvider, init_json_provider
+
+
+def test_init_json_provider(app):
+    assert isinstance(app.json, OrjsonProvider)
+
+
+def test_init_json_provider_disabled(app):
+    app.config['JSON_FAST_ENCODER'] = False
+    provider = app.json
+    init_json_provider(app)
+    assert app.json is provider
+
+
+def test_init_json_provider_without_orjson(app):
+    provider = app.json
+    with mock.patch.dict('sys.modules', {'orjson': None}):
+        init_json_provider(app)
+    assert app.json is provider
+
+
+def test_dumps_sorts_keys(app):
+    assert json.dumps({'stars': 10, 'name': 'repo-test'}) == '{"name":"repo-test","stars":10}'
+
+
+def test_loads(app):
+    assert json.loads('{"name": "repo-test"}') == {'name': 'repo-test'}
+
+
+def test_loads_with_standard_library_options(app):
+    assert json.loads('{"stars": 1.5}', parse_float=Decimal) == {'stars': Decimal('1.5')}
+
+
+def test_response(app):
+    value = {'stars': 10, 'name': 'repo-test', 'owners': ['a', 'b']}
+    app.debug = False
+    body = app.json.response(value).get_data()
+    assert json.loads(body) == value
+    assert body.endswith(b'\n')
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from chubbyrepo.cache import SimpleCache
+from chubbyrepo.core.gateways import DoesNotExist, Overloaded, RateLimitExceeded, UpstreamUnavailable
+from chubbyrepo.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def run_concurrently(single_flight, fn, callers=5):
+    """Call `fn` through single_flight from several threads while the first call is blocked."""
+    release = threading.Event()
+    results, errors = [], []
+
+    def blocked():
+        release.wait(1)
+        return fn()
+
+    def call():
+        try:
+            results.append(single_flight.do('key', blocked))
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    while single_flight.counters()['coalesced'] < callers - 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_key_is_stable():
+    assert SingleFlight.key('document', {'a': 1, 'b': 2}) == SingleFlight.key('document', {'b': 2, 'a': 1})
+    assert SingleFlight.key('document') == SingleFlight.key('document', {})
+    assert SingleFlight.key('document', {'a': 1}) != SingleFlight.key('document', {'a': 2})
+
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = SingleFlight()
+    fn = mock.Mock(return_value={'data': 'test'})
+    results, errors = run_concurrently(single_flight, fn)
+    assert results == [{'data': 'test'}] * 5
+    assert errors == []
+    fn.assert_called_once_with()
+    assert single_flight.counters() == {'executed': 1, 'coalesced': 4, 'coalesced_remote': 0}
+
+
+def test_concurrent_calls_share_exceptions():
+    single_flight = SingleFlight()
+    fn = mock.Mock(side_effect=DoesNotExist('Not found'))
+    results, errors = run_concurrently(single_flight, fn)
+    assert results == []
+    assert len(errors) == 5
+    assert all(isinstance(e, DoesNotExist) for e in errors)
+    fn.assert_called_once_with()
+
+
+def test_sequential_calls_are_not_coalesced():
+    single_flight = SingleFlight()
+    fn = mock.Mock(return_value='result')
+    assert single_flight.do('key', fn) == 'result'
+    assert single_flight.do('key', fn) == 'result'
+    assert fn.call_count == 2
+
+
+class TestDistributedSingleFlight:
+    def test_leader_publishes_result(self):
+        cache = SimpleCache()
+        single_flight = SingleFlight(cache=cache)
+        assert single_flight.do('key', lambda: {'data': 'test'}) == {'data': 'test'}
+        assert cache.get('singleflight:lock:key') is None
+        assert cache.get('singleflight:result:key') == '{"result": {"data": "test"}}'
+
+    @pytest.mark.parametrize('outcome,expected_exception,retry_after', [
+        ('{"error": "Not found", "type": "DoesNotExist", "retry_after": null}', DoesNotExist, None),
+        ('{"error": "Slow down", "type": "RateLimitExceeded", "retry_after": 30}', RateLimitExceeded, 30),
+        ('{"error": "Github is unavailable", "type": "UpstreamUnavailable", "retry_after": 5}',
+         UpstreamUnavailable, 5),
+        ('{"error": "Too many requests", "type": "Overloaded", "retry_after": 1}', Overloaded, 1),
+        ('{"error": "Boom", "type": null, "retry_after": null}', Exception, None),
+        ('{"error": "Boom"}', Exception, None),
+    ])
+    def test_followers_read_published_exceptions(self, outcome, expected_exception, retry_after):
+        cache = SimpleCache()
+        cache.add('singleflight:lock:key', '1', 10)
+        cache.set('singleflight:result:key', outcome, 10)
+        single_flight = SingleFlight(cache=cache)
+        fn = mock.Mock()
+        with pytest.raises(Exception) as e:
+            single_flight.do('key', fn)
+        assert type(e.value) is expected_exception
+        assert getattr(e.value, 'retry_after', None) == retry_after
+        fn.assert_not_called()
+        assert single_flight.counters()['coalesced_remote'] == 1
+
+    def test_followers_read_published_result(self):
+        cache = SimpleCache()
+        cache.add('singleflight:lock:key', '1', 10)
+        single_flight = SingleFlight(cache=cache, poll_interval=0.01)
+        timer = threading.Timer(0.05, cache.set, ('singleflight:result:key', '{"result": "remote"}', 10))
+        timer.start()
+        assert single_flight.do('key', mock.Mock()) == 'remote'
+        timer.join()
+
+    def test_leader_publishes_exceptions(self):
+        cache = SimpleCache()
+        single_flight = SingleFlight(cache=cache)
+        with pytest.raises(DoesNotExist):
+            single_flight.do('key', mock.Mock(side_effect=DoesNotExist('Not found')))
+        assert json.loads(cache.get('singleflight:result:key')) == {
+            'error': 'Not found', 'type': 'DoesNotExist', 'retry_after': None}
+        with pytest.raises(Overloaded):
+            single_flight.do('key', mock.Mock(side_effect=Overloaded('Too many requests', 1)))
+        assert json.loads(cache.get('singleflight:result:key')) == {
+            'error': 'Too many requests', 'type': 'Overloaded', 'retry_after': 1}
+        with pytest.raises(ValueError):
+            single_flight.do('key', mock.Mock(side_effect=ValueError('Boom')))
+        assert json.loads(cache.get('singleflight:result:key')) == {'error': 'Boom', 'type': None, 'retry_after': None}
+
+    def test_leader_publishes_errors_subclasses_as_their_known_base(self):
+        class SecondaryRateLimitExceeded(RateLimitExceeded):
+            pass
+
+        cache = SimpleCache()
+        with pytest.raises(SecondaryRateLimitExceeded):
+            SingleFlight(cache=cache).do('key', mock.Mock(side_effect=SecondaryRateLimitExceeded('Slow down', 60)))
+        assert json.loads(cache.get('singleflight:result:key'))['type'] == 'RateLimitExceeded'
+
+    def test_calls_run_directly_when_the_cache_is_down(self):
+        cache = mock.Mock()
+        cache.add.return_value = None
+        single_flight = SingleFlight(cache=cache, lock_timeout=10, poll_interval=10)
+        started = time.monotonic()
+        assert single_flight.do('key', lambda: 'local') == 'local'
+        assert time.monotonic() - started < 1
+        cache.get.assert_not_called()
+        cache.set.assert_not_called()
+        assert single_flight.counters()['executed'] == 1
+
+    def test_followers_stop_waiting_after_lock_timeout(self):
+        cache = SimpleCache()
+        cache.add('singleflight:lock:key', '1', 10)
+        single_flight = SingleFlight(cache=cache, lock_timeout=0.05, poll_interval=0.01)
+        assert single_flight.do('key', lambda: 'local') == 'local'
+        assert single_flight.counters()['executed'] == 1
+
+
+class TestAsyncSingleFlight:
+    def test_concurrent_calls_are_coalesced(self):
+        single_flight = AsyncSingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            return await asyncio.gather(*[single_flight.do('key', fn) for _ in range(5)])
+
+        assert asyncio.run(run()) == ['result'] * 5
+        assert calls == [1]
+        assert single_flight.counters() == {'executed': 1, 'coalesced': 4}
+
+    def test_concurrent_calls_share_exceptions(self):
+        single_flight = AsyncSingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            raise DoesNotExist('Not found')
+
+        async def run():
+            return await asyncio.gather(*[single_flight.do('key', fn) for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        assert all(isinstance(r, DoesNotExist) for r in results)
+        assert single_flight.counters() == {'executed': 1, 'coalesced': 2}
+
+    def test_cancelled_leader_leaves_followers_waiting(self):
+        single_flight = AsyncSingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def run():
+            leader = asyncio.ensure_future(single_flight.do('key', fn))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(single_flight.do('key', fn))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await leader
+            assert await follower == 'result'
+
+        asyncio.run(run())
+        assert single_flight.counters() == {'executed': 1, 'coalesced': 1}
+
+    def test_call_cancelled_once_every_caller_is(self):
+        single_flight = AsyncSingleFlight()
+        cancelled = []
+
+        async def fn():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def run():
+            callers = [asyncio.ensure_future(single_flight.do('key', fn)) for _ in range(2)]
+            await asyncio.sleep(0)
+            for caller in callers:
+                caller.cancel()
+            await asyncio.gather(*callers, return_exceptions=True)
+            await asyncio.sleep(0)
+            assert cancelled == [1]
+            assert not single_flight._calls
+
+        asyncio.run(run())
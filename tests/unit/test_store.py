@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from chubbyrepo.core.entities import OrganizationStats, OrganizationStatsSnapshot, Repository
+from chubbyrepo.store import SnapshotStore
+
+
+@pytest.fixture
+def store(tmpdir):
+    return SnapshotStore(str(tmpdir.join('snapshots.sqlite3')))
+
+
+def test_record(store):
+    organization_stats = OrganizationStats(4, Repository('repo-test', 10))
+    snapshot = store.record('Test', organization_stats, fetched_at=1500000000)
+    assert snapshot == OrganizationStatsSnapshot(1500000000.0, organization_stats)
+    assert store.latest('test') == snapshot
+
+
+def test_latest_not_recorded(store):
+    assert store.latest('test') is None
+
+
+def test_history(store):
+    for fetched_at in [1, 3, 2]:
+        store.record('test', OrganizationStats(fetched_at, Repository('repo-test', 10)), fetched_at=fetched_at)
+    store.record('other', OrganizationStats(1, Repository('repo-other', 10)), fetched_at=4)
+    assert [s.fetched_at for s in store.history('test', 2)] == [3.0, 2.0]
+
+
+def test_hottest(store):
+    now = time.time()
+    store.record('old', OrganizationStats(1, Repository('repo-old', 1)), fetched_at=now - 7200)
+    store.record('old', OrganizationStats(1, Repository('repo-old', 1)), fetched_at=now - 7200)
+    store.record('hot', OrganizationStats(1, Repository('repo-hot', 1)), fetched_at=now - 10)
+    store.record('hot', OrganizationStats(2, Repository('repo-hot', 2)), fetched_at=now)
+    store.record('warm', OrganizationStats(1, Repository('repo-warm', 1)), fetched_at=now)
+    hottest = store.hottest(10, now - 3600)
+    assert [name for name, _ in hottest] == ['hot', 'warm']
+    assert hottest[0][1].organization_stats == OrganizationStats(2, Repository('repo-hot', 2))
+
+
+def test_prune(store):
+    store.record('test', OrganizationStats(1, Repository('repo-test', 1)), fetched_at=1)
+    store.record('test', OrganizationStats(1, Repository('repo-test', 1)), fetched_at=10)
+    assert store.prune(5) == 1
+    assert [s.fetched_at for s in store.history('test', 10)] == [10.0]
+
+
+def test_prune_every_records(tmpdir):
+    store = SnapshotStore(str(tmpdir.join('snapshots.sqlite3')), retention=60, prune_every=3)
+    store.record('test', OrganizationStats(1, Repository('repo-test', 1)), fetched_at=1)
+    store.record('test', OrganizationStats(1, Repository('repo-test', 1)))
+    assert len(store.history('test', 10)) == 2
+    store.record('test', OrganizationStats(1, Repository('repo-test', 1)))
+    assert len(store.history('test', 10)) == 2
+
+
+def test_connection_per_thread(store):
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(store._connection()))
+    thread.start()
+    thread.join()
+    assert connections[0] is not store._connection()
+
+
+def test_wal_mode(store):
+    assert store._connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
@@ -0,0 +1,225 @@
+import contextvars
+import io
+import json
+from unittest import mock
+
+import pytest
+from flask import url_for
+
+from chubbyrepo import create_app
+from chubbyrepo.core.responses import ResponseFailure, ResponseSuccess
+from chubbyrepo.tracing import (
+    FileExporter, StdoutExporter, Tracer, _current, build_exporter, current_span, instrument, parse_traceparent, span
+)
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class ConfiguredExporter(ListExporter):
+    def __init__(self, config):
+        super().__init__()
+        self.config = config
+
+
+@pytest.fixture
+def tracer():
+    return Tracer(ListExporter(), sample_ratio=1)
+
+
+def run_in_trace(tracer, fn):
+    root = tracer.start_trace('root')
+    token = _current.set(root)
+    try:
+        fn()
+    finally:
+        _current.reset(token)
+    return root
+
+
+class TestTracer:
+    def test_samples_ratio_of_traces(self):
+        assert Tracer(ListExporter(), sample_ratio=0).start_trace('root') is None
+        root = Tracer(ListExporter(), sample_ratio=1).start_trace('root')
+        assert len(root.trace_id) == 32
+        assert root.parent_id is None
+
+    def test_continues_traceparent(self):
+        tracer = Tracer(ListExporter(), sample_ratio=0)
+        root = tracer.start_trace('root', '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID))
+        assert (root.trace_id, root.parent_id) == (TRACE_ID, '00f067aa0ba902b7')
+        assert root.traceparent() == '00-{}-{}-01'.format(TRACE_ID, root.span_id)
+
+    def test_follows_traceparent_sampling_decision(self):
+        tracer = Tracer(ListExporter(), sample_ratio=1)
+        assert tracer.start_trace('root', '00-{}-00f067aa0ba902b7-00'.format(TRACE_ID)) is None
+
+    @pytest.mark.parametrize('traceparent', [
+        'invalid',
+        '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID.upper()),
+        '00-{}-00f067aa0ba902b7-01'.format('0' * 32),
+        '00-{}-0000000000000000-01'.format(TRACE_ID),
+        'ff-{}-00f067aa0ba902b7-01'.format(TRACE_ID),
+        '00-{}-00f067aa0ba902b7-01-extra'.format(TRACE_ID),
+        '00-{}-00f067aa0ba902b7'.format(TRACE_ID),
+    ])
+    def test_ignores_invalid_traceparent(self, traceparent):
+        assert parse_traceparent(traceparent) is None
+        root = Tracer(ListExporter(), sample_ratio=1).start_trace('root', traceparent)
+        assert root.trace_id != TRACE_ID
+        assert Tracer(ListExporter(), sample_ratio=0).start_trace('root', traceparent) is None
+
+    def test_continues_traceparent_of_later_versions(self):
+        traceparent = '01-{}-00f067aa0ba902b7-03-extra'.format(TRACE_ID)
+        assert parse_traceparent(traceparent) == (TRACE_ID, '00f067aa0ba902b7', True)
+
+
+class TestSpan:
+    def test_does_nothing_out_of_trace(self):
+        with span('child') as child:
+            assert child is None
+
+    def test_nests_spans(self, tracer):
+        def nested():
+            with span('child', size=1) as child, span('grandchild') as grandchild:
+                assert grandchild.parent_id == child.span_id
+
+        root = run_in_trace(tracer, nested)
+        grandchild, child = tracer.exporter.spans
+        assert (child['name'], child['parent_id'], child['trace_id']) == ('child', root.span_id, root.trace_id)
+        assert child['attributes'] == {'size': 1}
+        assert grandchild['name'] == 'grandchild'
+        assert child['duration'] >= grandchild['duration'] >= 0
+
+    def test_records_errors(self, tracer):
+        def failing():
+            with pytest.raises(ValueError), span('child'):
+                raise ValueError('Boom')
+
+        run_in_trace(tracer, failing)
+        assert tracer.exporter.spans[0]['status'] == 'error'
+        assert tracer.exporter.spans[0]['attributes'] == {'error': 'ValueError'}
+
+    def test_current_span(self, tracer):
+        assert current_span() is None
+        root = run_in_trace(tracer, lambda: tracer.exporter.spans.append(current_span()))
+        assert tracer.exporter.spans == [root]
+
+    def test_exporter_failures_are_not_raised(self, tracer, caplog):
+        tracer.exporter = mock.Mock(**{'export.side_effect': OSError('No space left on device')})
+
+        def exported():
+            with span('child'):
+                return 1
+
+        run_in_trace(tracer, exported)
+        tracer.exporter.export.assert_called_once()
+        assert 'Exporting span child failed' in caplog.text
+
+    def test_instrument(self, tracer):
+        obj = instrument(mock.Mock(**{'run.return_value': 1}), 'run')
+        assert obj.run() == 1
+        assert tracer.exporter.spans == []
+        run_in_trace(tracer, obj.run)
+        assert tracer.exporter.spans[0]['name'] == 'Mock.run'
+
+
+class TestExporters:
+    def test_stdout_exporter(self):
+        stream = io.StringIO()
+        StdoutExporter(stream).export({'name': 'span'})
+        assert json.loads(stream.getvalue()) == {'name': 'span'}
+
+    def test_file_exporter(self, tmpdir):
+        path = str(tmpdir.join('spans.jsonl'))
+        exporter = FileExporter(path)
+        exporter.export({'name': 'a'})
+        exporter.export({'name': 'b'})
+        with open(path) as f:
+            assert [json.loads(line)['name'] for line in f] == ['a', 'b']
+
+    def test_build_exporter(self, app, tmpdir):
+        app.config['TRACING_EXPORTER'] = 'file'
+        app.config['TRACING_FILE'] = str(tmpdir.join('spans.jsonl'))
+        assert build_exporter(app).stream.name == str(tmpdir.join('spans.jsonl'))
+        app.instance_path = str(tmpdir.join('instance'))
+        app.config['TRACING_FILE'] = 'spans.jsonl'
+        assert build_exporter(app).stream.name == str(tmpdir.join('instance', 'spans.jsonl'))
+        app.config['TRACING_EXPORTER'] = 'tests.unit.test_tracing.ConfiguredExporter'
+        assert build_exporter(app).config is app.config
+
+
+@mock.patch('chubbyrepo.gateways.GithubGraphQLGateway._get_result_payload')
+def test_traces_requests_through_the_layers(mock_get_result_payload):
+    mock_get_result_payload.return_value = None, {'organization': {'repositories': {
+        'nodes': [{'name': 'repo-test', 'stargazers': {'totalCount': 10}}], 'totalCount': 4}}}, 120
+    app = create_app('testing', {'TRACING_ENABLED': True, 'TRACING_SAMPLE_RATIO': 0})
+    exporter = app.extensions['tracer'].exporter = ListExporter()
+    with app.test_request_context():
+        http_response = app.test_client().get(url_for('api.organization_stats', org_name='acme_corp'), headers={
+            'traceparent': '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID)})
+    assert http_response.status_code == 200
+    spans = {s['name']: s for s in exporter.spans}
+    assert set(spans) == {'GET api.organization_stats', 'OrganizationStatsRequest.from_dict',
+                          'OrganizationStatsInteractor.execute', 'OrganizationStatsInteractor._process_request',
+                          'github.graphql'}
+    assert {s['trace_id'] for s in exporter.spans} == {TRACE_ID}
+    root = spans['GET api.organization_stats']
+    assert root['parent_id'] == '00f067aa0ba902b7'
+    assert root['attributes']['http.status_code'] == 200
+    assert spans['OrganizationStatsInteractor.execute']['parent_id'] == root['span_id']
+    upstream = spans['github.graphql']
+    assert upstream['parent_id'] == spans['OrganizationStatsInteractor._process_request']['span_id']
+    assert upstream['attributes'] == {'gateway': 'StatsGateway', 'document': 'organization', 'variables_bytes': 25,
+                                      'response_bytes': 120, 'graphql_errors': 0}
+
+
+@pytest.fixture
+def traced_app():
+    app = create_app('testing', {'TRACING_ENABLED': True, 'TRACING_SAMPLE_RATIO': 0})
+    app.extensions['tracer'].exporter = ListExporter()
+    return app
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_traces_server_errors(mock_interactor, traced_app):
+    mock_interactor.return_value = ResponseFailure.build_system_error('Boom')
+    with traced_app.test_request_context():
+        http_response = traced_app.test_client().get(url_for('api.organization_stats', org_name='acme_corp'), headers={
+            'traceparent': '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID)})
+    assert http_response.status_code == 500
+    root, = [s for s in traced_app.extensions['tracer'].exporter.spans if s['name'] == 'GET api.organization_stats']
+    assert root['status'] == 'error'
+
+
+@mock.patch('chubbyrepo.core.interactors.OrganizationStatsInteractor.execute')
+def test_requests_out_of_the_sample_are_not_traced(mock_interactor, traced_app):
+    mock_interactor.return_value = ResponseSuccess({})
+    with traced_app.test_request_context():
+        http_response = traced_app.test_client().get(url_for('api.organization_stats', org_name='acme_corp'))
+    assert http_response.status_code == 200
+    assert traced_app.extensions['tracer'].exporter.spans == []
+
+
+def test_traces_ended_in_another_context(traced_app):
+    headers = {'traceparent': '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID)}
+    with traced_app.test_request_context('/chubbiest_repositories', headers=headers):
+        # Streamed responses are torn down out of the context the trace started in
+        contextvars.copy_context().run(traced_app.preprocess_request)
+        traced_app.do_teardown_request()
+    root, = traced_app.extensions['tracer'].exporter.spans
+    assert root['trace_id'] == TRACE_ID
+    assert current_span() is None
+
+
+def test_tracing_disabled(client, app):
+    assert app.extensions['tracer'] is None
+    interactor = app.extensions['container'].get('organization_stats_interactor')
+    assert 'execute' not in vars(interactor)
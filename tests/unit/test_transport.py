@@ -0,0 +1,14 @@
+from chubbyrepo.transport import build_session, timeout
+
+
+def test_build_session(config):
+    session = build_session(config)
+    adapter = session.get_adapter('https://api.github.com/graphql')
+    assert adapter._pool_maxsize == config['GITHUB_POOL_SIZE']
+    # Retried by the gateways, within the request deadline
+    assert adapter.max_retries.total == 0
+    assert 'gzip' in session.headers['Accept-Encoding']
+
+
+def test_timeout(config):
+    assert timeout(config) == (config['GITHUB_CONNECT_TIMEOUT'], config['GITHUB_READ_TIMEOUT'])
@@ -0,0 +1,96 @@
+import pytest
+
+from chubbyrepo import metrics
+from chubbyrepo.cache import SimpleCache
+from chubbyrepo.ttl import AdaptiveTTL, build_adaptive_ttls, organization_stats_changes, ranking_changes
+
+
+def stats(count, name, stars):
+    return {'repositories_count': count, 'chubby_repository': {'name': name, 'stars': stars}}
+
+
+@pytest.mark.parametrize('old, new, expected', [
+    (stats(4, 'chubby', 10), stats(4, 'chubby', 10), 0),
+    (stats(4, 'chubby', 10), stats(5, 'chubby', 13), 4),
+    (stats(4, 'chubby', 10), stats(4, 'other', 11), 2),
+])
+def test_organization_stats_changes(old, new, expected):
+    assert organization_stats_changes(old, new) == expected
+
+
+def test_ranking_changes():
+    assert ranking_changes([['a', 10], ['b', 5]], [['a', 10], ['b', 5]]) == 0
+    assert ranking_changes([['a', 10], ['b', 5]], [['a', 12], ['c', 6], ['b', 5]]) == 3
+
+
+class TestAdaptiveTTL:
+    @pytest.fixture
+    def policy(self):
+        return AdaptiveTTL(SimpleCache(), 'organization_stats', min_ttl=60, max_ttl=3600, tolerance=1, smoothing=0.5)
+
+    def test_first_fetch_gets_default_within_bounds(self, policy):
+        assert policy.ttl('a', stats(4, 'chubby', 10), 300, now=0) == 300
+        assert policy.ttl('b', stats(4, 'chubby', 10), 10, now=0) == 60
+        assert policy.ttl('c', stats(4, 'chubby', 10), 10000, now=0) == 3600
+
+    def test_quiet_keys_get_max_ttl(self, policy):
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        assert policy.ttl('a', stats(4, 'chubby', 10), 300, now=300) == 3600
+
+    def test_fast_moving_keys_get_min_ttl(self, policy):
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        assert policy.ttl('a', stats(4, 'chubby', 110), 300, now=300) == 60
+
+    def test_ttl_follows_velocity(self, policy):
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        # One change every 100 seconds
+        assert policy.ttl('a', stats(4, 'chubby', 13), 300, now=300) == 100
+        # Smoothed with a quiet period, backing off
+        assert policy.ttl('a', stats(4, 'chubby', 13), 300, now=400) == 200
+        assert policy.ttl('a', stats(4, 'chubby', 13), 300, now=600) == 400
+
+    def test_keys_are_independent(self, policy):
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        policy.ttl('b', stats(4, 'chubby', 10), 300, now=0)
+        policy.ttl('a', stats(4, 'chubby', 110), 300, now=300)
+        assert policy.ttl('b', stats(4, 'chubby', 10), 300, now=300) == 3600
+
+    def test_state_is_shared_through_the_cache(self, policy):
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        other_worker = AdaptiveTTL(policy.cache, 'organization_stats', 60, 3600)
+        assert other_worker.ttl('a', stats(4, 'chubby', 110), 300, now=300) == 60
+
+    def test_older_fetches_are_not_observed(self, policy):
+        policy.observe('a', stats(4, 'chubby', 10), 300, at=300)
+        state = policy.observe('a', stats(4, 'chubby', 110), 300, at=0)
+        assert state == {'at': 300, 'value': stats(4, 'chubby', 10), 'velocity': None}
+        assert policy.ttl('a', stats(4, 'chubby', 10), 300, now=600) == 3600
+
+    def test_remaining_counts_from_the_last_fetch(self, policy):
+        assert policy.remaining('a', 300, now=0) == 300
+        policy.observe('a', stats(4, 'chubby', 10), 300, at=100)
+        assert policy.remaining('a', 300, now=250) == 150
+        assert policy.remaining('a', 300, now=500) == -100
+
+    def test_recent_keys_are_bounded(self):
+        policy = AdaptiveTTL(SimpleCache(), 'organization_stats', 60, 3600, metrics_keys=2)
+        for key in ('a', 'b', 'c'):
+            policy.ttl(key, stats(4, 'chubby', 10), 300, now=10)
+        assert policy.recent() == {'b': (10, 300, 0), 'c': (10, 300, 0)}
+
+    def test_refreshes_and_ttls_are_observed(self, policy):
+        refreshes = metrics.CACHE_REFRESHES.samples()
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=0)
+        policy.ttl('a', stats(4, 'chubby', 10), 300, now=300)
+        policy.ttl('a', stats(4, 'chubby', 11), 300, now=600)
+        for result in ('first', 'unchanged', 'changed'):
+            key = ('organization_stats', result)
+            assert metrics.CACHE_REFRESHES.samples()[key] == refreshes.get(key, 0) + 1
+        assert ('organization_stats',) in metrics.CACHE_TTL.samples()
+
+
+def test_build_adaptive_ttls(config):
+    assert build_adaptive_ttls(config, SimpleCache()) == {}
+    policies = build_adaptive_ttls(dict(config, ADAPTIVE_TTL_ENABLED=True), SimpleCache())
+    assert set(policies) == {'organization_stats', 'chubbiest_repositories'}
+    assert policies['chubbiest_repositories'].tolerance == config['ADAPTIVE_TTL_TOLERANCE']['chubbiest_repositories']
@@ -0,0 +1,202 @@
+import hashlib
+import hmac
+import os
+from unittest import mock
+
+import pytest
+
+from chubbyrepo import metrics
+from chubbyrepo.cache import LRUCache, SimpleCache
+from chubbyrepo.core.entities import OrganizationStats, Repository
+from chubbyrepo.core.gateways import DoesNotExist
+from chubbyrepo.gateways import CachedStatsGateway, NotFoundCachedStatsGateway
+from chubbyrepo.webhooks import WebhookProcessor, adjust_organization_stats, verify_signature
+
+STATS = OrganizationStats(4, Repository('chubby', 10))
+
+
+def payload(name='repo-a', stars=5, owner='acme_corp', **extra):
+    return dict({'repository': {'name': name, 'stargazers_count': stars, 'owner': {'login': owner}}}, **extra)
+
+
+def test_verify_signature():
+    signature = 'sha256=' + hmac.new(b'secret', b'body', hashlib.sha256).hexdigest()
+    assert verify_signature('secret', b'body', signature)
+    assert not verify_signature('secret', b'other body', signature)
+    assert not verify_signature('other', b'body', signature)
+    assert not verify_signature('secret', b'body', None)
+    assert not verify_signature('secret', b'body', signature[7:])
+
+
+@pytest.mark.parametrize('event, action, repository, expected', [
+    ('star', 'created', Repository('repo-a', 5), STATS),
+    ('star', 'created', Repository('repo-a', 11), OrganizationStats(4, Repository('repo-a', 11))),
+    ('star', 'created', Repository('chubby', 11), OrganizationStats(4, Repository('chubby', 11))),
+    ('star', 'deleted', Repository('chubby', 9), None),
+    ('repository', 'created', Repository('repo-a', 0), OrganizationStats(5, Repository('chubby', 10))),
+    ('repository', 'publicized', Repository('repo-a', 20), OrganizationStats(5, Repository('repo-a', 20))),
+    ('public', None, Repository('repo-a', 20), OrganizationStats(4, Repository('repo-a', 20))),
+    ('repository', 'deleted', Repository('repo-a', 5), OrganizationStats(3, Repository('chubby', 10))),
+    ('repository', 'privatized', Repository('chubby', 10), None),
+    ('repository', 'transferred', Repository('repo-a', 5), None),
+    ('repository', 'archived', Repository('chubby', 10), STATS),
+])
+def test_adjust_organization_stats(event, action, repository, expected):
+    assert adjust_organization_stats(STATS, event, action, repository, {}) == expected
+
+
+def test_adjust_organization_stats_on_rename():
+    changes = {'repository': {'name': {'from': 'chubby'}}}
+    adjusted = adjust_organization_stats(STATS, 'repository', 'renamed', Repository('renamed', 10), changes)
+    assert adjusted == OrganizationStats(4, Repository('renamed', 10))
+
+
+class TestWebhookProcessor:
+    @pytest.fixture
+    def upstream(self):
+        return mock.Mock()
+
+    @pytest.fixture
+    def processor(self, upstream):
+        cache = SimpleCache()
+        not_found = NotFoundCachedStatsGateway(upstream, LRUCache(10), 60, cache)
+        stats_gateway = CachedStatsGateway(not_found, cache, 60)
+        stats_gateway.update('acme_corp', STATS)
+        return WebhookProcessor(mock.Mock(), stats_gateway, upstream, cache, not_found=not_found,
+                                leaderboard=mock.Mock(), in_background=False)
+
+    def test_applies_events_to_cached_stats(self, processor, upstream):
+        assert processor.submit('1', 'star', payload(stars=11))
+        assert processor.stats_gateway.cached('acme_corp') == OrganizationStats(4, Repository('repo-a', 11))
+        processor.leaderboard.update_stars.assert_called_once_with('acme_corp', 'repo-a', 11)
+        upstream.organization_stats.assert_not_called()
+
+    def test_requeries_ambiguous_events(self, processor, upstream):
+        upstream.organization_stats.return_value = OrganizationStats(3, Repository('repo-b', 8))
+        processor.submit('1', 'repository', payload('chubby', 10, action='deleted'))
+        assert processor.stats_gateway.cached('acme_corp') == OrganizationStats(3, Repository('repo-b', 8))
+        upstream.organization_stats.assert_called_once_with('acme_corp')
+        processor.leaderboard.remove.assert_called_once_with('acme_corp', 'chubby')
+
+    def test_requery_of_missing_organization_invalidates_it(self, processor, upstream):
+        upstream.organization_stats.side_effect = DoesNotExist('Not found')
+        processor.submit('1', 'star', payload('chubby', 9, action='deleted'))
+        assert processor.stats_gateway.cached('acme_corp') is None
+
+    def test_transfers_requery_both_owners(self, processor, upstream):
+        processor.stats_gateway.update('new_owner', STATS)
+        upstream.organization_stats.return_value = STATS
+        changes = {'owner': {'from': {'organization': {'login': 'acme_corp'}}}}
+        processor.submit('1', 'repository', payload(owner='new_owner', action='transferred', changes=changes))
+        assert upstream.organization_stats.call_args_list == [mock.call('acme_corp'), mock.call('new_owner')]
+        processor.leaderboard.rename.assert_called_once_with('acme_corp', 'repo-a', 'repo-a', 'new_owner')
+
+    def test_ignores_uncached_organizations(self, processor, upstream):
+        processor.submit('1', 'star', payload('chubby', 9, owner='other', action='deleted'))
+        upstream.organization_stats.assert_not_called()
+        assert processor.stats_gateway.cached('other') is None
+
+    def test_ignores_private_repositories(self, processor):
+        event = payload(stars=11, action='created')
+        event['repository']['private'] = True
+        processor.submit('1', 'star', event)
+        assert processor.stats_gateway.cached('acme_corp') == STATS
+
+    def test_ignores_redeliveries(self, processor):
+        processor.submit('1', 'repository', payload(action='created'))
+        processor.submit('1', 'repository', payload(action='created'))
+        assert processor.stats_gateway.cached('acme_corp').repositories_count == 5
+
+    def test_forgets_organizations_not_found(self, processor, upstream):
+        upstream.organization_stats.side_effect = [DoesNotExist('Not found'), STATS]
+        with pytest.raises(DoesNotExist):
+            processor.not_found.organization_stats('new_org')
+        processor.submit('1', 'repository', payload(owner='new_org', action='created'))
+        assert processor.not_found.organization_stats('new_org') == STATS
+
+    @pytest.mark.parametrize('event, body', [
+        ('issues', payload()),
+        ('star', {'action': 'created'}),
+        ('star', {'repository': 'acme_corp/repo-a'}),
+    ])
+    def test_ignores_unknown_events_and_payloads(self, processor, event, body):
+        ignored = metrics.WEBHOOK_EVENTS.samples().get((event, 'ignored'), 0)
+        assert processor.submit('1', event, body)
+        assert metrics.WEBHOOK_EVENTS.samples()[(event, 'ignored')] == ignored + 1
+        assert processor.cache.get('webhook_delivery:1') is None
+        assert processor.stats_gateway.cached('acme_corp') == STATS
+
+    def test_malformed_events_fail_alone(self, processor):
+        failed = metrics.WEBHOOK_EVENTS.samples().get(('star', 'failed'), 0)
+        assert processor.submit('1', 'star', {'repository': {'name': 'repo-a'}})
+        assert metrics.WEBHOOK_EVENTS.samples()[('star', 'failed')] == failed + 1
+        assert processor.submit('2', 'star', payload(stars=11))
+        assert processor.stats_gateway.cached('acme_corp') == OrganizationStats(4, Repository('repo-a', 11))
+
+    def test_records_adjusted_stats_in_snapshots(self, processor, upstream):
+        processor.snapshots = mock.Mock()
+        processor.submit('1', 'star', payload(stars=11))
+        processor.snapshots.record.assert_called_once_with('acme_corp', OrganizationStats(4, Repository('repo-a', 11)))
+        upstream.organization_stats.return_value = OrganizationStats(3, Repository('repo-b', 8))
+        processor.submit('2', 'repository', payload('repo-a', 11, action='deleted'))
+        processor.snapshots.record.assert_called_with('acme_corp', OrganizationStats(3, Repository('repo-b', 8)))
+
+    def test_unchanged_stats_are_not_updated(self, processor):
+        processor.snapshots = mock.Mock()
+        processor.submit('1', 'repository', payload(action='archived'))
+        processor.snapshots.record.assert_not_called()
+
+    def test_renames_leaderboard_repositories(self, processor):
+        changes = {'repository': {'name': {'from': 'repo-old'}}}
+        processor.submit('1', 'repository', payload(action='renamed', changes=changes))
+        processor.leaderboard.rename.assert_called_once_with('acme_corp', 'repo-old', 'repo-a')
+        processor.submit('2', 'repository', payload(action='renamed'))
+        processor.submit('3', 'repository', payload(action='archived'))
+        processor.leaderboard.rename.assert_called_once()
+
+    def test_without_leaderboard_nor_not_found(self, upstream):
+        cache = SimpleCache()
+        stats_gateway = CachedStatsGateway(upstream, cache, 60)
+        stats_gateway.update('acme_corp', STATS)
+        processor = WebhookProcessor(mock.Mock(), stats_gateway, upstream, cache, in_background=False)
+        processor.submit('1', 'star', payload(stars=11))
+        assert stats_gateway.cached('acme_corp') == OrganizationStats(4, Repository('repo-a', 11))
+
+    def test_worker_applies_queued_events(self, app, processor):
+        processor.app = app
+        processor.in_background = True
+        with mock.patch('threading.Thread') as mock_thread:
+            processor.submit('1', 'star', payload(stars=11))
+            processor.submit('2', 'star', payload(stars=12))
+        # Started once per process
+        mock_thread.assert_called_once()
+        processor._queue.put((None, None))
+        with mock.patch.object(processor, 'process', side_effect=[None, None, SystemExit]) as mock_process:
+            with pytest.raises(SystemExit):
+                processor._work()
+        assert mock_process.call_args_list == [
+            mock.call('star', payload(stars=11)), mock.call('star', payload(stars=12)), mock.call(None, None)]
+
+    def test_worker_started_by_another_thread_is_not_started_again(self, processor):
+        with mock.patch('threading.Thread') as mock_thread, mock.patch.object(processor, '_lock') as mock_lock:
+            mock_lock.__enter__.side_effect = lambda: setattr(processor, '_worker_pid', os.getpid())
+            processor._start_worker()
+        mock_thread.assert_not_called()
+
+    def test_queues_events_in_background(self, processor):
+        processor.in_background = True
+        with mock.patch.object(processor, '_start_worker'):
+            assert processor.submit('1', 'star', payload(stars=11))
+        assert processor.stats_gateway.cached('acme_corp') == STATS
+        processor.process(*processor._queue.get_nowait())
+        assert processor.stats_gateway.cached('acme_corp') == OrganizationStats(4, Repository('repo-a', 11))
+
+    def test_full_queue_rejects_events(self, processor):
+        processor.in_background = True
+        processor._queue.maxsize = 1
+        with mock.patch.object(processor, '_start_worker'):
+            assert processor.submit('1', 'star', payload())
+            assert not processor.submit('2', 'star', payload())
+            # Rejected deliveries can be sent again
+            assert processor.cache.get('webhook_delivery:2') is None
+            assert not processor.submit(None, 'star', payload())